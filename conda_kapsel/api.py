@@ -49,6 +49,25 @@ class AnacondaProject(object):
         """
         return project.Project(directory_path=directory_path)
 
+    def snapshot_project(self, project):
+        """Get an unchanging copy of a project that can be shared between threads.
+
+        The snapshot has the project's commands, env specs,
+        requirements and problems. It can be passed to the prepare
+        methods and ``unprepare`` instead of the project, and gives
+        exec info for its commands. It isn't updated when the
+        project changes; get a new snapshot for that. Getting a
+        snapshot of an unchanged project is cheap.
+
+        Args:
+            project (Project): from the ``load_project`` method
+
+        Returns:
+            a ProjectSnapshot instance
+
+        """
+        return project.snapshot()
+
     def create_project(self, directory_path, make_directory=False, name=None, icon=None, description=None):
         """Create a project skeleton in the given directory.
 
@@ -117,7 +136,7 @@ class AnacondaProject(object):
         advance.
 
         Args:
-            project (Project): from the ``load_project`` method
+            project (Project or ProjectSnapshot): from ``load_project`` or ``snapshot_project``
             environ (dict): os.environ or the previously-prepared environ; not modified in-place
             env_spec_name (str): the package set name to require, or None for default
             command_name (str): which named command to choose from the project, None for default
@@ -160,7 +179,7 @@ class AnacondaProject(object):
         that also apply to this method.
 
         Args:
-            project (Project): from the ``load_project`` method
+            project (Project or ProjectSnapshot): from ``load_project`` or ``snapshot_project``
             environ (dict): os.environ or the previously-prepared environ; not modified in-place
             env_spec_name (str): the package set name to require, or None for default
             command_name (str): which named command to choose from the project, None for default
@@ -198,7 +217,7 @@ class AnacondaProject(object):
         that also apply to this method.
 
         Args:
-            project (Project): from the ``load_project`` method
+            project (Project or ProjectSnapshot): from ``load_project`` or ``snapshot_project``
             environ (dict): os.environ or the previously-prepared environ; not modified in-place
             env_spec_name (str): the package set name to require, or None for default
             command_name (str): which named command to choose from the project, None for default
@@ -235,7 +254,7 @@ class AnacondaProject(object):
         that also apply to this method.
 
         Args:
-            project (Project): from the ``load_project`` method
+            project (Project or ProjectSnapshot): from ``load_project`` or ``snapshot_project``
             environ (dict): os.environ or the previously-prepared environ; not modified in-place
             env_spec_name (str): the package set name to require, or None for default
             command_name (str): which named command to choose from the project, None for default
@@ -268,7 +287,7 @@ class AnacondaProject(object):
         To stop a single service, use ``whitelist=["SERVICE_VARIABLE"]``.
 
         Args:
-            project (Project): the project
+            project (Project or ProjectSnapshot): the project
             prepare_result (PrepareResult): result from the previous prepare
             whitelist (iterable of str or type): ONLY call shutdown commands for the listed env vars' requirements
 
@@ -295,6 +314,28 @@ class AnacondaProject(object):
         """
         return project_ops.set_properties(project=project, name=name, icon=icon, description=description)
 
+    def transaction(self, project):
+        """Make several changes to a project, then check and save them all at once.
+
+        The methods of this class that modify kapsel.yml only
+        modify it in memory when called inside the ``with``
+        block. When the block ends, the project is checked for
+        problems, it's prepared once for all the requirements the
+        changes need, and kapsel.yml is saved once. If an
+        operation fails, the operations after it return its status
+        without doing anything, and none of the changes to
+        kapsel.yml are saved.
+
+        Args:
+            project (Project): the project
+
+        Returns:
+            a context manager giving an object whose ``status``
+            attribute is a ``Status`` for the whole transaction once
+            the block ends
+        """
+        return project_ops.transaction(project=project)
+
     def add_variables(self, project, vars_to_add, defaults):
         """Add variables in kapsel.yml, optionally setting their defaults.
 
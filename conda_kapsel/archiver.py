@@ -24,6 +24,7 @@ from conda_kapsel.internal.simple_status import SimpleStatus
 from conda_kapsel.internal.directory_contains import subdirectory_relative_to_directory
 from conda_kapsel.internal.rename import rename_over_existing
 from conda_kapsel.internal.makedirs import makedirs_ok_if_exists
+from conda_kapsel.internal import trash
 
 
 class _FileInfo(object):
@@ -217,7 +218,8 @@ def _enumerate_archive_files(project_directory, errors, requirements):
         assert errors
         return None
 
-    plugin_patterns = set()
+    # directories that clean() is still deleting in the background
+    plugin_patterns = set(["/%s/" % trash.TRASH_DIRECTORY_NAME])
     for req in requirements:
         plugin_patterns = plugin_patterns.union(req.ignore_patterns)
     plugin_patterns = [_FilePattern(s) for s in plugin_patterns]
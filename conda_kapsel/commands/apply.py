@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------------
+# Copyright © 2016, Continuum Analytics, Inc. All rights reserved.
+#
+# The full license is in the file LICENSE.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+"""The ``apply`` command, which makes a batch of changes to the project at once.
+
+The batch file is YAML (or JSON), a list of operations run in
+order. Each operation is a dictionary with one key, the name of a
+function in ``conda_kapsel.project_ops``, whose value is a
+dictionary of that function's arguments::
+
+    - add_variables: {vars_to_add: [DB_HOST, DB_PORT], defaults: {DB_PORT: '5432'}}
+    - add_packages: {env_spec_name: null, packages: [psycopg2], channels: []}
+    - add_command: {name: serve, command_type: unix, command: python serve.py}
+
+Nothing is saved unless every operation succeeds.
+"""
+from __future__ import absolute_import, print_function
+
+import codecs
+import sys
+
+from conda_kapsel.commands.project_load import load_project
+from conda_kapsel import project_ops
+from conda_kapsel.commands import console_utils
+from conda_kapsel.prepare import prepare_without_interaction
+from conda_kapsel.provide import PROVIDE_MODE_CHECK
+from conda_kapsel.yaml_file import _load_string_read_only, _YAMLError
+
+# operation name -> (required arguments, arguments that can be left out)
+_operations = {
+    'set_properties': ((), ('name', 'icon', 'description')),
+    'add_variables': (('vars_to_add', ), ('defaults', )),
+    'remove_variables': (('vars_to_remove', ), ('env_spec_name', )),
+    'add_download': (('env_var', 'url'), ('filename', 'hash_algorithm', 'hash_value')),
+    'remove_download': (('env_var', ), ()),
+    'add_env_spec': (('name', ), ('packages', 'channels')),
+    'remove_env_spec': (('name', ), ()),
+    'add_packages': (('packages', ), ('env_spec_name', 'channels')),
+    'remove_packages': (('packages', ), ('env_spec_name', )),
+    'add_command': (('name', 'command_type', 'command'), ('env_spec_name', 'supports_http_options')),
+    'update_command': (('name', ), ('command_type', 'command', 'new_name')),
+    'remove_command': (('name', ), ()),
+    'add_service': (('service_type', ), ('variable_name', )),
+    'remove_service': (('variable_name', ), ())
+}
+
+# these also want the result of a prepare, to know what to clean up
+_operations_needing_prepare_result = ('remove_download', 'remove_service')
+
+
+def _parse_operations(contents):
+    """Get a list of (name, kwargs) from the batch file contents, or raise ValueError."""
+    try:
+        items = _load_string_read_only(contents)
+    except _YAMLError as e:
+        raise ValueError("Batch file has a syntax error: %s" % str(e))
+
+    if not isinstance(items, list):
+        raise ValueError("Batch file should contain a list of operations.")
+
+    operations = []
+    for item in items:
+        if not isinstance(item, dict) or len(item) != 1:
+            raise ValueError("Each operation should be a dictionary with one key, the operation name, not %r" %
+                             (item, ))
+        (name, kwargs) = list(item.items())[0]
+        if name not in _operations:
+            raise ValueError("Unknown operation '%s', we know about: %s" % (name, ", ".join(sorted(_operations))))
+        if kwargs is None:
+            kwargs = dict()
+        if not isinstance(kwargs, dict):
+            raise ValueError("Arguments to %s should be a dictionary, not %r" % (name, kwargs))
+        (required, optional) = _operations[name]
+        for arg in required:
+            if arg not in kwargs:
+                raise ValueError("Operation %s is missing argument '%s'" % (name, arg))
+        for arg in kwargs:
+            if arg not in required and arg not in optional:
+                raise ValueError("Operation %s doesn't have an argument '%s'" % (name, arg))
+        # some of the functions don't have defaults for these
+        kwargs = dict(kwargs)
+        for arg in optional:
+            kwargs.setdefault(arg, None)
+        operations.append((name, kwargs))
+    return operations
+
+
+def apply_operations(project_dir, batch_filename):
+    """Apply a batch of operations to the project, saving it once at the end.
+
+    Returns:
+        exit code
+    """
+    try:
+        if batch_filename == '-':
+            contents = sys.stdin.read()
+        else:
+            with codecs.open(batch_filename, 'r', 'utf-8') as f:
+                contents = f.read()
+        operations = _parse_operations(contents)
+    except (IOError, OSError, ValueError) as e:
+        print("Failed to read %s: %s" % (batch_filename, str(e)), file=sys.stderr)
+        return 1
+
+    project = load_project(project_dir)
+    if console_utils.print_project_problems(project):
+        return 1
+
+    prepare_result = None
+    with project_ops.transaction(project) as transaction:
+        for (name, kwargs) in operations:
+            if name in _operations_needing_prepare_result:
+                if prepare_result is None:
+                    prepare_result = prepare_without_interaction(project, mode=PROVIDE_MODE_CHECK)
+                kwargs = dict(kwargs, prepare_result=prepare_result)
+            status = getattr(project_ops, name)(project, **kwargs)
+            if not status:
+                # nothing after this does anything
+                break
+
+    status = transaction.status
+    if status:
+        print(status.status_description)
+        return 0
+    else:
+        console_utils.print_status_errors(status)
+        return 1
+
+
+def main(args):
+    """Start the apply command and return exit status code."""
+    return apply_operations(args.directory, args.filename)
@@ -74,6 +74,23 @@ def print_names_and_descriptions(objects, name_attr='name', description_attr='de
     print(output[:-1])
 
 
+def print_download_progress(progress):
+    """Show download progress on stderr.
+
+    On a tty we keep rewriting a single line; otherwise we only
+    print the final line when the download finishes.
+    """
+    line = progress.format_line()
+    if sys.stderr.isatty():
+        # pad so a shorter line covers up the previous longer one
+        sys.stderr.write("\r" + line.ljust(79))
+        if progress.finished:
+            sys.stderr.write("\n")
+        sys.stderr.flush()
+    elif progress.finished:
+        print(line, file=sys.stderr)
+
+
 def stdin_is_interactive():
     """True if stdin is a tty."""
     return sys.stdin.isatty()
@@ -34,6 +34,7 @@ import conda_kapsel.commands.download_commands as download_commands
 import conda_kapsel.commands.service_commands as service_commands
 import conda_kapsel.commands.environment_commands as environment_commands
 import conda_kapsel.commands.command_commands as command_commands
+import conda_kapsel.commands.apply as apply
 
 
 def _parse_args_and_run_subcommand(argv):
@@ -279,6 +280,11 @@ def _parse_args_and_run_subcommand(argv):
     add_directory_arg(preset)
     preset.set_defaults(main=command_commands.main_list)
 
+    preset = subparsers.add_parser('apply', help="Apply a batch of changes to the project at once")
+    add_directory_arg(preset)
+    preset.add_argument('filename', metavar="BATCH_FILE", help="YAML or JSON list of operations, or - for stdin")
+    preset.set_defaults(main=apply.main)
+
     # argparse doesn't do this for us for whatever reason
     if len(argv) < 2:
         print("Must specify a subcommand.", file=sys.stderr)
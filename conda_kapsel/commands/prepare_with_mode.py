@@ -9,6 +9,7 @@ from __future__ import absolute_import, print_function
 
 from conda_kapsel import prepare
 from conda_kapsel import project_ops
+from conda_kapsel.internal.download_progress import add_progress_listener, remove_progress_listener
 from conda_kapsel.plugins.requirement import EnvVarRequirement
 
 from conda_kapsel.provide import (PROVIDE_MODE_PRODUCTION, PROVIDE_MODE_DEVELOPMENT, PROVIDE_MODE_CHECK)
@@ -121,23 +122,27 @@ def prepare_with_ui_mode_printing_errors(project,
         assert ui_mode != UI_MODE_TEXT_ASK_QUESTIONS  # Not implemented yet
 
         environ = None
-        while True:
-            result = prepare.prepare_without_interaction(project,
-                                                         environ,
-                                                         mode=provide_mode,
-                                                         env_spec_name=env_spec_name,
-                                                         command_name=command_name,
-                                                         command=command,
-                                                         extra_command_args=extra_command_args)
-
-            if result.failed:
-                result.print_output()
-
-                if ask and _interactively_fix_missing_variables(project, result):
-                    environ = result.environ
-                    continue  # re-prepare, building on our previous environ
-
-            # if we didn't continue, quit.
-            break
+        add_progress_listener(console_utils.print_download_progress)
+        try:
+            while True:
+                result = prepare.prepare_without_interaction(project,
+                                                             environ,
+                                                             mode=provide_mode,
+                                                             env_spec_name=env_spec_name,
+                                                             command_name=command_name,
+                                                             command=command,
+                                                             extra_command_args=extra_command_args)
+
+                if result.failed:
+                    result.print_output()
+
+                    if ask and _interactively_fix_missing_variables(project, result):
+                        environ = result.environ
+                        continue  # re-prepare, building on our previous environ
+
+                # if we didn't continue, quit.
+                break
+        finally:
+            remove_progress_listener(console_utils.print_download_progress)
 
     return result
@@ -196,6 +196,8 @@ def _monkeypatch_can_connect_to_socket_to_fail_to_find_redis(monkeypatch):
             return True  # can't start a custom Redis here
 
     monkeypatch.setattr("conda_kapsel.plugins.network_util.can_connect_to_socket", mock_can_connect_to_socket)
+    monkeypatch.setattr("conda_kapsel.plugins.network_util.can_bind_to_port", lambda port, host='': False)
+    monkeypatch.setattr("conda_kapsel.plugins.network_util.unix_sockets_supported", lambda: False)
 
 
 def test_main_fails_to_redis(monkeypatch, capsys):
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------------
+# Copyright © 2016, Continuum Analytics, Inc. All rights reserved.
+#
+# The full license is in the file LICENSE.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import absolute_import, print_function
+
+import codecs
+import os
+
+from conda_kapsel.commands.main import _parse_args_and_run_subcommand
+from conda_kapsel.internal.test.tmpfile_utils import with_directory_contents_completing_project_file
+from conda_kapsel.project import Project
+from conda_kapsel.project_file import DEFAULT_PROJECT_FILENAME
+
+_batch = """
+- add_variables: {vars_to_add: [FOO, BAR], defaults: {BAR: baz}}
+- add_command: {name: hello, command_type: unix, command: echo hello}
+- set_properties: {description: batched}
+"""
+
+
+def test_apply(capsys):
+    def check(dirname):
+        code = _parse_args_and_run_subcommand(['conda-kapsel', 'apply', '--directory', dirname,
+                                               os.path.join(dirname, 'batch.yml')])
+        assert 0 == code
+
+        out, err = capsys.readouterr()
+        assert "Project changes saved.\n" == out
+        assert "" == err
+
+        project = Project(dirname)
+        assert 'batched' == project.description
+        assert ['BAR', 'FOO'] == sorted(project.project_file.get_value('variables').keys())
+        assert 'baz' == project.project_file.get_value(['variables', 'BAR'])
+        assert 'echo hello' == project.command_for_name('hello').unix_shell_commandline
+
+    with_directory_contents_completing_project_file({'batch.yml': _batch}, check)
+
+
+def test_apply_saves_nothing_if_an_operation_fails(capsys):
+    def check(dirname):
+        code = _parse_args_and_run_subcommand(['conda-kapsel', 'apply', '--directory', dirname,
+                                               os.path.join(dirname, 'batch.yml')])
+        assert 1 == code
+
+        out, err = capsys.readouterr()
+        assert "" == out
+        assert "env_spec 'nope' for command 'hello' does not appear in the env_specs section" in err
+
+        project = Project(dirname)
+        assert {} == project.project_file.get_value('variables')
+        assert project.command_for_name('hello') is None
+
+    with_directory_contents_completing_project_file(
+        {'batch.yml': ("- add_variables: {vars_to_add: [FOO]}\n"
+                       "- add_command: {name: hello, command_type: unix, command: echo hello, env_spec_name: nope}\n")},
+        check)
+
+
+def test_apply_saves_nothing_if_an_operation_fails_early(capsys):
+    def check(dirname):
+        filename = os.path.join(dirname, DEFAULT_PROJECT_FILENAME)
+        with codecs.open(filename, 'r', 'utf-8') as f:
+            before = f.read()
+
+        code = _parse_args_and_run_subcommand(['conda-kapsel', 'apply', '--directory', dirname,
+                                               os.path.join(dirname, 'batch.yml')])
+        assert 1 == code
+
+        out, err = capsys.readouterr()
+        assert "" == out
+        assert "Bad package specifications: foo bar baz qux." in err
+
+        with codecs.open(filename, 'r', 'utf-8') as f:
+            assert before == f.read()
+
+    with_directory_contents_completing_project_file(
+        {'batch.yml': ("- add_variables: {vars_to_add: [FOO]}\n"
+                       "- add_env_spec: {name: newenv, packages: ['foo bar baz qux']}\n"
+                       "- remove_command: {name: nonexistent}\n")},
+        check)
+
+
+def test_apply_bad_batch_file(capsys):
+    def check(dirname):
+        for (contents, message) in [("a: b\n", "Batch file should contain a list of operations."),
+                                    ("- foo: {}\n", "Unknown operation 'foo', we know about: add_command, "),
+                                    ("- add_variables: []\n", "Arguments to add_variables should be a dictionary"),
+                                    ("- add_variables: {}\n", "Operation add_variables is missing argument "
+                                     "'vars_to_add'"),
+                                    ("- add_variables: {vars_to_add: [A], x: 1}\n", "Operation add_variables "
+                                     "doesn't have an argument 'x'"),
+                                    ("- add_variables: {}\n  remove_variables: {}\n", "Each operation should be a "
+                                     "dictionary with one key"),
+                                    ("- [\n", "Batch file has a syntax error")]:
+            batch_filename = os.path.join(dirname, 'batch.yml')
+            with open(batch_filename, 'w') as f:
+                f.write(contents)
+            code = _parse_args_and_run_subcommand(['conda-kapsel', 'apply', '--directory', dirname, batch_filename])
+            assert 1 == code
+
+            out, err = capsys.readouterr()
+            assert "" == out
+            assert err.startswith("Failed to read %s: " % batch_filename)
+            assert message in err
+
+        project = Project(dirname)
+        assert {} == project.project_file.get_value('variables')
+
+    with_directory_contents_completing_project_file({DEFAULT_PROJECT_FILENAME: ""}, check)
+
+
+def test_apply_missing_batch_file(capsys):
+    def check(dirname):
+        batch_filename = os.path.join(dirname, 'nope.yml')
+        code = _parse_args_and_run_subcommand(['conda-kapsel', 'apply', '--directory', dirname, batch_filename])
+        assert 1 == code
+
+        out, err = capsys.readouterr()
+        assert err.startswith("Failed to read %s: " % batch_filename)
+
+    with_directory_contents_completing_project_file(dict(), check)
@@ -125,3 +125,54 @@ def test_console_get_password(monkeypatch, capsys):
 
     assert out == ''
     assert err == 'foo: '
+
+
+def test_print_download_progress_not_a_tty(capsys):
+    from conda_kapsel.internal.download_progress import DownloadProgress
+
+    def progress(finished):
+        return DownloadProgress(url="http://example.com/data.csv",
+                                filename="/tmp/data.csv",
+                                bytes_done=10,
+                                bytes_total=20,
+                                elapsed=1.0,
+                                finished=finished)
+
+    console_utils.print_download_progress(progress(finished=False))
+    console_utils.print_download_progress(progress(finished=True))
+
+    out, err = capsys.readouterr()
+    assert out == ""
+    # only the final line since there's no tty to redraw on
+    assert err == "Downloading data.csv: 10B of 20B (50%) at 10B/s, done in 00:01\n"
+
+
+def test_print_download_progress_tty(monkeypatch):
+    from conda_kapsel.internal.download_progress import DownloadProgress
+
+    class FakeTty(object):
+        def __init__(self):
+            self.written = []
+
+        def isatty(self):
+            return True
+
+        def write(self, s):
+            self.written.append(s)
+
+        def flush(self):
+            pass
+
+    fake = FakeTty()
+    monkeypatch.setattr(sys, 'stderr', fake)
+
+    for finished in (False, True):
+        console_utils.print_download_progress(DownloadProgress(url="http://example.com/data.csv",
+                                                               filename="/tmp/data.csv",
+                                                               bytes_done=10,
+                                                               bytes_total=None,
+                                                               elapsed=1.0,
+                                                               finished=finished))
+
+    assert fake.written == ["\r" + "Downloading data.csv: 10B at 10B/s".ljust(79),
+                            "\r" + "Downloading data.csv: 10B at 10B/s, done in 00:01".ljust(79), "\n"]
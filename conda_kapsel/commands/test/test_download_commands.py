@@ -185,14 +185,14 @@ def test_remove_download(capsys, monkeypatch):
         assert code == 0
 
         out, err = capsys.readouterr()
-        filename = os.path.join(dirname, 'foo.tgz')
+        filename = os.path.join(dirname, 'foo.csv')
         assert ("Removed downloaded file %s.\nRemoved TEST_FILE from the project file.\n" % filename) == out
         assert '' == err
 
     with_directory_contents_completing_project_file(
         {
-            DEFAULT_PROJECT_FILENAME: "downloads:\n  TEST_FILE: http://localhost/foo.tgz",
-            'foo.tgz': 'data here'
+            DEFAULT_PROJECT_FILENAME: "downloads:\n  TEST_FILE: http://localhost/foo.csv",
+            'foo.csv': 'data here'
         }, check)
 
 
@@ -222,7 +222,7 @@ def test_remove_download_file_error(capsys, monkeypatch):
         from os import remove as real_remove
         _monkeypatch_pwd(monkeypatch, dirname)
 
-        test_filename = os.path.join(dirname, 'foo.tgz')
+        test_filename = os.path.join(dirname, 'foo.csv')
 
         # only allow mock to have side effect once
         # later, when cleaning up TEST directory, allow removal
@@ -245,8 +245,8 @@ def test_remove_download_file_error(capsys, monkeypatch):
 
     with_directory_contents_completing_project_file(
         {
-            DEFAULT_PROJECT_FILENAME: "downloads:\n  TEST_FILE: http://localhost/foo.tgz",
-            'foo.tgz': 'data here'
+            DEFAULT_PROJECT_FILENAME: "downloads:\n  TEST_FILE: http://localhost/foo.csv",
+            'foo.csv': 'data here'
         }, check)
 
 
@@ -168,7 +168,11 @@ def test_remove_env_spec_fails(capsys, monkeypatch):
                 raise Exception('Error')
             return real_rmtree(path, ignore_errors, onerror)
 
+        def mock_rename_to_trash(path):
+            raise OSError("No renaming here")
+
         monkeypatch.setattr('shutil.rmtree', mock_remove)
+        monkeypatch.setattr('conda_kapsel.internal.trash._rename_to_trash', mock_rename_to_trash)
 
         code = _parse_args_and_run_subcommand(['conda-kapsel', 'remove-env-spec', '--name', 'foo'])
         assert code == 1
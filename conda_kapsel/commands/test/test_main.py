@@ -16,7 +16,8 @@ all_subcommands = ('init', 'run', 'prepare', 'clean', 'activate', 'archive', 'un
                    'remove-variable', 'list-variables', 'set-variable', 'unset-variable', 'add-download',
                    'remove-download', 'list-downloads', 'add-service', 'remove-service', 'list-services',
                    'add-env-spec', 'remove-env-spec', 'list-env-specs', 'export-env-spec', 'add-packages',
-                   'remove-packages', 'list-packages', 'add-command', 'remove-command', 'list-commands')
+                   'remove-packages', 'list-packages', 'add-command', 'remove-command', 'list-commands',
+                   'apply')
 all_subcommands_in_curlies = "{" + ",".join(all_subcommands) + "}"
 all_subcommands_comma_space = ", ".join(["'" + s + "'" for s in all_subcommands])
 
@@ -95,6 +96,7 @@ expected_usage_msg_format = \
         '    add-command         Add a new command to the project\n' \
         '    remove-command      Remove a command from the project\n' \
         '    list-commands       List the commands on the project\n' \
+        '    apply               Apply a batch of changes to the project at once\n' \
         '\n' \
         'optional arguments:\n' \
         '  -h, --help            show this help message and exit\n' \
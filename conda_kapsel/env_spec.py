@@ -27,34 +27,47 @@ except ImportError:  # pragma: no cover
     import ruamel.yaml as ryaml  # pragma: no cover
 
 
-def _combine_keeping_last_duplicate(items1, items2, key_func=None):
-    def default_key(item):
-        return item
-
-    if key_func is None:
-        key_func = default_key
-    items2_keys = set([key_func(item) for item in items2])
-    combined = list([item for item in items1 if key_func(item) not in items2_keys])
-    combined = combined + list(items2)
-    return tuple(combined)
-
-
-def _conda_combine_key(spec):
-    parsed = conda_api.parse_spec(spec)
-    if parsed is None:
-        # this is broken but we complain about it in project.py, carry on here
-        return spec
-    else:
-        return parsed.name
-
-
-def _pip_combine_key(spec):
-    parsed = pip_api.parse_spec(spec)
-    if parsed is None:
-        # this is broken but we complain about it in project.py, carry on here
-        return spec
-    else:
-        return parsed.name
+def _combine_keeping_last_duplicates(item_lists, key_lists):
+    # concatenate the lists, dropping any item whose key appears again
+    # in a later list; done last list first so it's one pass
+    later_keys = set()
+    kept = []
+    for (items, keys) in zip(reversed(item_lists), reversed(key_lists)):
+        kept.append([item for (item, key) in zip(items, keys) if key not in later_keys])
+        later_keys.update(keys)
+    combined = []
+    for items in reversed(kept):
+        combined.extend(items)
+    return combined
+
+
+def _parsed_names(specs, parse_spec):
+    # the package name in each spec, or None for broken specs
+    names = []
+    for spec in specs:
+        parsed = parse_spec(spec)
+        names.append(None if parsed is None else parsed.name)
+    return tuple(names)
+
+
+def _combine_keys(specs, names):
+    # broken specs are their own key; we complain about them in project.py, carry on here
+    return [spec if name is None else name for (spec, name) in zip(specs, names)]
+
+
+def _combine_packages(ancestors, packages_attr, names_attr):
+    # returns (combined specs, dict from package name to spec)
+    item_lists = []
+    key_lists = []
+    for spec in ancestors:
+        (packages, names) = (getattr(spec, packages_attr), getattr(spec, names_attr))
+        item_lists.append(list(zip(packages, names)))
+        key_lists.append(_combine_keys(packages, names))
+    combined = _combine_keeping_last_duplicates(item_lists, key_lists)
+    # we quietly skip invalid specs here and let them fail
+    # somewhere we can more easily report an error message.
+    by_name = dict([(name, package) for (package, name) in combined if name is not None])
+    return (tuple([package for (package, name) in combined]), by_name)
 
 
 class EnvSpec(object):
@@ -100,23 +113,28 @@ class EnvSpec(object):
         for name in tuple([spec.name for spec in self._inherit_from]):
             assert name is None or name in self._inherit_from_names
 
-        conda_specs_by_name = dict()
-        for spec in self.conda_packages:
-            # we quietly skip invalid specs here and let them fail
-            # somewhere we can more easily report an error message.
-            parsed = conda_api.parse_spec(spec)
-            if parsed is not None:
-                conda_specs_by_name[parsed.name] = spec
-        self._conda_specs_by_name = conda_specs_by_name
-
-        pip_specs_by_name = dict()
-        for spec in self.pip_packages:
-            # we quietly skip invalid specs here and let them fail
-            # somewhere we can more easily report an error message.
-            parsed = pip_api.parse_spec(spec)
-            if parsed is not None:
-                pip_specs_by_name[parsed.name] = spec
-        self._pip_specs_by_name = pip_specs_by_name
+        # everything inherited is computed here once, since env specs
+        # never change and we look at these lists a lot; our parents
+        # have already done the same
+        ancestors = []
+        seen = set()
+        for parent in self._inherit_from:
+            for spec in parent._ancestors:
+                if id(spec) not in seen:
+                    seen.add(id(spec))
+                    ancestors.append(spec)
+        ancestors.append(self)
+        self._ancestors = tuple(ancestors)
+
+        self._conda_names = _parsed_names(self._conda_packages, conda_api.parse_spec)
+        self._pip_names = _parsed_names(self._pip_packages, pip_api.parse_spec)
+
+        (self._inherited_conda_packages, self._conda_specs_by_name) = _combine_packages(ancestors, '_conda_packages',
+                                                                                        '_conda_names')
+        (self._inherited_pip_packages, self._pip_specs_by_name) = _combine_packages(ancestors, '_pip_packages',
+                                                                                    '_pip_names')
+        self._inherited_channels = tuple(_combine_keeping_last_duplicates([spec._channels for spec in ancestors],
+                                                                          [spec._channels for spec in ancestors]))
 
     @property
     def name(self):
@@ -154,40 +172,20 @@ class EnvSpec(object):
             self._channels_and_packages_hash = m.hexdigest()
         return self._channels_and_packages_hash
 
-    def _get_inherited(self, public_attr, key_func=None):
-        def _linearized_ancestors(specs, accumulator):
-            for spec in specs:
-                if spec not in accumulator:
-                    _linearized_ancestors(spec._inherit_from, accumulator)
-                    accumulator.append(spec)
-
-        ancestors = []
-        _linearized_ancestors([self], ancestors)
-        assert ancestors[-1] is self
-
-        private_attr = '_' + public_attr
-        to_combine = []
-        for spec in ancestors:
-            to_combine.append(getattr(spec, private_attr))
-        combined = []
-        for item in to_combine:
-            combined = _combine_keeping_last_duplicate(combined, item, key_func=key_func)
-        return combined
-
     @property
     def conda_packages(self):
         """Get the conda packages to install in the environment as an iterable."""
-        return self._get_inherited('conda_packages', _conda_combine_key)
+        return self._inherited_conda_packages
 
     @property
     def channels(self):
         """Get the channels to install conda packages from."""
-        return self._get_inherited('channels')
+        return self._inherited_channels
 
     @property
     def pip_packages(self):
         """Get the pip packages to install in the environment as an iterable."""
-        return self._get_inherited('pip_packages', _pip_combine_key)
+        return self._inherited_pip_packages
 
     @property
     def conda_package_names_set(self):
@@ -375,8 +373,12 @@ def _load_environment_yml(filename):
 _requirement_option_re = re.compile('^-([-a-zA-Z0-9]+)\s(.*)')
 
 
-def _load_requirements_txt(filename):
-    """Load a requirements.txt as an EnvSpec, or None if not loaded."""
+def _load_requirements_txt(filename, included=None):
+    """Load a requirements.txt as an EnvSpec, or None if not loaded.
+
+    If included is a list, the paths of files included with ``-r``
+    are appended to it.
+    """
     try:
         with codecs.open(filename, 'r', 'utf-8') as file:
             lines = file.readlines()
@@ -409,7 +411,9 @@ def _load_requirements_txt(filename):
                 packages.append(package)
             elif option == 'r':
                 path = os.path.join(os.path.dirname(filename), package)
-                child_spec = _load_requirements_txt(path)
+                if included is not None:
+                    included.append(path)
+                child_spec = _load_requirements_txt(path, included)
                 if child_spec is not None:
                     packages.extend(child_spec.pip_packages)
         else:
@@ -418,18 +422,67 @@ def _load_requirements_txt(filename):
     return EnvSpec(name='default', conda_packages=(), channels=(), pip_packages=packages)
 
 
-def _load_importable(filename):
+def _load_importable(filename, included=None):
     if filename.endswith(".txt"):
-        return _load_requirements_txt(filename)
+        return _load_requirements_txt(filename, included)
     else:
         return _load_environment_yml(filename)
 
 
+# in the order we look for them
+_importable_spec_filenames = ("environment.yml", "environment.yaml", 'requirements.txt')
+
+# path -> (stats of the file and its includes, EnvSpec or None); every
+# project load looks for these files, and they rarely change
+_importable_cache = dict()
+
+
+def _file_stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return (path, None)
+    return (path, getattr(st, 'st_mtime_ns', st.st_mtime), st.st_size, st.st_ino)
+
+
+def _load_importable_cached(filename):
+    cached = _importable_cache.get(filename)
+    if cached is not None:
+        (stats, spec) = cached
+        if all(_file_stat(stat[0]) == stat for stat in stats):
+            return spec
+
+    # stat before reading, so a change while we read makes the entry stale
+    stat = _file_stat(filename)
+    included = []
+    spec = _load_importable(filename, included)
+    stats = [stat] + [_file_stat(path) for path in included]
+    if spec is not None:
+        # compute it once, since the spec is shared
+        spec.channels_and_packages_hash
+    _importable_cache[filename] = (stats, spec)
+    return spec
+
+
+def _importable_spec_dependencies(directory_path):
+    """Paths of every file the importable spec for a directory can come from.
+
+    That's each of ``_importable_spec_filenames``, whether or not it
+    exists, followed by any files they include with ``-r``.
+    """
+    paths = []
+    for filename in _importable_spec_filenames:
+        full = os.path.join(directory_path, filename)
+        _load_importable_cached(full)
+        (stats, spec) = _importable_cache[full]
+        paths.extend(stat[0] for stat in stats)
+    return paths
+
+
 def _find_importable_spec(directory_path):
-    filenames = ("environment.yml", "environment.yaml", 'requirements.txt')
-    for filename in filenames:
+    for filename in _importable_spec_filenames:
         full = os.path.join(directory_path, filename)
-        spec = _load_importable(full)
+        spec = _load_importable_cached(full)
         if spec is not None:
             return (spec, filename)
 
@@ -442,10 +495,9 @@ def _find_out_of_sync_importable_spec(project_specs, directory_path):
     if spec is None:
         return (None, None)
 
-    for existing in project_specs:
-        if existing.name == spec.name and \
-           existing.channels_and_packages_hash == spec.channels_and_packages_hash:
-            return (None, None)
+    in_sync = set((existing.name, existing.channels_and_packages_hash) for existing in project_specs)
+    if (spec.name, spec.channels_and_packages_hash) in in_sync:
+        return (None, None)
 
     return (spec, filename)
 
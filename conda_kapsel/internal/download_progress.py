@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------------
+# Copyright © 2016, Continuum Analytics, Inc. All rights reserved.
+#
+# The full license is in the file LICENSE.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import absolute_import, print_function
+
+import os
+import threading
+
+from conda_kapsel.verbose import _verbose_logger
+
+_listeners = []
+_listeners_lock = threading.Lock()
+
+
+def _format_bytes(count):
+    for unit in ('', 'K', 'M', 'G'):
+        if count < 1024 or unit == 'G':
+            if unit == '':
+                return "%dB" % count
+            return "%.1f%s" % (count, unit)
+        count = count / 1024.0
+
+
+def _format_seconds(seconds):
+    seconds = int(seconds + 0.5)
+    (minutes, seconds) = divmod(seconds, 60)
+    (hours, minutes) = divmod(minutes, 60)
+    if hours > 0:
+        return "%d:%02d:%02d" % (hours, minutes, seconds)
+    return "%02d:%02d" % (minutes, seconds)
+
+
+class DownloadProgress(object):
+    """Snapshot of how far along a download is."""
+
+    def __init__(self, url, filename, bytes_done, bytes_total, elapsed, finished=False, failed=False):
+        """Create a snapshot; bytes_total is None if the server didn't send a length."""
+        self.url = url
+        self.filename = filename
+        self.bytes_done = bytes_done
+        self.bytes_total = bytes_total
+        self.elapsed = elapsed
+        self.finished = finished
+        self.failed = failed
+
+    @property
+    def rate(self):
+        """Bytes per second so far, or None if we can't tell yet."""
+        if self.elapsed <= 0:
+            return None
+        return self.bytes_done / self.elapsed
+
+    @property
+    def fraction(self):
+        """Fraction complete from 0.0 to 1.0, or None if the total is unknown."""
+        if self.bytes_total is None or self.bytes_total <= 0:
+            return None
+        return min(1.0, float(self.bytes_done) / self.bytes_total)
+
+    @property
+    def eta(self):
+        """Seconds remaining at the current rate, or None if unknown."""
+        rate = self.rate
+        if self.bytes_total is None or rate is None or rate <= 0:
+            return None
+        return max(0, self.bytes_total - self.bytes_done) / rate
+
+    def format_line(self):
+        """Format as a single line of text suitable for a progress display."""
+        name = os.path.basename(self.filename)
+        if self.bytes_total is None:
+            line = "Downloading %s: %s" % (name, _format_bytes(self.bytes_done))
+        else:
+            line = "Downloading %s: %s of %s (%d%%)" % (name, _format_bytes(self.bytes_done),
+                                                        _format_bytes(self.bytes_total), int(self.fraction * 100))
+        rate = self.rate
+        if rate is not None:
+            line = line + " at %s/s" % _format_bytes(rate)
+        if self.failed:
+            line = line + ", failed"
+        elif self.finished:
+            line = line + ", done in %s" % _format_seconds(self.elapsed)
+        elif self.eta is not None:
+            line = line + ", %s remaining" % _format_seconds(self.eta)
+        return line
+
+    def to_json(self):
+        """Convert to a JSON-serializable dict."""
+        return dict(url=self.url,
+                    filename=self.filename,
+                    bytes_done=self.bytes_done,
+                    bytes_total=self.bytes_total,
+                    elapsed=self.elapsed,
+                    rate=self.rate,
+                    eta=self.eta,
+                    finished=self.finished,
+                    failed=self.failed,
+                    line=self.format_line())
+
+
+def add_progress_listener(listener):
+    """Add a function to be called with each ``DownloadProgress``.
+
+    Listeners may be called from any thread.
+    """
+    with _listeners_lock:
+        _listeners.append(listener)
+
+
+def remove_progress_listener(listener):
+    """Remove a listener added with ``add_progress_listener``."""
+    with _listeners_lock:
+        _listeners.remove(listener)
+
+
+def report_progress(progress):
+    """Send a ``DownloadProgress`` to all listeners."""
+    if progress.finished and not progress.failed:
+        # this is how we get throughput into logs for slow-mirror hunting
+        _verbose_logger().info("Downloaded %s from %s: %d bytes in %.2f seconds (%s/s)", progress.filename,
+                               progress.url, progress.bytes_done, progress.elapsed, _format_bytes(progress.rate or 0))
+    with _listeners_lock:
+        listeners = list(_listeners)
+    for listener in listeners:
+        listener(progress)
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------------
+# Copyright © 2016, Continuum Analytics, Inc. All rights reserved.
+#
+# The full license is in the file LICENSE.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import absolute_import, print_function
+
+import errno
+import os
+import stat
+import tempfile
+import time
+
+try:
+    import fcntl
+    msvcrt = None
+except ImportError:  # pragma: no cover (windows only)
+    fcntl = None  # pragma: no cover (windows only)
+    import msvcrt  # pragma: no cover (windows only)
+
+from conda_kapsel.internal.makedirs import makedirs_ok_if_exists
+
+
+def shared_lock_directory(name):
+    """Get a directory under the system temp dir that all users on the host can lock files in.
+
+    The directory is created if it doesn't exist yet.
+    """
+    path = os.path.join(tempfile.gettempdir(), name)
+    ensure_shared_directory(path)
+    return path
+
+
+def user_lock_directory(name):
+    """Get a directory under the system temp dir that only the current user can use.
+
+    The directory is created if it doesn't exist yet. Since anyone
+    can create the predictable name first, we refuse to use it
+    unless it's a real directory (not a symlink) owned by us.
+
+    Raises:
+        OSError if the path exists but isn't our own directory
+    """
+    if not hasattr(os, 'getuid'):  # pragma: no cover (windows only)
+        # the temp dir is already per-user on Windows
+        path = os.path.join(tempfile.gettempdir(), name)
+        makedirs_ok_if_exists(path)
+        return path
+
+    path = os.path.join(tempfile.gettempdir(), "%s-%d" % (name, os.getuid()))
+    try:
+        os.mkdir(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise e
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+        # lstat means a symlink is never S_ISDIR
+        raise OSError(errno.EPERM, "%s is not a directory owned by the current user, refusing to use it" % path)
+    if stat.S_IMODE(info.st_mode) != 0o700:
+        os.chmod(path, 0o700)
+    return path
+
+
+def ensure_shared_directory(path):
+    """Create path if needed, world-writable and sticky like /tmp itself."""
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+            os.chmod(path, 0o1777)
+        except OSError:
+            # someone else made it first, or we can't chmod on this platform
+            pass
+
+
+def _lock_fd(fd, blocking):
+    if fcntl is not None:
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags = flags | fcntl.LOCK_NB
+        fcntl.flock(fd, flags)
+    else:  # pragma: no cover (windows only)
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+
+
+def _unlock_fd(fd):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:  # pragma: no cover (windows only)
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+class FileLock(object):
+    """An exclusive advisory lock on a file, shared between processes.
+
+    The lock file is created if needed and never deleted, since
+    deleting it would race with other processes opening it.
+    """
+
+    def __init__(self, filename):
+        """Create a lock on filename; it isn't acquired until ``acquire()``."""
+        self._filename = filename
+        self._fd = None
+
+    @property
+    def filename(self):
+        """Path of the lock file."""
+        return self._filename
+
+    @property
+    def locked(self):
+        """True if we are holding the lock."""
+        return self._fd is not None
+
+    def _open(self):
+        makedirs_ok_if_exists(os.path.dirname(self._filename))
+        try:
+            return os.open(self._filename, os.O_RDWR | os.O_CREAT, 0o666)
+        except (IOError, OSError) as e:
+            # flock works on a read-only descriptor, which is all we
+            # get on a lock file another user created
+            if e.errno == errno.EACCES and os.path.exists(self._filename):
+                return os.open(self._filename, os.O_RDONLY)
+            raise e
+
+    def try_acquire(self):
+        """Take the lock if nobody else has it.
+
+        Returns:
+            True if we got the lock
+        """
+        assert self._fd is None
+        fd = self._open()
+        try:
+            _lock_fd(fd, blocking=False)
+        except (IOError, OSError) as e:
+            os.close(fd)
+            if e.errno in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+                return False
+            raise e
+        self._fd = fd
+        return True
+
+    def acquire(self, timeout=None, poll_interval=0.1):
+        """Wait for the lock, up to timeout seconds if not None.
+
+        Returns:
+            True if we got the lock
+        """
+        if timeout is None and fcntl is not None:
+            assert self._fd is None
+            fd = self._open()
+            try:
+                _lock_fd(fd, blocking=True)
+            except Exception:
+                os.close(fd)
+                raise
+            self._fd = fd
+            return True
+
+        deadline = None if timeout is None else (time.time() + timeout)
+        while not self.try_acquire():
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(poll_interval)
+        return True
+
+    def release(self):
+        """Let go of the lock if we have it."""
+        if self._fd is not None:
+            fd = self._fd
+            self._fd = None
+            try:
+                _unlock_fd(fd)
+            finally:
+                os.close(fd)
+
+    def __enter__(self):
+        """Acquire the lock, waiting as long as it takes."""
+        self.acquire()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        """Release the lock."""
+        self.release()
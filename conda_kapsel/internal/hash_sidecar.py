@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------------
+# Copyright © 2016, Continuum Analytics, Inc. All rights reserved.
+#
+# The full license is in the file LICENSE.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import absolute_import, print_function
+
+import codecs
+import hashlib
+import json
+import mmap
+import os
+import uuid
+
+from conda_kapsel.internal.rename import rename_over_existing
+
+SIDECAR_SUFFIX = ".kapsel-hash"
+
+# hash in chunks so we don't page a huge file into memory all at once
+_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def sidecar_filename(filename):
+    return filename + SIDECAR_SUFFIX
+
+
+def _stat_fingerprint(statinfo):
+    # st_mtime_ns is py3 only
+    mtime_ns = getattr(statinfo, 'st_mtime_ns', None)
+    if mtime_ns is None:  # pragma: no cover (py2 only)
+        mtime_ns = int(statinfo.st_mtime * 1000000000)
+    return dict(size=statinfo.st_size, mtime_ns=mtime_ns, inode=statinfo.st_ino)
+
+
+def compute_file_hash(filename, algorithm):
+    """Hash the file with the given hashlib algorithm, returning the hex digest."""
+    hasher = getattr(hashlib, algorithm)()
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        # mmap refuses to map an empty file
+        if size > 0:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                offset = 0
+                while offset < size:
+                    hasher.update(mapped[offset:offset + _CHUNK_SIZE])
+                    offset += _CHUNK_SIZE
+            finally:
+                mapped.close()
+    return hasher.hexdigest()
+
+
+def read_sidecar(filename):
+    """Load the sidecar for filename as a dict, or None if missing or unreadable."""
+    try:
+        with codecs.open(sidecar_filename(filename), 'r', 'utf-8') as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if not isinstance(data, dict):
+        return None
+    return data
+
+
+def write_sidecar(filename, algorithm, digest):
+    """Record the digest of filename along with its current stat.
+
+    The sidecar is only a cache, so failing to write it is not an error;
+    we return False and the file simply gets rehashed next time.
+    """
+    try:
+        data = _stat_fingerprint(os.stat(filename))
+        data['algorithm'] = algorithm
+        data['digest'] = digest
+        path = sidecar_filename(filename)
+        tmp = path + ".tmp-" + str(uuid.uuid4())
+        try:
+            with codecs.open(tmp, 'w', 'utf-8') as f:
+                json.dump(data, f, sort_keys=True)
+            rename_over_existing(tmp, path)
+        finally:
+            try:
+                os.remove(tmp)
+            except (IOError, OSError):
+                pass
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def remove_sidecar(filename):
+    """Delete the sidecar for filename if it exists."""
+    try:
+        os.remove(sidecar_filename(filename))
+    except (IOError, OSError):
+        pass
+
+
+def cached_file_hash(filename, algorithm):
+    """Get the digest of filename, trusting the sidecar if the file is unchanged.
+
+    If the sidecar's size, mtime and inode match the file and it
+    used the same algorithm, the recorded digest is returned without
+    reading the file. Otherwise the file is rehashed and a fresh
+    sidecar is written.
+
+    Returns:
+        hex digest string
+    """
+    sidecar = read_sidecar(filename)
+    if sidecar is not None and sidecar.get('algorithm') == algorithm:
+        fingerprint = _stat_fingerprint(os.stat(filename))
+        if all(sidecar.get(key) == value for (key, value) in fingerprint.items()) and 'digest' in sidecar:
+            return sidecar['digest']
+
+    digest = compute_file_hash(filename, algorithm)
+    write_sidecar(filename, algorithm, digest)
+    return digest
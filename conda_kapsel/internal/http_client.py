@@ -7,27 +7,84 @@
 from __future__ import absolute_import, print_function
 
 from tornado import httpclient
+from tornado import httputil
 from tornado import gen
+from tornado import simple_httpclient
 
 import conda_kapsel.internal.makedirs as makedirs
 import conda_kapsel.internal.rename as rename
+from conda_kapsel.internal.download_progress import DownloadProgress, report_progress
+from conda_kapsel.internal.network_budget import NetworkBudget
 
 import os
 import hashlib
+import time
+
+# don't flood the UI with progress events
+_PROGRESS_INTERVAL_SECONDS = 0.25
+
+# how many bytes we let through between bandwidth budget checks,
+# so we aren't taking the budget lock on every chunk
+_THROTTLE_BATCH_BYTES = 256 * 1024
+
+
+class _FlowControlledConnection(simple_httpclient._HTTPConnection):
+    def data_received(self, chunk):
+        # Tornado drops whatever the streaming callback returns, but the
+        # connection stops reading while a Future returned from here is
+        # pending, so passing it along lets a download pause without
+        # blocking the IOLoop.
+        if self.request.streaming_callback is None or self._should_follow_redirect():
+            return super(_FlowControlledConnection, self).data_received(chunk)
+        return self.request.streaming_callback(chunk)
+
+
+class _FlowControlledHTTPClient(simple_httpclient.SimpleAsyncHTTPClient):
+    def _connection_class(self):
+        return _FlowControlledConnection
 
 
 class FileDownloader(object):
-    def __init__(self, url, filename, hash_algorithm=None):
+    def __init__(self, url, filename, hash_algorithm=None, unpacker=None, budget=None):
         """Downloader for the given url to the given filename, computing the given hash.
 
         hash_algorithm is the name of a hash function in hashlib
+
+        If unpacker is provided (a ``StreamingUnpacker``), chunks are
+        fed to it as they arrive instead of being written to filename,
+        and the caller is responsible for committing or discarding it.
+
+        budget is a ``NetworkBudget`` to stay within, by default the
+        one configured in the environment if any.
         """
         self._url = url
         self._filename = filename
         self._hash_algorithm = hash_algorithm
+        self._unpacker = unpacker
+        if budget is None:
+            budget = NetworkBudget.from_environ()
+        self._budget = budget
+        self._unthrottled_bytes = 0
         self._hash = None
         self._client = None
         self._errors = []
+        self._bytes_done = 0
+        self._bytes_total = None
+        self._start_time = None
+        self._last_progress_time = None
+
+    def _report_progress(self, finished=False):
+        now = time.time()
+        if not finished and (now - self._last_progress_time) < _PROGRESS_INTERVAL_SECONDS:
+            return
+        self._last_progress_time = now
+        report_progress(DownloadProgress(url=self._url,
+                                         filename=self._filename,
+                                         bytes_done=self._bytes_done,
+                                         bytes_total=self._bytes_total,
+                                         elapsed=(now - self._start_time),
+                                         finished=finished,
+                                         failed=(finished and len(self._errors) > 0)))
 
     @gen.coroutine
     def run(self, io_loop):
@@ -43,7 +100,7 @@ class FileDownloader(object):
 
         if self._hash_algorithm is not None:
             hasher = getattr(hashlib, self._hash_algorithm)()
-        self._client = httpclient.AsyncHTTPClient(
+        self._client = _FlowControlledHTTPClient(
             io_loop=io_loop,
             max_clients=1,
             # without this we buffer a huge amount
@@ -55,13 +112,16 @@ class FileDownloader(object):
             force_instance=True)
 
         tmp_filename = self._filename + ".part"
-        try:
-            _file = open(tmp_filename, 'wb')
-        except EnvironmentError as e:
-            self._errors.append("Failed to open %s: %s" % (tmp_filename, e))
-            raise gen.Return(None)
+        if self._unpacker is None:
+            try:
+                _file = open(tmp_filename, 'wb')
+            except EnvironmentError as e:
+                self._errors.append("Failed to open %s: %s" % (tmp_filename, e))
+                raise gen.Return(None)
 
         def cleanup_tmp():
+            if self._unpacker is not None:
+                return
             try:
                 _file.close()
                 # future: we could save it in order to try
@@ -72,13 +132,43 @@ class FileDownloader(object):
             except EnvironmentError:
                 pass
 
+        def on_header(line):
+            (name, _, value) = line.partition(":")
+            if name.strip().lower() == 'content-length':
+                try:
+                    self._bytes_total = int(value.strip())
+                except ValueError:
+                    pass
+
+        def throttle(chunk):
+            if self._budget is None:
+                return None
+            self._unthrottled_bytes += len(chunk)
+            if self._unthrottled_bytes < _THROTTLE_BATCH_BYTES:
+                return None
+            delay = self._budget.reserve(self._unthrottled_bytes)
+            self._unthrottled_bytes = 0
+            if delay <= 0:
+                return None
+            # while we don't read, the TCP window fills up and the
+            # server slows down
+            return gen.sleep(delay)
+
         def writer(chunk):
             if len(self._errors) > 0:
-                return
+                return None
+
+            self._bytes_done += len(chunk)
+            self._report_progress()
 
             if self._hash_algorithm is not None:
                 hasher.update(chunk)
 
+            if self._unpacker is not None:
+                self._unpacker.write(chunk)
+                self._errors.extend(self._unpacker.errors)
+                return throttle(chunk)
+
             try:
                 _file.write(chunk)
             except EnvironmentError as e:
@@ -86,22 +176,40 @@ class FileDownloader(object):
                 # we ignore all future chunks once we have an error, which does mean
                 # we continue to download bytes that we don't use. yuck.
                 self._errors.append("Failed to write to %s: %s" % (tmp_filename, e))
+            return throttle(chunk)
 
         try:
             timeout_in_seconds = 60 * 10  # pretty long because we could be dealing with huge files
             request = httpclient.HTTPRequest(url=self._url,
+                                             header_callback=on_header,
                                              streaming_callback=writer,
                                              request_timeout=timeout_in_seconds)
+            transfer = None
+            if self._budget is not None and self._budget.max_transfers is not None:
+                transfer = self._budget.try_acquire_transfer()
+                while transfer is None:
+                    yield gen.sleep(0.25)
+                    transfer = self._budget.try_acquire_transfer()
+
+            self._start_time = time.time()
+            self._last_progress_time = self._start_time
             try:
                 response = yield self._client.fetch(request)
             except Exception as e:
                 self._errors.append("Failed download to %s: %s" % (self._filename, str(e)))
+                self._report_progress(finished=True)
                 raise gen.Return(None)
+            finally:
+                if transfer is not None:
+                    transfer.release()
 
             # assert fetch() was supposed to throw the error, not leave it here unthrown
             assert response.error is None
 
-            if len(self._errors) == 0:
+            if len(self._errors) == 0 and self._unpacker is not None:
+                if not self._unpacker.finish():
+                    self._errors.extend(self._unpacker.errors)
+            elif len(self._errors) == 0:
                 try:
                     _file.close()  # be sure tmp_filename is flushed
                     rename.rename_over_existing(tmp_filename, self._filename)
@@ -111,6 +219,7 @@ class FileDownloader(object):
             if len(self._errors) == 0 and self._hash_algorithm is not None:
                 self._hash = hasher.hexdigest()
 
+            self._report_progress(finished=True)
             raise gen.Return(response)
         finally:
             cleanup_tmp()
@@ -124,3 +233,82 @@ class FileDownloader(object):
     def errors(self):
         """List of errors if we failed to download, empty list if we succeeded."""
         return self._errors
+
+
+class _ProbeFinished(Exception):
+    pass
+
+
+class MirrorProber(object):
+    def __init__(self, urls, probe_bytes=64 * 1024, timeout_in_seconds=10):
+        """Prober that times a small ranged request against each of the given urls.
+
+        Only the first probe_bytes of each url are requested; servers
+        that ignore the Range header are cut off once that much has
+        arrived.
+        """
+        self._urls = list(urls)
+        self._probe_bytes = probe_bytes
+        self._timeout_in_seconds = timeout_in_seconds
+        self._timings = dict()
+        self._errors = []
+
+    @gen.coroutine
+    def _probe(self, client, url):
+        state = dict(code=None, received=0)
+        start = time.time()
+
+        def on_header(line):
+            if state['code'] is None and line.startswith("HTTP/"):
+                try:
+                    state['code'] = httputil.parse_response_start_line(line.strip()).code
+                except httputil.HTTPInputError:
+                    pass
+
+        def on_chunk(chunk):
+            if state['code'] not in (200, 206):
+                return
+            state['received'] += len(chunk)
+            if state['received'] >= self._probe_bytes and url not in self._timings:
+                self._timings[url] = time.time() - start
+                # this aborts the request, so we don't download the whole
+                # file from a server that doesn't support Range
+                raise _ProbeFinished()
+
+        request = httpclient.HTTPRequest(url=url,
+                                         headers={'Range': 'bytes=0-%d' % (self._probe_bytes - 1)},
+                                         header_callback=on_header,
+                                         streaming_callback=on_chunk,
+                                         request_timeout=self._timeout_in_seconds)
+        try:
+            response = yield client.fetch(request)
+            if url not in self._timings and response.code in (200, 206):
+                self._timings[url] = time.time() - start
+        except Exception as e:
+            if url not in self._timings:
+                self._errors.append("Mirror %s did not respond: %s" % (url, str(e)))
+
+    @gen.coroutine
+    def run(self, io_loop):
+        """Probe all the urls concurrently on the given io_loop.
+
+        Returns the urls that responded, fastest first.
+        """
+        self._client = httpclient.AsyncHTTPClient(io_loop=io_loop, max_clients=len(self._urls), force_instance=True)
+        try:
+            yield [self._probe(self._client, url) for url in self._urls]
+        finally:
+            self._client.close()
+
+        ranked = sorted(self._timings.keys(), key=lambda url: (self._timings[url], self._urls.index(url)))
+        raise gen.Return(ranked)
+
+    @property
+    def timings(self):
+        """Dict from url to seconds taken by its probe, for urls that responded."""
+        return self._timings
+
+    @property
+    def errors(self):
+        """List of errors for urls that didn't respond."""
+        return self._errors
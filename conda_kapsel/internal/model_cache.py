@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------------
+# Copyright © 2016, Continuum Analytics, Inc. All rights reserved.
+#
+# The full license is in the file LICENSE.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import absolute_import
+
+import hashlib
+import os
+import pickle
+import sys
+import uuid
+
+from conda_kapsel.internal.makedirs import makedirs_ok_if_exists
+from conda_kapsel.internal.rename import rename_over_existing
+from conda_kapsel.version import version
+
+# a directory to keep cached models in, or empty to not cache them
+MODEL_CACHE_VARIABLE = 'KAPSEL_MODEL_CACHE'
+
+# keep the models for this many projects, dropping the least recently saved
+_MAX_ENTRIES = 200
+
+# stands in for the plugin registry in pickles, since the registry
+# belongs to whoever loads the model
+_REGISTRY_ID = 'registry'
+
+
+def default_model_cache_directory():
+    """Where compiled project models are cached, None if they shouldn't be."""
+    if MODEL_CACHE_VARIABLE in os.environ:
+        return os.environ[MODEL_CACHE_VARIABLE] or None
+    if os.name == 'nt':  # pragma: no cover (windows only)
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser("~"))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "conda-kapsel", "models")
+
+
+def model_key(directory, texts, filenames):
+    """Hash everything a project's model is computed from.
+
+    Args:
+        directory (str): the project directory
+        texts (list of str): contents of files that were already read
+        filenames (list of str): other files to include, which may not exist
+
+    Returns:
+        the key as a string
+    """
+    digest = hashlib.sha256()
+
+    def add(data):
+        digest.update(data)
+        digest.update(b'\0')
+
+    for text in [version, sys.version, directory] + list(texts):
+        add(text.encode('utf-8'))
+    for filename in filenames:
+        try:
+            with open(filename, 'rb') as f:
+                add(f.read())
+        except (IOError, OSError):
+            add(b'(missing)')
+    return digest.hexdigest()
+
+
+def _entry_filename(cache_directory, directory):
+    return os.path.join(cache_directory, hashlib.sha1(directory.encode('utf-8')).hexdigest() + ".pickle")
+
+
+def load_model(cache_directory, directory, key, registry):
+    """Get the model saved for a project, or None if there isn't one for this key.
+
+    Args:
+        cache_directory (str): the cache directory
+        directory (str): the project directory
+        key (str): key from ``model_key()``
+        registry (PluginRegistry): registry to give the loaded requirements
+
+    Returns:
+        the model, or None
+    """
+    try:
+        with open(_entry_filename(cache_directory, directory), 'rb') as f:
+            unpickler = pickle.Unpickler(f)
+
+            def persistent_load(persistent_id):
+                if persistent_id != _REGISTRY_ID:
+                    raise pickle.UnpicklingError("unknown persistent id %r" % persistent_id)
+                return registry
+
+            unpickler.persistent_load = persistent_load
+            if unpickler.load() != key:
+                return None
+            return unpickler.load()
+    except Exception:
+        # missing, or written by a version whose classes have changed
+        return None
+
+
+def _prune(cache_directory):
+    try:
+        names = [name for name in os.listdir(cache_directory) if name.endswith(".pickle")]
+        if len(names) <= _MAX_ENTRIES:
+            return
+        paths = sorted([os.path.join(cache_directory, name) for name in names], key=os.path.getmtime)
+        for path in paths[:len(paths) - _MAX_ENTRIES]:
+            os.remove(path)
+    except OSError:
+        # someone else is pruning at the same time
+        pass
+
+
+def save_model(cache_directory, directory, key, model, registry):
+    """Save a project's model, replacing whatever was saved for it before.
+
+    Failing to save isn't an error; the model just gets computed again next time.
+
+    Args:
+        cache_directory (str): the cache directory
+        directory (str): the project directory
+        key (str): key from ``model_key()``
+        model: anything picklable
+        registry (PluginRegistry): registry the model refers to, which isn't saved
+    """
+    filename = _entry_filename(cache_directory, directory)
+    tmp_filename = filename + ".tmp-" + str(uuid.uuid4())
+    try:
+        makedirs_ok_if_exists(cache_directory)
+        with open(tmp_filename, 'wb') as f:
+            pickler = pickle.Pickler(f, 2)
+
+            def persistent_id(obj):
+                if obj is registry:
+                    return _REGISTRY_ID
+                return None
+
+            pickler.persistent_id = persistent_id
+            pickler.dump(key)
+            pickler.dump(model)
+        rename_over_existing(tmp_filename, filename)
+    except Exception:
+        try:
+            os.remove(tmp_filename)
+        except OSError:
+            pass
+        return
+    _prune(cache_directory)
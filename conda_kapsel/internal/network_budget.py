@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------------
+# Copyright © 2016, Continuum Analytics, Inc. All rights reserved.
+#
+# The full license is in the file LICENSE.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import absolute_import, print_function
+
+import codecs
+import os
+import sys
+import tempfile
+import time
+
+from conda_kapsel.internal.file_lock import FileLock, ensure_shared_directory
+
+# these are read from the real process environment, not the project
+# environ, since the budget is shared by everything on the host
+MAX_BYTES_PER_SECOND_VARIABLE = 'KAPSEL_MAX_DOWNLOAD_BYTES_PER_SECOND'
+MAX_TRANSFERS_VARIABLE = 'KAPSEL_MAX_CONCURRENT_DOWNLOADS'
+BUDGET_DIRECTORY_VARIABLE = 'KAPSEL_NETWORK_BUDGET_DIR'
+
+# an idle host may burst this many seconds' worth of bytes
+_BURST_SECONDS = 1.0
+
+# the clock file is writable by every user on the host, so we never
+# believe it if it says the bandwidth is booked further ahead than this
+_MAX_SECONDS_AHEAD = 60.0
+
+# (variable, value) pairs we've already complained about; a FileDownloader
+# loads the budget every time, and once per process is enough to hear it
+_reported_invalid = set()
+
+_size_suffixes = {'': 1, 'K': 1024, 'M': 1024 * 1024, 'G': 1024 * 1024 * 1024}
+
+
+def _parse_size(value):
+    value = value.strip().upper()
+    if value.endswith('B'):
+        value = value[:-1]
+    suffix = ''
+    if len(value) > 0 and value[-1] in _size_suffixes:
+        suffix = value[-1]
+        value = value[:-1]
+    try:
+        size = float(value) * _size_suffixes[suffix]
+    except ValueError:
+        return None
+    if size <= 0:
+        return None
+    return int(size)
+
+
+def _parse_count(value):
+    try:
+        count = int(value.strip())
+    except ValueError:
+        return None
+    if count <= 0:
+        return None
+    return count
+
+
+def default_budget_directory():
+    """Directory holding the shared budget state for this host."""
+    return os.path.join(tempfile.gettempdir(), "kapsel-network-budget")
+
+
+class NetworkBudget(object):
+    """A limit on network use shared by all kapsel processes on the host.
+
+    Processes coordinate through lock files in a common directory:
+    one lock per concurrent transfer slot, and a lock protecting a
+    small file that tracks when the shared bandwidth is next free.
+    """
+
+    def __init__(self, directory, max_bytes_per_second=None, max_transfers=None):
+        """Create a budget; either limit may be None for unlimited."""
+        self._directory = directory
+        self.max_bytes_per_second = max_bytes_per_second
+        self.max_transfers = max_transfers
+
+    def _lock(self, name):
+        # every user on the host shares the budget
+        ensure_shared_directory(self._directory)
+        return FileLock(os.path.join(self._directory, name))
+
+    @classmethod
+    def from_environ(cls, environ=None):
+        """Load the budget configured in the environment, or None if there isn't one."""
+        if environ is None:
+            environ = os.environ
+
+        def parse(name, parser):
+            if name not in environ:
+                return None
+            parsed = parser(environ[name])
+            if parsed is None and (name, environ[name]) not in _reported_invalid:
+                _reported_invalid.add((name, environ[name]))
+                print("Ignoring invalid %s=%s" % (name, environ[name]), file=sys.stderr)
+            return parsed
+
+        max_bytes_per_second = parse(MAX_BYTES_PER_SECOND_VARIABLE, _parse_size)
+        max_transfers = parse(MAX_TRANSFERS_VARIABLE, _parse_count)
+        if max_bytes_per_second is None and max_transfers is None:
+            return None
+        directory = environ.get(BUDGET_DIRECTORY_VARIABLE, default_budget_directory())
+        return cls(directory, max_bytes_per_second=max_bytes_per_second, max_transfers=max_transfers)
+
+    def try_acquire_transfer(self):
+        """Take a transfer slot if one is free.
+
+        Returns:
+            a ``FileLock`` to release when the transfer is done, or None
+        """
+        assert self.max_transfers is not None
+        for i in range(0, self.max_transfers):
+            lock = self._lock("transfer-%d.lock" % i)
+            if lock.try_acquire():
+                return lock
+        return None
+
+    def acquire_transfer(self, poll_interval=0.25):
+        """Wait for a transfer slot, returning a ``FileLock`` to release when done."""
+        while True:
+            lock = self.try_acquire_transfer()
+            if lock is not None:
+                return lock
+            time.sleep(poll_interval)
+
+    def reserve(self, byte_count):
+        """Account for byte_count bytes transferred.
+
+        Returns:
+            how many seconds the caller should pause to stay within the rate
+        """
+        if self.max_bytes_per_second is None or byte_count <= 0:
+            return 0.0
+
+        clock_filename = os.path.join(self._directory, "bandwidth-clock")
+        with self._lock("bandwidth.lock"):
+            now = time.time()
+            try:
+                with codecs.open(clock_filename, 'r', 'utf-8') as f:
+                    next_free = float(f.read().strip())
+            except (IOError, OSError, ValueError):
+                next_free = 0.0
+            if not (next_free <= now + _MAX_SECONDS_AHEAD):
+                # also catches inf and nan
+                next_free = now + _MAX_SECONDS_AHEAD
+            start = max(now - _BURST_SECONDS, next_free)
+            next_free = start + float(byte_count) / self.max_bytes_per_second
+            try:
+                with codecs.open(clock_filename, 'w', 'utf-8') as f:
+                    f.write(repr(next_free))
+            except (IOError, OSError):
+                # still throttle ourselves even if we can't share the clock
+                pass
+        return max(0.0, next_free - now)
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------------
+# Copyright © 2016, Continuum Analytics, Inc. All rights reserved.
+#
+# The full license is in the file LICENSE.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import absolute_import, print_function
+
+import codecs
+import errno
+import os
+
+
+# file systems with coarse timestamps (FAT has 2 second resolution)
+# can record an mtime a little before the write really happened
+_MTIME_SLACK_SECONDS = 2.0
+
+
+def read_pidfile(pidfile, written_since=None):
+    """Get the pid from a pidfile, or None if it's missing or garbled.
+
+    If ``written_since`` is a ``time.time()`` value, a pidfile last
+    modified before then is left over from some earlier process and
+    is treated as missing.
+    """
+    try:
+        if written_since is not None and os.stat(pidfile).st_mtime < written_since - _MTIME_SLACK_SECONDS:
+            return None
+        with codecs.open(pidfile, 'r', 'utf-8') as f:
+            return int(f.read().strip())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def process_is_alive(pid):
+    """Check whether a process exists and hasn't exited."""
+    if os.name == 'nt':  # pragma: no cover (windows only)
+        # no cheap way to check, so callers rely on probes and timeouts
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # EPERM means it exists but belongs to someone else
+        return e.errno == errno.EPERM
+    # a daemon that died can linger as a zombie until init reaps it
+    try:
+        with codecs.open("/proc/%d/stat" % pid, 'r', 'utf-8') as f:
+            # the state comes after the parenthesized command name
+            return f.read().rsplit(")", 1)[1].split()[0] != 'Z'
+    except (IOError, OSError, IndexError):
+        return True
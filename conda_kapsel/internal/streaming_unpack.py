@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------------
+# Copyright © 2016, Continuum Analytics, Inc. All rights reserved.
+#
+# The full license is in the file LICENSE.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import absolute_import, print_function
+
+import bz2
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import zlib
+
+try:
+    import queue
+except ImportError:  # pragma: no cover (py2 only)
+    import Queue as queue  # pragma: no cover (py2 only)
+
+from conda_kapsel.internal import rename
+from conda_kapsel.internal.makedirs import makedirs_ok_if_exists
+from conda_kapsel.internal.ziputils import move_unpacked_into_place
+
+_TAR_MODES = {'tar': 'r|', 'tar.gz': 'r|gz', 'tar.bz2': 'r|bz2', 'tar.xz': 'r|xz'}
+
+_SINGLE_FILE_FORMATS = ('gz', 'bz2', 'xz')
+
+# formats we can unpack while the bytes are still arriving
+# (zip can't be streamed since its directory is at the end)
+STREAMING_FORMATS = tuple(sorted(_TAR_MODES.keys())) + _SINGLE_FILE_FORMATS
+
+
+def _decompressor_for(archive_format):
+    if archive_format == 'gz':
+        # 16 + MAX_WBITS means expect a gzip header
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif archive_format == 'bz2':
+        return bz2.BZ2Decompressor()
+    else:
+        assert archive_format == 'xz'
+        import lzma  # py3 only
+        return lzma.LZMADecompressor()
+
+
+class _ConcatenatedDecompressor(object):
+    """Decompress a stream of one or more concatenated compressed members.
+
+    gzip, bzip2 and xz all allow several members back to back (what
+    ``cat a.gz b.gz`` or pigz/pbzip2 produce), but each decompressor
+    object stops at the end of the first one and leaves the rest in
+    ``unused_data``, so we start a fresh decompressor for each member.
+    """
+
+    def __init__(self, archive_format):
+        self._archive_format = archive_format
+        self._current = _decompressor_for(archive_format)
+
+    def _member_ended(self):
+        # py2 zlib has no eof attribute, but leftover input means the member ended
+        return getattr(self._current, 'eof', False) or len(self._current.unused_data) > 0
+
+    def decompress(self, data):
+        pieces = []
+        while len(data) > 0:
+            if self._member_ended():
+                self._current = _decompressor_for(self._archive_format)
+            pieces.append(self._current.decompress(data))
+            data = self._current.unused_data
+        return b''.join(pieces)
+
+    def flush(self):
+        if hasattr(self._current, 'flush'):
+            return self._current.flush()
+        else:
+            return b''
+
+    @property
+    def eof(self):
+        return getattr(self._current, 'eof', True)
+
+
+class _ChunkPipe(object):
+    """A bounded file-like pipe from a chunk producer to a reader thread."""
+
+    def __init__(self, max_chunks=16):
+        # bounded so a slow unpacker applies backpressure to the download
+        self._queue = queue.Queue(maxsize=max_chunks)
+        self._current = b''
+        self._offset = 0
+        self._eof = False
+
+    def write(self, chunk):
+        if len(chunk) > 0:
+            self._queue.put(chunk)
+
+    def close(self):
+        self._queue.put(None)
+
+    def _next_chunk(self):
+        chunk = self._queue.get()
+        if chunk is None:
+            self._eof = True
+        else:
+            self._current = chunk
+            self._offset = 0
+
+    def read(self, size=-1):
+        pieces = []
+        while size != 0:
+            if self._offset >= len(self._current):
+                if self._eof:
+                    break
+                self._next_chunk()
+                continue
+            available = len(self._current) - self._offset
+            if size < 0 or size >= available:
+                take = available
+            else:
+                take = size
+            pieces.append(self._current[self._offset:self._offset + take])
+            self._offset += take
+            if size > 0:
+                size -= take
+        return b''.join(pieces)
+
+    def drain(self):
+        # consume until the producer closes, so it never blocks on a full queue
+        while not self._eof:
+            self._next_chunk()
+
+
+def _member_is_safe(member, dest):
+    dest = os.path.realpath(dest)
+
+    def inside(path):
+        resolved = os.path.realpath(os.path.join(dest, path))
+        return resolved == dest or resolved.startswith(dest + os.sep)
+
+    if os.path.isabs(member.name) or not inside(member.name):
+        return False
+    if member.issym() and not inside(os.path.join(os.path.dirname(member.name), member.linkname)):
+        return False
+    if member.islnk() and not inside(member.linkname):
+        return False
+    if member.isdev():
+        return False
+    return True
+
+
+class StreamingUnpacker(object):
+    """Unpack an archive from chunks as they are downloaded.
+
+    Tar archives are extracted on a worker thread into a temporary
+    directory next to ``target_path``; single compressed files are
+    decompressed into ``target_path + ".part"``. Nothing is moved to
+    ``target_path`` until ``commit()``, so a failed download or hash
+    mismatch can still be thrown away with ``discard()``.
+    """
+
+    def __init__(self, target_path, archive_format):
+        """Create an unpacker for the given format (one of ``STREAMING_FORMATS``)."""
+        assert archive_format in STREAMING_FORMATS
+        self._target_path = target_path
+        self._archive_format = archive_format
+        self._errors = []
+        self._finished = False
+        self._tmp_path = None
+        self._thread = None
+        self._file = None
+
+        makedirs_ok_if_exists(os.path.dirname(target_path))
+        if archive_format in _TAR_MODES:
+            self._tmp_path = tempfile.mkdtemp(prefix=(target_path + "_tmp"), dir=os.path.dirname(target_path))
+            self._pipe = _ChunkPipe()
+            self._thread = threading.Thread(target=self._extract_tar)
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            self._tmp_path = target_path + ".part"
+            self._decompressor = _ConcatenatedDecompressor(archive_format)
+            self._file = open(self._tmp_path, 'wb')
+
+    def _extract_tar(self):
+        try:
+            with tarfile.open(fileobj=self._pipe, mode=_TAR_MODES[self._archive_format]) as tf:
+
+                def safe_members():
+                    for member in tf:
+                        if not _member_is_safe(member, self._tmp_path):
+                            raise ValueError("archive member %s would be unpacked outside of %s" %
+                                             (member.name, self._target_path))
+                        yield member
+
+                if hasattr(tarfile, 'data_filter'):
+                    tf.extractall(self._tmp_path, members=safe_members(), filter='data')
+                else:  # pragma: no cover (older pythons)
+                    tf.extractall(self._tmp_path, members=safe_members())
+        except Exception as e:
+            self._errors.append("Failed to unpack %s: %s" % (self._target_path, str(e)))
+        finally:
+            self._pipe.drain()
+
+    @property
+    def errors(self):
+        """List of errors from unpacking, empty if everything went fine so far."""
+        return self._errors
+
+    def write(self, chunk):
+        """Feed the next chunk of the archive; errors are recorded rather than raised."""
+        assert not self._finished
+        if self._thread is not None:
+            self._pipe.write(chunk)
+        elif len(self._errors) == 0:
+            try:
+                self._file.write(self._decompressor.decompress(chunk))
+            except Exception as e:
+                self._errors.append("Failed to decompress %s: %s" % (self._target_path, str(e)))
+
+    def finish(self):
+        """Signal the end of the archive and wait for unpacking to complete.
+
+        Returns:
+            True if the whole archive was unpacked
+        """
+        if not self._finished:
+            self._finished = True
+            if self._thread is not None:
+                self._pipe.close()
+                self._thread.join()
+            else:
+                try:
+                    if len(self._errors) == 0:
+                        self._file.write(self._decompressor.flush())
+                        if not self._decompressor.eof:
+                            self._errors.append("Failed to decompress %s: compressed data ended early" %
+                                                self._target_path)
+                finally:
+                    self._file.close()
+        return len(self._errors) == 0
+
+    def commit(self, errors):
+        """Move the unpacked content to the target path.
+
+        Returns:
+            True on success, otherwise False and ``errors`` is appended to
+        """
+        try:
+            if not self.finish():
+                errors.extend(self._errors)
+                return False
+            elif self._thread is not None:
+                return move_unpacked_into_place(self._tmp_path, self._target_path, errors,
+                                                archive_description="Archive")
+            elif os.path.isdir(self._target_path):
+                errors.append("%s exists and is a directory, not unzipping a plain file over it." % self._target_path)
+                return False
+            else:
+                rename.rename_over_existing(self._tmp_path, self._target_path)
+                return True
+        except EnvironmentError as e:
+            errors.append("Failed to move unpacked %s into place: %s" % (self._target_path, str(e)))
+            return False
+        finally:
+            self.discard()
+
+    def discard(self):
+        """Throw away anything unpacked so far (does nothing after a commit)."""
+        self.finish()
+        try:
+            if os.path.isdir(self._tmp_path):
+                shutil.rmtree(path=self._tmp_path)
+            elif os.path.isfile(self._tmp_path):
+                os.remove(self._tmp_path)
+        except EnvironmentError:
+            pass
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------------
+# Copyright © 2016, Continuum Analytics, Inc. All rights reserved.
+#
+# The full license is in the file LICENSE.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import absolute_import, print_function
+
+import logging
+
+from conda_kapsel.internal.download_progress import (DownloadProgress, add_progress_listener,
+                                                     remove_progress_listener, report_progress)
+from conda_kapsel.verbose import push_verbose_logger, pop_verbose_logger
+
+
+def test_progress_with_total():
+    progress = DownloadProgress(url="http://example.com/data.csv",
+                                filename="/tmp/data.csv",
+                                bytes_done=1024 * 1024,
+                                bytes_total=4 * 1024 * 1024,
+                                elapsed=2.0)
+    assert progress.rate == 512 * 1024
+    assert progress.fraction == 0.25
+    assert progress.eta == 6.0
+    assert progress.format_line() == "Downloading data.csv: 1.0M of 4.0M (25%) at 512.0K/s, 00:06 remaining"
+
+
+def test_progress_without_total():
+    progress = DownloadProgress(url="http://example.com/data.csv",
+                                filename="/tmp/data.csv",
+                                bytes_done=100,
+                                bytes_total=None,
+                                elapsed=0.0)
+    assert progress.rate is None
+    assert progress.fraction is None
+    assert progress.eta is None
+    assert progress.format_line() == "Downloading data.csv: 100B"
+
+
+def test_progress_finished_and_failed():
+    finished = DownloadProgress(url="http://example.com/data.csv",
+                                filename="/tmp/data.csv",
+                                bytes_done=2048,
+                                bytes_total=2048,
+                                elapsed=3700.0,
+                                finished=True)
+    assert finished.format_line() == "Downloading data.csv: 2.0K of 2.0K (100%) at 0B/s, done in 1:01:40"
+    failed = DownloadProgress(url="http://example.com/data.csv",
+                              filename="/tmp/data.csv",
+                              bytes_done=10,
+                              bytes_total=None,
+                              elapsed=1.0,
+                              finished=True,
+                              failed=True)
+    assert failed.format_line() == "Downloading data.csv: 10B at 10B/s, failed"
+    json = failed.to_json()
+    assert json['failed']
+    assert json['finished']
+    assert json['rate'] == 10.0
+    assert json['line'] == failed.format_line()
+
+
+def test_report_progress_to_listeners_and_verbose_logger():
+    received = []
+    progress = DownloadProgress(url="http://example.com/data.csv",
+                                filename="/tmp/data.csv",
+                                bytes_done=10,
+                                bytes_total=10,
+                                elapsed=1.0,
+                                finished=True)
+
+    class Handler(logging.Handler):
+        def __init__(self):
+            super(Handler, self).__init__()
+            self.messages = []
+
+        def emit(self, record):
+            self.messages.append(record.getMessage())
+
+    logger = logging.getLogger(name='test_download_progress')
+    logger.setLevel(logging.DEBUG)
+    handler = Handler()
+    logger.addHandler(handler)
+
+    add_progress_listener(received.append)
+    push_verbose_logger(logger)
+    try:
+        report_progress(progress)
+    finally:
+        pop_verbose_logger()
+        remove_progress_listener(received.append)
+        logger.removeHandler(handler)
+
+    assert received == [progress]
+    assert handler.messages == ["Downloaded /tmp/data.csv from http://example.com/data.csv: " +
+                                "10 bytes in 1.00 seconds (10B/s)"]
+
+    # no longer listening
+    report_progress(progress)
+    assert received == [progress]
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------------
+# Copyright © 2016, Continuum Analytics, Inc. All rights reserved.
+#
+# The full license is in the file LICENSE.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import absolute_import, print_function
+
+import os
+import platform
+import stat
+
+import pytest
+
+from conda_kapsel.internal.file_lock import FileLock, user_lock_directory
+from conda_kapsel.internal.test.tmpfile_utils import with_directory_contents
+
+
+def test_lock_excludes_other_lockers():
+    def check(dirname):
+        filename = os.path.join(dirname, "subdir", "foo.lock")
+        first = FileLock(filename)
+        second = FileLock(filename)
+        assert first.filename == filename
+        assert first.try_acquire()
+        assert first.locked
+        assert os.path.isfile(filename)
+        assert not second.try_acquire()
+        assert not second.acquire(timeout=0.2, poll_interval=0.05)
+        assert not second.locked
+        first.release()
+        assert not first.locked
+        assert second.try_acquire()
+        second.release()
+        # releasing twice is harmless
+        second.release()
+
+    with_directory_contents(dict(), check)
+
+
+def test_lock_as_context_manager():
+    def check(dirname):
+        filename = os.path.join(dirname, "foo.lock")
+        with FileLock(filename) as lock:
+            assert lock.locked
+            assert not FileLock(filename).try_acquire()
+        assert not lock.locked
+        assert FileLock(filename).acquire(timeout=0)
+
+    with_directory_contents(dict(), check)
+
+
+@pytest.mark.skipif(platform.system() == 'Windows', reason="user lock directories are shared on Windows")
+def test_user_lock_directory_is_private(monkeypatch):
+    def check(dirname):
+        monkeypatch.setattr('tempfile.gettempdir', lambda: dirname)
+        path = user_lock_directory("kapsel-test")
+        assert path == os.path.join(dirname, "kapsel-test-%d" % os.getuid())
+        assert stat.S_IMODE(os.lstat(path).st_mode) == 0o700
+
+        # an existing directory of ours gets locked down
+        os.chmod(path, 0o777)
+        assert path == user_lock_directory("kapsel-test")
+        assert stat.S_IMODE(os.lstat(path).st_mode) == 0o700
+
+    with_directory_contents(dict(), check)
+
+
+@pytest.mark.skipif(platform.system() == 'Windows', reason="user lock directories are shared on Windows")
+def test_user_lock_directory_refuses_planted_paths(monkeypatch):
+    def check(dirname):
+        monkeypatch.setattr('tempfile.gettempdir', lambda: dirname)
+        elsewhere = os.path.join(dirname, "elsewhere")
+        os.mkdir(elsewhere)
+        os.symlink(elsewhere, os.path.join(dirname, "kapsel-link-%d" % os.getuid()))
+        with open(os.path.join(dirname, "kapsel-file-%d" % os.getuid()), 'w') as f:
+            f.write("not a directory")
+
+        for name in ("kapsel-link", "kapsel-file"):
+            with pytest.raises(OSError) as excinfo:
+                user_lock_directory(name)
+            assert "not a directory owned by the current user" in str(excinfo.value)
+
+    with_directory_contents(dict(), check)
+
+
+@pytest.mark.skipif(not hasattr(os, 'geteuid') or os.geteuid() != 0, reason="need to be root to chown")
+def test_user_lock_directory_refuses_someone_elses_directory(monkeypatch):
+    def check(dirname):
+        monkeypatch.setattr('tempfile.gettempdir', lambda: dirname)
+        path = os.path.join(dirname, "kapsel-theirs-%d" % os.getuid())
+        os.mkdir(path)
+        os.chown(path, 12345, 12345)
+        with pytest.raises(OSError) as excinfo:
+            user_lock_directory("kapsel-theirs")
+        assert "not a directory owned by the current user" in str(excinfo.value)
+
+    with_directory_contents(dict(), check)
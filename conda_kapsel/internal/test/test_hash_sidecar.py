@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------------
+# Copyright © 2016, Continuum Analytics, Inc. All rights reserved.
+#
+# The full license is in the file LICENSE.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import absolute_import, print_function
+
+import hashlib
+import os
+
+from conda_kapsel.internal.hash_sidecar import (compute_file_hash, cached_file_hash, read_sidecar, write_sidecar,
+                                                remove_sidecar, sidecar_filename)
+import conda_kapsel.internal.hash_sidecar as hash_sidecar
+from conda_kapsel.internal.test.tmpfile_utils import with_directory_contents
+
+
+def test_compute_file_hash():
+    def check(dirname):
+        filename = os.path.join(dirname, "foo")
+        assert compute_file_hash(filename, 'sha256') == hashlib.sha256(b'hello world').hexdigest()
+
+    with_directory_contents(dict(foo='hello world'), check)
+
+
+def test_compute_file_hash_empty_file():
+    def check(dirname):
+        filename = os.path.join(dirname, "foo")
+        assert compute_file_hash(filename, 'md5') == hashlib.md5(b'').hexdigest()
+
+    with_directory_contents(dict(foo=''), check)
+
+
+def test_compute_file_hash_multiple_chunks(monkeypatch):
+    monkeypatch.setattr('conda_kapsel.internal.hash_sidecar._CHUNK_SIZE', 3)
+
+    def check(dirname):
+        filename = os.path.join(dirname, "foo")
+        assert compute_file_hash(filename, 'sha1') == hashlib.sha1(b'abcdefghij').hexdigest()
+
+    with_directory_contents(dict(foo='abcdefghij'), check)
+
+
+def test_cached_file_hash_writes_and_uses_sidecar(monkeypatch):
+    def check(dirname):
+        filename = os.path.join(dirname, "foo")
+        assert read_sidecar(filename) is None
+        expected = hashlib.md5(b'hello').hexdigest()
+        assert cached_file_hash(filename, 'md5') == expected
+        sidecar = read_sidecar(filename)
+        assert sidecar['digest'] == expected
+        assert sidecar['algorithm'] == 'md5'
+        assert sidecar['size'] == 5
+
+        hashes = []
+
+        def mock_compute_file_hash(filename, algorithm):
+            hashes.append(filename)
+            return 'computed'
+
+        monkeypatch.setattr(hash_sidecar, 'compute_file_hash', mock_compute_file_hash)
+        assert cached_file_hash(filename, 'md5') == expected
+        assert hashes == []
+
+        # a different algorithm can't use the sidecar
+        assert cached_file_hash(filename, 'sha1') == 'computed'
+        assert hashes == [filename]
+
+    with_directory_contents(dict(foo='hello'), check)
+
+
+def test_cached_file_hash_rehashes_modified_file():
+    def check(dirname):
+        filename = os.path.join(dirname, "foo")
+        write_sidecar(filename, 'md5', 'stale')
+        with open(filename, 'w') as f:
+            f.write('goodbye')
+        assert cached_file_hash(filename, 'md5') == hashlib.md5(b'goodbye').hexdigest()
+
+    with_directory_contents(dict(foo='hello'), check)
+
+
+def test_read_corrupted_sidecar():
+    def check(dirname):
+        filename = os.path.join(dirname, "foo")
+        assert read_sidecar(filename) is None
+        assert cached_file_hash(filename, 'md5') == hashlib.md5(b'hello').hexdigest()
+
+    with_directory_contents({'foo': 'hello', 'foo' + hash_sidecar.SIDECAR_SUFFIX: '{not json'}, check)
+
+
+def test_write_sidecar_missing_file():
+    def check(dirname):
+        assert not write_sidecar(os.path.join(dirname, "nope"), 'md5', 'abc')
+        assert not os.path.exists(sidecar_filename(os.path.join(dirname, "nope")))
+
+    with_directory_contents(dict(), check)
+
+
+def test_remove_sidecar():
+    def check(dirname):
+        filename = os.path.join(dirname, "foo")
+        assert write_sidecar(filename, 'md5', 'abc')
+        assert os.path.isfile(sidecar_filename(filename))
+        remove_sidecar(filename)
+        assert not os.path.exists(sidecar_filename(filename))
+        # no error if it's already gone
+        remove_sidecar(filename)
+
+    with_directory_contents(dict(foo='hello'), check)
@@ -6,16 +6,18 @@
 # ----------------------------------------------------------------------------
 from __future__ import absolute_import, print_function
 
-from conda_kapsel.internal.http_client import FileDownloader
+from conda_kapsel.internal.download_progress import add_progress_listener, remove_progress_listener
+from conda_kapsel.internal.http_client import FileDownloader, MirrorProber
 from conda_kapsel.internal.test.http_server import HttpServerTestContext
 from conda_kapsel.internal.test.tmpfile_utils import with_directory_contents
 
-from tornado.ioloop import IOLoop
+from tornado.ioloop import IOLoop, PeriodicCallback
 
 import os
 import sys
 import platform
 import stat
+import time
 
 
 def _download_file(length, hash_algorithm):
@@ -82,6 +84,78 @@ def test_download_has_http_error():
     with_directory_contents(dict(), inside_directory_get_http_error)
 
 
+def test_download_reports_progress():
+    def inside_directory_download_file(dirname):
+        filename = os.path.join(dirname, "downloaded-file")
+        events = []
+        add_progress_listener(events.append)
+        try:
+            with HttpServerTestContext() as server:
+                url = server.new_download_url(download_length=1024 * 1024, hash_algorithm=None)
+                download = FileDownloader(url=url, filename=filename)
+                IOLoop.current().run_sync(lambda: download.run(IOLoop.current()))
+                assert [] == download.errors
+        finally:
+            remove_progress_listener(events.append)
+
+        assert len(events) > 0
+        assert events[-1].finished
+        assert not events[-1].failed
+        assert events[-1].bytes_done == 1024 * 1024
+        assert events[-1].bytes_total == 1024 * 1024
+        assert [e for e in events if e.finished] == [events[-1]]
+
+    with_directory_contents(dict(), inside_directory_download_file)
+
+
+def test_download_throttles_without_blocking_io_loop():
+    def inside_directory_download_file(dirname):
+        filename = os.path.join(dirname, "downloaded-file")
+        reserved = []
+
+        class FakeBudget(object):
+            max_transfers = None
+
+            def reserve(self, byte_count):
+                reserved.append(byte_count)
+                return 0.05
+
+        ticks = []
+        timer = PeriodicCallback(lambda: ticks.append(time.time()), 5)
+        with HttpServerTestContext() as server:
+            url = server.new_download_url(download_length=1024 * 1024, hash_algorithm=None)
+            download = FileDownloader(url=url, filename=filename, budget=FakeBudget())
+            timer.start()
+            start = time.time()
+            try:
+                IOLoop.current().run_sync(lambda: download.run(IOLoop.current()))
+            finally:
+                timer.stop()
+            assert [] == download.errors
+
+        # we paused after every batch, but the loop kept running meanwhile
+        assert len(reserved) >= 3
+        assert all(byte_count >= 256 * 1024 for byte_count in reserved)
+        assert time.time() - start >= 0.05 * len(reserved)
+        assert len([tick for tick in ticks if tick >= start]) >= 2 * len(reserved)
+        assert os.stat(filename).st_size == 1024 * 1024
+
+    with_directory_contents(dict(), inside_directory_download_file)
+
+
+def test_probe_mirrors():
+    with HttpServerTestContext() as server:
+        big_url = server.new_download_url(download_length=1024 * 1024, hash_algorithm=None)
+        small_url = server.new_download_url(download_length=10, hash_algorithm=None)
+        prober = MirrorProber(urls=[server.error_url, big_url, small_url], probe_bytes=1024)
+        ranked = IOLoop.current().run_sync(lambda: prober.run(IOLoop.current()))
+        # the test server ignores Range, but we stop reading after probe_bytes
+        assert sorted(ranked) == sorted([big_url, small_url])
+        assert set(prober.timings.keys()) == set([big_url, small_url])
+        assert len(prober.errors) == 1
+        assert prober.errors[0].startswith("Mirror %s did not respond: " % server.error_url)
+
+
 def test_download_fail_to_create_directory(monkeypatch):
     def inside_directory_fail_to_create_directory(dirname):
         def mock_makedirs(name):
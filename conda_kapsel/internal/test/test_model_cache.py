@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------------
+# Copyright © 2016, Continuum Analytics, Inc. All rights reserved.
+#
+# The full license is in the file LICENSE.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import absolute_import
+
+import os
+
+from conda_kapsel.internal import model_cache
+from conda_kapsel.internal.test.tmpfile_utils import with_directory_contents
+
+
+class _FakeRegistry(object):
+    pass
+
+
+def test_default_model_cache_directory(monkeypatch):
+    monkeypatch.setenv(model_cache.MODEL_CACHE_VARIABLE, '/foo/models')
+    assert '/foo/models' == model_cache.default_model_cache_directory()
+    monkeypatch.setenv(model_cache.MODEL_CACHE_VARIABLE, '')
+    assert model_cache.default_model_cache_directory() is None
+    monkeypatch.delenv(model_cache.MODEL_CACHE_VARIABLE)
+    monkeypatch.setenv('XDG_CACHE_HOME', '/cache')
+    assert os.path.join('/cache', 'conda-kapsel', 'models') == model_cache.default_model_cache_directory()
+
+
+def test_model_key_covers_texts_and_files():
+    def check(dirname):
+        filename = os.path.join(dirname, 'environment.yml')
+        missing = os.path.join(dirname, 'requirements.txt')
+        key = model_cache.model_key(dirname, ['a: b'], [filename, missing])
+        assert key == model_cache.model_key(dirname, ['a: b'], [filename, missing])
+        assert key != model_cache.model_key(dirname, ['a: c'], [filename, missing])
+        assert key != model_cache.model_key(dirname + "2", ['a: b'], [filename, missing])
+
+        with open(filename, 'w') as f:
+            f.write('changed')
+        assert key != model_cache.model_key(dirname, ["a: b"], [filename, missing])
+
+    with_directory_contents({'environment.yml': 'name: foo'}, check)
+
+
+def test_save_and_load_model():
+    def check(dirname):
+        cache_directory = os.path.join(dirname, 'cache')
+        saving_registry = _FakeRegistry()
+        loading_registry = _FakeRegistry()
+        model = dict(name='foo', things=[saving_registry, 42])
+
+        assert model_cache.load_model(cache_directory, '/project', 'key', loading_registry) is None
+
+        model_cache.save_model(cache_directory, '/project', 'key', model, saving_registry)
+        loaded = model_cache.load_model(cache_directory, '/project', 'key', loading_registry)
+        assert 'foo' == loaded['name']
+        assert loaded['things'][0] is loading_registry
+        assert 42 == loaded['things'][1]
+
+        assert model_cache.load_model(cache_directory, '/project', 'other key', loading_registry) is None
+        assert model_cache.load_model(cache_directory, '/other', 'key', loading_registry) is None
+
+        # a new key replaces the old one
+        model_cache.save_model(cache_directory, '/project', 'new key', dict(name='bar'), saving_registry)
+        assert model_cache.load_model(cache_directory, '/project', 'key', loading_registry) is None
+        assert 'bar' == model_cache.load_model(cache_directory, '/project', 'new key', loading_registry)['name']
+        assert 1 == len(os.listdir(cache_directory))
+
+    with_directory_contents(dict(), check)
+
+
+def test_load_garbage_model():
+    def check(dirname):
+        cache_directory = os.path.join(dirname, 'cache')
+        model_cache.save_model(cache_directory, '/project', 'key', dict(), _FakeRegistry())
+        [name] = os.listdir(cache_directory)
+        with open(os.path.join(cache_directory, name), 'wb') as f:
+            f.write(b'not a pickle')
+        assert model_cache.load_model(cache_directory, '/project', 'key', _FakeRegistry()) is None
+
+    with_directory_contents(dict(), check)
+
+
+def test_save_model_unpicklable():
+    def check(dirname):
+        cache_directory = os.path.join(dirname, 'cache')
+        model_cache.save_model(cache_directory, '/project', 'key', dict(f=lambda: None), _FakeRegistry())
+        assert [] == os.listdir(cache_directory)
+        assert model_cache.load_model(cache_directory, '/project', 'key', _FakeRegistry()) is None
+
+    with_directory_contents(dict(), check)
+
+
+def test_save_model_prunes_old_entries(monkeypatch):
+    monkeypatch.setattr('conda_kapsel.internal.model_cache._MAX_ENTRIES', 3)
+
+    def check(dirname):
+        cache_directory = os.path.join(dirname, 'cache')
+        for i in range(5):
+            model_cache.save_model(cache_directory, '/project%d' % i, 'key', dict(i=i), _FakeRegistry())
+            filename = model_cache._entry_filename(cache_directory, '/project%d' % i)
+            os.utime(filename, (1000 + i, 1000 + i))
+        assert 3 == len(os.listdir(cache_directory))
+        assert model_cache.load_model(cache_directory, '/project0', 'key', _FakeRegistry()) is None
+        assert 4 == model_cache.load_model(cache_directory, '/project4', 'key', _FakeRegistry())['i']
+
+    with_directory_contents(dict(), check)
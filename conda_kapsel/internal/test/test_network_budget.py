@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------------
+# Copyright © 2016, Continuum Analytics, Inc. All rights reserved.
+#
+# The full license is in the file LICENSE.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import absolute_import, print_function
+
+import os
+
+from conda_kapsel.internal.network_budget import (NetworkBudget, default_budget_directory,
+                                                  MAX_BYTES_PER_SECOND_VARIABLE, MAX_TRANSFERS_VARIABLE,
+                                                  BUDGET_DIRECTORY_VARIABLE)
+from conda_kapsel.internal.test.tmpfile_utils import with_directory_contents
+
+
+def test_no_budget_in_environ():
+    assert NetworkBudget.from_environ(dict()) is None
+
+
+def test_budget_from_environ():
+    budget = NetworkBudget.from_environ({MAX_BYTES_PER_SECOND_VARIABLE: '1.5M', MAX_TRANSFERS_VARIABLE: '3'})
+    assert budget.max_bytes_per_second == 1024 * 1024 * 3 // 2
+    assert budget.max_transfers == 3
+    assert budget._directory == default_budget_directory()
+
+    budget = NetworkBudget.from_environ({MAX_BYTES_PER_SECOND_VARIABLE: '2048', BUDGET_DIRECTORY_VARIABLE: '/foo'})
+    assert budget.max_bytes_per_second == 2048
+    assert budget.max_transfers is None
+    assert budget._directory == '/foo'
+
+    budget = NetworkBudget.from_environ({MAX_BYTES_PER_SECOND_VARIABLE: '100kb'})
+    assert budget.max_bytes_per_second == 100 * 1024
+
+
+def test_invalid_budget_in_environ(monkeypatch, capsys):
+    monkeypatch.setattr('conda_kapsel.internal.network_budget._reported_invalid', set())
+    budget = NetworkBudget.from_environ({MAX_BYTES_PER_SECOND_VARIABLE: 'fast', MAX_TRANSFERS_VARIABLE: '0'})
+    assert budget is None
+    out, err = capsys.readouterr()
+    assert ("Ignoring invalid %s=fast\nIgnoring invalid %s=0\n" %
+            (MAX_BYTES_PER_SECOND_VARIABLE, MAX_TRANSFERS_VARIABLE)) == err
+
+    # every download loads the budget, but we only complain once
+    assert NetworkBudget.from_environ({MAX_BYTES_PER_SECOND_VARIABLE: 'fast', MAX_TRANSFERS_VARIABLE: '0'}) is None
+    assert ('', '') == capsys.readouterr()
+
+
+def test_transfer_slots():
+    def check(dirname):
+        budget = NetworkBudget(os.path.join(dirname, "budget"), max_transfers=2)
+        # a second process would see the same lock files
+        other = NetworkBudget(os.path.join(dirname, "budget"), max_transfers=2)
+        first = budget.try_acquire_transfer()
+        second = other.try_acquire_transfer()
+        assert first is not None
+        assert second is not None
+        assert budget.try_acquire_transfer() is None
+        second.release()
+        third = budget.acquire_transfer()
+        assert third.filename == second.filename
+        third.release()
+        first.release()
+
+    with_directory_contents(dict(), check)
+
+
+def test_bandwidth_is_shared():
+    def check(dirname):
+        budget = NetworkBudget(os.path.join(dirname, "budget"), max_bytes_per_second=1000)
+        other = NetworkBudget(os.path.join(dirname, "budget"), max_bytes_per_second=1000)
+        # we get to burst a second's worth from idle
+        assert budget.reserve(500) == 0.0
+        assert other.reserve(500) == 0.0
+        # now we're at the limit, so the next 1000 bytes cost a second
+        delay = budget.reserve(1000)
+        assert 0.9 < delay <= 1.0
+        delay = other.reserve(1000)
+        assert 1.9 < delay <= 2.0
+
+        assert budget.reserve(0) == 0.0
+        assert NetworkBudget(os.path.join(dirname, "budget"), max_transfers=1).reserve(1000) == 0.0
+
+    with_directory_contents(dict(), check)
+
+
+def test_bandwidth_clock_from_the_far_future_is_clamped():
+    def check(dirname):
+        budget = NetworkBudget(os.path.join(dirname, "budget"), max_bytes_per_second=1000)
+        assert budget.reserve(500) == 0.0
+        clock_filename = os.path.join(dirname, "budget", "bandwidth-clock")
+        for bogus in ("1e300", "inf", "nan"):
+            # another user could write anything here
+            with open(clock_filename, 'w') as f:
+                f.write(bogus)
+            delay = budget.reserve(1000)
+            assert 60.9 < delay <= 61.0
+
+    with_directory_contents(dict(), check)
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------------
+# Copyright © 2016, Continuum Analytics, Inc. All rights reserved.
+#
+# The full license is in the file LICENSE.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import absolute_import, print_function
+
+import bz2
+import codecs
+import gzip
+import io
+import lzma
+import os
+import tarfile
+
+from conda_kapsel.internal.streaming_unpack import StreamingUnpacker
+from conda_kapsel.internal.test.tmpfile_utils import with_directory_contents
+
+
+def _tarball(contents, mode):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode=mode) as tf:
+        for name, data in sorted(contents.items()):
+            data = data.encode('utf-8')
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def _feed(unpacker, data, chunk_size=7):
+    for i in range(0, len(data), chunk_size):
+        unpacker.write(data[i:i + chunk_size])
+
+
+def _read(path):
+    with codecs.open(path, 'r', 'utf-8') as f:
+        return f.read()
+
+
+def _unpack_tarball(archive_format, mode):
+    def check(dirname):
+        target = os.path.join(dirname, "data")
+        unpacker = StreamingUnpacker(target, archive_format)
+        _feed(unpacker, _tarball({'foo': 'hello\n', 'bar/baz': 'world\n'}, mode))
+        # nothing in place until we commit
+        assert not os.path.exists(target)
+        errors = []
+        assert unpacker.commit(errors)
+        assert [] == errors
+        assert _read(os.path.join(target, 'foo')) == 'hello\n'
+        assert _read(os.path.join(target, 'bar', 'baz')) == 'world\n'
+        assert os.listdir(dirname) == ['data']
+
+    with_directory_contents(dict(), check)
+
+
+def test_unpack_tar():
+    _unpack_tarball('tar', 'w')
+
+
+def test_unpack_tar_gz():
+    _unpack_tarball('tar.gz', 'w:gz')
+
+
+def test_unpack_tar_bz2():
+    _unpack_tarball('tar.bz2', 'w:bz2')
+
+
+def test_unpack_tar_xz():
+    _unpack_tarball('tar.xz', 'w:xz')
+
+
+def test_unpack_tarball_with_single_toplevel_dir_matching_target():
+    def check(dirname):
+        target = os.path.join(dirname, "data")
+        unpacker = StreamingUnpacker(target, 'tar.gz')
+        _feed(unpacker, _tarball({'data/foo': 'hello\n'}, 'w:gz'), chunk_size=1024)
+        errors = []
+        assert unpacker.commit(errors)
+        assert _read(os.path.join(target, 'foo')) == 'hello\n'
+
+    with_directory_contents(dict(), check)
+
+
+def test_unpack_corrupt_tarball():
+    def check(dirname):
+        target = os.path.join(dirname, "data")
+        unpacker = StreamingUnpacker(target, 'tar.gz')
+        _feed(unpacker, b'this is not gzip data' * 100)
+        errors = []
+        assert not unpacker.commit(errors)
+        assert len(errors) == 1
+        assert errors[0].startswith("Failed to unpack %s: " % target)
+        assert os.listdir(dirname) == []
+
+    with_directory_contents(dict(), check)
+
+
+def test_unpack_tarball_with_member_outside_target():
+    def check(dirname):
+        target = os.path.join(dirname, "data")
+        unpacker = StreamingUnpacker(target, 'tar')
+        _feed(unpacker, _tarball({'../evil': 'gotcha\n'}, 'w'))
+        errors = []
+        assert not unpacker.commit(errors)
+        assert len(errors) == 1
+        assert "outside" in errors[0]
+        assert os.listdir(dirname) == []
+
+    with_directory_contents(dict(), check)
+
+
+def test_discard_tarball():
+    def check(dirname):
+        target = os.path.join(dirname, "data")
+        unpacker = StreamingUnpacker(target, 'tar')
+        # we give up halfway through
+        _feed(unpacker, _tarball({'foo': 'hello\n' * 1000}, 'w')[:2000])
+        unpacker.discard()
+        assert os.listdir(dirname) == []
+        # discarding twice is fine
+        unpacker.discard()
+
+    with_directory_contents(dict(), check)
+
+
+def test_decompress_gz():
+    def check(dirname):
+        target = os.path.join(dirname, "data.csv")
+        unpacker = StreamingUnpacker(target, 'gz')
+        _feed(unpacker, gzip.compress(b'a,b,c\n1,2,3\n'), chunk_size=3)
+        assert os.path.isfile(target + ".part")
+        errors = []
+        assert unpacker.commit(errors)
+        assert [] == errors
+        assert _read(target) == 'a,b,c\n1,2,3\n'
+        assert os.listdir(dirname) == ['data.csv']
+
+    with_directory_contents(dict(), check)
+
+
+def test_decompress_multi_member_gz():
+    def check(dirname):
+        target = os.path.join(dirname, "data.csv")
+        data = gzip.compress(b'a,b,c\n') + gzip.compress(b'1,2,3\n') + gzip.compress(b'4,5,6\n')
+        # try chunks that split members and chunks that end right on a member boundary
+        for chunk_size in (5, len(gzip.compress(b'a,b,c\n'))):
+            unpacker = StreamingUnpacker(target, 'gz')
+            _feed(unpacker, data, chunk_size=chunk_size)
+            errors = []
+            assert unpacker.commit(errors)
+            assert [] == errors
+            assert _read(target) == 'a,b,c\n1,2,3\n4,5,6\n'
+
+    with_directory_contents(dict(), check)
+
+
+def test_decompress_multi_stream_bz2():
+    def check(dirname):
+        target = os.path.join(dirname, "data.csv")
+        unpacker = StreamingUnpacker(target, 'bz2')
+        _feed(unpacker, bz2.compress(b'a,b,c\n') + bz2.compress(b'1,2,3\n'))
+        errors = []
+        assert unpacker.commit(errors)
+        assert [] == errors
+        assert _read(target) == 'a,b,c\n1,2,3\n'
+
+    with_directory_contents(dict(), check)
+
+
+def test_decompress_truncated_second_gz_member():
+    def check(dirname):
+        target = os.path.join(dirname, "data.csv")
+        unpacker = StreamingUnpacker(target, 'gz')
+        _feed(unpacker, gzip.compress(b'a,b,c\n') + gzip.compress(b'1,2,3\n' * 100)[:20])
+        errors = []
+        assert not unpacker.commit(errors)
+        assert ["Failed to decompress %s: compressed data ended early" % target] == errors
+
+    with_directory_contents(dict(), check)
+
+
+def test_decompress_xz():
+    def check(dirname):
+        target = os.path.join(dirname, "data.csv")
+        unpacker = StreamingUnpacker(target, 'xz')
+        _feed(unpacker, lzma.compress(b'a,b,c\n'))
+        errors = []
+        assert unpacker.commit(errors)
+        assert _read(target) == 'a,b,c\n'
+
+    with_directory_contents(dict(), check)
+
+
+def test_decompress_truncated_gz():
+    def check(dirname):
+        target = os.path.join(dirname, "data.csv")
+        unpacker = StreamingUnpacker(target, 'gz')
+        _feed(unpacker, gzip.compress(b'a,b,c\n' * 100)[:20])
+        errors = []
+        assert not unpacker.commit(errors)
+        assert ["Failed to decompress %s: compressed data ended early" % target] == errors
+        assert os.listdir(dirname) == []
+
+    with_directory_contents(dict(), check)
+
+
+def test_decompress_garbage_bz2():
+    def check(dirname):
+        target = os.path.join(dirname, "data.csv")
+        unpacker = StreamingUnpacker(target, 'bz2')
+        _feed(unpacker, b'not bzip2 at all')
+        assert len(unpacker.errors) == 1
+        errors = []
+        assert not unpacker.commit(errors)
+        assert errors[0].startswith("Failed to decompress %s: " % target)
+        assert os.listdir(dirname) == []
+
+    with_directory_contents(dict(), check)
+
+
+def test_decompress_over_directory():
+    def check(dirname):
+        target = os.path.join(dirname, "data")
+        unpacker = StreamingUnpacker(target, 'gz')
+        _feed(unpacker, gzip.compress(b'hello'))
+        errors = []
+        assert not unpacker.commit(errors)
+        assert ["%s exists and is a directory, not unzipping a plain file over it." % target] == errors
+        assert not os.path.exists(target + ".part")
+
+    with_directory_contents(dict(data=None), check)
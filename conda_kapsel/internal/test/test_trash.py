@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------------
+# Copyright © 2016, Continuum Analytics, Inc. All rights reserved.
+#
+# The full license is in the file LICENSE.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import absolute_import
+
+import os
+
+import pytest
+
+from conda_kapsel.internal import trash
+from conda_kapsel.internal.test.tmpfile_utils import with_directory_contents
+
+
+def test_remove_directory():
+    def check(dirname):
+        target = os.path.join(dirname, "services")
+        assert os.path.isdir(os.path.join(target, "foo"))
+
+        trash.remove_directory(target)
+        assert not os.path.exists(target)
+
+        trash.wait_for_background_deletes()
+        assert not os.path.exists(os.path.join(dirname, trash.TRASH_DIRECTORY_NAME))
+        assert ['keep.txt'] == os.listdir(dirname)
+
+    with_directory_contents({"services/foo/bar.txt": "bar", "services/baz.txt": "baz", "keep.txt": "keep"}, check)
+
+
+def test_remove_directory_rename_fails(monkeypatch):
+    def check(dirname):
+        def mock_rename(src, dst):
+            raise OSError("no renaming")
+
+        monkeypatch.setattr('os.rename', mock_rename)
+
+        target = os.path.join(dirname, "services")
+        trash.remove_directory(target)
+        # deleted right away instead
+        assert not os.path.exists(target)
+        assert trash._pending == []
+
+    with_directory_contents({"services/foo/bar.txt": "bar"}, check)
+
+
+def test_remove_directory_missing():
+    def check(dirname):
+        with pytest.raises(OSError):
+            trash.remove_directory(os.path.join(dirname, "nope"))
+
+    with_directory_contents(dict(), check)
+
+
+def test_remove_directory_background_delete_fails(monkeypatch):
+    def check(dirname):
+        def mock_Popen(*args, **kwargs):
+            raise OSError("no processes")
+
+        monkeypatch.setattr('subprocess.Popen', mock_Popen)
+
+        target = os.path.join(dirname, "services")
+        trash.remove_directory(target)
+        assert not os.path.exists(target)
+        assert [] == os.listdir(os.path.join(dirname, trash.TRASH_DIRECTORY_NAME))
+
+    with_directory_contents({"services/foo/bar.txt": "bar"}, check)
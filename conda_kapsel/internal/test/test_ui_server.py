@@ -6,13 +6,20 @@
 # ----------------------------------------------------------------------------
 from __future__ import absolute_import, print_function
 
+import json
+import os
+import threading
+
 from bs4 import BeautifulSoup
+from tornado import gen
+from tornado.httpclient import HTTPError
 from tornado.ioloop import IOLoop
 
+from conda_kapsel.internal.download_progress import DownloadProgress, report_progress
 from conda_kapsel.internal.plugin_html import _BEAUTIFUL_SOUP_BACKEND
 from conda_kapsel.project import Project
 from conda_kapsel.prepare import ConfigurePrepareContext, _FunctionPrepareStage, PrepareSuccess
-from conda_kapsel.internal.test.http_utils import http_get, http_post
+from conda_kapsel.internal.test.http_utils import http_get, http_get_async, http_post, http_post_async
 from conda_kapsel.internal.test.multipart import MultipartEncoder
 from conda_kapsel.internal.test.tmpfile_utils import with_directory_contents
 from conda_kapsel.internal.ui_server import UIServer, UIServerDoneEvent
@@ -169,3 +176,120 @@ def test_ui_server_invalid_req_id_in_posted_name(capsys):
 
 def test_ui_server_invalid_provider_key_in_posted_name(capsys):
     _ui_server_bad_form_name_test(capsys, "%s.BadProvider.value", "did not find provider BadProvider\n")
+
+
+def test_ui_server_download_progress():
+    def do_test(dirname):
+        io_loop = IOLoop()
+        io_loop.make_current()
+
+        def event_handler(event):
+            pass
+
+        project = Project(dirname)
+        local_state_file = LocalStateFile.load_for_directory(dirname)
+        context = ConfigurePrepareContext(dict(), local_state_file, 'default', UserConfigOverrides(), [])
+        server = UIServer(project, _no_op_prepare(context), event_handler, io_loop)
+
+        try:
+            empty_response = http_get(io_loop, server.url + "progress")
+            assert json.loads(empty_response.body.decode('utf-8')) == []
+
+            report_progress(DownloadProgress(url="http://example.com/data.csv",
+                                             filename=os.path.join(dirname, "data.csv"),
+                                             bytes_done=10,
+                                             bytes_total=20,
+                                             elapsed=1.0))
+            progress_response = http_get(io_loop, server.url + "progress")
+            progress = json.loads(progress_response.body.decode('utf-8'))
+            assert len(progress) == 1
+            assert progress[0]['bytes_done'] == 10
+            assert progress[0]['line'] == "Downloading data.csv: 10B of 20B (50%) at 10B/s, 00:01 remaining"
+        finally:
+            server.unlisten()
+
+        # we stop listening once the server goes away
+        report_progress(DownloadProgress(url="http://example.com/data.csv",
+                                         filename=os.path.join(dirname, "other.csv"),
+                                         bytes_done=10,
+                                         bytes_total=20,
+                                         elapsed=1.0))
+        assert [p.filename for p in server._application.latest_progress()] == [os.path.join(dirname, "data.csv")]
+
+    with_directory_contents(dict(), do_test)
+
+
+def test_ui_server_rejects_requests_while_executing():
+    def do_test(dirname):
+        io_loop = IOLoop()
+        io_loop.make_current()
+
+        events = []
+
+        def event_handler(event):
+            events.append(event)
+
+        project = Project(dirname)
+        local_state_file = LocalStateFile.load_for_directory(dirname)
+        context = ConfigurePrepareContext(dict(), local_state_file, 'default', UserConfigOverrides(), [])
+
+        release = threading.Event()
+        executions = []
+
+        def _wait_then_finish(stage):
+            executions.append(stage)
+            release.wait()
+            stage.set_result(
+                PrepareSuccess(logs=[],
+                               statuses=(),
+                               command_exec_info=None,
+                               environ=dict(),
+                               overrides=UserConfigOverrides()),
+                [])
+            return None
+
+        stage = _FunctionPrepareStage(dict(), UserConfigOverrides(), "Wait", [], _wait_then_finish, context)
+        server = UIServer(project, stage, event_handler, io_loop)
+
+        @gen.coroutine
+        def overlapping_posts():
+            first = http_post_async(server.url, body='', headers={})
+            while not server._application.executing:
+                yield gen.sleep(0.01)
+            try:
+                yield http_post_async(server.url, body='', headers={})
+                assert False, "second post should have been rejected"  # pragma: no cover
+            except HTTPError as e:
+                second_code = e.code
+            # a refresh while we're executing doesn't touch the stage either
+            configures_before_get = len(configures)
+            get_response = yield http_get_async(server.url)
+            assert b"Setup is already running" in get_response.body
+            assert configures_before_get == len(configures)
+            release.set()
+            first_response = yield first
+            raise gen.Return((first_response.code, second_code))
+
+        configures = []
+        real_configure = stage.configure
+
+        def counting_configure():
+            configures.append(True)
+            return real_configure()
+
+        stage.configure = counting_configure
+
+        try:
+            (first_code, second_code) = io_loop.run_sync(overlapping_posts)
+        finally:
+            release.set()
+            server.unlisten()
+
+        assert 200 == first_code
+        assert 409 == second_code
+        assert len(executions) == 1
+        assert not server._application.executing
+        assert len(events) == 1
+        assert isinstance(events[0], UIServerDoneEvent)
+
+    with_directory_contents(dict(), do_test)
@@ -14,6 +14,7 @@ import sys
 import zipfile
 
 from conda_kapsel.internal.makedirs import makedirs_ok_if_exists
+from conda_kapsel.internal import trash
 from conda_kapsel.local_state_file import LocalStateFile
 from conda_kapsel.yaml_file import _load_string
 from conda_kapsel.project_file import (possible_project_file_names, DEFAULT_PROJECT_FILENAME)
@@ -27,6 +28,8 @@ class TmpDir(object):
         self._dir = tempfile.mkdtemp(prefix=prefix, dir=local_tmp)
 
     def __exit__(self, type, value, traceback):
+        # don't race with deletes from clean() or unprepare()
+        trash.wait_for_background_deletes()
         try:
             shutil.rmtree(path=self._dir)
         except Exception as e:
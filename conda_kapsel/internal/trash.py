@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------------
+# Copyright © 2016, Continuum Analytics, Inc. All rights reserved.
+#
+# The full license is in the file LICENSE.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import absolute_import, print_function
+
+import errno
+import os
+import shutil
+import subprocess
+import sys
+import uuid
+
+from conda_kapsel.internal.makedirs import makedirs_ok_if_exists
+
+TRASH_DIRECTORY_NAME = ".kapsel-trash"
+
+_DELETE_SCRIPT = """
+import os, shutil, sys
+shutil.rmtree(sys.argv[1], ignore_errors=True)
+try:
+    os.rmdir(os.path.dirname(sys.argv[1]))
+except OSError:
+    pass
+"""
+
+# background deletions started by this process, so tests can wait for them
+_pending = []
+
+
+def trash_directory_for(path):
+    """The trash directory used when deleting path, a sibling of path."""
+    return os.path.join(os.path.dirname(os.path.abspath(path)), TRASH_DIRECTORY_NAME)
+
+
+def _rename_to_trash(path):
+    trash_dir = trash_directory_for(path)
+    target = os.path.join(trash_dir, "%s-%s" % (os.path.basename(path), uuid.uuid4().hex))
+    # a background delete may remove an empty trash dir right
+    # after we create it, so try again if that happens
+    for attempt in (1, 2):
+        makedirs_ok_if_exists(trash_dir)
+        try:
+            os.rename(path, target)
+            return target
+        except OSError as e:
+            if e.errno != errno.ENOENT or not os.path.exists(path) or attempt == 2:
+                raise e
+
+
+def _delete_in_background(path):
+    kwargs = dict(close_fds=True)
+    if hasattr(os, 'setsid'):
+        # keep going after our process exits
+        kwargs['preexec_fn'] = os.setsid
+    with open(os.devnull, 'r+b') as devnull:
+        process = subprocess.Popen([sys.executable, '-c', _DELETE_SCRIPT, path],
+                                   stdin=devnull,
+                                   stdout=devnull,
+                                   stderr=devnull,
+                                   **kwargs)
+    _pending[:] = [p for p in _pending if p.poll() is None]
+    _pending.append(process)
+
+
+def remove_directory(path):
+    """Delete a directory tree without waiting for the delete to finish.
+
+    The directory is renamed into a trash directory next to it, so it
+    disappears right away, and a detached process deletes it. If the
+    rename isn't possible, the directory is deleted before returning.
+
+    Raises:
+        an ``OSError`` or ``IOError`` if the directory couldn't be deleted
+    """
+    try:
+        trashed = _rename_to_trash(path)
+    except OSError:
+        shutil.rmtree(path)
+        return
+
+    try:
+        _delete_in_background(trashed)
+    except (IOError, OSError):
+        shutil.rmtree(trashed, ignore_errors=True)
+
+
+def wait_for_background_deletes():
+    """Wait for deletes started by ``remove_directory`` in this process."""
+    while _pending:
+        _pending.pop().wait()
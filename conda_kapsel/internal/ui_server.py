@@ -7,14 +7,19 @@
 from __future__ import absolute_import, print_function
 
 import collections
+import json
 import socket
 import sys
+import threading
 import uuid
 
+from tornado import gen
+from tornado.concurrent import Future
 from tornado.httpserver import HTTPServer
 from tornado.netutil import bind_sockets
 from tornado.web import Application, RequestHandler
 
+from conda_kapsel.internal.download_progress import add_progress_listener, remove_progress_listener
 from conda_kapsel.internal.plugin_html import cleanup_and_scope_form, html_tag
 
 
@@ -38,6 +43,43 @@ def _html_escape(text):
     return text
 
 
+# while the form is being submitted the old page stays up, so we
+# poll for download progress and show it until the response arrives
+_progress_script = """
+<div id="download-progress"></div>
+<script>
+(function() {
+  var form = document.getElementById("prepare-form");
+  var progress = document.getElementById("download-progress");
+  function poll() {
+    var request = new XMLHttpRequest();
+    request.onload = function() {
+      var lines = JSON.parse(request.responseText).map(function(p) { return p.line; });
+      progress.textContent = "";
+      lines.forEach(function(line) {
+        var div = document.createElement("div");
+        div.textContent = line;
+        progress.appendChild(div);
+      });
+    };
+    request.open("GET", "/progress");
+    request.send();
+  }
+  form.addEventListener("submit", function() { window.setInterval(poll, 500); });
+})();
+</script>
+"""
+
+
+# while an earlier submit is still executing, check back every
+# couple of seconds until the results page can be shown
+_refresh_script = """
+<script>
+window.setTimeout(function() { window.location.reload(); }, 2000);
+</script>
+"""
+
+
 class PrepareViewHandler(RequestHandler):
     def __init__(self, application, *args, **kwargs):
         # Note: application is stored as self.application
@@ -104,8 +146,15 @@ class PrepareViewHandler(RequestHandler):
 <div>Done! Close this window now if you like.</div>
 """ + status_list_html)
 
+    def _still_preparing_page(self, extra_html=""):
+        return self._outer_page("<div>Setup is already running, please wait for it to finish.</div>" + extra_html)
+
     def get(self, *args, **kwargs):
-        if self.application.prepare_stage is None:
+        if self.application.executing:
+            # the stage is executing on another thread, so we mustn't
+            # configure() it or look at its local state right now
+            page = self._still_preparing_page(_refresh_script)
+        elif self.application.prepare_stage is None:
             self.application.emit_event(UIServerDoneEvent(result=self.application.last_stage_result))
             page = self._result_page(self.application.last_stage_result, self.application.latest_statuses)
         else:
@@ -125,18 +174,28 @@ class PrepareViewHandler(RequestHandler):
 
             page = self._outer_page("""
 <div>
-  <form action="/" method="post" enctype="multipart/form-data">
+  <form id="prepare-form" action="/" method="post" enctype="multipart/form-data">
     <h2>Project "%s" has these requirements that may need setup:</h2>
     %s
     <input type="submit" value="%s"></input>
   </form>
 </div>
-""" % (self.application.project.name, config_html, self.application.prepare_stage.description_of_action))
+""" % (self.application.project.name, config_html, self.application.prepare_stage.description_of_action) +
+                                    _progress_script)
 
         self.set_header("Content-Type", 'text/html')
         self.write(page)
 
+    @gen.coroutine
     def post(self, *args, **kwargs):
+        if self.application.executing:
+            # a second submit (double click, another tab) must not
+            # run the same stage again while the first is still going
+            self.set_status(409)
+            self.set_header("Content-Type", 'text/html')
+            self.write(self._still_preparing_page())
+            return
+
         prepare_context = self.application.prepare_stage.configure()
 
         if prepare_context is not None:
@@ -156,7 +215,13 @@ class PrepareViewHandler(RequestHandler):
 
             prepare_context.local_state_file.save()
 
-        next_stage = self.application.prepare_stage.execute()
+        # run on a thread so we can keep answering /progress requests
+        self.application.clear_progress()
+        self.application.executing = True
+        try:
+            next_stage = yield self.application.run_in_thread(self.application.prepare_stage.execute)
+        finally:
+            self.application.executing = False
         self.application.latest_statuses = self.application.prepare_stage.statuses_after_execute
         if next_stage is None:
             self.application.last_stage_result = self.application.prepare_stage.result
@@ -164,7 +229,18 @@ class PrepareViewHandler(RequestHandler):
             self.application.latest_statuses = next_stage.statuses_before_execute
         self.application.prepare_stage = next_stage
 
-        return self.get(*args, **kwargs)
+        self.get(*args, **kwargs)
+
+
+class ProgressViewHandler(RequestHandler):
+    def __init__(self, application, *args, **kwargs):
+        # Note: application is stored as self.application
+        super(ProgressViewHandler, self).__init__(application, *args, **kwargs)
+
+    def get(self, *args, **kwargs):
+        self.set_header("Content-Type", 'application/json')
+        self.set_header("Cache-Control", 'no-cache')
+        self.write(json.dumps([progress.to_json() for progress in self.application.latest_progress()]))
 
 
 class UIApplication(Application):
@@ -175,16 +251,50 @@ class UIApplication(Application):
         self.prepare_stage = prepare_stage
         self.last_stage_result = None
         self.latest_statuses = prepare_stage.statuses_before_execute
+        # only touched on the io loop thread, so no lock needed
+        self.executing = False
 
         self._requirements_by_id = {}
         self._ids_by_requirement = {}
 
-        patterns = [(r'/?', PrepareViewHandler)]
+        self._progress_lock = threading.Lock()
+        self._progress_by_filename = collections.OrderedDict()
+
+        patterns = [(r'/progress', ProgressViewHandler), (r'/?', PrepareViewHandler)]
         super(UIApplication, self).__init__(patterns, **kwargs)
 
     def emit_event(self, event):
         self.io_loop.add_callback(lambda: self._event_handler(event))
 
+    def on_download_progress(self, progress):
+        # called from the thread doing the download
+        with self._progress_lock:
+            self._progress_by_filename[progress.filename] = progress
+
+    def latest_progress(self):
+        with self._progress_lock:
+            return list(self._progress_by_filename.values())
+
+    def clear_progress(self):
+        with self._progress_lock:
+            self._progress_by_filename.clear()
+
+    def run_in_thread(self, func):
+        future = Future()
+
+        def worker():
+            try:
+                result = func()
+            except Exception as e:
+                self.io_loop.add_callback(lambda error=e: future.set_exception(error))
+            else:
+                self.io_loop.add_callback(lambda value=result: future.set_result(value))
+
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        return future
+
     def refresh_form_ids(self, prepare_context):
         old_ids_by_requirement = self._ids_by_requirement
         self._requirements_by_id = {}
@@ -226,6 +336,7 @@ class UIServer(object):
 
         self._application = UIApplication(project, prepare_stage, event_handler, io_loop)
         self._http = HTTPServer(self._application, io_loop=io_loop)
+        add_progress_listener(self._application.on_download_progress)
 
         # these would throw OSError on failure
         sockets = bind_sockets(port=None, address='127.0.0.1')
@@ -250,5 +361,6 @@ class UIServer(object):
 
     def unlisten(self):
         """Permanently close down the HTTP server, no longer listen on any sockets."""
+        remove_progress_listener(self._application.on_download_progress)
         self._http.close_all_connections()
         self._http.stop()
@@ -14,43 +14,52 @@ import zipfile
 from conda_kapsel.internal import rename
 
 
-# we overwrite as long as the zip contains a file and target_path
-# is a file, or the zip is a dir and target_path is a dir, but if
-# they don't match we don't overwrite. Hopefully this will catch
-# most mistaken collisions.
+def move_unpacked_into_place(tmp_dir, target_path, errors, archive_description="Zip archive"):
+    """Rename the contents of tmp_dir (which we unpacked an archive into) to target_path.
+
+    We overwrite as long as the archive contains a file and
+    target_path is a file, or the archive is a dir and target_path
+    is a dir, but if they don't match we don't overwrite. Hopefully
+    this will catch most mistaken collisions.
+    """
+    target_file = os.path.basename(target_path)
+    extracted = os.listdir(tmp_dir)
+    if len(extracted) == 0:
+        errors.append("%s was empty." % archive_description)
+        return False
+    elif len(extracted) == 1 and extracted[0] == target_file:
+        # don't keep a pointless directory level, if
+        # the zip just contains a single directory or
+        # file with the same name as the target
+        src_path = os.path.join(tmp_dir, extracted[0])
+    else:
+        src_path = tmp_dir
+    src_is_dir = os.path.isdir(src_path)
+    target_is_dir = os.path.isdir(target_path)
+    if os.path.exists(target_path) and (src_is_dir != target_is_dir):
+        if src_is_dir:
+            errors.append("%s exists and isn't a directory, not unzipping a directory over it." % target_path)
+        else:
+            errors.append("%s exists and is a directory, not unzipping a plain file over it." % target_path)
+        return False
+    else:
+        rename.rename_over_existing(src_path, target_path)
+        return True
+
+
 def unpack_zip(zip_path, target_path, errors):
     try:
         with zipfile.ZipFile(zip_path, mode='r') as zf:
-            target_dir, target_file = os.path.split(target_path)
+            target_dir = os.path.dirname(target_path)
+            # extract straight from the finished download into a sibling
+            # of the target; renaming that into place doesn't copy data.
             tmp_dir = tempfile.mkdtemp(prefix=(target_path + "_tmp"), dir=target_dir)
             try:
                 zf.extractall(tmp_dir)
-                extracted = os.listdir(tmp_dir)
-                if len(extracted) == 0:
-                    errors.append("Zip archive was empty.")
-                    return False
-                elif len(extracted) == 1 and extracted[0] == target_file:
-                    # don't keep a pointless directory level, if
-                    # the zip just contains a single directory or
-                    # file with the same name as the target
-                    src_path = os.path.join(tmp_dir, extracted[0])
-                else:
-                    src_path = tmp_dir
-                src_is_dir = os.path.isdir(src_path)
-                target_is_dir = os.path.isdir(target_path)
-                if os.path.exists(target_path) and (src_is_dir != target_is_dir):
-                    if src_is_dir:
-                        errors.append("%s exists and isn't a directory, not unzipping a directory over it." %
-                                      target_path)
-                    else:
-                        errors.append("%s exists and is a directory, not unzipping a plain file over it." % target_path)
-                    return False
-                else:
-                    rename.rename_over_existing(src_path, target_path)
+                return move_unpacked_into_place(tmp_dir, target_path, errors)
             finally:
                 if os.path.isdir(tmp_dir):
                     shutil.rmtree(path=tmp_dir)
-            return True
     except Exception as e:
         errors.append("Failed to unzip %s: %s" % (zip_path, str(e)))
         return False
@@ -7,9 +7,15 @@
 """Project "local state" file loading and manipulation."""
 from __future__ import absolute_import
 
+import codecs
+from copy import deepcopy
+import errno
+import hashlib
 import os
+import threading
 
-from conda_kapsel.yaml_file import YamlFile
+from conda_kapsel.internal.file_lock import FileLock, shared_lock_directory
+from conda_kapsel.yaml_file import YamlFile, _load_string_read_only, _YAMLError
 
 # these are in the order we'll use them if multiple are present
 possible_local_state_file_names = ("kapsel-local.yml", "kapsel-local.yaml")
@@ -18,6 +24,37 @@ DEFAULT_LOCAL_STATE_FILENAME = possible_local_state_file_names[0]
 
 SERVICE_RUN_STATES_SECTION = "service_run_states"
 
+# stands in for a key that isn't there
+_missing = object()
+
+
+def _lock_filename(filename):
+    # not next to the file, where it would end up in archives of the project
+    digest = hashlib.sha1(os.path.realpath(filename).encode('utf-8')).hexdigest()
+    return os.path.join(shared_lock_directory("kapsel-local-state"), digest + ".lock")
+
+
+def _merge_independent_changes(base, ours, theirs):
+    # make the changes that turn base into theirs in ours, unless
+    # ours changed the same thing; ours is modified in place
+    keys = list(theirs.keys()) + [key for key in base.keys() if key not in theirs]
+    for key in keys:
+        base_value = base.get(key, _missing)
+        our_value = ours.get(key, _missing)
+        their_value = theirs.get(key, _missing)
+        if their_value == base_value or their_value == our_value:
+            continue
+        if our_value == base_value:
+            if their_value is _missing:
+                del ours[key]
+            else:
+                ours[key] = deepcopy(their_value)
+        elif isinstance(our_value, dict) and isinstance(their_value, dict):
+            if not isinstance(base_value, dict):
+                base_value = dict()
+            _merge_independent_changes(base_value, our_value, their_value)
+        # otherwise we both changed it, and our change wins
+
 
 class LocalStateFile(YamlFile):
     """Represents the locally-configured/user-specific state of the project directory.
@@ -28,8 +65,30 @@ class LocalStateFile(YamlFile):
     Be careful with creating your own instance of this class,
     because you have to think about when other code might load or
     save in a way that conflicts with your loads and saves.
+
+    The service run state methods, ``get_value()``, ``set_value()``,
+    ``unset_value()`` and ``save()`` may be called from several
+    threads at once.
+
+    Several processes may also load and save the file at once.
+    ``save()`` holds a lock shared with them, and keeps the changes
+    they saved since we loaded the file, unless we changed the same
+    value.
     """
 
+    def __init__(self, filename):
+        """Load a LocalStateFile from the given filename."""
+        # prepare and unprepare handle services concurrently
+        self._lock = threading.RLock()
+        super(LocalStateFile, self).__init__(filename)
+
+    def load(self):
+        """Override superclass to remember what we loaded, to merge with later."""
+        with self._lock:
+            super(LocalStateFile, self).load()
+            # the file's text as we last loaded or saved it, None if corrupted
+            self._base_contents = self._unmodified_contents()
+
     @classmethod
     def load_for_directory(cls, directory):
         """Load the project local state file from the given directory, even if it doesn't exist.
@@ -80,7 +139,8 @@ class LocalStateFile(YamlFile):
         """
         if not isinstance(state, dict):
             raise ValueError("service state should be a dict")
-        self.set_value([SERVICE_RUN_STATES_SECTION, service_name], state)
+        with self._lock:
+            self.set_value([SERVICE_RUN_STATES_SECTION, service_name], state)
 
     def get_service_run_state(self, service_name):
         """Get the running instance state for a service.
@@ -91,7 +151,8 @@ class LocalStateFile(YamlFile):
         Returns:
             The state dict (empty dict if no state was saved)
         """
-        return self.get_value([SERVICE_RUN_STATES_SECTION, service_name], default=dict())
+        with self._lock:
+            return self.get_value([SERVICE_RUN_STATES_SECTION, service_name], default=dict())
 
     def get_all_service_run_states(self):
         """Get all saved service run states.
@@ -101,4 +162,60 @@ class LocalStateFile(YamlFile):
         Returns:
             a dict from service name to service state dict
         """
-        return self.get_value(SERVICE_RUN_STATES_SECTION, default=dict())
+        with self._lock:
+            return self.get_value(SERVICE_RUN_STATES_SECTION, default=dict())
+
+    def save(self):
+        """Override superclass to lock the file and merge in changes saved by others."""
+        with self._lock:
+            if self._coalescing > 0 or not self._dirty or self.corrupted:
+                # put off, nothing to do, or an exception
+                super(LocalStateFile, self).save()
+                return
+
+            with FileLock(_lock_filename(self.filename)):
+                self._merge_saved_changes()
+                super(LocalStateFile, self).save()
+                self._base_contents = self._unmodified_contents()
+
+    def _merge_saved_changes(self):
+        try:
+            with codecs.open(self.filename, 'r', 'utf-8') as file:
+                contents = file.read()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise e
+            contents = ""
+
+        if contents == self._base_contents or self._base_contents is None:
+            return
+
+        try:
+            theirs = _load_string_read_only(contents)
+            base = _load_string_read_only(self._base_contents)
+        except _YAMLError:
+            # someone broke it; we replace it as we always have
+            return
+        if theirs is None:
+            theirs = dict()
+        if base is None:
+            base = dict()
+        ours = self._editable_yaml()
+        if isinstance(theirs, dict) and isinstance(base, dict) and isinstance(ours, dict):
+            _merge_independent_changes(base, ours, theirs)
+            self._note_edit(None)
+
+    def get_value(self, path, default=None):
+        """Override superclass to read under our lock."""
+        with self._lock:
+            return super(LocalStateFile, self).get_value(path, default)
+
+    def set_value(self, path, value):
+        """Override superclass to modify under our lock."""
+        with self._lock:
+            super(LocalStateFile, self).set_value(path, value)
+
+    def unset_value(self, path):
+        """Override superclass to modify under our lock."""
+        with self._lock:
+            super(LocalStateFile, self).unset_value(path)
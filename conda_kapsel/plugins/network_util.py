@@ -5,8 +5,12 @@
 # The full license is in the file LICENSE.txt, distributed with this software.
 # ----------------------------------------------------------------------------
 """Network utilities for use by plugins."""
+import os
 import socket
 
+from conda_kapsel.internal.file_lock import FileLock, shared_lock_directory
+from conda_kapsel.internal import py2_compat
+
 
 def _get_urlparse():
     try:
@@ -38,3 +42,139 @@ def can_connect_to_socket(host, port, timeout_seconds=0.5):
         return True
     except IOError:
         return False
+
+
+def can_connect_to_unix_socket(path, timeout_seconds=0.5):
+    """Check whether we can connect to a server on the Unix domain socket at path.
+
+    Args:
+        path (str): the socket's filename
+        timeout_seconds (float): how long to wait for failure
+    Returns:
+        True if we could connect
+    """
+    if not unix_sockets_supported():
+        return False
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.settimeout(timeout_seconds)
+        s.connect(path)
+        return True
+    except IOError:
+        return False
+    finally:
+        s.close()
+
+
+def socket_handshake_succeeds(address, request, expected_reply, timeout_seconds=0.5):
+    """Send a request to a server and check the start of its reply.
+
+    This tells us the server is actually answering, not just that
+    something accepted the connection.
+
+    Args:
+        address: a (host, port) tuple for TCP, or a Unix domain socket filename
+        request (bytes): what to send
+        expected_reply (bytes): what the reply should start with
+        timeout_seconds (float): how long to wait for failure
+    Returns:
+        True if the server replied as expected
+    """
+    if py2_compat.is_string(address):
+        if not unix_sockets_supported():
+            return False
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.settimeout(timeout_seconds)
+        s.connect(address)
+        s.sendall(request)
+        reply = b''
+        while len(reply) < len(expected_reply):
+            chunk = s.recv(len(expected_reply) - len(reply))
+            if len(chunk) == 0:
+                break
+            reply = reply + chunk
+        return reply == expected_reply
+    except IOError:
+        return False
+    finally:
+        s.close()
+
+
+def unix_sockets_supported():
+    """True if this platform has Unix domain sockets."""
+    return hasattr(socket, 'AF_UNIX')
+
+
+def can_bind_to_port(port, host=''):
+    """Check whether a server could listen on the given TCP port.
+
+    This binds and immediately closes a socket rather than
+    connecting, so it's fast and doesn't bother whoever might be
+    listening.
+
+    Args:
+        port (int): the port
+        host (str): address to bind, default all interfaces
+    Returns:
+        True if the port is free
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        # on Windows SO_REUSEADDR means "steal the port even if
+        # someone is listening", which is the opposite of what we want;
+        # elsewhere it just ignores connections stuck in TIME_WAIT.
+        if os.name != 'nt':
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((host, port))
+        return True
+    except IOError:
+        return False
+    finally:
+        s.close()
+
+
+class PortReservation(object):
+    """A TCP port we've claimed, shared across processes on the host via a lock file."""
+
+    def __init__(self, port, lock):
+        """Create a reservation holding lock for port."""
+        self.port = port
+        self._lock = lock
+
+    def release(self):
+        """Let other processes have the port.
+
+        Release once the server is listening; from then on, nobody
+        else will be able to bind the port anyway.
+        """
+        self._lock.release()
+
+
+def reserve_port(lower_port, upper_port, lock_directory=None):
+    """Find a free port in the range and reserve it.
+
+    Concurrent callers, even in other processes, never get the same
+    port as long as the reservation is held.
+
+    Args:
+        lower_port (int): lowest port to try
+        upper_port (int): highest port to try
+        lock_directory (str): where to keep the lock files, None for default
+    Returns:
+        a ``PortReservation``, or None if every port was taken
+    """
+    if lock_directory is None:
+        lock_directory = shared_lock_directory("kapsel-ports")
+    for port in range(lower_port, upper_port + 1):
+        lock = FileLock(os.path.join(lock_directory, "port-%d.lock" % port))
+        if not lock.try_acquire():
+            continue
+        # check after locking, since someone could have started a
+        # server on the port and released their lock
+        if can_bind_to_port(port):
+            return PortReservation(port, lock)
+        lock.release()
+    return None
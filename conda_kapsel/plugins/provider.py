@@ -9,14 +9,19 @@ from __future__ import absolute_import
 
 from abc import ABCMeta, abstractmethod
 from copy import deepcopy
+import codecs
 import os
 import shutil
+import signal
+import time
 
 from conda_kapsel.internal import conda_api
 from conda_kapsel.internal import logged_subprocess
 from conda_kapsel.internal.metaclass import with_metaclass
 from conda_kapsel.internal.makedirs import makedirs_ok_if_exists
+from conda_kapsel.internal.pidfile import read_pidfile, process_is_alive
 from conda_kapsel.internal.simple_status import SimpleStatus
+import conda_kapsel.plugins.service_supervisor as service_supervisor
 
 
 def _service_directory(local_state_file, relative_name):
@@ -100,6 +105,83 @@ class ProvideContext(object):
         return self._mode
 
 
+# how long a service's shutdown commands get to finish, after which
+# they are killed; the service itself is then killed if it's still up
+SHUTDOWN_TIMEOUT_SECONDS = 10.0
+_KILL_GRACE_SECONDS = 2.0
+
+
+def _wait_until(predicate, deadline, interval=0.01, max_interval=0.1):
+    while not predicate():
+        if time.time() >= deadline:
+            return False
+        time.sleep(interval)
+        interval = min(interval * 2, max_interval)
+    return True
+
+
+def _kill_service_process(service_name, pidfile, deadline, errors):
+    pid = read_pidfile(pidfile)
+    if pid is None:
+        return
+
+    def exited():
+        return not process_is_alive(pid)
+
+    if _wait_until(exited, deadline):
+        return
+    for (sig, description) in ((signal.SIGTERM, "terminated"), (getattr(signal, 'SIGKILL', signal.SIGTERM), "killed")):
+        if read_pidfile(pidfile) != pid:
+            # it exited and the pid may belong to someone else by now
+            return
+        try:
+            os.kill(pid, sig)
+        except OSError:
+            return
+        if _wait_until(exited, time.time() + _KILL_GRACE_SECONDS):
+            errors.append("Shutting down %s, process %d didn't exit, so it was %s." % (service_name, pid, description))
+            return
+    errors.append("Shutting down %s, process %d couldn't be killed." % (service_name, pid))
+
+
+def run_shutdown_commands(service_name, run_state, errors, timeout_seconds=SHUTDOWN_TIMEOUT_SECONDS):
+    """Run the shutdown commands from a service's run state, appending any problems to errors.
+
+    Commands still running when the timeout expires are killed. If the
+    run state has a ``pidfile`` and the service process is still alive
+    after the commands, it's sent SIGTERM and then SIGKILL.
+
+    Args:
+        service_name (str): name of the service for error messages
+        run_state (dict): the service's run state
+        errors (list): list to append errors to
+        timeout_seconds (float): how long the service gets to shut down
+
+    Returns:
+        None
+    """
+    deadline = time.time() + timeout_seconds
+    if 'supervisor_key' in run_state:
+        # so it doesn't restart the service we're about to stop
+        service_supervisor.unsupervise_service(run_state['supervisor_key'])
+    for command in run_state.get('shutdown_commands', []):
+        try:
+            process = logged_subprocess.Popen(command)
+        except OSError as e:
+            errors.append("Shutting down %s, command %s failed: %s." % (service_name, repr(command), str(e)))
+            continue
+        if not _wait_until(lambda: process.poll() is not None, deadline):
+            process.kill()
+            process.wait()
+            errors.append("Shutting down %s, command %s didn't finish in %d seconds." %
+                          (service_name, repr(command), timeout_seconds))
+        elif process.returncode != 0:
+            errors.append("Shutting down %s, command %s failed with code %d." %
+                          (service_name, repr(command), process.returncode))
+    if 'pidfile' in run_state:
+        _kill_service_process(service_name, run_state['pidfile'], deadline, errors)
+
+
 def shutdown_service_run_state(local_state_file, service_name):
     """Run any shutdown commands from the local state file for the given service.
 
@@ -119,13 +201,7 @@ def shutdown_service_run_state(local_state_file, service_name):
         return SimpleStatus(success=True, description=("Nothing to do to shut down %s." % service_name))
 
     errors = []
-    state = run_states[service_name]
-    if 'shutdown_commands' in state:
-        commands = state['shutdown_commands']
-        for command in commands:
-            code = logged_subprocess.call(command)
-            if code != 0:
-                errors.append("Shutting down %s, command %s failed with code %d." % (service_name, repr(command), code))
+    run_shutdown_commands(service_name, run_states[service_name], errors)
     # clear out the run state once we try to shut it down
     local_state_file.set_service_run_state(service_name, dict())
     local_state_file.save()
@@ -165,6 +241,104 @@ def delete_service_directory(local_state_file, relative_name):
         pass
 
 
+SERVICE_READY = "ready"
+SERVICE_EXITED = "exited"
+SERVICE_TIMED_OUT = "timed_out"
+
+
+class _LogTail(object):
+    """Reads whatever has been appended to a log file since last time."""
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._offset = 0
+        self._partial = ""
+
+    def read_lines(self):
+        try:
+            with codecs.open(self._filename, 'r', 'utf-8', errors='replace') as f:
+                f.seek(self._offset)
+                text = f.read()
+                self._offset = f.tell()
+        except (IOError, OSError):
+            return []
+        lines = (self._partial + text).split("\n")
+        # hang on to an incomplete last line until the rest shows up
+        self._partial = lines.pop()
+        return lines
+
+
+def wait_for_service_ready(probe,
+                           pidfile=None,
+                           logfile=None,
+                           ready_marker=None,
+                           timeout_seconds=10.0,
+                           initial_interval=0.005,
+                           max_interval=0.25,
+                           tick=0.02,
+                           launched_at=None):
+    """Wait for a service we just started to be usable.
+
+    ``probe`` should do a real protocol-level handshake with the
+    service and return True once it gets a sane reply. It's retried
+    with exponential backoff between ``initial_interval`` and
+    ``max_interval``. In between probes we watch the pidfile and the
+    log: if the process named in the pidfile goes away (or the pidfile
+    is removed once it has appeared) we give up right away, and if
+    ``ready_marker`` shows up in the log we probe immediately. A
+    pidfile older than ``launched_at`` is ignored, since it's left over
+    from an earlier run and names some other process.
+
+    Args:
+        probe (function): no-argument function returning True when the service is ready
+        pidfile (str): pidfile the service writes, or None
+        logfile (str): log file the service writes, or None
+        ready_marker (str): case-insensitive text the service logs when it's ready, or None
+        timeout_seconds (float): how long to wait before giving up
+        launched_at (float): ``time.time()`` just before the service was started, or None
+
+    Returns:
+        one of ``SERVICE_READY``, ``SERVICE_EXITED``, or ``SERVICE_TIMED_OUT``
+    """
+    start = time.time()
+    deadline = start + timeout_seconds
+    log_tail = _LogTail(logfile) if (logfile is not None and ready_marker is not None) else None
+    pid = None
+    interval = initial_interval
+    next_probe = start
+
+    while True:
+        if pidfile is not None:
+            current_pid = read_pidfile(pidfile, written_since=launched_at)
+            if current_pid is not None:
+                pid = current_pid
+                if not process_is_alive(pid):
+                    return SERVICE_EXITED
+            elif pid is not None:
+                # services remove their pidfile when they exit
+                return SERVICE_EXITED
+
+        if log_tail is not None:
+            for line in log_tail.read_lines():
+                if ready_marker.lower() in line.lower():
+                    next_probe = time.time()
+                    interval = initial_interval
+
+        now = time.time()
+        if now >= next_probe:
+            if probe():
+                return SERVICE_READY
+            now = time.time()
+            next_probe = now + interval
+            interval = min(interval * 2, max_interval)
+
+        if now >= deadline:
+            return SERVICE_TIMED_OUT
+
+        # wake up at least every tick to check on the pidfile and log
+        time.sleep(max(0.0, min(next_probe - now, deadline - now, tick)))
+
+
 class ProviderAnalysis(object):
     """A Provider's preflight check snapshotting the state prior to ``provide()``.
 
@@ -265,6 +439,24 @@ class Provider(with_metaclass(ABCMeta)):
         """
         pass  # pragma: no cover
 
+    def env_prefix_needed(self, requirement, environ, local_state_file):
+        """Get whether the project's conda environment has to exist before we can provide.
+
+        A provider which only needs the environment for a program it
+        runs can return False when that program is installed somewhere
+        else. Such a provider is then provided while the environment
+        is still being created, rather than afterward.
+
+        Args:
+            requirement (Requirement): requirement instance we are providing for
+            environ (dict): current environment variable dict
+            local_state_file (LocalStateFile): local state file
+
+        Returns:
+            True if the environment is needed
+        """
+        return True
+
     @abstractmethod
     def read_config(self, requirement, environ, local_state_file, default_env_spec_name, overrides):
         """Read a config dict from the local state file for the given requirement.
@@ -389,6 +581,8 @@ class EnvVarProvider(Provider):
         """Override superclass to require env prefix."""
         if self._get_env_prefix(environ) is not None:
             return ()
+        elif not self.env_prefix_needed(requirement, environ, local_state_file):
+            return ()
         else:
             return (conda_api.conda_prefix_variable(), )
 
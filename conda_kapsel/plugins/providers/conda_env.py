@@ -8,9 +8,9 @@
 from __future__ import absolute_import, print_function
 
 import os
-import shutil
 
 from conda_kapsel.internal import conda_api
+from conda_kapsel.internal import trash
 from conda_kapsel.internal.simple_status import SimpleStatus
 from conda_kapsel.conda_manager import new_conda_manager, CondaManagerError
 from conda_kapsel.plugins.provider import EnvVarProvider
@@ -21,7 +21,7 @@ def _remove_env_path(env_path):
     """Also used by project_ops.py to delete environment files."""
     if os.path.exists(env_path):
         try:
-            shutil.rmtree(env_path)
+            trash.remove_directory(env_path)
             return SimpleStatus(success=True, description=("Deleted environment files in %s." % env_path))
         except Exception as e:
             problem = "Failed to remove environment files in {}: {}.".format(env_path, str(e))
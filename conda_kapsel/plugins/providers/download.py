@@ -12,7 +12,9 @@ import shutil
 
 from tornado.ioloop import IOLoop
 
-from conda_kapsel.internal.http_client import FileDownloader
+from conda_kapsel.internal.http_client import FileDownloader, MirrorProber
+from conda_kapsel.internal.hash_sidecar import cached_file_hash, write_sidecar, remove_sidecar
+from conda_kapsel.internal.streaming_unpack import StreamingUnpacker, STREAMING_FORMATS
 from conda_kapsel.internal.ziputils import unpack_zip
 from conda_kapsel.internal.simple_status import SimpleStatus
 from conda_kapsel.plugins.provider import EnvVarProvider, ProviderAnalysis
@@ -22,9 +24,11 @@ from conda_kapsel.provide import PROVIDE_MODE_CHECK
 class _DownloadProviderAnalysis(ProviderAnalysis):
     """Subtype of ProviderAnalysis showing if a filename exists."""
 
-    def __init__(self, config, missing_to_configure, missing_to_provide, existing_filename):
+    def __init__(self, config, missing_to_configure, missing_to_provide, existing_filename,
+                 existing_hash_mismatch=None):
         super(_DownloadProviderAnalysis, self).__init__(config, missing_to_configure, missing_to_provide)
         self.existing_filename = existing_filename
+        self.existing_hash_mismatch = existing_hash_mismatch
 
 
 class DownloadProvider(EnvVarProvider):
@@ -86,33 +90,71 @@ class DownloadProvider(EnvVarProvider):
         analysis = super(DownloadProvider, self).analyze(requirement, environ, local_state_file, default_env_spec_name,
                                                          overrides)
         filename = os.path.join(environ['PROJECT_DIR'], requirement.filename)
+        existing_hash_mismatch = None
         if os.path.exists(filename):
             existing_filename = filename
+            # the hash is of the downloaded file, so we can only check
+            # it if we didn't unzip it into something else
+            if requirement.hash_value is not None and os.path.isfile(filename) and not requirement.unzip:
+                try:
+                    digest = cached_file_hash(filename, requirement.hash_algorithm)
+                except (IOError, OSError) as e:
+                    digest = None
+                    existing_hash_mismatch = "Failed to verify {}: {}".format(filename, str(e))
+                if digest is not None and digest != requirement.hash_value:
+                    existing_hash_mismatch = ("Existing file {} has the wrong hash. Expected: {}, calculated: {}"
+                                              .format(filename, requirement.hash_value, digest))
+                if existing_hash_mismatch is not None:
+                    existing_filename = None
         else:
             existing_filename = None
         return _DownloadProviderAnalysis(analysis.config,
                                          analysis.missing_env_vars_to_configure,
                                          analysis.missing_env_vars_to_provide,
-                                         existing_filename=existing_filename)
+                                         existing_filename=existing_filename,
+                                         existing_hash_mismatch=existing_hash_mismatch)
 
-    def _provide_download(self, requirement, context, errors, logs):
-        filename = context.status.analysis.existing_filename
-        if filename is not None:
-            logs.append("Previously downloaded file located at {}".format(filename))
-            return filename
+    def _preferred_mirror_path(self, requirement):
+        return ["download_options", requirement.env_var, "preferred_mirror"]
 
-        filename = os.path.abspath(os.path.join(context.environ['PROJECT_DIR'], requirement.filename))
-        if requirement.unzip:
+    def _ordered_urls(self, requirement, context, ioloop, logs):
+        urls = requirement.urls
+        if len(urls) == 1:
+            return urls
+
+        preferred = context.local_state_file.get_value(self._preferred_mirror_path(requirement), default=None)
+        if preferred in urls:
+            # we already probed on a previous prepare
+            return [preferred] + [url for url in urls if url != preferred]
+
+        prober = MirrorProber(urls)
+        ranked = ioloop.run_sync(lambda: prober.run(ioloop))
+        for error in prober.errors:
+            logs.append(error)
+        # still try the mirrors that didn't answer the probe, as a last resort
+        return ranked + [url for url in urls if url not in ranked]
+
+    def _download_from_url(self, requirement, url, filename, ioloop, errors):
+        streaming = requirement.unzip and requirement.archive_format in STREAMING_FORMATS
+        if requirement.unzip and not streaming:
+            # zip files have their index at the end, so we can't unpack
+            # until the whole thing is on disk
             download_filename = filename + ".zip"
         else:
             download_filename = filename
-        download = FileDownloader(url=requirement.url,
-                                  filename=download_filename,
-                                  hash_algorithm=requirement.hash_algorithm)
 
+        unpacker = None
         try:
-            _ioloop = IOLoop(make_current=False)
-            response = _ioloop.run_sync(lambda: download.run(_ioloop))
+            if streaming:
+                # tarballs and compressed files are unpacked as the bytes
+                # arrive, so we never store the archive itself
+                unpacker = StreamingUnpacker(filename, requirement.archive_format)
+            download = FileDownloader(url=url,
+                                      filename=download_filename,
+                                      hash_algorithm=requirement.hash_algorithm,
+                                      unpacker=unpacker)
+
+            response = ioloop.run_sync(lambda: download.run(ioloop))
             if response is None:
                 for error in download.errors:
                     errors.append(error)
@@ -120,9 +162,17 @@ class DownloadProvider(EnvVarProvider):
             elif response.code == 200:
                 if requirement.hash_value is not None and requirement.hash_value != download.hash:
                     errors.append("Error downloading {}: mismatched hashes. Expected: {}, calculated: {}".format(
-                        requirement.url, requirement.hash_value, download.hash))
+                        url, requirement.hash_value, download.hash))
                     return None
-                if requirement.unzip:
+                if requirement.hash_value is not None and not requirement.unzip:
+                    # remember the hash so we don't have to rehash to verify later
+                    write_sidecar(filename, requirement.hash_algorithm, download.hash)
+                if unpacker is not None:
+                    if unpacker.commit(errors):
+                        return filename
+                    else:
+                        return None
+                elif requirement.unzip:
                     if unpack_zip(download_filename, filename, errors):
                         os.remove(download_filename)
                         return filename
@@ -130,14 +180,62 @@ class DownloadProvider(EnvVarProvider):
                         return None
                 return filename
             else:
-                errors.append("Error downloading {}: response code {}".format(requirement.url, response.code))
+                errors.append("Error downloading {}: response code {}".format(url, response.code))
                 return None
         except Exception as e:
-            errors.append("Error downloading {}: {}".format(requirement.url, str(e)))
+            errors.append("Error downloading {}: {}".format(url, str(e)))
+            return None
+        finally:
+            if unpacker is not None:
+                # no-op if we committed it
+                unpacker.discard()
+
+    def _provide_download(self, requirement, context, errors, logs):
+        filename = context.status.analysis.existing_filename
+        if filename is not None:
+            logs.append("Previously downloaded file located at {}".format(filename))
+            return filename
+
+        if context.status.analysis.existing_hash_mismatch is not None:
+            logs.append(context.status.analysis.existing_hash_mismatch)
+
+        filename = os.path.abspath(os.path.join(context.environ['PROJECT_DIR'], requirement.filename))
+
+        _ioloop = IOLoop(make_current=False)
+        try:
+            urls = self._ordered_urls(requirement, context, _ioloop, logs)
+            for (index, url) in enumerate(urls):
+                attempt_errors = []
+                result = self._download_from_url(requirement, url, filename, _ioloop, attempt_errors)
+                if result is not None:
+                    if len(urls) > 1:
+                        self._remember_preferred_mirror(requirement, context, url, logs)
+                    return result
+                elif index + 1 < len(urls):
+                    # the hash check means any mirror is as good as another
+                    logs.extend(attempt_errors)
+                    logs.append("Trying next mirror for {}.".format(requirement.env_var))
+                else:
+                    errors.extend(attempt_errors)
+            if len(urls) > 1:
+                self._remember_preferred_mirror(requirement, context, None, logs)
             return None
         finally:
             _ioloop.close()
 
+    def _remember_preferred_mirror(self, requirement, context, url, logs):
+        path = self._preferred_mirror_path(requirement)
+        local_state_file = context.local_state_file
+        if local_state_file.get_value(path, default=None) == url:
+            return
+        if url is None:
+            # everything failed, so probe again next time
+            local_state_file.unset_value(path)
+        else:
+            logs.append("Using mirror {} for {}.".format(url, requirement.env_var))
+            local_state_file.set_value(path, url)
+        local_state_file.save()
+
     def provide(self, requirement, context):
         """Override superclass to start a download..
 
@@ -169,6 +267,7 @@ class DownloadProvider(EnvVarProvider):
                 shutil.rmtree(filename)
             elif os.path.isfile(filename):
                 os.remove(filename)
+                remove_sidecar(filename)
             else:
                 return SimpleStatus(success=True,
                                     description=("No need to remove %s which wasn't downloaded." % filename))
@@ -8,23 +8,180 @@
 from __future__ import print_function
 
 import codecs
+from distutils.spawn import find_executable
 import errno
+import json
 import os
+import re
+import shutil
 import subprocess
 import sys
 import time
+import uuid
 
 from conda_kapsel.plugins.provider import (EnvVarProvider, ProviderAnalysis, shutdown_service_run_state,
-                                           delete_service_directory)
+                                           run_shutdown_commands, delete_service_directory, wait_for_service_ready,
+                                           SERVICE_READY, SERVICE_EXITED)
 import conda_kapsel.plugins.network_util as network_util
+import conda_kapsel.plugins.service_supervisor as service_supervisor
+import conda_kapsel.plugins.warm_pool as warm_pool
 from conda_kapsel.provide import PROVIDE_MODE_DEVELOPMENT
 from conda_kapsel.internal import py2_compat
 from conda_kapsel.internal import logged_subprocess
+from conda_kapsel.internal.file_lock import FileLock, user_lock_directory
+from conda_kapsel.internal.rename import rename_over_existing
+from conda_kapsel.internal.simple_status import SimpleStatus
 
 _DEFAULT_SYSTEM_REDIS_HOST = "localhost"
 _DEFAULT_SYSTEM_REDIS_PORT = 6379
 _DEFAULT_SYSTEM_REDIS_URL = "redis://%s:%d" % (_DEFAULT_SYSTEM_REDIS_HOST, _DEFAULT_SYSTEM_REDIS_PORT)
 
+_DEFAULT_LOWER_PORT = 6380  # one above 6379 default Redis
+_DEFAULT_UPPER_PORT = 6449  # entirely arbitrary
+
+# inline command syntax, so we don't need a client library to check on the server
+_REDIS_PING = b"PING\r\n"
+_REDIS_PONG = b"+PONG"
+# redis-server logs this (with varying capitalization and suffix) when it's listening
+_REDIS_READY_MARKER = "ready to accept connections"
+_REDIS_READY_TIMEOUT = 10
+
+_PERSISTENCE_MODES = ('none', 'snapshot', 'append_only')
+_MAXMEMORY_POLICIES = ('noeviction', 'allkeys-lru', 'volatile-lru', 'allkeys-lfu', 'volatile-lfu', 'allkeys-random',
+                       'volatile-random', 'volatile-ttl')
+_APPENDFSYNC_MODES = ('always', 'everysec', 'no')
+_MEMORY_SIZE_PATTERN = re.compile(r'^[0-9]+(b|k|kb|m|mb|g|gb)?$', re.IGNORECASE)
+
+
+def _parse_persistence(value):
+    if value is False:
+        return 'none'
+    if value in _PERSISTENCE_MODES:
+        return value
+    return None
+
+
+def _parse_maxmemory(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int) and value > 0:
+        return str(value)
+    if py2_compat.is_string(value) and _MEMORY_SIZE_PATTERN.match(value.strip()):
+        return value.strip().lower()
+    return None
+
+
+def _parse_choice(choices):
+    def parse(value):
+        if value in choices:
+            return value
+        return None
+
+    return parse
+
+
+def _parse_io_threads(value):
+    if isinstance(value, bool):
+        return None
+    try:
+        threads = int(value)
+    except (TypeError, ValueError):
+        return None
+    if threads < 1:
+        return None
+    return threads
+
+
+# performance profile options, which can go in the services: entry or
+# service_options, with the parser for each and what to say if it's bad
+_PROFILE_OPTIONS = (
+    ('persistence', _parse_persistence, "one of " + ", ".join(_PERSISTENCE_MODES)),
+    ('maxmemory', _parse_maxmemory, "a size like 100mb"),
+    ('maxmemory_policy', _parse_choice(_MAXMEMORY_POLICIES), "one of " + ", ".join(_MAXMEMORY_POLICIES)),
+    ('io_threads', _parse_io_threads, "a positive number"),
+    ('appendfsync', _parse_choice(_APPENDFSYNC_MODES), "one of " + ", ".join(_APPENDFSYNC_MODES)))
+
+
+def _profile_args(config):
+    args = []
+    persistence = config['persistence']
+    if persistence == 'none':
+        # an empty save line turns off snapshots
+        args.extend(['--save', '', '--appendonly', 'no'])
+    elif persistence == 'snapshot':
+        args.extend(['--appendonly', 'no'])
+    elif persistence == 'append_only':
+        args.extend(['--appendonly', 'yes'])
+    if config['maxmemory'] is not None:
+        args.extend(['--maxmemory', config['maxmemory']])
+    if config['maxmemory_policy'] is not None:
+        args.extend(['--maxmemory-policy', config['maxmemory_policy']])
+    if config['io_threads'] is not None:
+        # only understood by Redis 6 and newer
+        args.extend(['--io-threads', str(config['io_threads'])])
+    if config['appendfsync'] is not None:
+        args.extend(['--appendfsync', config['appendfsync']])
+    return args
+
+
+def _shared_server_settings(config):
+    return dict(unix_socket=config['unix_socket'], profile=_profile_args(config))
+
+
+# the shared redis-server gives each project its own database number;
+# database 0 is left alone for anyone poking at the server by hand
+_SHARED_REDIS_DATABASES = 256
+
+
+def _shared_redis_directory():
+    return user_lock_directory("kapsel-shared-redis")
+
+
+def _load_shared_state(directory):
+    try:
+        with codecs.open(os.path.join(directory, "shared-redis.json"), 'r', 'utf-8') as f:
+            state = json.load(f)
+    except (IOError, OSError, ValueError):
+        state = dict()
+    if not isinstance(state, dict):
+        state = dict()
+    state.setdefault('server', dict())
+    state.setdefault('databases', dict())
+    return state
+
+
+def _save_shared_state(directory, state):
+    filename = os.path.join(directory, "shared-redis.json")
+    tmp = filename + ".tmp-" + str(uuid.uuid4())
+    with codecs.open(tmp, 'w', 'utf-8') as f:
+        json.dump(state, f, sort_keys=True, indent=2)
+    rename_over_existing(tmp, filename)
+
+
+def _server_address(server):
+    if 'unix_socket' in server:
+        return server['unix_socket']
+    else:
+        return ('localhost', server['port'])
+
+
+def _server_is_alive(server):
+    if 'unix_socket' not in server and 'port' not in server:
+        return False
+    return network_util.socket_handshake_succeeds(_server_address(server), _REDIS_PING, _REDIS_PONG)
+
+
+def _shared_database_url(server, database):
+    if 'unix_socket' in server:
+        return "unix://{path}?db={database}".format(path=server['unix_socket'], database=database)
+    else:
+        return "redis://localhost:{port}/{database}".format(port=server['port'], database=database)
+
+
+def _flush_shared_database(server, database):
+    request = "SELECT {database}\r\nFLUSHDB\r\n".format(database=database).encode('ascii')
+    return network_util.socket_handshake_succeeds(_server_address(server), request, b"+OK\r\n+OK\r\n")
+
 
 class _RedisProviderAnalysis(ProviderAnalysis):
     """Subtype of ProviderAnalysis with extra fields RedisProvider needs to track."""
@@ -38,7 +195,13 @@ class _RedisProviderAnalysis(ProviderAnalysis):
 
 # future: this should introduce a requirement that redis-server is on path
 class RedisProvider(EnvVarProvider):
-    """Runs a project-scoped Redis process (each project needing Redis gets its own)."""
+    """Runs a project-scoped Redis process (each project needing Redis gets its own).
+
+    With ``scope: shared``, projects instead get their own database
+    number on a single redis-server that all of the user's projects share.
+    That server keeps the ``unix_socket`` and performance profile options
+    of whichever project started it.
+    """
 
     @classmethod
     def _parse_port_range(cls, s):
@@ -68,12 +231,12 @@ class RedisProvider(EnvVarProvider):
 
         section = self._config_section(requirement)
 
-        scope = local_state_file.get_value(section + ['scope'], default='all')
+        scope = local_state_file.get_value(section + ['scope'], default=requirement.options.get('scope', 'all'))
         if config['source'] == 'unset':
             config['source'] = 'find_' + scope
 
-        default_lower_port = 6380  # one above 6379 default Redis
-        default_upper_port = 6449  # entirely arbitrary
+        default_lower_port = _DEFAULT_LOWER_PORT
+        default_upper_port = _DEFAULT_UPPER_PORT
         default_port_range = "%d-%d" % (default_lower_port, default_upper_port)
         port_range_string = local_state_file.get_value(section + ['port_range'], default=default_port_range)
         parsed_port_range = self._parse_port_range(port_range_string)
@@ -86,6 +249,25 @@ class RedisProvider(EnvVarProvider):
             config['lower_port'] = parsed_port_range[0]
             config['upper_port'] = parsed_port_range[1]
 
+        # these can go in the services: entry, and local state can override them
+        def option(name, default=None):
+            return local_state_file.get_value(section + [name], default=requirement.options.get(name, default))
+
+        unix_socket = option('unix_socket', default=False)
+        if not isinstance(unix_socket, bool):
+            print("Invalid unix_socket '%s', should be true or false" % (unix_socket), file=sys.stderr)
+            unix_socket = False
+        config['unix_socket'] = unix_socket
+
+        for (name, parse, expected) in _PROFILE_OPTIONS:
+            value = option(name)
+            parsed = None
+            if value is not None:
+                parsed = parse(value)
+                if parsed is None:
+                    print("Invalid %s '%s', should be %s" % (name, value, expected), file=sys.stderr)
+            config[name] = parsed
+
         return config
 
     def set_config_values_as_strings(self, requirement, environ, local_state_file, default_env_spec_name, overrides,
@@ -102,6 +284,16 @@ class RedisProvider(EnvVarProvider):
 
         local_state_file.set_value(section + ['port_range'], "%s-%s" % (lower_port, upper_port))
 
+        if 'unix_socket' in values:
+            local_state_file.set_value(section + ['unix_socket'], values['unix_socket'] in (True, 'true', 'True'))
+
+        for (name, parse, expected) in _PROFILE_OPTIONS:
+            if name in values:
+                if values[name] in (None, ''):
+                    local_state_file.unset_value(section + [name])
+                else:
+                    local_state_file.set_value(section + [name], values[name])
+
         if 'source' in values:
             if values['source'] == 'find_all':
                 scope = 'all'
@@ -109,6 +301,8 @@ class RedisProvider(EnvVarProvider):
                 scope = 'project'
             elif values['source'] == 'find_system':
                 scope = 'system'
+            elif values['source'] == 'find_shared':
+                scope = 'shared'
             else:
                 scope = None
             if scope is not None:
@@ -129,8 +323,25 @@ class RedisProvider(EnvVarProvider):
                                                                 default_env_spec_name, overrides, values)
 
     def _previously_run_redis_url_if_alive(self, run_state):
+        if 'shared_key' in run_state:
+            state = _load_shared_state(_shared_redis_directory())
+            database = state['databases'].get(run_state['shared_key'], None)
+            if database is not None and database == run_state['database'] and _server_is_alive(state['server']):
+                return _shared_database_url(state['server'], database)
+            return None
+        if 'supervisor_key' in run_state:
+            # the supervisor is already health checking it, so we don't have to
+            status = service_supervisor.supervised_service_status(run_state['supervisor_key'])
+            if status == service_supervisor.STATUS_RUNNING:
+                if 'unix_socket' in run_state:
+                    return "unix://{path}".format(path=run_state['unix_socket'])
+                return "redis://localhost:{port}".format(port=run_state['port'])
+            elif status == service_supervisor.STATUS_RESTARTING:
+                return None
         if 'port' in run_state and network_util.can_connect_to_socket(host='localhost', port=run_state['port']):
             return "redis://localhost:{port}".format(port=run_state['port'])
+        elif 'unix_socket' in run_state and network_util.can_connect_to_unix_socket(run_state['unix_socket']):
+            return "unix://{path}".format(path=run_state['unix_socket'])
         else:
             return None
 
@@ -167,8 +378,16 @@ class RedisProvider(EnvVarProvider):
   <div>
     <label><input type="radio" name="source" value="find_project"/>%s</label>
   </div>
+  <div>
+    <label><input type="radio" name="source" value="find_shared"/>Use a database on a redis-server shared
+        with other projects</label>
+  </div>
 """ % (system_option, project_option)
 
+    def env_prefix_needed(self, requirement, environ, local_state_file):
+        """Override superclass so we don't wait for the environment if redis-server is installed elsewhere."""
+        return find_executable('redis-server', environ.get('PATH', os.defpath)) is None
+
     def analyze(self, requirement, environ, local_state_file, default_env_spec_name, overrides):
         """Override superclass to store additional fields in the analysis."""
         analysis = super(RedisProvider, self).analyze(requirement, environ, local_state_file, default_env_spec_name,
@@ -201,108 +420,306 @@ class RedisProvider(EnvVarProvider):
             # require the user to have set up anything in advance,
             # e.g. if we use Chalmers we should automatically take
             # care of configuring/starting Chalmers itself.
+            was_shared = 'shared_key' in run_state
+            if was_shared:
+                # switching from the shared server to our own
+                self._release_shared_database(run_state['shared_key'])
+                run_state.clear()
+
+            # if we were using the shared server, the previous url is
+            # the database we just released, not a server of our own
             url = context.status.analysis.existing_scoped_instance_url
-            if url is not None:
+            if url is not None and not was_shared:
                 logs.append("Using redis-server we started previously at {url}".format(url=url))
                 return url
 
+            if 'supervisor_key' in run_state:
+                # we're replacing it, so don't let the supervisor bring it back
+                service_supervisor.unsupervise_service(run_state['supervisor_key'])
+            if 'pool_instance' in run_state:
+                # it came from the warm pool and has since died
+                shutil.rmtree(run_state['pool_instance'], ignore_errors=True)
             run_state.clear()
 
+            if warm_pool.pool_size('redis', context.environ) > 0:
+                url = self._claim_pool_instance(config, run_state, context, logs)
+                if url is not None:
+                    return url
+
             workdir = context.ensure_service_directory(requirement.env_var)
-            pidfile = os.path.join(workdir, "redis.pid")
-            logfile = os.path.join(workdir, "redis.log")
-
-            # 6379 is the default Redis port; leave that one free
-            # for a systemwide Redis. Try looking for a port above
-            # it. This is a pretty huge hack and a race condition,
-            # but Redis doesn't as far as I know have "let the OS
-            # pick the port" mode.
-            LOWER_PORT = config['lower_port']
-            UPPER_PORT = config['upper_port']
-            port = LOWER_PORT
-            while port <= UPPER_PORT:
-                if not network_util.can_connect_to_socket(host='localhost', port=port):
-                    break
-                port += 1
-            if port > UPPER_PORT:
-                errors.append(("All ports from {lower} to {upper} were in use, " +
-                               "could not start redis-server on one of them.").format(lower=LOWER_PORT,
-                                                                                      upper=UPPER_PORT))
+            return self._start_redis_in(workdir, config, run_state, context.environ, errors, logs)
+
+        return context.transform_service_run_state(requirement.env_var, ensure_redis)
+
+    def _pool_instance_usable(self, instance, config):
+        port = instance['run_state'].get('port', None)
+        return (not config['unix_socket'] and instance.get('profile', None) == _profile_args(config) and
+                port is not None and config['lower_port'] <= port <= config['upper_port'] and
+                self.pool_instance_is_alive(instance))
+
+    def _claim_pool_instance(self, config, run_state, context, logs):
+        instance = warm_pool.claim_instance('redis', lambda instance: self._pool_instance_usable(instance, config))
+        # replace what we took, or fill the pool for next time
+        warm_pool.refill_in_background('redis', self.__class__.__name__, context.environ)
+        if instance is None:
+            return None
+        run_state.update(instance['run_state'])
+        run_state['pool_instance'] = instance['directory']
+        logs.append("Using redis-server from the warm pool at {url}".format(url=instance['url']))
+        return instance['url']
+
+    def start_pool_instance(self, directory, environ):
+        """Start an idle redis-server for the warm pool (see ``conda_kapsel.plugins.warm_pool``)."""
+        config = dict(lower_port=_DEFAULT_LOWER_PORT, upper_port=_DEFAULT_UPPER_PORT, unix_socket=False)
+        for (name, parse, expected) in _PROFILE_OPTIONS:
+            config[name] = None
+        run_state = dict()
+        url = self._start_redis_in(directory, config, run_state, environ, [], [], supervise=False)
+        if url is None:
+            return None
+        return dict(url=url, run_state=run_state, profile=_profile_args(config))
+
+    def pool_instance_is_alive(self, instance):
+        """True if a warm pool instance is still answering."""
+        return _server_is_alive(instance['run_state'])
+
+    def _provide_shared(self, requirement, context, errors, logs):
+        config = context.status.analysis.config
+        key = "%s:%s" % (os.path.dirname(os.path.abspath(context.local_state_file.filename)), requirement.env_var)
+
+        def ensure_shared_database(run_state):
+            if 'shared_key' not in run_state:
+                # we had a dedicated redis-server; don't leave it running
+                if 'supervisor_key' in run_state:
+                    service_supervisor.unsupervise_service(run_state['supervisor_key'])
+                run_shutdown_commands("redis-server", run_state, logs)
+                if 'pool_instance' in run_state:
+                    shutil.rmtree(run_state['pool_instance'], ignore_errors=True)
+                run_state.clear()
+
+            directory = _shared_redis_directory()
+            with FileLock(os.path.join(directory, "shared-redis.lock")):
+                state = _load_shared_state(directory)
+                server = state['server']
+                if not _server_is_alive(server):
+                    server = dict()
+                    url = self._start_redis_in(directory,
+                                               config,
+                                               server,
+                                               context.environ,
+                                               errors,
+                                               logs,
+                                               extra_args=['--databases', str(_SHARED_REDIS_DATABASES)])
+                    if url is None:
+                        return None
+                    # a new server means nobody's databases exist anymore
+                    state = dict(server=server, databases=dict(), settings=_shared_server_settings(config))
+                elif 'settings' in state and state['settings'] != _shared_server_settings(config):
+                    # whoever starts the server picks its settings, and
+                    # we can't change them under the other projects
+                    logs.append("The shared redis-server was started with another project's settings, so this " +
+                                "project's unix_socket and performance profile options don't apply to it.")
+
+                databases = state['databases']
+                database = databases.get(key, None)
+                if database is None:
+                    in_use = set(databases.values())
+                    free = [n for n in range(1, _SHARED_REDIS_DATABASES) if n not in in_use]
+                    if len(free) == 0:
+                        errors.append("All {count} databases on the shared redis-server are in use.".format(
+                            count=_SHARED_REDIS_DATABASES - 1))
+                        return None
+                    database = free[0]
+                    # in case a project didn't clean up after itself
+                    _flush_shared_database(server, database)
+                    databases[key] = database
+                    _save_shared_state(directory, state)
+
+            run_state.clear()
+            run_state['shared_key'] = key
+            run_state['database'] = database
+            url = _shared_database_url(server, database)
+            logs.append("Using database {database} on the shared redis-server at {url}".format(database=database,
+                                                                                               url=url))
+            return url
+
+        return context.transform_service_run_state(requirement.env_var, ensure_shared_database)
+
+    def _release_shared_database(self, key):
+        """Give back our database, shutting down the shared server if nobody else uses it."""
+        errors = []
+        directory = _shared_redis_directory()
+        with FileLock(os.path.join(directory, "shared-redis.lock")):
+            state = _load_shared_state(directory)
+            server = state['server']
+            database = state['databases'].pop(key, None)
+            if database is not None and _server_is_alive(server):
+                _flush_shared_database(server, database)
+            if len(state['databases']) == 0:
+                run_shutdown_commands("shared redis-server", server, errors)
+                state = dict()
+                description = "Shut down the shared redis-server."
+            else:
+                description = "Released our database on the shared redis-server, still used by {count} others.".format(
+                    count=len(state['databases']))
+            _save_shared_state(directory, state)
+
+        if errors:
+            return SimpleStatus(success=False,
+                                description="Shutdown commands failed for the shared redis-server.",
+                                errors=errors)
+        else:
+            return SimpleStatus(success=True, description=description)
+
+    def _start_redis_in(self, workdir, config, run_state, environ, errors, logs, extra_args=(), supervise=True):
+        pidfile = os.path.join(workdir, "redis.pid")
+        logfile = os.path.join(workdir, "redis.log")
+        # keep any snapshot or append-only file in the service directory
+        extra_args = ['--dir', workdir] + _profile_args(config) + list(extra_args)
+
+        if config['unix_socket']:
+            if network_util.unix_sockets_supported():
+                # no port to pick, and no way to collide with another project
+                unix_socket = os.path.join(workdir, "redis.sock")
+                return self._start_redis(pidfile, logfile, None, unix_socket, run_state, environ, errors, logs,
+                                         extra_args, supervise)
+            logs.append("Unix domain sockets aren't available on this platform, using a TCP port for Redis.")
+
+        # 6379 is the default Redis port; leave that one free
+        # for a systemwide Redis. Redis doesn't have a "let the OS
+        # pick the port" mode, so we reserve a port above it with a
+        # lock file until redis-server is listening there.
+        LOWER_PORT = config['lower_port']
+        UPPER_PORT = config['upper_port']
+        reservation = network_util.reserve_port(LOWER_PORT, UPPER_PORT)
+        unix_socket = None
+        if reservation is None:
+            message = ("All ports from {lower} to {upper} were in use, " +
+                       "could not start redis-server on one of them.").format(lower=LOWER_PORT, upper=UPPER_PORT)
+            if not network_util.unix_sockets_supported():
+                errors.append(message)
                 return None
+            logs.append(message + " Using a Unix domain socket instead.")
+            unix_socket = os.path.join(workdir, "redis.sock")
 
-            # be sure we don't get confused by an old log file
+        try:
+            return self._start_redis(pidfile, logfile, reservation, unix_socket, run_state, environ, errors, logs,
+                                     extra_args, supervise)
+        finally:
+            if reservation is not None:
+                reservation.release()
+
+    def _start_redis(self, pidfile, logfile, reservation, unix_socket, run_state, environ, errors, logs, extra_args,
+                     supervise):
+        # be sure we don't get confused by an old log file, or by
+        # the pidfile of a redis-server that crashed without removing it
+        for leftover in (logfile, pidfile):
             try:
-                os.remove(logfile)
+                os.remove(leftover)
             except IOError:  # pragma: no cover (py3 only)
                 pass
             except OSError:  # pragma: no cover (py2 only)
                 pass
 
-            command = ['redis-server', '--pidfile', pidfile, '--logfile', logfile, '--daemonize', 'yes', '--port',
-                       str(port)]
-            logs.append("Starting " + repr(command))
+        if unix_socket is not None:
+            # port 0 means don't listen on TCP at all
+            listen_args = ['--port', '0', '--unixsocket', unix_socket]
+        else:
+            port = reservation.port
+            listen_args = ['--port', str(port)]
+        command = ['redis-server', '--pidfile', pidfile, '--logfile', logfile, '--daemonize', 'yes']
+        command = command + list(extra_args) + listen_args
+        logs.append("Starting " + repr(command))
+
+        # we don't close_fds=True because on Windows that is documented to
+        # keep us from collected stderr. But on Unix it's kinda broken not
+        # to close_fds. Hmm.
+        launched_at = time.time()
+        try:
+            popen = logged_subprocess.Popen(args=command,
+                                            stderr=subprocess.PIPE,
+                                            env=py2_compat.env_without_unicode(environ))
+        except Exception as e:
+            errors.append("Error executing redis-server: %s" % (str(e)))
+            return None
 
-            # we don't close_fds=True because on Windows that is documented to
-            # keep us from collected stderr. But on Unix it's kinda broken not
-            # to close_fds. Hmm.
-            try:
-                popen = logged_subprocess.Popen(args=command,
-                                                stderr=subprocess.PIPE,
-                                                env=py2_compat.env_without_unicode(context.environ))
-            except Exception as e:
-                errors.append("Error executing redis-server: %s" % (str(e)))
-                return None
+        # communicate() waits for the process to exit, which
+        # is supposed to happen immediately due to --daemonize
+        (out, err) = popen.communicate()
+        assert out is None  # because we didn't PIPE it
+        err = err.decode(errors='replace')
+
+        if unix_socket is not None:
+            where = "socket %s" % unix_socket
+            address = unix_socket
+        else:
+            where = "port %d" % port
+            address = ('localhost', port)
 
-            # communicate() waits for the process to exit, which
-            # is supposed to happen immediately due to --daemonize
-            (out, err) = popen.communicate()
-            assert out is None  # because we didn't PIPE it
-            err = err.decode(errors='replace')
-
-            url = None
-            if popen.returncode == 0:
-                # now we need to wait for Redis to be ready
-                redis_is_ready = False
-                MAX_WAIT_TIME = 10
-                so_far = 0
-                while so_far < MAX_WAIT_TIME:
-                    increment = MAX_WAIT_TIME / 500.0
-                    time.sleep(increment)
-                    so_far += increment
-                    if network_util.can_connect_to_socket(host='localhost', port=port):
-                        redis_is_ready = True
-                        break
-
-                if redis_is_ready:
+        def ping():
+            return network_util.socket_handshake_succeeds(address, _REDIS_PING, _REDIS_PONG)
+
+        url = None
+        if popen.returncode == 0:
+            # now we need to wait for Redis to be ready
+            readiness = wait_for_service_ready(ping,
+                                               pidfile=pidfile,
+                                               logfile=logfile,
+                                               ready_marker=_REDIS_READY_MARKER,
+                                               timeout_seconds=_REDIS_READY_TIMEOUT,
+                                               launched_at=launched_at)
+
+            if readiness == SERVICE_READY:
+                # lets shutdown kill it if redis-cli can't stop it
+                run_state['pidfile'] = pidfile
+                if unix_socket is not None:
+                    run_state['unix_socket'] = unix_socket
+                    url = "unix://{path}".format(path=unix_socket)
+                    run_state['shutdown_commands'] = [['redis-cli', '-s', unix_socket, 'shutdown']]
+                else:
                     run_state['port'] = port
                     url = "redis://localhost:{port}".format(port=port)
 
                     # note: --port doesn't work, only -p, and the failure with --port is silent.
                     run_state['shutdown_commands'] = [['redis-cli', '-p', str(port), 'shutdown']]
-                else:
-                    logs.append("redis-server started successfully, but we timed out trying to connect to it on port %d"
-                                % (port))
 
-            if url is None:
-                for line in err.split("\n"):
-                    if line != "":
-                        logs.append(line)
-                try:
-                    with codecs.open(logfile, 'r', 'utf-8') as log:
-                        for line in log.readlines():
-                            logs.append(line)
-                except IOError as e:
-                    # just be silent if redis-server failed before creating a log file,
-                    # that's fine. Hopefully it had some stderr.
-                    if e.errno != errno.ENOENT:
-                        logs.append("Failed to read {logfile}: {error}".format(logfile=logfile, error=e))
-
-                errors.append("redis-server process failed or timed out, exited with code {code}".format(
-                    code=popen.returncode))
-
-            return url
+                if supervise and service_supervisor.supervisor_enabled(environ):
+                    self._supervise(command, pidfile, address, run_state, environ, logs)
+            elif readiness == SERVICE_EXITED:
+                logs.append("redis-server started successfully, but it exited before accepting connections on %s" %
+                            (where))
+            else:
+                logs.append("redis-server started successfully, but we timed out trying to connect to it on %s" %
+                            (where))
 
-        return context.transform_service_run_state(requirement.env_var, ensure_redis)
+        if url is None:
+            for line in err.split("\n"):
+                if line != "":
+                    logs.append(line)
+            try:
+                with codecs.open(logfile, 'r', 'utf-8') as log:
+                    for line in log.readlines():
+                        logs.append(line)
+            except IOError as e:
+                # just be silent if redis-server failed before creating a log file,
+                # that's fine. Hopefully it had some stderr.
+                if e.errno != errno.ENOENT:
+                    logs.append("Failed to read {logfile}: {error}".format(logfile=logfile, error=e))
+
+            errors.append("redis-server process failed or timed out, exited with code {code}".format(
+                code=popen.returncode))
+
+        return url
+
+    def _supervise(self, command, pidfile, address, run_state, environ, logs):
+        # the pidfile is unique to this project and service
+        key = pidfile
+        probe = dict(address=address, request=_REDIS_PING.decode('ascii'), expected_reply=_REDIS_PONG.decode('ascii'))
+        if service_supervisor.supervise_service(key, command, pidfile, probe=probe, environ=dict(environ)):
+            run_state['supervisor_key'] = key
+            logs.append("The service supervisor will restart redis-server if it stops.")
+        else:
+            logs.append("Could not reach the service supervisor, redis-server won't be restarted if it stops.")
 
     def provide(self, requirement, context):
         """Override superclass to start a project-scoped redis-server.
@@ -331,6 +748,10 @@ class RedisProvider(EnvVarProvider):
             if context.mode == PROVIDE_MODE_DEVELOPMENT:
                 url = self._provide_project(requirement, context, errors, logs)
 
+        if url is None and source == 'find_shared':
+            if context.mode == PROVIDE_MODE_DEVELOPMENT:
+                url = self._provide_shared(requirement, context, errors, logs)
+
         if url is not None:
             context.environ[requirement.env_var] = url
 
@@ -338,6 +759,15 @@ class RedisProvider(EnvVarProvider):
 
     def unprovide(self, requirement, environ, local_state_file, overrides, requirement_status=None):
         """Override superclass to shut down any redis-server we started."""
+        run_state = local_state_file.get_service_run_state(requirement.env_var)
+        if 'shared_key' in run_state:
+            status = self._release_shared_database(run_state['shared_key'])
+            local_state_file.set_service_run_state(requirement.env_var, dict())
+            local_state_file.save()
+            delete_service_directory(local_state_file, requirement.env_var)
+            return status
         status = shutdown_service_run_state(local_state_file, requirement.env_var)
         delete_service_directory(local_state_file, requirement.env_var)
+        if 'pool_instance' in run_state:
+            shutil.rmtree(run_state['pool_instance'], ignore_errors=True)
         return status
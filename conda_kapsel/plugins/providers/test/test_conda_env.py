@@ -131,7 +131,11 @@ def test_unprepare_gets_error_on_delete(monkeypatch):
         def mock_rmtree(path):
             raise IOError("I will never rm the tree!")
 
+        def mock_rename_to_trash(path):
+            raise OSError("I will never rename the tree!")
+
         monkeypatch.setattr('shutil.rmtree', mock_rmtree)
+        monkeypatch.setattr('conda_kapsel.internal.trash._rename_to_trash', mock_rename_to_trash)
 
         status = unprepare(project, result)
         assert status.status_description == ('Failed to remove environment files in %s: I will never rm the tree!.' %
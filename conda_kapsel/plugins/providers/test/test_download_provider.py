@@ -7,8 +7,11 @@
 from __future__ import absolute_import
 
 import codecs
+import hashlib
+import io
 import os
 import shutil
+import tarfile
 import zipfile
 
 from conda_kapsel.test.project_utils import project_no_dedicated_env
@@ -17,6 +20,7 @@ from conda_kapsel.internal.test.tmpfile_utils import (with_directory_contents,
                                                       complete_project_file_content)
 from conda_kapsel.test.environ_utils import minimal_environ, strip_environ
 from conda_kapsel.internal.test.http_utils import http_get_async, http_post_async
+from conda_kapsel.internal.hash_sidecar import SIDECAR_SUFFIX
 from conda_kapsel.local_state_file import DEFAULT_LOCAL_STATE_FILENAME
 from conda_kapsel.local_state_file import LocalStateFile
 from conda_kapsel.plugins.registry import PluginRegistry
@@ -35,6 +39,14 @@ DATAFILE_CONTENT = ("downloads:\n"
                     "        md5: 12345abcdef\n"
                     "        filename: data.csv\n")
 
+DATAFILE_MD5 = hashlib.md5(b'data').hexdigest()
+
+DATAFILE_CONTENT_CORRECT_CHECKSUM = ("downloads:\n"
+                                     "    DATAFILE:\n"
+                                     "        url: http://localhost/data.csv\n"
+                                     "        md5: %s\n"
+                                     "        filename: data.csv\n") % DATAFILE_MD5
+
 ZIPPED_DATAFILE_CONTENT = ("downloads:\n"
                            "    DATAFILE:\n"
                            "        url: http://localhost/data.zip\n"
@@ -328,11 +340,73 @@ def test_file_exists(monkeypatch):
 
     with_directory_contents_completing_project_file(
         {
-            DEFAULT_PROJECT_FILENAME: DATAFILE_CONTENT,
+            DEFAULT_PROJECT_FILENAME: DATAFILE_CONTENT_CORRECT_CHECKSUM,
             DEFAULT_LOCAL_STATE_FILENAME: LOCAL_STATE
         }, provide_download)
 
 
+def test_file_exists_hash_is_cached_in_sidecar(monkeypatch):
+    def provide_download(dirname):
+        FILENAME = os.path.join(dirname, 'data.csv')
+        with open(FILENAME, 'w') as out:
+            out.write('data')
+        project = project_no_dedicated_env(dirname)
+
+        result = prepare_without_interaction(project, environ=minimal_environ(PROJECT_DIR=dirname))
+        assert result
+        assert os.path.isfile(FILENAME + SIDECAR_SUFFIX)
+
+        def mock_compute_file_hash(filename, algorithm):
+            raise AssertionError("should have used the sidecar instead of hashing")
+
+        monkeypatch.setattr('conda_kapsel.internal.hash_sidecar.compute_file_hash', mock_compute_file_hash)
+
+        result = prepare_without_interaction(project, environ=minimal_environ(PROJECT_DIR=dirname))
+        assert result
+        assert result.environ['DATAFILE'] == FILENAME
+
+    with_directory_contents_completing_project_file({DEFAULT_PROJECT_FILENAME: DATAFILE_CONTENT_CORRECT_CHECKSUM},
+                                                    provide_download)
+
+
+def test_file_exists_with_wrong_hash_is_downloaded_again(monkeypatch):
+    def provide_download(dirname):
+        FILENAME = os.path.join(dirname, 'data.csv')
+        with open(FILENAME, 'w') as out:
+            out.write('corrupted')
+
+        @gen.coroutine
+        def mock_downloader_run(self, loop):
+            class Res:
+                pass
+
+            res = Res()
+            res.code = 200
+            with open(FILENAME, 'w') as out:
+                out.write('data')
+            self._hash = DATAFILE_MD5
+            raise gen.Return(res)
+
+        monkeypatch.setattr("conda_kapsel.internal.http_client.FileDownloader.run", mock_downloader_run)
+        project = project_no_dedicated_env(dirname)
+
+        result = prepare_without_interaction(project, environ=minimal_environ(PROJECT_DIR=dirname))
+        assert result
+        assert ("Existing file %s has the wrong hash. Expected: %s, calculated: %s" %
+                (FILENAME, DATAFILE_MD5, hashlib.md5(b'corrupted').hexdigest())) in result.logs
+        with open(FILENAME, 'r') as f:
+            assert f.read() == 'data'
+        assert os.path.isfile(FILENAME + SIDECAR_SUFFIX)
+
+        status = unprepare(project, result)
+        assert status
+        assert not os.path.exists(FILENAME)
+        assert not os.path.exists(FILENAME + SIDECAR_SUFFIX)
+
+    with_directory_contents_completing_project_file({DEFAULT_PROJECT_FILENAME: DATAFILE_CONTENT_CORRECT_CHECKSUM},
+                                                    provide_download)
+
+
 def test_prepare_download_of_zip_file(monkeypatch):
     def provide_download_of_zip(zipname, dirname):
         with codecs.open(os.path.join(dirname, DEFAULT_PROJECT_FILENAME), 'w', 'utf-8') as f:
@@ -497,6 +571,199 @@ def test_prepare_download_of_broken_zip_file(monkeypatch):
     with_directory_contents(dict(), provide_download_of_zip)
 
 
+TARBALL_DATAFILE_CONTENT = ("downloads:\n"
+                            "    DATAFILE:\n"
+                            "        url: http://localhost/data.tar.gz\n"
+                            "        filename: data\n"
+                            "        unzip: true\n")
+
+
+def _tarball_bytes(contents):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tf:
+        for name, data in contents.items():
+            data = data.encode('utf-8')
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def test_prepare_download_of_tarball_unpacks_while_streaming(monkeypatch):
+    def provide_download_of_tarball(dirname):
+        tarball = _tarball_bytes(dict(foo='hello\n'))
+
+        @gen.coroutine
+        def mock_downloader_run(self, loop):
+            class Res:
+                pass
+
+            res = Res()
+            res.code = 200
+            assert self._url.endswith(".tar.gz")
+            assert self._unpacker is not None
+            for i in range(0, len(tarball), 10):
+                self._unpacker.write(tarball[i:i + 10])
+            self._unpacker.finish()
+            raise gen.Return(res)
+
+        monkeypatch.setattr("conda_kapsel.internal.http_client.FileDownloader.run", mock_downloader_run)
+
+        project = project_no_dedicated_env(dirname)
+
+        result = prepare_without_interaction(project, environ=minimal_environ(PROJECT_DIR=dirname))
+        assert hasattr(result, 'environ')
+        assert 'DATAFILE' in result.environ
+        assert os.path.isdir(os.path.join(dirname, 'data'))
+        assert codecs.open(os.path.join(dirname, 'data', 'foo')).read() == 'hello\n'
+        # we never stored the tarball itself or left temporaries around
+        assert sorted(os.listdir(dirname)) == sorted([DEFAULT_PROJECT_FILENAME, DEFAULT_LOCAL_STATE_FILENAME, 'data'])
+
+    with_directory_contents_completing_project_file({DEFAULT_PROJECT_FILENAME: TARBALL_DATAFILE_CONTENT},
+                                                    provide_download_of_tarball)
+
+
+def test_prepare_download_of_tarball_mismatched_checksum_discards(monkeypatch):
+    def provide_download_of_tarball(dirname):
+        tarball = _tarball_bytes(dict(foo='hello\n'))
+
+        @gen.coroutine
+        def mock_downloader_run(self, loop):
+            class Res:
+                pass
+
+            res = Res()
+            res.code = 200
+            self._unpacker.write(tarball)
+            self._unpacker.finish()
+            self._hash = 'abcdef'
+            raise gen.Return(res)
+
+        monkeypatch.setattr("conda_kapsel.internal.http_client.FileDownloader.run", mock_downloader_run)
+
+        project = project_no_dedicated_env(dirname)
+
+        result = prepare_without_interaction(project, environ=minimal_environ(PROJECT_DIR=dirname))
+        assert not result
+        assert ('Error downloading http://localhost/data.tar.gz: mismatched hashes. '
+                'Expected: 12345abcdef, calculated: abcdef') in result.errors
+        assert sorted(os.listdir(dirname)) == sorted([DEFAULT_PROJECT_FILENAME, DEFAULT_LOCAL_STATE_FILENAME])
+
+    with_directory_contents_completing_project_file(
+        {DEFAULT_PROJECT_FILENAME: TARBALL_DATAFILE_CONTENT + "        md5: 12345abcdef\n"},
+        provide_download_of_tarball)
+
+
+MIRRORED_DATAFILE_CONTENT = ("downloads:\n"
+                             "    DATAFILE:\n"
+                             "        url: http://localhost/data.csv\n"
+                             "        mirrors:\n"
+                             "          - http://mirror1/data.csv\n"
+                             "          - http://mirror2/data.csv\n"
+                             "        md5: %s\n"
+                             "        filename: data.csv\n") % DATAFILE_MD5
+
+
+def _mock_mirrors(monkeypatch, ranked, failing_urls, probed, downloaded):
+    @gen.coroutine
+    def mock_prober_run(self, loop):
+        probed.append(list(self._urls))
+        raise gen.Return(ranked)
+
+    @gen.coroutine
+    def mock_downloader_run(self, loop):
+        class Res:
+            pass
+
+        downloaded.append(self._url)
+        if self._url in failing_urls:
+            self._errors.append("Failed download to %s: HTTP 404: Not Found" % self._filename)
+            raise gen.Return(None)
+        res = Res()
+        res.code = 200
+        with open(self._filename, 'w') as out:
+            out.write('data')
+        self._hash = DATAFILE_MD5
+        raise gen.Return(res)
+
+    monkeypatch.setattr("conda_kapsel.internal.http_client.MirrorProber.run", mock_prober_run)
+    monkeypatch.setattr("conda_kapsel.internal.http_client.FileDownloader.run", mock_downloader_run)
+
+
+def test_prepare_download_uses_fastest_mirror_and_remembers_it(monkeypatch):
+    def provide_download(dirname):
+        probed = []
+        downloaded = []
+        _mock_mirrors(monkeypatch, ['http://mirror2/data.csv', 'http://localhost/data.csv'], [], probed,
+                      downloaded)
+        project = project_no_dedicated_env(dirname)
+        result = prepare_without_interaction(project, environ=minimal_environ(PROJECT_DIR=dirname))
+        assert result
+        assert probed == [['http://localhost/data.csv', 'http://mirror1/data.csv', 'http://mirror2/data.csv']]
+        assert downloaded == ['http://mirror2/data.csv']
+        assert "Using mirror http://mirror2/data.csv for DATAFILE." in result.logs
+
+        local_state = LocalStateFile.load_for_directory(dirname)
+        assert local_state.get_value(['download_options', 'DATAFILE', 'preferred_mirror']) == 'http://mirror2/data.csv'
+
+        # next time we go straight to the remembered mirror without probing
+        os.remove(os.path.join(dirname, 'data.csv'))
+        project = project_no_dedicated_env(dirname)
+        result = prepare_without_interaction(project, environ=minimal_environ(PROJECT_DIR=dirname))
+        assert result
+        assert len(probed) == 1
+        assert downloaded == ['http://mirror2/data.csv', 'http://mirror2/data.csv']
+
+    with_directory_contents_completing_project_file({DEFAULT_PROJECT_FILENAME: MIRRORED_DATAFILE_CONTENT},
+                                                    provide_download)
+
+
+def test_prepare_download_falls_back_to_next_mirror(monkeypatch):
+    def provide_download(dirname):
+        probed = []
+        downloaded = []
+        # mirror1 didn't answer the probe, so it's tried last
+        _mock_mirrors(monkeypatch, ['http://mirror2/data.csv', 'http://localhost/data.csv'],
+                      ['http://mirror2/data.csv', 'http://localhost/data.csv'], probed, downloaded)
+        project = project_no_dedicated_env(dirname)
+        result = prepare_without_interaction(project, environ=minimal_environ(PROJECT_DIR=dirname))
+        assert result
+        assert downloaded == ['http://mirror2/data.csv', 'http://localhost/data.csv', 'http://mirror1/data.csv']
+        assert "Trying next mirror for DATAFILE." in result.logs
+        assert "Using mirror http://mirror1/data.csv for DATAFILE." in result.logs
+
+        local_state = LocalStateFile.load_for_directory(dirname)
+        assert local_state.get_value(['download_options', 'DATAFILE', 'preferred_mirror']) == 'http://mirror1/data.csv'
+
+    with_directory_contents_completing_project_file({DEFAULT_PROJECT_FILENAME: MIRRORED_DATAFILE_CONTENT},
+                                                    provide_download)
+
+
+def test_prepare_download_all_mirrors_fail(monkeypatch):
+    def provide_download(dirname):
+        probed = []
+        downloaded = []
+        urls = ['http://localhost/data.csv', 'http://mirror1/data.csv', 'http://mirror2/data.csv']
+        _mock_mirrors(monkeypatch, [], urls, probed, downloaded)
+        with codecs.open(os.path.join(dirname, DEFAULT_LOCAL_STATE_FILENAME), 'w', 'utf-8') as f:
+            f.write("download_options:\n  DATAFILE:\n    preferred_mirror: http://mirror1/data.csv\n")
+
+        project = project_no_dedicated_env(dirname)
+        result = prepare_without_interaction(project, environ=minimal_environ(PROJECT_DIR=dirname))
+        assert not result
+        # remembered mirror goes first and we don't probe
+        assert probed == []
+        assert downloaded == ['http://mirror1/data.csv', 'http://localhost/data.csv', 'http://mirror2/data.csv']
+        assert ("Failed download to %s: HTTP 404: Not Found" % os.path.join(dirname, 'data.csv')) in result.errors
+
+        # we forget the remembered mirror so we probe again next time
+        local_state = LocalStateFile.load_for_directory(dirname)
+        assert local_state.get_value(['download_options', 'DATAFILE', 'preferred_mirror']) is None
+
+    with_directory_contents_completing_project_file({DEFAULT_PROJECT_FILENAME: MIRRORED_DATAFILE_CONTENT},
+                                                    provide_download)
+
+
 def test_config_html(monkeypatch):
     def config_html(dirname):
         FILENAME = os.path.join(dirname, 'data.csv')
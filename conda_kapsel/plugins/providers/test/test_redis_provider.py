@@ -9,8 +9,11 @@ from __future__ import absolute_import
 import codecs
 import os
 import platform
+import subprocess
+import sys
 
 from conda_kapsel.test.project_utils import project_no_dedicated_env
+from conda_kapsel.internal import conda_api
 from conda_kapsel.internal.test.tmpfile_utils import (with_directory_contents,
                                                       with_directory_contents_completing_project_file)
 from conda_kapsel.test.environ_utils import minimal_environ, strip_environ
@@ -19,6 +22,7 @@ from conda_kapsel.local_state_file import LocalStateFile
 from conda_kapsel.plugins.registry import PluginRegistry
 from conda_kapsel.plugins.requirement import UserConfigOverrides
 from conda_kapsel.plugins.providers.redis import RedisProvider
+from conda_kapsel.plugins import warm_pool
 from conda_kapsel.plugins.requirements.redis import RedisRequirement
 from conda_kapsel.prepare import prepare_without_interaction, unprepare
 from conda_kapsel import provide
@@ -51,6 +55,26 @@ def test_reading_default_config():
     with_directory_contents(dict(), read_config)
 
 
+def test_env_prefix_only_needed_when_redis_server_not_installed():
+    def check(dirname):
+        local_state = LocalStateFile.load_for_directory(dirname)
+        requirement = _redis_requirement()
+        provider = RedisProvider()
+        prefix_variable = conda_api.conda_prefix_variable()
+
+        environ = dict(PATH=os.path.join(dirname, "empty"))
+        assert provider.env_prefix_needed(requirement, environ, local_state)
+        assert (prefix_variable, ) == provider.missing_env_vars_to_configure(requirement, environ, local_state)
+        assert (prefix_variable, ) == provider.missing_env_vars_to_provide(requirement, environ, local_state)
+
+        environ = dict(PATH=os.path.join(dirname, "bin"))
+        assert not provider.env_prefix_needed(requirement, environ, local_state)
+        assert () == provider.missing_env_vars_to_configure(requirement, environ, local_state)
+        assert () == provider.missing_env_vars_to_provide(requirement, environ, local_state)
+
+    with_directory_contents({"bin/redis-server": "", "empty/foo": ""}, check)
+
+
 def test_reading_valid_config():
     def read_config(dirname):
         local_state = LocalStateFile.load_for_directory(dirname)
@@ -154,6 +178,39 @@ def test_set_config_values_as_strings():
     with_directory_contents(dict(), set_config)
 
 
+def test_reading_unix_socket_config(capsys):
+    def read_config(dirname):
+        local_state = LocalStateFile.load_for_directory(dirname)
+        provider = RedisProvider()
+        requirement = _redis_requirement()
+        config = provider.read_config(requirement, dict(), local_state, 'default', UserConfigOverrides())
+        assert config['unix_socket'] is False
+
+        requirement = RedisRequirement(registry=PluginRegistry(),
+                                       env_var="REDIS_URL",
+                                       options=dict(type='redis', unix_socket=True))
+        config = provider.read_config(requirement, dict(), local_state, 'default', UserConfigOverrides())
+        assert config['unix_socket'] is True
+
+        # local state overrides the project file
+        local_state.set_value(['service_options', 'REDIS_URL', 'unix_socket'], False)
+        config = provider.read_config(requirement, dict(), local_state, 'default', UserConfigOverrides())
+        assert config['unix_socket'] is False
+
+        provider.set_config_values_as_strings(requirement, dict(), local_state, 'default', UserConfigOverrides(),
+                                              dict(unix_socket='true'))
+        config = provider.read_config(requirement, dict(), local_state, 'default', UserConfigOverrides())
+        assert config['unix_socket'] is True
+
+        local_state.set_value(['service_options', 'REDIS_URL', 'unix_socket'], 'sometimes')
+        config = provider.read_config(requirement, dict(), local_state, 'default', UserConfigOverrides())
+        assert config['unix_socket'] is False
+        out, err = capsys.readouterr()
+        assert "Invalid unix_socket 'sometimes', should be true or false\n" == err
+
+    with_directory_contents(dict(), read_config)
+
+
 def _monkeypatch_can_connect_to_socket_to_succeed(monkeypatch):
     can_connect_args = dict()
 
@@ -261,6 +318,228 @@ services:
 """}, start_local_redis)
 
 
+def test_prepare_local_redis_server_with_stale_pidfile(monkeypatch):
+    # this test will fail if you don't have Redis installed, since
+    # it actually starts it.
+    if platform.system() == 'Windows':
+        print("Cannot start redis-server on Windows")
+        return
+
+    from conda_kapsel.plugins.network_util import can_connect_to_socket as real_can_connect_to_socket
+
+    _monkeypatch_can_connect_to_socket_on_nonstandard_port_only(monkeypatch, real_can_connect_to_socket)
+
+    def start_local_redis(dirname):
+        # a redis-server that crashed left its pidfile behind, naming a dead process
+        process = subprocess.Popen([sys.executable, "-c", "pass"])
+        process.wait()
+        redisdir = os.path.join(dirname, "services", "REDIS_URL")
+        os.makedirs(redisdir)
+        pidfile = os.path.join(redisdir, "redis.pid")
+        with codecs.open(pidfile, 'w', 'utf-8') as f:
+            f.write("%d\n" % process.pid)
+
+        project = project_no_dedicated_env(dirname)
+        result = _prepare_printing_errors(project, environ=minimal_environ())
+        assert result
+        try:
+            with codecs.open(pidfile, 'r', 'utf-8') as f:
+                assert int(f.read().strip()) != process.pid
+        finally:
+            assert unprepare(project, result)
+
+    with_directory_contents_completing_project_file(
+        {DEFAULT_PROJECT_FILENAME: """
+services:
+  REDIS_URL: redis
+"""}, start_local_redis)
+
+
+def test_prepare_and_unprepare_local_redis_server_on_unix_socket(monkeypatch):
+    # this test will fail if you don't have Redis installed, since
+    # it actually starts it.
+    if platform.system() == 'Windows':
+        print("No Unix domain sockets on Windows")
+        return
+
+    from conda_kapsel.plugins.network_util import can_connect_to_socket as real_can_connect_to_socket
+    from conda_kapsel.plugins.network_util import can_connect_to_unix_socket
+
+    _monkeypatch_can_connect_to_socket_on_nonstandard_port_only(monkeypatch, real_can_connect_to_socket)
+
+    def start_local_redis(dirname):
+        project = project_no_dedicated_env(dirname)
+        result = _prepare_printing_errors(project, environ=minimal_environ())
+        assert result
+
+        local_state_file = LocalStateFile.load_for_directory(dirname)
+        state = local_state_file.get_service_run_state('REDIS_URL')
+        assert 'port' not in state
+        socket_path = os.path.join(dirname, "services", "REDIS_URL", "redis.sock")
+        assert socket_path == state['unix_socket']
+
+        assert dict(REDIS_URL=("unix://" + socket_path),
+                    PROJECT_DIR=project.directory_path) == strip_environ(result.environ)
+        assert can_connect_to_unix_socket(socket_path)
+
+        status = unprepare(project, result)
+        assert status
+        assert not can_connect_to_unix_socket(socket_path)
+        assert not os.path.exists(os.path.join(dirname, "services"))
+
+    with_directory_contents_completing_project_file(
+        {DEFAULT_PROJECT_FILENAME: """
+services:
+  REDIS_URL:
+    type: redis
+    unix_socket: true
+"""}, start_local_redis)
+
+
+def test_prepare_and_unprepare_supervised_local_redis_server(monkeypatch):
+    # this test will fail if you don't have Redis installed, since
+    # it actually starts it.
+    if platform.system() == 'Windows':
+        print("Cannot start redis-server on Windows")
+        return
+
+    from conda_kapsel.plugins.network_util import can_connect_to_socket as real_can_connect_to_socket
+
+    _monkeypatch_can_connect_to_socket_on_nonstandard_port_only(monkeypatch, real_can_connect_to_socket)
+
+    supervised = dict()
+
+    def mock_supervise_service(key, command, pidfile, probe=None, environ=None, directory=None):
+        supervised[key] = dict(command=command, pidfile=pidfile, probe=probe)
+        return True
+
+    def mock_unsupervise_service(key, directory=None):
+        del supervised[key]
+
+    def mock_supervised_service_status(key, directory=None):
+        return "running" if key in supervised else "unknown"
+
+    monkeypatch.setattr("conda_kapsel.plugins.service_supervisor.supervise_service", mock_supervise_service)
+    monkeypatch.setattr("conda_kapsel.plugins.service_supervisor.unsupervise_service", mock_unsupervise_service)
+    monkeypatch.setattr("conda_kapsel.plugins.service_supervisor.supervised_service_status",
+                        mock_supervised_service_status)
+
+    def start_local_redis(dirname):
+        project = project_no_dedicated_env(dirname)
+        environ = minimal_environ(KAPSEL_SUPERVISE_SERVICES='1')
+        result = _prepare_printing_errors(project, environ=environ)
+        assert result
+
+        local_state_file = LocalStateFile.load_for_directory(dirname)
+        state = local_state_file.get_service_run_state('REDIS_URL')
+        pidfile = os.path.join(dirname, "services", "REDIS_URL", "redis.pid")
+        assert pidfile == state['supervisor_key']
+        assert [pidfile] == list(supervised.keys())
+        assert pidfile == supervised[pidfile]['pidfile']
+        assert 'redis-server' == supervised[pidfile]['command'][0]
+        assert dict(address=('localhost', state['port']),
+                    request="PING\r\n",
+                    expected_reply="+PONG") == supervised[pidfile]['probe']
+
+        # second time around we ask the supervisor
+        result = _prepare_printing_errors(project, environ=environ)
+        assert result
+        assert ("redis://localhost:%d" % state['port']) == result.environ['REDIS_URL']
+
+        status = unprepare(project, result)
+        assert status
+        assert dict() == supervised
+
+    with_directory_contents_completing_project_file(
+        {DEFAULT_PROJECT_FILENAME: """
+services:
+  REDIS_URL: redis
+"""}, start_local_redis)
+
+
+def test_previously_run_redis_url_from_supervisor(monkeypatch):
+    statuses = dict(a="running", b="restarting", c="unknown", d=None)
+    monkeypatch.setattr("conda_kapsel.plugins.service_supervisor.supervised_service_status",
+                        lambda key, directory=None: statuses[key])
+
+    def mock_can_connect_to_socket(host, port, timeout_seconds=0.5):
+        return port == 1234
+
+    monkeypatch.setattr("conda_kapsel.plugins.network_util.can_connect_to_socket", mock_can_connect_to_socket)
+
+    provider = RedisProvider()
+    # running according to the supervisor, so we don't connect at all
+    assert "redis://localhost:42" == provider._previously_run_redis_url_if_alive(dict(supervisor_key='a', port=42))
+    assert "unix:///tmp/redis.sock" == provider._previously_run_redis_url_if_alive(
+        dict(supervisor_key='a', unix_socket='/tmp/redis.sock'))
+    # the supervisor is bringing it back, but it isn't usable now
+    assert provider._previously_run_redis_url_if_alive(dict(supervisor_key='b', port=1234)) is None
+    # the supervisor doesn't know about it or isn't running, so we check ourselves
+    url = provider._previously_run_redis_url_if_alive(dict(supervisor_key='c', port=1234))
+    assert "redis://localhost:1234" == url
+    assert provider._previously_run_redis_url_if_alive(dict(supervisor_key='d', port=42)) is None
+
+
+def test_prepare_and_unprepare_shared_redis_server(monkeypatch, tmpdir):
+    # this test will fail if you don't have Redis installed, since
+    # it actually starts it.
+    if platform.system() == 'Windows':
+        print("Cannot start redis-server on Windows")
+        return
+
+    from conda_kapsel.plugins.network_util import can_connect_to_socket as real_can_connect_to_socket
+
+    _monkeypatch_can_connect_to_socket_on_nonstandard_port_only(monkeypatch, real_can_connect_to_socket)
+    shared_dir = str(tmpdir)
+    monkeypatch.setattr("conda_kapsel.plugins.providers.redis._shared_redis_directory", lambda: shared_dir)
+
+    project_file = {DEFAULT_PROJECT_FILENAME: """
+services:
+  REDIS_URL:
+    type: redis
+    scope: shared
+"""}
+
+    def start_two_projects(first_dirname):
+        first = project_no_dedicated_env(first_dirname)
+        first_result = _prepare_printing_errors(first, environ=minimal_environ())
+        assert first_result
+
+        def start_second(second_dirname):
+            second = project_no_dedicated_env(second_dirname)
+            second_result = _prepare_printing_errors(second, environ=minimal_environ())
+            assert second_result
+
+            first_url = first_result.environ['REDIS_URL']
+            second_url = second_result.environ['REDIS_URL']
+            assert first_url.startswith("redis://localhost:")
+            assert first_url.endswith("/1")
+            assert second_url == first_url[:-1] + "2"
+            port = int(first_url.split(":")[2].split("/")[0])
+
+            local_state_file = LocalStateFile.load_for_directory(second_dirname)
+            state = local_state_file.get_service_run_state('REDIS_URL')
+            assert dict(shared_key=(second_dirname + ":REDIS_URL"), database=2) == state
+
+            # preparing again reuses our database
+            again = _prepare_printing_errors(second, environ=minimal_environ())
+            assert second_url == again.environ['REDIS_URL']
+
+            status = unprepare(first, first_result)
+            assert status
+            assert {(second_dirname + ":REDIS_URL"): 2} == _read_shared_state(shared_dir)['databases']
+            assert real_can_connect_to_socket(host='localhost', port=port)
+
+            status = unprepare(second, again)
+            assert status
+            assert dict() == _read_shared_state(shared_dir)
+            assert not real_can_connect_to_socket(host='localhost', port=port)
+
+        with_directory_contents_completing_project_file(project_file, start_second)
+
+    with_directory_contents_completing_project_file(project_file, start_two_projects)
+
+
 def test_prepare_and_unprepare_local_redis_server_with_failed_unprovide(monkeypatch):
     # this test will fail if you don't have Redis installed, since
     # it actually starts it.
@@ -452,7 +731,8 @@ def test_prepare_local_redis_server_times_out(monkeypatch, capsys):
         assert not result
 
         out, err = capsys.readouterr()
-        assert "redis-server started successfully, but we timed out trying to connect to it on port" in out
+        # we notice the process is gone rather than waiting out the timeout
+        assert "redis-server started successfully, but it exited before accepting connections on port" in out
         assert "redis-server process failed or timed out, exited with code 0" in err
 
     with_directory_contents_completing_project_file(
@@ -473,7 +753,13 @@ def _monkeypatch_can_connect_to_socket_always_succeeds_on_nonstandard(monkeypatc
         can_connect_args_list.append(can_connect_args)
         return port != 6379
 
+    def mock_can_bind_to_port(port, host=''):
+        can_connect_args_list.append(dict(port=port))
+        return False
+
     monkeypatch.setattr("conda_kapsel.plugins.network_util.can_connect_to_socket", mock_can_connect_to_socket)
+    monkeypatch.setattr("conda_kapsel.plugins.network_util.can_bind_to_port", mock_can_bind_to_port)
+    monkeypatch.setattr("conda_kapsel.plugins.network_util.unix_sockets_supported", lambda: False)
 
     return can_connect_args_list
 
@@ -500,6 +786,95 @@ services:
     assert "" == out
 
 
+def test_prepare_local_redis_server_falls_back_to_unix_socket(monkeypatch, capsys):
+    if platform.system() == 'Windows':
+        print("No Unix domain sockets on Windows")
+        return
+
+    _monkeypatch_can_connect_to_socket_always_succeeds_on_nonstandard(monkeypatch)
+    monkeypatch.setattr("conda_kapsel.plugins.network_util.unix_sockets_supported", lambda: True)
+
+    commands = []
+
+    def start_local_redis(dirname):
+        from subprocess import Popen as real_Popen
+
+        def mock_Popen(*args, **kwargs):
+            if 'args' not in kwargs:
+                # `pip list` goes through this codepath
+                return real_Popen(*args, **kwargs)
+            commands.append(kwargs['args'])
+            kwargs['args'] = ['python', '-c', 'import sys; sys.exit(1)']
+            return real_Popen(*args, **kwargs)
+
+        monkeypatch.setattr("subprocess.Popen", mock_Popen)
+
+        project = project_no_dedicated_env(dirname)
+        result = _prepare_printing_errors(project, environ=minimal_environ())
+        assert not result
+
+        socket_path = os.path.join(dirname, "services", "REDIS_URL", "redis.sock")
+        assert len(commands) == 1
+        assert commands[0][-4:] == ['--port', '0', '--unixsocket', socket_path]
+
+    with_directory_contents_completing_project_file(
+        {DEFAULT_PROJECT_FILENAME: """
+services:
+  REDIS_URL: redis
+"""}, start_local_redis)
+
+    out, err = capsys.readouterr()
+    assert ("All ports from 6380 to 6449 were in use, could not start redis-server on one of them. " +
+            "Using a Unix domain socket instead.") in out
+    assert "redis-server process failed or timed out, exited with code 1" in err
+
+
+def test_prepare_local_redis_server_with_unix_socket_option(monkeypatch, capsys):
+    if platform.system() == 'Windows':
+        print("No Unix domain sockets on Windows")
+        return
+
+    can_connect_args_list = _monkeypatch_can_connect_to_socket_always_succeeds_on_nonstandard(monkeypatch)
+    monkeypatch.setattr("conda_kapsel.plugins.network_util.unix_sockets_supported", lambda: True)
+
+    commands = []
+
+    def start_local_redis(dirname):
+        from subprocess import Popen as real_Popen
+
+        def mock_Popen(*args, **kwargs):
+            if 'args' not in kwargs:
+                # `pip list` goes through this codepath
+                return real_Popen(*args, **kwargs)
+            commands.append(kwargs['args'])
+            kwargs['args'] = ['python', '-c', 'import sys; sys.exit(1)']
+            return real_Popen(*args, **kwargs)
+
+        monkeypatch.setattr("subprocess.Popen", mock_Popen)
+
+        project = project_no_dedicated_env(dirname)
+        result = _prepare_printing_errors(project, environ=minimal_environ())
+        assert not result
+
+        socket_path = os.path.join(dirname, "services", "REDIS_URL", "redis.sock")
+        assert len(commands) == 1
+        assert commands[0][-4:] == ['--port', '0', '--unixsocket', socket_path]
+        # we never looked for a free port
+        assert [] == [args for args in can_connect_args_list if 'host' not in args]
+
+    with_directory_contents_completing_project_file(
+        {DEFAULT_PROJECT_FILENAME: """
+services:
+  REDIS_URL:
+    type: redis
+    unix_socket: true
+"""}, start_local_redis)
+
+    out, err = capsys.readouterr()
+    assert "were in use" not in out
+    assert "redis-server process failed or timed out, exited with code 1" in err
+
+
 def test_do_not_start_local_redis_server_in_prod_mode(monkeypatch, capsys):
     can_connect_args_list = _monkeypatch_can_connect_to_socket_always_succeeds_on_nonstandard(monkeypatch)
 
@@ -820,3 +1195,446 @@ def test_set_scope_in_local_state(monkeypatch):
 services:
   REDIS_URL: redis
 """}, prepare_after_setting_scope)
+
+
+def test_shared_scope_config():
+    def check(dirname):
+        local_state = LocalStateFile.load_for_directory(dirname)
+        provider = RedisProvider()
+        requirement = RedisRequirement(registry=PluginRegistry(),
+                                       env_var="REDIS_URL",
+                                       options=dict(type='redis', scope='shared'))
+        config = provider.read_config(requirement, dict(), local_state, 'default', UserConfigOverrides())
+        assert 'find_shared' == config['source']
+
+        provider.set_config_values_as_strings(requirement, dict(), local_state, 'default', UserConfigOverrides(),
+                                              dict(source='find_project'))
+        config = provider.read_config(requirement, dict(), local_state, 'default', UserConfigOverrides())
+        assert 'find_project' == config['source']
+
+        provider.set_config_values_as_strings(requirement, dict(), local_state, 'default', UserConfigOverrides(),
+                                              dict(source='find_shared'))
+        assert 'shared' == local_state.get_value(['service_options', 'REDIS_URL', 'scope'])
+
+    with_directory_contents(dict(), check)
+
+
+def _write_shared_state(directory, state):
+    import json
+    with codecs.open(os.path.join(directory, "shared-redis.json"), 'w', 'utf-8') as f:
+        json.dump(state, f)
+
+
+def _read_shared_state(directory):
+    import json
+    with codecs.open(os.path.join(directory, "shared-redis.json"), 'r', 'utf-8') as f:
+        return json.load(f)
+
+
+def test_release_shared_database(monkeypatch, tmpdir):
+    shared_dir = str(tmpdir)
+    monkeypatch.setattr("conda_kapsel.plugins.providers.redis._shared_redis_directory", lambda: shared_dir)
+    monkeypatch.setattr("conda_kapsel.plugins.providers.redis._server_is_alive", lambda server: True)
+    flushed = []
+    monkeypatch.setattr("conda_kapsel.plugins.providers.redis._flush_shared_database",
+                        lambda server, database: flushed.append(database))
+    calls = []
+
+    class MockProcess(object):
+        def __init__(self, args):
+            calls.append(args)
+            self.returncode = 1 if 'fail' in args else 0
+
+        def poll(self):
+            return self.returncode
+
+    monkeypatch.setattr("conda_kapsel.internal.logged_subprocess.Popen", MockProcess)
+
+    server = dict(port=6390, shutdown_commands=[['redis-cli', '-p', '6390', 'shutdown']])
+    _write_shared_state(shared_dir, dict(server=server, databases=dict(a=1, b=2)))
+
+    provider = RedisProvider()
+    status = provider._release_shared_database('a')
+    assert status
+    assert "Released our database on the shared redis-server, still used by 1 others." == status.status_description
+    assert [1] == flushed
+    assert [] == calls
+    assert dict(server=server, databases=dict(b=2)) == _read_shared_state(shared_dir)
+
+    status = provider._release_shared_database('b')
+    assert status
+    assert "Shut down the shared redis-server." == status.status_description
+    assert [1, 2] == flushed
+    assert [['redis-cli', '-p', '6390', 'shutdown']] == calls
+    assert dict() == _read_shared_state(shared_dir)
+
+    server = dict(port=6390, shutdown_commands=[['fail']])
+    _write_shared_state(shared_dir, dict(server=server, databases=dict(c=3)))
+    status = provider._release_shared_database('c')
+    assert not status
+    assert "Shutdown commands failed for the shared redis-server." == status.status_description
+    assert ["Shutting down shared redis-server, command ['fail'] failed with code 1."] == status.errors
+
+
+def test_previously_run_shared_redis_url(monkeypatch, tmpdir):
+    shared_dir = str(tmpdir)
+    monkeypatch.setattr("conda_kapsel.plugins.providers.redis._shared_redis_directory", lambda: shared_dir)
+    alive = dict(value=True)
+    monkeypatch.setattr("conda_kapsel.plugins.providers.redis._server_is_alive", lambda server: alive['value'])
+
+    provider = RedisProvider()
+    run_state = dict(shared_key='a', database=3)
+    # no shared state at all
+    assert provider._previously_run_redis_url_if_alive(run_state) is None
+
+    _write_shared_state(shared_dir, dict(server=dict(port=6390), databases=dict(a=3)))
+    assert "redis://localhost:6390/3" == provider._previously_run_redis_url_if_alive(run_state)
+
+    _write_shared_state(shared_dir, dict(server=dict(unix_socket="/tmp/r.sock"), databases=dict(a=3)))
+    assert "unix:///tmp/r.sock?db=3" == provider._previously_run_redis_url_if_alive(run_state)
+
+    # the server was restarted and someone else has our number now
+    _write_shared_state(shared_dir, dict(server=dict(port=6390), databases=dict(b=3)))
+    assert provider._previously_run_redis_url_if_alive(run_state) is None
+
+    _write_shared_state(shared_dir, dict(server=dict(port=6390), databases=dict(a=3)))
+    alive['value'] = False
+    assert provider._previously_run_redis_url_if_alive(run_state) is None
+
+
+def test_switch_from_shared_to_project_redis_server(monkeypatch, tmpdir):
+    # this test will fail if you don't have Redis installed, since
+    # it actually starts it.
+    if platform.system() == 'Windows':
+        print("Cannot start redis-server on Windows")
+        return
+
+    from conda_kapsel.plugins.network_util import can_connect_to_socket as real_can_connect_to_socket
+
+    _monkeypatch_can_connect_to_socket_on_nonstandard_port_only(monkeypatch, real_can_connect_to_socket)
+    shared_dir = str(tmpdir)
+    monkeypatch.setattr("conda_kapsel.plugins.providers.redis._shared_redis_directory", lambda: shared_dir)
+    monkeypatch.setattr("conda_kapsel.plugins.providers.redis._server_is_alive", lambda server: True)
+    monkeypatch.setattr("conda_kapsel.plugins.providers.redis._flush_shared_database", lambda server, database: None)
+    _write_shared_state(shared_dir, dict(server=dict(port=6390), databases=dict(ours=3, theirs=4)))
+
+    def start_local_redis(dirname):
+        # last time we used the shared server, now the project wants its own
+        local_state_file = LocalStateFile.load_for_directory(dirname)
+        local_state_file.set_service_run_state('REDIS_URL', dict(shared_key='ours', database=3))
+        local_state_file.save()
+
+        project = project_no_dedicated_env(dirname)
+        result = _prepare_printing_errors(project, environ=minimal_environ())
+        assert result
+        try:
+            local_state_file.load()
+            state = local_state_file.get_service_run_state('REDIS_URL')
+            assert 'shared_key' not in state
+            assert ("redis://localhost:%d" % state['port']) == result.environ['REDIS_URL']
+            assert dict(theirs=4) == _read_shared_state(shared_dir)['databases']
+        finally:
+            assert unprepare(project, result)
+
+    with_directory_contents_completing_project_file(
+        {DEFAULT_PROJECT_FILENAME: """
+services:
+  REDIS_URL: redis
+"""}, start_local_redis)
+
+
+def test_switch_from_project_to_shared_redis_server(monkeypatch, tmpdir):
+    _monkeypatch_can_connect_to_socket_always_succeeds_on_nonstandard(monkeypatch)
+    shared_dir = str(tmpdir.join("shared"))
+    os.makedirs(shared_dir)
+    monkeypatch.setattr("conda_kapsel.plugins.providers.redis._shared_redis_directory", lambda: shared_dir)
+    monkeypatch.setattr("conda_kapsel.plugins.providers.redis._server_is_alive", lambda server: True)
+    monkeypatch.setattr("conda_kapsel.plugins.providers.redis._flush_shared_database", lambda server, database: None)
+    _write_shared_state(shared_dir, dict(server=dict(port=6390), databases=dict(theirs=1)))
+
+    shut_down = []
+    monkeypatch.setattr("conda_kapsel.plugins.providers.redis.run_shutdown_commands",
+                        lambda description, run_state, errors: shut_down.append(dict(run_state)))
+    unsupervised = []
+    monkeypatch.setattr("conda_kapsel.plugins.service_supervisor.unsupervise_service", unsupervised.append)
+    pool_instance = str(tmpdir.join("pool-instance"))
+    os.makedirs(pool_instance)
+
+    def start_shared_redis(dirname):
+        # last time we had a dedicated server from the warm pool
+        dedicated = dict(port=6381, pidfile='/nonexistent/redis.pid', supervisor_key='/nonexistent/redis.pid',
+                         pool_instance=pool_instance, shutdown_commands=[['redis-cli', '-p', '6381', 'shutdown']])
+        local_state_file = LocalStateFile.load_for_directory(dirname)
+        local_state_file.set_service_run_state('REDIS_URL', dedicated)
+        local_state_file.save()
+
+        project = project_no_dedicated_env(dirname)
+        result = _prepare_printing_errors(project, environ=minimal_environ())
+        assert result
+        assert "redis://localhost:6390/2" == result.environ['REDIS_URL']
+
+        assert [dedicated] == shut_down
+        assert ['/nonexistent/redis.pid'] == unsupervised
+        assert not os.path.exists(pool_instance)
+        local_state_file.load()
+        # nothing left over from the dedicated server
+        assert dict(shared_key=(dirname + ":REDIS_URL"),
+                    database=2) == local_state_file.get_service_run_state('REDIS_URL')
+
+    with_directory_contents_completing_project_file(
+        {DEFAULT_PROJECT_FILENAME: """
+services:
+  REDIS_URL:
+    type: redis
+    scope: shared
+"""}, start_shared_redis)
+
+
+def test_shared_redis_server_started_with_other_settings(monkeypatch, tmpdir):
+    _monkeypatch_can_connect_to_socket_always_succeeds_on_nonstandard(monkeypatch)
+    shared_dir = str(tmpdir)
+    monkeypatch.setattr("conda_kapsel.plugins.providers.redis._shared_redis_directory", lambda: shared_dir)
+    monkeypatch.setattr("conda_kapsel.plugins.providers.redis._server_is_alive", lambda server: True)
+    monkeypatch.setattr("conda_kapsel.plugins.providers.redis._flush_shared_database", lambda server, database: None)
+    settings = dict(unix_socket=False, profile=[])
+    _write_shared_state(shared_dir, dict(server=dict(port=6390), databases=dict(theirs=1), settings=settings))
+
+    def prepare_with_profile(dirname):
+        project = project_no_dedicated_env(dirname)
+        result = _prepare_printing_errors(project, environ=minimal_environ())
+        assert result
+        assert "redis://localhost:6390/2" == result.environ['REDIS_URL']
+        assert ("The shared redis-server was started with another project's settings, so this project's " +
+                "unix_socket and performance profile options don't apply to it.") in result.logs
+        # the server keeps the settings it started with
+        assert settings == _read_shared_state(shared_dir)['settings']
+
+    with_directory_contents_completing_project_file(
+        {DEFAULT_PROJECT_FILENAME: """
+services:
+  REDIS_URL:
+    type: redis
+    scope: shared
+    persistence: none
+"""}, prepare_with_profile)
+
+
+def test_shared_redis_databases_all_in_use(monkeypatch, capsys, tmpdir):
+    _monkeypatch_can_connect_to_socket_always_succeeds_on_nonstandard(monkeypatch)
+    shared_dir = str(tmpdir)
+    monkeypatch.setattr("conda_kapsel.plugins.providers.redis._shared_redis_directory", lambda: shared_dir)
+    monkeypatch.setattr("conda_kapsel.plugins.providers.redis._server_is_alive", lambda server: True)
+    databases = dict(("project%d" % n, n) for n in range(1, 256))
+    _write_shared_state(shared_dir, dict(server=dict(port=6390), databases=databases))
+
+    def start_local_redis(dirname):
+        project = project_no_dedicated_env(dirname)
+        result = _prepare_printing_errors(project, environ=minimal_environ())
+        assert not result
+
+    with_directory_contents_completing_project_file(
+        {DEFAULT_PROJECT_FILENAME: """
+services:
+  REDIS_URL:
+    type: redis
+    scope: shared
+"""}, start_local_redis)
+
+    out, err = capsys.readouterr()
+    assert "All 255 databases on the shared redis-server are in use." in err
+
+
+def test_reading_performance_profile(capsys):
+    def read_config(dirname):
+        local_state = LocalStateFile.load_for_directory(dirname)
+        provider = RedisProvider()
+        config = provider.read_config(_redis_requirement(), dict(), local_state, 'default', UserConfigOverrides())
+        for name in ('persistence', 'maxmemory', 'maxmemory_policy', 'io_threads', 'appendfsync'):
+            assert config[name] is None
+
+        requirement = RedisRequirement(registry=PluginRegistry(),
+                                       env_var="REDIS_URL",
+                                       options=dict(type='redis',
+                                                    persistence=False,
+                                                    maxmemory='256MB',
+                                                    maxmemory_policy='allkeys-lru',
+                                                    io_threads=4,
+                                                    appendfsync='everysec'))
+        config = provider.read_config(requirement, dict(), local_state, 'default', UserConfigOverrides())
+        assert 'none' == config['persistence']
+        assert '256mb' == config['maxmemory']
+        assert 'allkeys-lru' == config['maxmemory_policy']
+        assert 4 == config['io_threads']
+        assert 'everysec' == config['appendfsync']
+
+        # local state wins
+        provider.set_config_values_as_strings(requirement, dict(), local_state, 'default', UserConfigOverrides(),
+                                              dict(persistence='append_only', io_threads='2', appendfsync=''))
+        config = provider.read_config(requirement, dict(), local_state, 'default', UserConfigOverrides())
+        assert 'append_only' == config['persistence']
+        assert 2 == config['io_threads']
+        assert 'everysec' == config['appendfsync']
+        assert local_state.get_value(['service_options', 'REDIS_URL', 'appendfsync']) is None
+
+    with_directory_contents(dict(), read_config)
+
+
+def test_reading_invalid_performance_profile(capsys):
+    def read_config(dirname):
+        local_state = LocalStateFile.load_for_directory(dirname)
+        provider = RedisProvider()
+        config = provider.read_config(_redis_requirement(), dict(), local_state, 'default', UserConfigOverrides())
+        for name in ('persistence', 'maxmemory', 'maxmemory_policy', 'io_threads', 'appendfsync'):
+            assert config[name] is None
+        out, err = capsys.readouterr()
+        assert ("Invalid persistence 'sometimes', should be one of none, snapshot, append_only\n" +
+                "Invalid maxmemory 'lots', should be a size like 100mb\n" +
+                "Invalid maxmemory_policy 'lru', should be one of noeviction, allkeys-lru, volatile-lru, " +
+                "allkeys-lfu, volatile-lfu, allkeys-random, volatile-random, volatile-ttl\n" +
+                "Invalid io_threads '0', should be a positive number\n" +
+                "Invalid appendfsync 'never', should be one of always, everysec, no\n") == err
+
+    with_directory_contents(
+        {
+            DEFAULT_LOCAL_STATE_FILENAME: """
+service_options:
+  REDIS_URL:
+    persistence: sometimes
+    maxmemory: lots
+    maxmemory_policy: lru
+    io_threads: 0
+    appendfsync: never
+"""
+        }, read_config)
+
+
+def test_prepare_local_redis_server_with_performance_profile(monkeypatch, capsys):
+    _monkeypatch_can_connect_to_socket_on_nonstandard_port_only(monkeypatch, lambda host, port, timeout: False)
+
+    commands = []
+
+    def start_local_redis(dirname):
+        from subprocess import Popen as real_Popen
+
+        def mock_Popen(*args, **kwargs):
+            if 'args' not in kwargs:
+                # `pip list` goes through this codepath
+                return real_Popen(*args, **kwargs)
+            commands.append(kwargs['args'])
+            kwargs['args'] = ['python', '-c', 'import sys; sys.exit(1)']
+            return real_Popen(*args, **kwargs)
+
+        monkeypatch.setattr("subprocess.Popen", mock_Popen)
+
+        project = project_no_dedicated_env(dirname)
+        result = _prepare_printing_errors(project, environ=minimal_environ())
+        assert not result
+
+        workdir = os.path.join(dirname, "services", "REDIS_URL")
+        assert len(commands) == 1
+        assert commands[0][7:-2] == ['--dir', workdir, '--save', '', '--appendonly', 'no', '--maxmemory', '100mb',
+                                     '--maxmemory-policy', 'allkeys-lru', '--io-threads', '2']
+
+    with_directory_contents_completing_project_file(
+        {DEFAULT_PROJECT_FILENAME: """
+services:
+  REDIS_URL:
+    type: redis
+    persistence: none
+    maxmemory: 100mb
+    maxmemory_policy: allkeys-lru
+    io_threads: 2
+"""}, start_local_redis)
+
+
+def test_prepare_redis_from_warm_pool(monkeypatch, tmpdir):
+    pool_dir = str(tmpdir)
+    monkeypatch.setattr("conda_kapsel.plugins.warm_pool.pool_directory", lambda service_type: pool_dir)
+    monkeypatch.setattr("conda_kapsel.plugins.providers.redis._server_is_alive", lambda server: True)
+    _monkeypatch_can_connect_to_socket_always_succeeds_on_nonstandard(monkeypatch)
+    refills = []
+    monkeypatch.setattr("conda_kapsel.plugins.warm_pool.refill_in_background",
+                        lambda service_type, provider_class_name, environ: refills.append(provider_class_name))
+
+    # one instance with a performance profile we don't want, and one we can use
+    warm_pool.add_instance(lambda directory: dict(url="redis://localhost:6391",
+                                                  run_state=dict(port=6391),
+                                                  profile=['--appendonly', 'yes']), pool_dir)
+    warm_pool.add_instance(lambda directory: dict(url="redis://localhost:6390",
+                                                  run_state=dict(port=6390, shutdown_commands=[]),
+                                                  profile=[]), pool_dir)
+
+    def prepare_from_pool(dirname):
+        project = project_no_dedicated_env(dirname)
+        result = _prepare_printing_errors(project, environ=minimal_environ(KAPSEL_WARM_POOL_REDIS='2'))
+        assert result
+        assert "redis://localhost:6390" == result.environ['REDIS_URL']
+        assert ['RedisProvider'] == refills
+
+        local_state_file = LocalStateFile.load_for_directory(dirname)
+        run_state = local_state_file.get_service_run_state('REDIS_URL')
+        assert 6390 == run_state['port']
+        instance_dir = run_state['pool_instance']
+        assert os.path.isdir(instance_dir)
+
+        # the other one is still in the pool
+        assert 1 == len([name for name in os.listdir(pool_dir) if name.startswith("ready-")])
+
+        status = unprepare(project, result)
+        assert status
+        assert not os.path.exists(instance_dir)
+
+    with_directory_contents_completing_project_file(
+        {DEFAULT_PROJECT_FILENAME: """
+services:
+  REDIS_URL: redis
+"""}, prepare_from_pool)
+
+
+def test_start_pool_instance(monkeypatch):
+    started = []
+
+    def mock_start_redis_in(self, workdir, config, run_state, environ, errors, logs, extra_args=(), supervise=True):
+        started.append((workdir, config, supervise))
+        if workdir == 'fail':
+            return None
+        run_state['port'] = 6390
+        return "redis://localhost:6390"
+
+    monkeypatch.setattr("conda_kapsel.plugins.providers.redis.RedisProvider._start_redis_in", mock_start_redis_in)
+    provider = RedisProvider()
+    instance = provider.start_pool_instance('pooldir', dict())
+    assert dict(url="redis://localhost:6390", run_state=dict(port=6390), profile=[]) == instance
+    (workdir, config, supervise) = started[0]
+    assert 'pooldir' == workdir
+    assert 6380 == config['lower_port']
+    assert not config['unix_socket']
+    assert not supervise
+
+    assert provider.start_pool_instance('fail', dict()) is None
+
+
+def test_warm_pool_with_real_redis_server(monkeypatch, tmpdir):
+    # this test will fail if you don't have Redis installed, since
+    # it actually starts it.
+    if platform.system() == 'Windows':
+        print("Cannot start redis-server on Windows")
+        return
+
+    from conda_kapsel.plugins.provider import run_shutdown_commands
+
+    pool_dir = str(tmpdir)
+    provider = RedisProvider()
+    environ = minimal_environ()
+    assert 1 == warm_pool.refill('redis', 1, lambda directory: provider.start_pool_instance(directory, environ),
+                                 alive=provider.pool_instance_is_alive, directory=pool_dir)
+    instance = warm_pool.claim_instance('redis', provider.pool_instance_is_alive, directory=pool_dir)
+    assert instance is not None
+    try:
+        assert instance['url'].startswith("redis://localhost:")
+        assert provider.pool_instance_is_alive(instance)
+    finally:
+        errors = []
+        run_shutdown_commands("redis-server", instance['run_state'], errors)
+        assert [] == errors
+    assert not provider.pool_instance_is_alive(instance)
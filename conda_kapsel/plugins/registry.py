@@ -4,17 +4,223 @@
 #
 # The full license is in the file LICENSE.txt, distributed with this software.
 # ----------------------------------------------------------------------------
-"""The plugin registry (used to locate plugins)."""
+"""The plugin registry (used to locate plugins).
+
+Besides the built-in service types and providers, other packages can
+add their own with setuptools entry points::
+
+    entry_points={
+        'conda_kapsel.service_types': ['postgres = kapsel_postgres:PostgresRequirement'],
+        'conda_kapsel.providers': ['PostgresProvider = kapsel_postgres:PostgresProvider'],
+    }
+
+A service type's entry point names a ``ServiceRequirement`` subclass,
+which should set the ``default_variable`` and
+``service_type_description`` class attributes. A provider's entry
+point names a ``Provider`` subclass; requirements refer to providers
+by the entry point name.
+
+Scanning installed distributions for entry points is slow, so what we
+find is saved in an index file, which is rebuilt only when something
+on ``sys.path`` changes. Plugin modules aren't imported until a plugin
+is actually used.
+"""
 from __future__ import absolute_import, print_function
 
 from collections import namedtuple
+import codecs
+import importlib
+import json
+import os
+import sys
+
+from conda_kapsel.internal.makedirs import makedirs_ok_if_exists
+from conda_kapsel.internal.rename import rename_over_existing
+from conda_kapsel.version import version
 
 ServiceType = namedtuple('ServiceType', ['name', 'default_variable', 'description'])
 
+SERVICE_TYPES_ENTRY_POINT_GROUP = 'conda_kapsel.service_types'
+PROVIDERS_ENTRY_POINT_GROUP = 'conda_kapsel.providers'
+PLUGIN_INDEX_VARIABLE = 'KAPSEL_PLUGIN_INDEX'
+
+# built-in plugins can't be replaced by entry points
+_builtin_service_types = [
+    (ServiceType(name='redis', default_variable='REDIS_URL', description='A Redis server'),
+     'conda_kapsel.plugins.requirements.redis:RedisRequirement')
+]
+
+_builtin_providers = {
+    'CondaEnvProvider': 'conda_kapsel.plugins.providers.conda_env:CondaEnvProvider',
+    'RedisProvider': 'conda_kapsel.plugins.providers.redis:RedisProvider',
+    'EnvVarProvider': 'conda_kapsel.plugins.provider:EnvVarProvider',
+    'DownloadProvider': 'conda_kapsel.plugins.providers.download:DownloadProvider'
+}
+
+# the index, loaded at most once per process
+_loaded_index = None
+
+
+def default_plugin_index_filename():
+    """Where the plugin index is saved, overridable with ``KAPSEL_PLUGIN_INDEX``."""
+    if PLUGIN_INDEX_VARIABLE in os.environ:
+        return os.environ[PLUGIN_INDEX_VARIABLE]
+    if os.name == 'nt':  # pragma: no cover (windows only)
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser("~"))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "conda-kapsel", "plugin-index.json")
+
+
+def _sys_path_fingerprint():
+    # installing or removing a distribution touches its site-packages
+    # directory, which is much cheaper to check than the entry points
+    stamps = [version, sys.version]
+    for path in sys.path:
+        if path == '':
+            # the current directory, which isn't where plugins get installed
+            continue
+        try:
+            stamps.append("%s:%r" % (path, os.stat(path).st_mtime))
+        except OSError:
+            stamps.append("%s:" % path)
+    return stamps
+
+
+def _iter_entry_points(group):
+    try:
+        from importlib import metadata
+    except ImportError:  # pragma: no cover (py2 only)
+        import pkg_resources  # pragma: no cover (py2 only)
+        return [(ep.name, "%s:%s" % (ep.module_name, ".".join(ep.attrs)))
+                for ep in pkg_resources.iter_entry_points(group)]  # pragma: no cover (py2 only)
+    all_entry_points = metadata.entry_points()
+    if hasattr(all_entry_points, 'select'):
+        found = all_entry_points.select(group=group)
+    else:  # pragma: no cover (python < 3.10)
+        found = all_entry_points.get(group, [])
+    return [(ep.name, ep.value) for ep in found]
+
+
+def _import_object(target):
+    (module_name, attribute) = target.split(":", 1)
+    obj = importlib.import_module(module_name.strip())
+    for piece in attribute.strip().split("."):
+        obj = getattr(obj, piece)
+    return obj
+
+
+# plugin targets we've already complained about, so a broken plugin
+# doesn't repeat its warning for every requirement that uses it
+_reported_broken_targets = set()
+
+
+def _import_plugin(kind, name, target):
+    try:
+        return _import_object(target)
+    except Exception as e:
+        if target not in _reported_broken_targets:
+            _reported_broken_targets.add(target)
+            print("Failed to load kapsel %s %s from %s: %s" % (kind, name, target, str(e)), file=sys.stderr)
+        return None
+
+
+def _scan_entry_points():
+    service_types = []
+    for (name, target) in _iter_entry_points(SERVICE_TYPES_ENTRY_POINT_GROUP):
+        # we import the class this one time to record its metadata in the index
+        try:
+            requirement_class = _import_object(target)
+        except Exception as e:
+            print("Failed to load kapsel service type %s from %s: %s" % (name, target, str(e)), file=sys.stderr)
+            continue
+        default_variable = getattr(requirement_class, 'default_variable', None) or (name.upper() + "_URL")
+        description = getattr(requirement_class, 'service_type_description', None) or name
+        service_types.append(dict(name=name, default_variable=default_variable, description=description,
+                                  target=target))
+    providers = dict()
+    for (name, target) in _iter_entry_points(PROVIDERS_ENTRY_POINT_GROUP):
+        providers[name] = target
+    return dict(service_types=service_types, providers=providers)
+
+
+def _read_index(filename):
+    try:
+        with codecs.open(filename, 'r', 'utf-8') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _write_index(filename, index):
+    tmp_filename = filename + ".tmp-%d" % os.getpid()
+    try:
+        makedirs_ok_if_exists(os.path.dirname(filename))
+        with codecs.open(tmp_filename, 'w', 'utf-8') as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        rename_over_existing(tmp_filename, filename)
+    except (IOError, OSError):
+        # we'll just scan again next time
+        try:
+            os.remove(tmp_filename)
+        except OSError:
+            pass
+
+
+def load_plugin_index(filename=None):
+    """Get the plugins installed via entry points, from the index file if it's current.
+
+    Args:
+        filename (str): index file, None for the default
+
+    Returns:
+        dict with ``service_types`` (list of dicts) and ``providers`` (dict from name to target)
+    """
+    if filename is None:
+        filename = default_plugin_index_filename()
+    fingerprint = _sys_path_fingerprint()
+    index = _read_index(filename)
+    if isinstance(index, dict) and index.get('fingerprint', None) == fingerprint:
+        return index
+    index = _scan_entry_points()
+    index['fingerprint'] = fingerprint
+    _write_index(filename, index)
+    return index
+
+
+def _plugin_index():
+    global _loaded_index
+    if _loaded_index is None:
+        _loaded_index = load_plugin_index()
+    return _loaded_index
+
 
 class PluginRegistry(object):
     """Allows creating Requirement and Provider instances."""
 
+    def __init__(self, plugin_index=None):
+        """Create a registry.
+
+        Args:
+            plugin_index (dict): plugins from ``load_plugin_index()``, None to
+                load the default index the first time a plugin is looked up
+        """
+        self._index = plugin_index
+
+    def _get_index(self):
+        if self._index is None:
+            self._index = _plugin_index()
+        return self._index
+
+    def _service_type_target(self, service_type):
+        for (builtin, target) in _builtin_service_types:
+            if builtin.name == service_type:
+                return target
+        for info in self._get_index()['service_types']:
+            if info['name'] == service_type:
+                return info['target']
+        return None
+
     def find_requirement_by_env_var(self, env_var, options):
         """Create a requirement instance given an environment variable name.
 
@@ -43,12 +249,13 @@ class PluginRegistry(object):
             options = options.copy()
             options['type'] = service_type
 
-        # future goal will be to un-hardcode this
-        if service_type == 'redis':
-            from .requirements.redis import RedisRequirement
-            return RedisRequirement(registry=self, env_var=env_var, options=options)
-        else:
+        target = self._service_type_target(service_type)
+        if target is None:
             return None
+        requirement_class = _import_plugin("service type", service_type, target)
+        if requirement_class is None:
+            return None
+        return requirement_class(registry=self, env_var=env_var, options=options)
 
     def list_service_types(self):
         """List known service types.
@@ -56,7 +263,14 @@ class PluginRegistry(object):
         Returns:
            iterable of ``ServiceType`` named tuples with (name,default_variable,description)
         """
-        return [ServiceType(name='redis', default_variable='REDIS_URL', description='A Redis server')]
+        types = [builtin for (builtin, target) in _builtin_service_types]
+        builtin_names = set([builtin.name for builtin in types])
+        for info in self._get_index()['service_types']:
+            if info['name'] not in builtin_names:
+                types.append(ServiceType(name=info['name'],
+                                         default_variable=info['default_variable'],
+                                         description=info['description']))
+        return types
 
     def find_provider_by_class_name(self, class_name):
         """Look up a provider by class name.
@@ -67,18 +281,12 @@ class PluginRegistry(object):
         Returns:
             an instance of the passed-in class name or None if not found
         """
-        # future goal will be to un-hardcode this of course
-        if class_name == 'CondaEnvProvider':
-            from .providers.conda_env import CondaEnvProvider
-            return CondaEnvProvider()
-        elif class_name == 'RedisProvider':
-            from .providers.redis import RedisProvider
-            return RedisProvider()
-        elif class_name == 'EnvVarProvider':
-            from .provider import EnvVarProvider
-            return EnvVarProvider()
-        elif class_name == 'DownloadProvider':
-            from .providers.download import DownloadProvider
-            return DownloadProvider()
-        else:
+        target = _builtin_providers.get(class_name, None)
+        if target is None:
+            target = self._get_index()['providers'].get(class_name, None)
+        if target is None:
+            return None
+        provider_class = _import_plugin("provider", class_name, target)
+        if provider_class is None:
             return None
+        return provider_class()
@@ -47,6 +47,11 @@ class RequirementStatus(Status):
 
     """
 
+    # prepare makes a new status for each requirement every time it
+    # checks, and projects can have thousands of requirements
+    __slots__ = ('_requirement', '_has_been_provided', '_status_description', '_provider', '_analysis',
+                 '_latest_provide_result')
+
     def __init__(self, requirement, has_been_provided, status_description, provider, analysis, latest_provide_result):
         """Construct an abstract RequirementStatus."""
         self._requirement = requirement
@@ -181,9 +186,19 @@ class Requirement(with_metaclass(ABCMeta)):
         """Set of ignore patterns for files this requirement's provider might autogenerate."""
         return set()
 
+    def _find_provider(self, provider_class_name):
+        provider = self.registry.find_provider_by_class_name(provider_class_name)
+        if provider is None:
+            # the provider's plugin is missing or failed to load (the
+            # registry already said why); the user can still set the
+            # variable by hand.
+            from .provider import EnvVarProvider
+            provider = EnvVarProvider()
+        return provider
+
     def _create_status(self, environ, local_state_file, default_env_spec_name, overrides, latest_provide_result,
                        has_been_provided, status_description, provider_class_name):
-        provider = self.registry.find_provider_by_class_name(provider_class_name)
+        provider = self._find_provider(provider_class_name)
         analysis = provider.analyze(self, environ, local_state_file, default_env_spec_name, overrides)
         return RequirementStatus(self,
                                  has_been_provided=has_been_provided,
@@ -194,7 +209,7 @@ class Requirement(with_metaclass(ABCMeta)):
 
     def _create_status_from_analysis(self, environ, local_state_file, default_env_spec_name, overrides,
                                      latest_provide_result, provider_class_name, status_getter):
-        provider = self.registry.find_provider_by_class_name(provider_class_name)
+        provider = self._find_provider(provider_class_name)
         analysis = provider.analyze(self, environ, local_state_file, default_env_spec_name, overrides)
         (has_been_provided, status_description) = status_getter(environ, local_state_file, analysis)
         return RequirementStatus(self,
@@ -13,10 +13,27 @@ import os
 from conda_kapsel.plugins.requirement import EnvVarRequirement
 from conda_kapsel.plugins.network_util import urlparse
 
+from conda_kapsel.internal.hash_sidecar import SIDECAR_SUFFIX
 from conda_kapsel.internal.py2_compat import is_string
 
 _hash_algorithms = ('md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512')
 
+# (url suffix, archive format) in the order we try to match them,
+# so the longer tarball suffixes win over plain .gz, .bz2, .xz
+_archive_suffixes = (('.tar.gz', 'tar.gz'), ('.tgz', 'tar.gz'), ('.tar.bz2', 'tar.bz2'), ('.tbz2', 'tar.bz2'),
+                     ('.tar.xz', 'tar.xz'), ('.txz', 'tar.xz'), ('.tar', 'tar'), ('.zip', 'zip'), ('.gz', 'gz'),
+                     ('.bz2', 'bz2'), ('.xz', 'xz'))
+
+_archive_formats = ('zip', 'tar', 'tar.gz', 'tar.bz2', 'tar.xz', 'gz', 'bz2', 'xz')
+
+
+def _archive_suffix_and_format(path):
+    lowered = path.lower()
+    for (suffix, archive_format) in _archive_suffixes:
+        if lowered.endswith(suffix) and len(lowered) > len(suffix):
+            return (suffix, archive_format)
+    return (None, None)
+
 
 class DownloadRequirement(EnvVarRequirement):
     """A requirement for ``env_var`` to point to a downloaded file."""
@@ -29,7 +46,9 @@ class DownloadRequirement(EnvVarRequirement):
         hash_algorithm = None
         hash_value = None
         unzip = None
+        archive_format = None
         description = None
+        mirrors = None
         if is_string(item):
             url = item
         elif isinstance(item, dict):
@@ -59,6 +78,19 @@ class DownloadRequirement(EnvVarRequirement):
                         problems.append("Checksum value for {} should be a string not {}.".format(varname, hash_value))
                         return
 
+            mirrors = item.get('mirrors', None)
+            if mirrors is not None and (not isinstance(mirrors, list) or
+                                        not all(is_string(mirror) and mirror != '' for mirror in mirrors)):
+                problems.append("Value of 'mirrors' for download item {} should be a list of URL strings, not {}."
+                                .format(varname, mirrors))
+                return
+
+            if mirrors and hash_algorithm is None:
+                # without a checksum we'd have no way to tell a mirror is serving the right file
+                problems.append("Download item {} has 'mirrors' but no checksum; add one of {} to use mirrors."
+                                .format(varname, ", ".join(_hash_algorithms)))
+                return
+
             filename = item.get('filename', None)
             unzip = item.get('unzip', None)
             if unzip is not None and not isinstance(unzip, bool):
@@ -66,6 +98,12 @@ class DownloadRequirement(EnvVarRequirement):
                                                                                                             unzip))
                 return
 
+            archive_format = item.get('archive_format', None)
+            if archive_format is not None and archive_format not in _archive_formats:
+                problems.append("Value of 'archive_format' for download item {} should be one of {}, not {}.".format(
+                    varname, ", ".join(_archive_formats), archive_format))
+                return
+
         if url is None or not is_string(url):
             problems.append(("Download name {} should be followed by a URL string or a dictionary " +
                              "describing the download.").format(varname))
@@ -79,22 +117,27 @@ class DownloadRequirement(EnvVarRequirement):
         # return pretty nonsensical stuff on invalid urls, in particular
         # an empty path is very possible
         url_path = os.path.basename(urlparse.urlsplit(url).path)
-        url_path_is_zip = url_path.lower().endswith(".zip")
+        (url_suffix, url_archive_format) = _archive_suffix_and_format(url_path)
+
+        if unzip is None and archive_format is not None:
+            # asking for an archive format means we want to unpack
+            unzip = True
 
         if filename is None:
             if url_path != '':
                 filename = url_path
-                if url_path_is_zip:
-                    if unzip is None:
-                        # url is a zip and neither filename nor unzip specified, assume unzip
+                if url_archive_format is not None:
+                    if unzip is None and url_archive_format == 'zip':
+                        # url is a zip and neither filename nor unzip specified, assume unzip;
+                        # other archive formats are only unpacked if asked for
                         unzip = True
                     if unzip:
-                        # unzip specified True, or we guessed True, and url ends in zip;
-                        # take the .zip off the filename we invented based on the url.
-                        filename = filename[:-4]
-        elif url_path_is_zip and unzip is None and not filename.lower().endswith(".zip"):
-            # URL is a zip, filename is not a zip, unzip was not specified, so assume
-            # we want to unzip
+                        # unzip specified True, or we guessed True, and url ends in an archive suffix;
+                        # take the suffix off the filename we invented based on the url.
+                        filename = filename[:-len(url_suffix)]
+        elif url_archive_format == 'zip' and unzip is None and not filename.lower().endswith(url_suffix):
+            # URL is a zip, filename is not, unzip was not specified, so assume
+            # we want to unpack
             unzip = True
 
         if filename is None:
@@ -103,6 +146,10 @@ class DownloadRequirement(EnvVarRequirement):
         if unzip is None:
             unzip = False
 
+        if unzip and archive_format is None:
+            # we have always assumed zip when unzip is requested for an unrecognized url
+            archive_format = url_archive_format if url_archive_format is not None else 'zip'
+
         requirements.append(DownloadRequirement(registry,
                                                 env_var=varname,
                                                 url=url,
@@ -110,7 +157,9 @@ class DownloadRequirement(EnvVarRequirement):
                                                 hash_algorithm=hash_algorithm,
                                                 hash_value=hash_value,
                                                 unzip=unzip,
-                                                description=description))
+                                                description=description,
+                                                archive_format=archive_format,
+                                                mirrors=mirrors))
 
     def __init__(self,
                  registry,
@@ -120,8 +169,15 @@ class DownloadRequirement(EnvVarRequirement):
                  hash_algorithm=None,
                  hash_value=None,
                  unzip=False,
-                 description=None):
-        """Extend init to accept url and hash parameters."""
+                 description=None,
+                 archive_format=None,
+                 mirrors=None):
+        """Extend init to accept url and hash parameters.
+
+        If ``unzip`` is True, ``archive_format`` says how to unpack the
+        download (defaults to 'zip'). ``mirrors`` is a list of
+        alternate urls serving the same file as ``url``.
+        """
         options = None
         if description is not None:
             options = dict(description=description)
@@ -136,6 +192,23 @@ class DownloadRequirement(EnvVarRequirement):
         self.hash_algorithm = hash_algorithm
         self.hash_value = hash_value
         self.unzip = unzip
+        if unzip and archive_format is None:
+            archive_format = 'zip'
+        assert archive_format is None or archive_format in _archive_formats
+        self.archive_format = archive_format if unzip else None
+        if mirrors is None:
+            mirrors = []
+        self.mirrors = [mirror for mirror in mirrors if mirror != url]
+
+    @property
+    def urls(self):
+        """All the urls we can download from, ``url`` first and then any mirrors.
+
+        Mirrors are only used if we have a hash to check their downloads against.
+        """
+        if self.hash_value is None:
+            return [self.url]
+        return [self.url] + self.mirrors
 
     @property
     def description(self):
@@ -145,7 +218,7 @@ class DownloadRequirement(EnvVarRequirement):
     @property
     def ignore_patterns(self):
         """Override superclass with our ignore patterns."""
-        return set(['/' + self.filename, '/' + self.filename + ".part"])
+        return set(['/' + self.filename, '/' + self.filename + ".part", '/' + self.filename + SIDECAR_SUFFIX])
 
     def _why_not_provided(self, environ):
         if self.env_var not in environ:
@@ -14,6 +14,9 @@ import conda_kapsel.plugins.network_util as network_util
 class RedisRequirement(ServiceRequirement):
     """A requirement for REDIS_URL (or another specified env var) to point to a running Redis."""
 
+    default_variable = 'REDIS_URL'
+    service_type_description = 'A Redis server'
+
     @property
     def description(self):
         """Override superclass to supply our description."""
@@ -24,12 +27,18 @@ class RedisRequirement(ServiceRequirement):
         if url is None:
             return self._unset_message()
         split = network_util.urlparse.urlsplit(url)
-        if split.scheme != 'redis':
-            return "{env_var} value '{url}' does not have 'redis:' scheme.".format(env_var=self.env_var, url=url)
-        port = 6379
-        if split.port is not None:
-            port = split.port
-        if network_util.can_connect_to_socket(split.hostname, port):
+        if split.scheme == 'unix':
+            # unix:///path/to/redis.sock, as understood by redis-py
+            can_connect = network_util.can_connect_to_unix_socket(split.path)
+        elif split.scheme == 'redis':
+            port = 6379
+            if split.port is not None:
+                port = split.port
+            can_connect = network_util.can_connect_to_socket(split.hostname, port)
+        else:
+            return "{env_var} value '{url}' does not have 'redis:' or 'unix:' scheme.".format(
+                env_var=self.env_var, url=url)
+        if can_connect:
             return None
         else:
             return "Cannot connect to Redis at {url}.".format(url=url, env_var=self.env_var)
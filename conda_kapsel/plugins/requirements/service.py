@@ -15,6 +15,10 @@ from conda_kapsel.internal.py2_compat import is_string
 class ServiceRequirement(EnvVarRequirement):
     """Abstract base class for a requirement from the services section of the project file."""
 
+    # subclasses registered as service types describe themselves with these
+    default_variable = None
+    service_type_description = None
+
     @classmethod
     def _parse(cls, registry, varname, item, problems, requirements):
         """Parse an item from the services: section."""
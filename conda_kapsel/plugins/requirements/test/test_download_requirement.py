@@ -242,3 +242,210 @@ def test_no_unzip_if_url_ends_in_zip_and_filename_also_does():
     assert requirements[0].filename == 'something.zip'
     assert requirements[0].url == 'http://example.com/bar.zip'
     assert not requirements[0].unzip
+
+
+def test_no_unpack_by_default_if_url_ends_in_tarball():
+    # only zip is unpacked without being asked, as it always has been
+    for suffix in ('.tar.gz', '.tgz', '.tar.bz2', '.tar.xz', '.tar', '.gz', '.bz2', '.xz'):
+        problems = []
+        requirements = []
+        DownloadRequirement._parse(PluginRegistry(),
+                                   varname='FOO',
+                                   item='http://example.com/bar' + suffix,
+                                   problems=problems,
+                                   requirements=requirements)
+        assert [] == problems
+        assert len(requirements) == 1
+        assert requirements[0].filename == 'bar' + suffix
+        assert not requirements[0].unzip
+        assert requirements[0].archive_format is None
+
+
+def test_unpack_if_url_ends_in_tarball_and_unzip_true():
+    for (suffix, archive_format) in (('.tar.gz', 'tar.gz'), ('.tgz', 'tar.gz'), ('.tar.bz2', 'tar.bz2'),
+                                     ('.tar.xz', 'tar.xz'), ('.tar', 'tar'), ('.TAR.GZ', 'tar.gz')):
+        problems = []
+        requirements = []
+        DownloadRequirement._parse(PluginRegistry(),
+                                   varname='FOO',
+                                   item=dict(url='http://example.com/bar' + suffix,
+                                             unzip=True),
+                                   problems=problems,
+                                   requirements=requirements)
+        assert [] == problems
+        assert len(requirements) == 1
+        assert requirements[0].filename == 'bar'
+        assert requirements[0].unzip
+        assert requirements[0].archive_format == archive_format
+
+
+def test_decompress_if_url_ends_in_single_file_compression_and_unzip_true():
+    problems = []
+    requirements = []
+    DownloadRequirement._parse(PluginRegistry(),
+                               varname='FOO',
+                               item=dict(url='http://example.com/bar.csv.xz',
+                                         unzip=True),
+                               problems=problems,
+                               requirements=requirements)
+    assert [] == problems
+    assert len(requirements) == 1
+    assert requirements[0].filename == 'bar.csv'
+    assert requirements[0].unzip
+    assert requirements[0].archive_format == 'xz'
+
+
+def test_unpack_if_url_ends_in_tarball_and_archive_format_given():
+    problems = []
+    requirements = []
+    DownloadRequirement._parse(PluginRegistry(),
+                               varname='FOO',
+                               item=dict(url='http://example.com/bar.tgz',
+                                         archive_format='tar.gz'),
+                               problems=problems,
+                               requirements=requirements)
+    assert [] == problems
+    assert len(requirements) == 1
+    assert requirements[0].filename == 'bar'
+    assert requirements[0].unzip
+    assert requirements[0].archive_format == 'tar.gz'
+
+
+def test_no_unpack_if_url_ends_in_tarball_and_filename_also_does():
+    problems = []
+    requirements = []
+    DownloadRequirement._parse(PluginRegistry(),
+                               varname='FOO',
+                               item=dict(url='http://example.com/bar.tar.gz',
+                                         filename='something.tar.gz'),
+                               problems=problems,
+                               requirements=requirements)
+    assert [] == problems
+    assert len(requirements) == 1
+    assert requirements[0].filename == 'something.tar.gz'
+    assert not requirements[0].unzip
+    assert requirements[0].archive_format is None
+
+
+def test_explicit_archive_format():
+    problems = []
+    requirements = []
+    DownloadRequirement._parse(PluginRegistry(),
+                               varname='FOO',
+                               item=dict(url='http://example.com/download?id=1234',
+                                         filename='data',
+                                         archive_format='tar.bz2'),
+                               problems=problems,
+                               requirements=requirements)
+    assert [] == problems
+    assert len(requirements) == 1
+    assert requirements[0].filename == 'data'
+    assert requirements[0].unzip
+    assert requirements[0].archive_format == 'tar.bz2'
+
+
+def test_unzip_without_archive_suffix_assumes_zip():
+    problems = []
+    requirements = []
+    DownloadRequirement._parse(PluginRegistry(),
+                               varname='FOO',
+                               item=dict(url='http://example.com/data',
+                                         unzip=True),
+                               problems=problems,
+                               requirements=requirements)
+    assert [] == problems
+    assert requirements[0].unzip
+    assert requirements[0].archive_format == 'zip'
+
+
+def test_archive_format_is_not_valid():
+    problems = []
+    requirements = []
+    DownloadRequirement._parse(PluginRegistry(),
+                               varname='FOO',
+                               item=dict(url='http://example.com/data',
+                                         archive_format='rar'),
+                               problems=problems,
+                               requirements=requirements)
+    assert [("Value of 'archive_format' for download item FOO should be one of " +
+             "zip, tar, tar.gz, tar.bz2, tar.xz, gz, bz2, xz, not rar.")] == problems
+    assert len(requirements) == 0
+
+
+def test_download_mirrors():
+    problems = []
+    requirements = []
+    DownloadRequirement._parse(PluginRegistry(),
+                               varname='FOO',
+                               item=dict(url='http://example.com/data.csv',
+                                         mirrors=['http://mirror1.example.com/data.csv',
+                                                  'http://mirror2.example.com/data.csv'],
+                                         md5='12345abcdef'),
+                               problems=problems,
+                               requirements=requirements)
+    assert [] == problems
+    assert len(requirements) == 1
+    assert requirements[0].url == 'http://example.com/data.csv'
+    assert requirements[0].urls == ['http://example.com/data.csv', 'http://mirror1.example.com/data.csv',
+                                    'http://mirror2.example.com/data.csv']
+    assert requirements[0].filename == 'data.csv'
+
+
+def test_download_no_mirrors():
+    requirement = DownloadRequirement(PluginRegistry(),
+                                      env_var='FOO',
+                                      url='http://example.com/data.csv',
+                                      filename='data.csv')
+    assert requirement.mirrors == []
+    assert requirement.urls == ['http://example.com/data.csv']
+
+
+def test_download_mirrors_without_checksum():
+    problems = []
+    requirements = []
+    DownloadRequirement._parse(PluginRegistry(),
+                               varname='FOO',
+                               item=dict(url='http://example.com/data.csv',
+                                         mirrors=['http://mirror1.example.com/data.csv']),
+                               problems=problems,
+                               requirements=requirements)
+    assert [("Download item FOO has 'mirrors' but no checksum; add one of " +
+             "md5, sha1, sha224, sha256, sha384, sha512 to use mirrors.")] == problems
+    assert len(requirements) == 0
+
+
+def test_download_mirrors_unused_without_hash():
+    requirement = DownloadRequirement(PluginRegistry(),
+                                      env_var='FOO',
+                                      url='http://example.com/data.csv',
+                                      filename='data.csv',
+                                      mirrors=['http://mirror1.example.com/data.csv'])
+    assert requirement.urls == ['http://example.com/data.csv']
+
+
+def test_download_mirrors_not_a_list():
+    problems = []
+    requirements = []
+    DownloadRequirement._parse(PluginRegistry(),
+                               varname='FOO',
+                               item=dict(url='http://example.com/data.csv',
+                                         mirrors='http://mirror1.example.com/data.csv'),
+                               problems=problems,
+                               requirements=requirements)
+    assert [("Value of 'mirrors' for download item FOO should be a list of URL strings, " +
+             "not http://mirror1.example.com/data.csv.")] == problems
+    assert len(requirements) == 0
+
+
+def test_download_mirrors_contains_non_string():
+    problems = []
+    requirements = []
+    DownloadRequirement._parse(PluginRegistry(),
+                               varname='FOO',
+                               item=dict(url='http://example.com/data.csv',
+                                         mirrors=['http://mirror1.example.com/data.csv', 42]),
+                               problems=problems,
+                               requirements=requirements)
+    assert [("Value of 'mirrors' for download item FOO should be a list of URL strings, " +
+             "not ['http://mirror1.example.com/data.csv', 42].")] == problems
+    assert len(requirements) == 0
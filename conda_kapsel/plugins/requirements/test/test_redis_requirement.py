@@ -42,7 +42,8 @@ def test_redis_url_bad_scheme():
             'default',
             UserConfigOverrides())
         assert not status
-        assert "REDIS_URL value 'http://example.com/' does not have 'redis:' scheme." == status.status_description
+        expected = "REDIS_URL value 'http://example.com/' does not have 'redis:' or 'unix:' scheme."
+        assert expected == status.status_description
 
     with_directory_contents({}, check_bad_scheme)
 
@@ -78,3 +79,37 @@ def test_redis_url_cannot_connect(monkeypatch):
         assert expected == status.status_description
 
     with_directory_contents({}, check_cannot_connect)
+
+
+def test_redis_url_unix_socket(monkeypatch):
+    def check_unix_socket(dirname):
+        local_state = LocalStateFile.load_for_directory(dirname)
+        requirement = RedisRequirement(registry=PluginRegistry(), env_var="REDIS_URL")
+        paths = []
+
+        def mock_can_connect_to_unix_socket(path, timeout_seconds=0.5):
+            paths.append(path)
+            return len(paths) == 1
+
+        monkeypatch.setattr("conda_kapsel.plugins.network_util.can_connect_to_unix_socket",
+                            mock_can_connect_to_unix_socket)
+        _monkeypatch_can_connect_to_socket_fails(monkeypatch)
+
+        status = requirement.check_status(
+            dict(REDIS_URL="unix:///tmp/redis.sock"),
+            local_state,
+            'default',
+            UserConfigOverrides())
+        assert status
+        assert "Using Redis server at unix:///tmp/redis.sock" == status.status_description
+
+        status = requirement.check_status(
+            dict(REDIS_URL="unix:///tmp/redis.sock"),
+            local_state,
+            'default',
+            UserConfigOverrides())
+        assert not status
+        assert "Cannot connect to Redis at unix:///tmp/redis.sock." == status.status_description
+        assert ['/tmp/redis.sock', '/tmp/redis.sock'] == paths
+
+    with_directory_contents({}, check_unix_socket)
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------------
+# Copyright © 2016, Continuum Analytics, Inc. All rights reserved.
+#
+# The full license is in the file LICENSE.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+"""A per-user process that watches services started by providers and restarts them.
+
+Providers register a service (the command that starts it, its pidfile,
+and a health probe) after starting it. The supervisor checks every
+registered service periodically and reruns the start command, with
+backoff, if the process has died or stops answering its probe.
+Providers can then ask the supervisor for a service's status rather
+than probing the service themselves.
+
+The supervisor listens on a Unix domain socket; requests and replies
+are single lines of JSON. It's only used if ``KAPSEL_SUPERVISE_SERVICES``
+is set in the environment, and only where Unix domain sockets exist.
+"""
+from __future__ import absolute_import, print_function
+
+import codecs
+import errno
+import json
+import os
+import select
+import socket
+import subprocess
+import sys
+import time
+
+import conda_kapsel.plugins.network_util as network_util
+from conda_kapsel.internal.file_lock import FileLock, user_lock_directory
+from conda_kapsel.internal.makedirs import makedirs_ok_if_exists
+from conda_kapsel.internal.pidfile import read_pidfile, process_is_alive
+from conda_kapsel.internal import py2_compat
+
+SUPERVISE_SERVICES_VARIABLE = 'KAPSEL_SUPERVISE_SERVICES'
+
+STATUS_RUNNING = "running"
+STATUS_RESTARTING = "restarting"
+STATUS_UNKNOWN = "unknown"
+
+_CHECK_INTERVAL = 2.0
+_INITIAL_BACKOFF = 1.0
+_MAX_BACKOFF = 60.0
+# exit if there's nothing to supervise for this long
+_IDLE_TIMEOUT = 600.0
+_MAX_REQUEST_SIZE = 1024 * 1024
+
+
+def supervisor_enabled(environ=None):
+    """True if services should be handed to the supervisor."""
+    if environ is None:
+        environ = os.environ
+    value = environ.get(SUPERVISE_SERVICES_VARIABLE, '')
+    return value.lower() not in ('', '0', 'false', 'no') and network_util.unix_sockets_supported()
+
+
+def supervisor_directory():
+    """Directory for this user's supervisor socket, lock and log."""
+    return user_lock_directory("kapsel-supervisor")
+
+
+def _socket_path(directory):
+    return os.path.join(directory, "supervisor.sock")
+
+
+def _run_start_command(spec):
+    env = spec.get('environ', None)
+    if env is not None:
+        env = py2_compat.env_without_unicode(env)
+    try:
+        # the command is expected to daemonize, so this returns right away
+        with open(os.devnull, 'r+b') as devnull:
+            return subprocess.call(args=spec['command'], env=env, stdin=devnull, stdout=devnull, stderr=devnull)
+    except (IOError, OSError) as e:
+        return str(e)
+
+
+class _SupervisedService(object):
+    def __init__(self, spec):
+        self.spec = spec
+        self.status = STATUS_RUNNING
+        self.restarts = 0
+        self.last_error = None
+        self.backoff = _INITIAL_BACKOFF
+        self.next_restart = 0.0
+
+    def is_healthy(self):
+        pid = read_pidfile(self.spec['pidfile'])
+        if pid is None or not process_is_alive(pid):
+            return False
+        probe = self.spec.get('probe', None)
+        if probe is None:
+            return True
+        address = probe['address']
+        if not py2_compat.is_string(address):
+            address = tuple(address)
+        return network_util.socket_handshake_succeeds(address, probe['request'].encode('utf-8'),
+                                                      probe['expected_reply'].encode('utf-8'))
+
+    def check(self, now):
+        if self.is_healthy():
+            if self.status != STATUS_RUNNING:
+                self.status = STATUS_RUNNING
+                self.backoff = _INITIAL_BACKOFF
+            return
+        self.status = STATUS_RESTARTING
+        if now < self.next_restart:
+            return
+        self.restarts += 1
+        code = _run_start_command(self.spec)
+        if code != 0:
+            self.last_error = "Restarting %s failed: %s" % (self.spec['key'], code)
+        # give it until the backoff expires to come back up
+        self.next_restart = now + self.backoff
+        self.backoff = min(self.backoff * 2, _MAX_BACKOFF)
+
+    def to_json(self):
+        return dict(key=self.spec['key'], status=self.status, restarts=self.restarts, last_error=self.last_error)
+
+
+class ServiceSupervisor(object):
+    """The supervisor's state: services being watched and how they're doing."""
+
+    def __init__(self):
+        """Create a supervisor with no services."""
+        self._services = dict()
+        self._stopped = False
+
+    @property
+    def stopped(self):
+        """True once a shutdown request has been handled."""
+        return self._stopped
+
+    @property
+    def service_count(self):
+        """Number of services being watched."""
+        return len(self._services)
+
+    def check_services(self, now=None):
+        """Health check every service, restarting those that need it."""
+        if now is None:
+            now = time.time()
+        for service in list(self._services.values()):
+            service.check(now)
+
+    def handle_request(self, request):
+        """Handle one decoded JSON request, returning the reply as a dict."""
+        command = request.get('command', None)
+        if command == 'ping':
+            return dict(ok=True)
+        elif command == 'supervise':
+            spec = request.get('service', None)
+            if not isinstance(spec, dict) or 'key' not in spec or 'command' not in spec or 'pidfile' not in spec:
+                return dict(ok=False, error="Service needs a key, command and pidfile.")
+            self._services[spec['key']] = _SupervisedService(spec)
+            return dict(ok=True)
+        elif command == 'unsupervise':
+            self._services.pop(request.get('key', None), None)
+            return dict(ok=True)
+        elif command == 'status':
+            key = request.get('key', None)
+            if key is None:
+                return dict(ok=True, services=[service.to_json() for service in self._services.values()])
+            elif key in self._services:
+                return dict(ok=True, service=self._services[key].to_json())
+            else:
+                return dict(ok=True, service=dict(key=key, status=STATUS_UNKNOWN))
+        elif command == 'shutdown':
+            self._stopped = True
+            return dict(ok=True)
+        else:
+            return dict(ok=False, error="Unknown supervisor command %r." % (command))
+
+    def _handle_connection(self, connection):
+        connection.settimeout(1.0)
+        data = b''
+        try:
+            while not data.endswith(b'\n') and len(data) < _MAX_REQUEST_SIZE:
+                chunk = connection.recv(4096)
+                if len(chunk) == 0:
+                    break
+                data = data + chunk
+            try:
+                reply = self.handle_request(json.loads(data.decode('utf-8')))
+            except ValueError as e:
+                reply = dict(ok=False, error="Bad request: %s" % str(e))
+            connection.sendall(json.dumps(reply).encode('utf-8') + b'\n')
+        except (IOError, OSError):
+            # the client gave up on us, nothing to do
+            pass
+        finally:
+            connection.close()
+
+    def serve(self, listener, check_interval=_CHECK_INTERVAL, idle_timeout=_IDLE_TIMEOUT):
+        """Answer requests on a listening socket and check services until stopped or idle."""
+        next_check = time.time() + check_interval
+        idle_since = time.time()
+        while not self._stopped:
+            now = time.time()
+            if self._services:
+                idle_since = now
+            elif now - idle_since >= idle_timeout:
+                break
+            if now >= next_check:
+                self.check_services(now)
+                next_check = time.time() + check_interval
+            (readable, writable, errored) = select.select([listener], [], [], max(0.0, next_check - time.time()))
+            if readable:
+                (connection, address) = listener.accept()
+                self._handle_connection(connection)
+
+
+def request_supervisor(request, directory=None, timeout_seconds=2.0):
+    """Send a request to the supervisor.
+
+    Args:
+        request (dict): the request, with a 'command' key
+        directory (str): supervisor directory, None for the default
+        timeout_seconds (float): how long to wait for a reply
+
+    Returns:
+        the reply dict, or None if the supervisor isn't running or didn't answer
+    """
+    if directory is None:
+        directory = supervisor_directory()
+    if not network_util.unix_sockets_supported():
+        return None
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.settimeout(timeout_seconds)
+        s.connect(_socket_path(directory))
+        s.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = s.recv(4096)
+            if len(chunk) == 0:
+                break
+            data = data + chunk
+        return json.loads(data.decode('utf-8'))
+    except (IOError, OSError, ValueError):
+        return None
+    finally:
+        s.close()
+
+
+def ensure_supervisor_running(directory=None, timeout_seconds=5.0):
+    """Start the supervisor if it isn't running yet.
+
+    Returns:
+        True if the supervisor is up
+    """
+    if directory is None:
+        directory = supervisor_directory()
+    if request_supervisor(dict(command='ping'), directory=directory) is not None:
+        return True
+
+    makedirs_ok_if_exists(directory)
+    try:
+        with codecs.open(os.path.join(directory, "supervisor.log"), 'a', 'utf-8') as log:
+            kwargs = dict(stdout=log, stderr=subprocess.STDOUT, close_fds=True)
+            if hasattr(os, 'setsid'):
+                # don't die with the terminal that ran prepare
+                kwargs['preexec_fn'] = os.setsid
+            with open(os.devnull, 'r') as devnull:
+                subprocess.Popen([sys.executable, '-m', 'conda_kapsel.plugins.service_supervisor', directory],
+                                 stdin=devnull,
+                                 **kwargs)
+    except (IOError, OSError):
+        return False
+
+    deadline = time.time() + timeout_seconds
+    while time.time() < deadline:
+        if request_supervisor(dict(command='ping'), directory=directory) is not None:
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def supervise_service(key, command, pidfile, probe=None, environ=None, directory=None):
+    """Ask the supervisor to watch a service we just started, starting the supervisor if needed.
+
+    Args:
+        key (str): unique name for this service instance
+        command (list of str): command that (re)starts the service, which should daemonize
+        pidfile (str): where the service writes its pid
+        probe (dict): optional health probe with 'address' (a (host, port) pair or Unix
+            socket filename), 'request' and 'expected_reply' strings
+        environ (dict): environment to run the command in
+        directory (str): supervisor directory, None for the default
+
+    Returns:
+        True if the supervisor took the service
+    """
+    if not ensure_supervisor_running(directory=directory):
+        return False
+    spec = dict(key=key, command=command, pidfile=pidfile, probe=probe, environ=environ)
+    reply = request_supervisor(dict(command='supervise', service=spec), directory=directory)
+    return reply is not None and reply.get('ok', False)
+
+
+def unsupervise_service(key, directory=None):
+    """Tell the supervisor to stop watching a service (before shutting the service down)."""
+    request_supervisor(dict(command='unsupervise', key=key), directory=directory)
+
+
+def supervised_service_status(key, directory=None):
+    """Ask the supervisor about a service.
+
+    Returns:
+        one of ``STATUS_RUNNING``, ``STATUS_RESTARTING``, ``STATUS_UNKNOWN``, or None if
+        the supervisor couldn't be reached
+    """
+    reply = request_supervisor(dict(command='status', key=key), directory=directory)
+    if reply is None or not reply.get('ok', False):
+        return None
+    return reply['service']['status']
+
+
+def main(directory):
+    """Run the supervisor until it's idle or told to shut down."""
+    makedirs_ok_if_exists(directory)
+    lock = FileLock(os.path.join(directory, "supervisor.lock"))
+    if not lock.try_acquire():
+        # someone else got there first
+        return 0
+    path = _socket_path(directory)
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise e
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        listener.bind(path)
+        listener.listen(16)
+        ServiceSupervisor().serve(listener)
+    finally:
+        listener.close()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        lock.release()
+    return 0
+
+
+if __name__ == '__main__':  # pragma: no cover (runs in the supervisor process)
+    sys.exit(main(sys.argv[1]))
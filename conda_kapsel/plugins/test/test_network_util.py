@@ -7,6 +7,7 @@
 import conda_kapsel.plugins.network_util as network_util
 
 import socket
+import threading
 
 
 def test_can_connect_to_socket():
@@ -33,3 +34,125 @@ def test_cannot_connect_to_socket():
     s.close()
 
     assert not network_util.can_connect_to_socket("127.0.0.1", port)
+
+
+def test_can_bind_to_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("", 0))
+    s.listen(1)
+    port = s.getsockname()[1]
+
+    try:
+        assert not network_util.can_bind_to_port(port)
+    finally:
+        s.close()
+
+    assert network_util.can_bind_to_port(port)
+
+
+def test_reserve_port(tmpdir):
+    lock_directory = str(tmpdir)
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("", 0))
+    s.listen(1)
+    busy_port = s.getsockname()[1]
+
+    try:
+        # the busy port is skipped
+        assert network_util.reserve_port(busy_port, busy_port, lock_directory=lock_directory) is None
+
+        first = network_util.reserve_port(busy_port, busy_port + 2, lock_directory=lock_directory)
+        second = network_util.reserve_port(busy_port, busy_port + 2, lock_directory=lock_directory)
+        # the ports after a busy port are likely free, but not guaranteed
+        if first is not None and second is not None:
+            assert first.port != second.port
+            assert busy_port not in (first.port, second.port)
+        for reservation in (first, second):
+            if reservation is not None:
+                reservation.release()
+    finally:
+        s.close()
+
+
+def test_reserve_port_skips_locked_ports(tmpdir, monkeypatch):
+    monkeypatch.setattr("conda_kapsel.plugins.network_util.can_bind_to_port", lambda port, host='': True)
+    lock_directory = str(tmpdir)
+    first = network_util.reserve_port(7000, 7001, lock_directory=lock_directory)
+    second = network_util.reserve_port(7000, 7001, lock_directory=lock_directory)
+    assert first.port == 7000
+    assert second.port == 7001
+    assert network_util.reserve_port(7000, 7001, lock_directory=lock_directory) is None
+    first.release()
+    third = network_util.reserve_port(7000, 7001, lock_directory=lock_directory)
+    assert third.port == 7000
+    third.release()
+    second.release()
+
+
+def test_can_connect_to_unix_socket(tmpdir):
+    if not network_util.unix_sockets_supported():
+        return
+    path = str(tmpdir.join("test.sock"))
+    assert not network_util.can_connect_to_unix_socket(path)
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.bind(path)
+    s.listen(1)
+    try:
+        assert network_util.can_connect_to_unix_socket(path)
+    finally:
+        s.close()
+
+
+def _serve_one_reply(listener, reply):
+    def serve():
+        (connection, address) = listener.accept()
+        try:
+            connection.recv(1024)
+            connection.sendall(reply)
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def test_socket_handshake_succeeds():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    s.listen(1)
+    port = s.getsockname()[1]
+
+    try:
+        thread = _serve_one_reply(s, b"+PONG\r\n")
+        assert network_util.socket_handshake_succeeds(('127.0.0.1', port), b"PING\r\n", b"+PONG")
+        thread.join()
+
+        thread = _serve_one_reply(s, b"-LOADING\r\n")
+        assert not network_util.socket_handshake_succeeds(('127.0.0.1', port), b"PING\r\n", b"+PONG")
+        thread.join()
+
+        thread = _serve_one_reply(s, b"")
+        assert not network_util.socket_handshake_succeeds(('127.0.0.1', port), b"PING\r\n", b"+PONG")
+        thread.join()
+    finally:
+        s.close()
+
+    assert not network_util.socket_handshake_succeeds(('127.0.0.1', port), b"PING\r\n", b"+PONG")
+
+
+def test_socket_handshake_succeeds_unix_socket(tmpdir):
+    if not network_util.unix_sockets_supported():
+        return
+    path = str(tmpdir.join("test.sock"))
+    assert not network_util.socket_handshake_succeeds(path, b"PING\r\n", b"+PONG")
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.bind(path)
+    s.listen(1)
+    try:
+        thread = _serve_one_reply(s, b"+PONG\r\n")
+        assert network_util.socket_handshake_succeeds(path, b"PING\r\n", b"+PONG")
+        thread.join()
+    finally:
+        s.close()
@@ -6,7 +6,11 @@
 # ----------------------------------------------------------------------------
 from __future__ import absolute_import
 
+import codecs
 import os
+import subprocess
+import sys
+import time
 
 import pytest
 
@@ -14,7 +18,8 @@ from conda_kapsel.internal.test.tmpfile_utils import (with_directory_contents, t
                                                       with_directory_contents_completing_project_file)
 from conda_kapsel.local_state_file import LocalStateFile, DEFAULT_LOCAL_STATE_FILENAME
 from conda_kapsel.plugins.provider import (Provider, ProvideContext, EnvVarProvider, ProvideResult,
-                                           shutdown_service_run_state)
+                                           shutdown_service_run_state, run_shutdown_commands, wait_for_service_ready,
+                                           SERVICE_READY, SERVICE_EXITED, SERVICE_TIMED_OUT)
 from conda_kapsel.plugins.registry import PluginRegistry
 from conda_kapsel.plugins.requirement import EnvVarRequirement, UserConfigOverrides
 from conda_kapsel.project import Project
@@ -594,3 +599,223 @@ sys.exit(1)
         assert status.errors == ["Shutting down FOO, command %r failed with code 1." % false_commandline]
 
     with_directory_contents(dict(), check)
+
+
+def test_wait_for_service_ready_after_a_few_probes():
+    probes = []
+
+    def probe():
+        probes.append(True)
+        return len(probes) == 3
+
+    assert SERVICE_READY == wait_for_service_ready(probe, timeout_seconds=5)
+    assert 3 == len(probes)
+
+
+def test_wait_for_service_ready_times_out():
+    probes = []
+
+    def probe():
+        probes.append(True)
+        return False
+
+    assert SERVICE_TIMED_OUT == wait_for_service_ready(probe, timeout_seconds=0.2)
+    # backoff means we don't probe every tick
+    assert 2 <= len(probes) < 20
+
+
+def test_wait_for_service_ready_process_exited():
+    def check(dirname):
+        pidfile = os.path.join(dirname, "service.pid")
+        process = subprocess.Popen([sys.executable, "-c", "pass"])
+        process.wait()
+        with codecs.open(pidfile, 'w', 'utf-8') as f:
+            f.write("%d\n" % process.pid)
+
+        assert SERVICE_EXITED == wait_for_service_ready(lambda: False, pidfile=pidfile, timeout_seconds=30)
+
+    with_directory_contents(dict(), check)
+
+
+def test_wait_for_service_ready_pidfile_removed(monkeypatch):
+    def check(dirname):
+        pidfile = os.path.join(dirname, "service.pid")
+        with codecs.open(pidfile, 'w', 'utf-8') as f:
+            f.write("%d\n" % os.getpid())
+
+        def probe():
+            os.remove(pidfile)
+            return False
+
+        assert SERVICE_EXITED == wait_for_service_ready(probe, pidfile=pidfile, timeout_seconds=30)
+
+    with_directory_contents(dict(), check)
+
+
+def test_wait_for_service_ready_ignores_stale_pidfile():
+    def check(dirname):
+        pidfile = os.path.join(dirname, "service.pid")
+        process = subprocess.Popen([sys.executable, "-c", "pass"])
+        process.wait()
+        # left behind by a crashed run an hour ago
+        with codecs.open(pidfile, 'w', 'utf-8') as f:
+            f.write("%d\n" % process.pid)
+        an_hour_ago = time.time() - 3600
+        os.utime(pidfile, (an_hour_ago, an_hour_ago))
+
+        probes = []
+
+        def probe():
+            probes.append(True)
+            if len(probes) == 2:
+                # the new service rewrites the pidfile
+                with codecs.open(pidfile, 'w', 'utf-8') as f:
+                    f.write("%d\n" % os.getpid())
+            return len(probes) == 3
+
+        assert SERVICE_READY == wait_for_service_ready(probe,
+                                                       pidfile=pidfile,
+                                                       timeout_seconds=30,
+                                                       launched_at=time.time())
+        assert 3 == len(probes)
+
+    with_directory_contents(dict(), check)
+
+
+def test_wait_for_service_ready_marker_in_log_triggers_probe():
+    def check(dirname):
+        logfile = os.path.join(dirname, "service.log")
+        probes = []
+
+        def probe():
+            probes.append(True)
+            if len(probes) == 1:
+                # the first probe fails, and then the log says we're ready
+                # in two writes so we see an incomplete line
+                with codecs.open(logfile, 'w', 'utf-8') as f:
+                    f.write("starting up\nnow Ready to acc")
+                return False
+            if len(probes) == 2:
+                with codecs.open(logfile, 'a', 'utf-8') as f:
+                    f.write("ept connections\n")
+                return False
+            return True
+
+        # a huge max interval means we'd time out without the marker
+        assert SERVICE_READY == wait_for_service_ready(probe,
+                                                       logfile=logfile,
+                                                       ready_marker="ready to accept connections",
+                                                       timeout_seconds=5,
+                                                       initial_interval=0.1,
+                                                       max_interval=100)
+        assert 3 == len(probes)
+
+    with_directory_contents(dict(), check)
+
+
+def test_shutdown_service_run_state_unsupervises(monkeypatch):
+    unsupervised = []
+    monkeypatch.setattr("conda_kapsel.plugins.service_supervisor.unsupervise_service",
+                        lambda key, directory=None: unsupervised.append(key))
+
+    def check(dirname):
+        local_state_file = LocalStateFile.load_for_directory(dirname)
+        local_state_file.set_service_run_state('FOO', {'supervisor_key': 'foo-key', 'shutdown_commands': []})
+        status = shutdown_service_run_state(local_state_file, 'FOO')
+        assert status
+        assert ['foo-key'] == unsupervised
+
+    with_directory_contents(dict(), check)
+
+
+def test_run_shutdown_commands_kills_hung_command():
+    def check(dirname):
+        hung_commandline = tmp_script_commandline("""import time
+time.sleep(60)
+""")
+        errors = []
+        start = time.time()
+        run_shutdown_commands('FOO', {'shutdown_commands': [hung_commandline]}, errors, timeout_seconds=0.5)
+        assert time.time() - start < 30
+        assert errors == ["Shutting down FOO, command %r didn't finish in 0 seconds." % hung_commandline]
+
+    with_directory_contents(dict(), check)
+
+
+def test_run_shutdown_commands_missing_command():
+    errors = []
+    run_shutdown_commands('FOO', {'shutdown_commands': [['this-command-does-not-exist-kapsel']]}, errors)
+    assert 1 == len(errors)
+    assert errors[0].startswith("Shutting down FOO, command ['this-command-does-not-exist-kapsel'] failed: ")
+
+
+def test_run_shutdown_commands_terminates_leftover_process():
+    def check(dirname):
+        pidfile = os.path.join(dirname, "service.pid")
+        service = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+        try:
+            with codecs.open(pidfile, 'w', 'utf-8') as f:
+                f.write("%d\n" % service.pid)
+            errors = []
+            run_shutdown_commands('FOO', {'shutdown_commands': [], 'pidfile': pidfile}, errors, timeout_seconds=0.2)
+            assert errors == ["Shutting down FOO, process %d didn't exit, so it was terminated." % service.pid]
+            assert service.wait() != 0
+        finally:
+            if service.poll() is None:
+                service.kill()
+                service.wait()
+
+    with_directory_contents(dict(), check)
+
+
+def test_run_shutdown_commands_process_already_gone():
+    def check(dirname):
+        pidfile = os.path.join(dirname, "service.pid")
+        process = subprocess.Popen([sys.executable, "-c", "pass"])
+        process.wait()
+        with codecs.open(pidfile, 'w', 'utf-8') as f:
+            f.write("%d\n" % process.pid)
+        errors = []
+        run_shutdown_commands('FOO', {'pidfile': pidfile}, errors, timeout_seconds=5)
+        assert errors == []
+
+    with_directory_contents(dict(), check)
+
+
+def test_unprepare_shuts_down_services_concurrently(monkeypatch):
+    monkeypatch.setattr("conda_kapsel.plugins.network_util.can_connect_to_socket",
+                        lambda host, port, timeout_seconds=0.5: True)
+
+    def check(dirname):
+        slow_commandline = tmp_script_commandline("""import time
+time.sleep(1)
+""")
+        local_state_file = LocalStateFile.load_for_directory(dirname)
+        for name in ('FOO', 'BAR', 'BAZ'):
+            local_state_file.set_service_run_state(name, {'shutdown_commands': [slow_commandline]})
+        local_state_file.save()
+
+        project = project_no_dedicated_env(dirname)
+        environ = minimal_environ(FOO='redis://localhost:6379',
+                                  BAR='redis://localhost:6380',
+                                  BAZ='redis://localhost:6381')
+        result = prepare_without_interaction(project, environ=environ)
+        assert result
+
+        start = time.time()
+        status = unprepare(project, result)
+        assert status
+        # three one-second shutdowns in parallel
+        assert time.time() - start < 2.5
+        assert status.status_description == "Success."
+        local_state_file.load()
+        assert dict() == local_state_file.get_service_run_state('FOO')
+        assert dict() == local_state_file.get_service_run_state('BAZ')
+
+    with_directory_contents_completing_project_file(
+        {DEFAULT_PROJECT_FILENAME: """
+services:
+   FOO: redis
+   BAR: redis
+   BAZ: redis
+"""}, check)
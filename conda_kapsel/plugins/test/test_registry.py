@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------------
+# Copyright © 2016, Continuum Analytics, Inc. All rights reserved.
+#
+# The full license is in the file LICENSE.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import absolute_import
+
+import os
+
+from conda_kapsel.local_state_file import LocalStateFile
+from conda_kapsel.plugins import registry as registry_module
+from conda_kapsel.plugins.provider import EnvVarProvider
+from conda_kapsel.plugins.registry import PluginRegistry, ServiceType, load_plugin_index
+from conda_kapsel.plugins.requirements.redis import RedisRequirement
+from conda_kapsel.plugins.requirements.service import ServiceRequirement
+
+_THIS_MODULE = 'conda_kapsel.plugins.test.test_registry'
+
+
+class FakeRequirement(ServiceRequirement):
+    default_variable = 'FAKE_URL'
+    service_type_description = 'A fake server'
+
+
+class UndescribedRequirement(ServiceRequirement):
+    pass
+
+
+class FakeProvider(EnvVarProvider):
+    pass
+
+
+def _fake_entry_points(group):
+    if group == registry_module.SERVICE_TYPES_ENTRY_POINT_GROUP:
+        return [('fake', _THIS_MODULE + ':FakeRequirement'), ('undescribed', _THIS_MODULE + ':UndescribedRequirement'),
+                ('broken', 'conda_kapsel.plugins.test.no_such_module:Nope')]
+    elif group == registry_module.PROVIDERS_ENTRY_POINT_GROUP:
+        return [('FakeProvider', _THIS_MODULE + ':FakeProvider')]
+    else:
+        return []
+
+
+def test_load_plugin_index_scans_and_caches(monkeypatch, tmpdir, capsys):
+    monkeypatch.setattr('conda_kapsel.plugins.registry._iter_entry_points', _fake_entry_points)
+    filename = str(tmpdir.join("plugin-index.json"))
+
+    index = load_plugin_index(filename)
+    assert os.path.isfile(filename)
+    assert [dict(name='fake', default_variable='FAKE_URL', description='A fake server',
+                 target=_THIS_MODULE + ':FakeRequirement'),
+            dict(name='undescribed', default_variable='UNDESCRIBED_URL', description='undescribed',
+                 target=_THIS_MODULE + ':UndescribedRequirement')] == index['service_types']
+    assert dict(FakeProvider=_THIS_MODULE + ':FakeProvider') == index['providers']
+    (out, err) = capsys.readouterr()
+    assert err.startswith("Failed to load kapsel service type broken from "
+                          "conda_kapsel.plugins.test.no_such_module:Nope")
+
+    # the second time we don't scan at all
+    def no_scanning():
+        raise AssertionError("should have used the index file")
+
+    monkeypatch.setattr('conda_kapsel.plugins.registry._scan_entry_points', no_scanning)
+    assert index == load_plugin_index(filename)
+
+    # but we do if sys.path changes
+    monkeypatch.setattr('conda_kapsel.plugins.registry._scan_entry_points',
+                        lambda: dict(service_types=[], providers=dict()))
+    monkeypatch.setattr('conda_kapsel.plugins.registry._sys_path_fingerprint', lambda: ['changed'])
+    assert dict(service_types=[], providers=dict(), fingerprint=['changed']) == load_plugin_index(filename)
+
+
+def test_load_plugin_index_corrupt_or_unwritable(monkeypatch, tmpdir):
+    monkeypatch.setattr('conda_kapsel.plugins.registry._iter_entry_points', lambda group: [])
+    filename = str(tmpdir.join("plugin-index.json"))
+    with open(filename, 'w') as f:
+        f.write("not json")
+    assert [] == load_plugin_index(filename)['service_types']
+
+    # a file where the directory should be
+    filename = str(tmpdir.join("plugin-index.json", "index.json"))
+    assert [] == load_plugin_index(filename)['service_types']
+    assert not os.path.exists(filename)
+
+
+def test_default_plugin_index_filename(monkeypatch):
+    monkeypatch.setenv('KAPSEL_PLUGIN_INDEX', '/foo/index.json')
+    assert '/foo/index.json' == registry_module.default_plugin_index_filename()
+    monkeypatch.delenv('KAPSEL_PLUGIN_INDEX')
+    assert registry_module.default_plugin_index_filename().endswith('plugin-index.json')
+
+
+def test_registry_uses_plugin_index(monkeypatch, tmpdir):
+    monkeypatch.setattr('conda_kapsel.plugins.registry._iter_entry_points', _fake_entry_points)
+    index = load_plugin_index(str(tmpdir.join("plugin-index.json")))
+    registry = PluginRegistry(plugin_index=index)
+
+    assert [ServiceType(name='redis', default_variable='REDIS_URL', description='A Redis server'),
+            ServiceType(name='fake', default_variable='FAKE_URL', description='A fake server'),
+            ServiceType(name='undescribed', default_variable='UNDESCRIBED_URL',
+                        description='undescribed')] == registry.list_service_types()
+
+    found = registry.find_requirement_by_service_type(service_type='fake', env_var='MYFAKE', options=dict())
+    assert isinstance(found, FakeRequirement)
+    assert 'fake' == found.service_type
+    assert 'MYFAKE' == found.env_var
+
+    assert isinstance(registry.find_provider_by_class_name('FakeProvider'), FakeProvider)
+    assert registry.find_provider_by_class_name('NotAThing') is None
+
+
+def test_registry_builtins_win(tmpdir):
+    index = dict(service_types=[dict(name='redis', default_variable='FAKE_URL', description='Not redis',
+                                     target=_THIS_MODULE + ':FakeRequirement')],
+                 providers=dict(RedisProvider=_THIS_MODULE + ':FakeProvider'))
+    registry = PluginRegistry(plugin_index=index)
+    assert [ServiceType(name='redis', default_variable='REDIS_URL',
+                        description='A Redis server')] == registry.list_service_types()
+    found = registry.find_requirement_by_service_type(service_type='redis', env_var='REDIS_URL', options=dict())
+    assert isinstance(found, RedisRequirement)
+    assert registry.find_provider_by_class_name('RedisProvider').__class__.__name__ == 'RedisProvider'
+
+
+def test_builtin_lookups_do_not_load_index(monkeypatch):
+    def no_index():
+        raise AssertionError("should not need the plugin index")
+
+    monkeypatch.setattr('conda_kapsel.plugins.registry._plugin_index', no_index)
+    registry = PluginRegistry()
+    assert registry.find_requirement_by_service_type(service_type='redis', env_var='REDIS_URL',
+                                                     options=dict()) is not None
+    assert registry.find_provider_by_class_name('EnvVarProvider') is not None
+
+
+def test_registry_broken_plugin_is_unknown(monkeypatch, capsys):
+    monkeypatch.setattr('conda_kapsel.plugins.registry._reported_broken_targets', set())
+    # the index says these are installed, but they're gone or broken now
+    index = dict(service_types=[dict(name='gone', default_variable='GONE_URL', description='Gone',
+                                     target='conda_kapsel.plugins.test.no_such_module:Nope')],
+                 providers=dict(GoneProvider=_THIS_MODULE + ':NoSuchProvider'))
+    registry = PluginRegistry(plugin_index=index)
+
+    for i in range(2):
+        assert registry.find_requirement_by_service_type(service_type='gone', env_var='GONE_URL',
+                                                         options=dict()) is None
+        assert registry.find_provider_by_class_name('GoneProvider') is None
+
+    (out, err) = capsys.readouterr()
+    assert '' == out
+    # we complain once per plugin, naming it
+    assert [("Failed to load kapsel service type gone from conda_kapsel.plugins.test.no_such_module:Nope: "
+             "No module named 'conda_kapsel.plugins.test.no_such_module'"),
+            ("Failed to load kapsel provider GoneProvider from %s:NoSuchProvider: module '%s' has no "
+             "attribute 'NoSuchProvider'") % (_THIS_MODULE, _THIS_MODULE)] == err.strip().split("\n")
+
+
+def test_requirement_with_broken_provider_falls_back_to_env_var(monkeypatch, capsys, tmpdir):
+    monkeypatch.setattr('conda_kapsel.plugins.registry._reported_broken_targets', set())
+    registry = PluginRegistry(plugin_index=dict(service_types=[], providers=dict(
+        GoneProvider=_THIS_MODULE + ':NoSuchProvider')))
+    requirement = FakeRequirement(registry=registry, env_var='FAKE_URL', options=dict(type='fake'))
+    local_state_file = LocalStateFile.load_for_directory(str(tmpdir))
+    status = requirement._create_status(dict(FAKE_URL='http://example.com'), local_state_file, 'default', None, None,
+                                        has_been_provided=True, status_description="ok",
+                                        provider_class_name='GoneProvider')
+    assert isinstance(status.provider, EnvVarProvider)
+    assert "GoneProvider" in capsys.readouterr()[1]
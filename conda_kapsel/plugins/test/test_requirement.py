@@ -67,3 +67,10 @@ def test_requirement_status_repr():
     status = requirement.check_status(dict(FOO=''), tmp_local_state_file(), 'default', UserConfigOverrides())
     assert "RequirementStatus(False,'Environment variable FOO is not set.',EnvVarRequirement(env_var='FOO'))" == repr(
         status)
+
+
+def test_requirement_status_has_no_dict():
+    requirement = EnvVarRequirement(registry=PluginRegistry(), env_var='FOO')
+    status = requirement.check_status(dict(FOO='bar'), tmp_local_state_file(), 'default', UserConfigOverrides())
+    assert not hasattr(status, '__dict__')
+    assert status.has_been_provided
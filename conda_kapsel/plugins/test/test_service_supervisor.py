@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------------
+# Copyright © 2016, Continuum Analytics, Inc. All rights reserved.
+#
+# The full license is in the file LICENSE.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import absolute_import
+
+import codecs
+import os
+import socket
+import sys
+import threading
+import time
+
+import conda_kapsel.plugins.network_util as network_util
+from conda_kapsel.plugins import service_supervisor
+from conda_kapsel.plugins.service_supervisor import (ServiceSupervisor, STATUS_RUNNING, STATUS_RESTARTING,
+                                                     STATUS_UNKNOWN)
+
+
+def _write_pid_command(pidfile, pid):
+    return [sys.executable, '-c', "import sys; open(sys.argv[1], 'w').write(sys.argv[2])", pidfile, str(pid)]
+
+
+def test_supervisor_enabled(monkeypatch):
+    monkeypatch.setattr("conda_kapsel.plugins.network_util.unix_sockets_supported", lambda: True)
+    assert not service_supervisor.supervisor_enabled(dict())
+    assert not service_supervisor.supervisor_enabled(dict(KAPSEL_SUPERVISE_SERVICES='0'))
+    assert not service_supervisor.supervisor_enabled(dict(KAPSEL_SUPERVISE_SERVICES='false'))
+    assert service_supervisor.supervisor_enabled(dict(KAPSEL_SUPERVISE_SERVICES='1'))
+
+    monkeypatch.setattr("conda_kapsel.plugins.network_util.unix_sockets_supported", lambda: False)
+    assert not service_supervisor.supervisor_enabled(dict(KAPSEL_SUPERVISE_SERVICES='1'))
+
+
+def test_handle_requests():
+    supervisor = ServiceSupervisor()
+    assert dict(ok=True) == supervisor.handle_request(dict(command='ping'))
+    assert dict(ok=False, error="Unknown supervisor command 'frobnicate'.") == supervisor.handle_request(
+        dict(command='frobnicate'))
+    assert dict(ok=False, error="Service needs a key, command and pidfile.") == supervisor.handle_request(
+        dict(command='supervise', service=dict(key='foo')))
+
+    spec = dict(key='foo', command=['true'], pidfile='/nonexistent/foo.pid')
+    assert dict(ok=True) == supervisor.handle_request(dict(command='supervise', service=spec))
+    assert 1 == supervisor.service_count
+    assert dict(ok=True,
+                service=dict(key='foo', status=STATUS_RUNNING, restarts=0,
+                             last_error=None)) == supervisor.handle_request(dict(command='status', key='foo'))
+    assert dict(ok=True,
+                service=dict(key='bar', status=STATUS_UNKNOWN)) == supervisor.handle_request(dict(command='status',
+                                                                                                  key='bar'))
+    assert ['foo'] == [service['key'] for service in supervisor.handle_request(dict(command='status'))['services']]
+
+    assert dict(ok=True) == supervisor.handle_request(dict(command='unsupervise', key='foo'))
+    assert 0 == supervisor.service_count
+
+    assert not supervisor.stopped
+    assert dict(ok=True) == supervisor.handle_request(dict(command='shutdown'))
+    assert supervisor.stopped
+
+
+def test_restart_dead_service(tmpdir):
+    pidfile = str(tmpdir.join("service.pid"))
+    supervisor = ServiceSupervisor()
+    # the "service" is this process, which is certainly alive once the command writes its pid
+    spec = dict(key='foo', command=_write_pid_command(pidfile, os.getpid()), pidfile=pidfile)
+    supervisor.handle_request(dict(command='supervise', service=spec))
+
+    now = time.time()
+    supervisor.check_services(now)
+    status = supervisor.handle_request(dict(command='status', key='foo'))['service']
+    assert STATUS_RESTARTING == status['status']
+    assert 1 == status['restarts']
+    assert os.path.exists(pidfile)
+
+    supervisor.check_services(now + 0.1)
+    status = supervisor.handle_request(dict(command='status', key='foo'))['service']
+    assert STATUS_RUNNING == status['status']
+    assert 1 == status['restarts']
+    assert status['last_error'] is None
+
+
+def test_restart_backs_off(tmpdir):
+    pidfile = str(tmpdir.join("service.pid"))
+    supervisor = ServiceSupervisor()
+    # this never writes the pidfile, so every restart fails
+    spec = dict(key='foo', command=[sys.executable, '-c', 'import sys; sys.exit(3)'], pidfile=pidfile)
+    supervisor.handle_request(dict(command='supervise', service=spec))
+
+    def restarts():
+        return supervisor.handle_request(dict(command='status', key='foo'))['service']['restarts']
+
+    now = time.time()
+    supervisor.check_services(now)
+    assert 1 == restarts()
+    supervisor.check_services(now + 0.5)
+    assert 1 == restarts()
+    supervisor.check_services(now + 1.0)
+    assert 2 == restarts()
+    # backoff has doubled to 2 seconds
+    supervisor.check_services(now + 2.5)
+    assert 2 == restarts()
+    supervisor.check_services(now + 3.0)
+    assert 3 == restarts()
+
+    status = supervisor.handle_request(dict(command='status', key='foo'))['service']
+    assert STATUS_RESTARTING == status['status']
+    assert "Restarting foo failed: 3" == status['last_error']
+
+
+def test_unhealthy_probe_restarts_live_process(tmpdir):
+    pidfile = str(tmpdir.join("service.pid"))
+    with codecs.open(pidfile, 'w', 'utf-8') as f:
+        f.write(str(os.getpid()))
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+
+    supervisor = ServiceSupervisor()
+    spec = dict(key='foo',
+                command=[sys.executable, '-c', 'pass'],
+                pidfile=pidfile,
+                probe=dict(address=['127.0.0.1', port], request="PING\r\n", expected_reply="+PONG"))
+    supervisor.handle_request(dict(command='supervise', service=spec))
+    supervisor.check_services()
+    status = supervisor.handle_request(dict(command='status', key='foo'))['service']
+    assert STATUS_RESTARTING == status['status']
+    assert 1 == status['restarts']
+
+
+def _start_serving(directory, check_interval=0.05):
+    path = os.path.join(directory, "supervisor.sock")
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(4)
+    supervisor = ServiceSupervisor()
+    thread = threading.Thread(target=lambda: supervisor.serve(listener, check_interval=check_interval))
+    thread.daemon = True
+    thread.start()
+    return (listener, thread)
+
+
+def test_client_requests(tmpdir):
+    if not network_util.unix_sockets_supported():
+        return
+    directory = str(tmpdir)
+    assert service_supervisor.request_supervisor(dict(command='ping'), directory=directory) is None
+    assert service_supervisor.supervised_service_status('foo', directory=directory) is None
+
+    (listener, thread) = _start_serving(directory)
+    try:
+        pidfile = str(tmpdir.join("service.pid"))
+        assert service_supervisor.supervise_service('foo',
+                                                    _write_pid_command(pidfile, os.getpid()),
+                                                    pidfile,
+                                                    environ=dict(os.environ),
+                                                    directory=directory)
+        # the first check restarts it since there's no pidfile, then it's running
+        deadline = time.time() + 10
+        while service_supervisor.supervised_service_status('foo', directory=directory) != STATUS_RUNNING:
+            assert time.time() < deadline
+            time.sleep(0.05)
+
+        service_supervisor.unsupervise_service('foo', directory=directory)
+        assert STATUS_UNKNOWN == service_supervisor.supervised_service_status('foo', directory=directory)
+
+        assert dict(ok=True) == service_supervisor.request_supervisor(dict(command='shutdown'), directory=directory)
+        thread.join()
+    finally:
+        listener.close()
+
+
+def test_bad_request(tmpdir):
+    if not network_util.unix_sockets_supported():
+        return
+    directory = str(tmpdir)
+    (listener, thread) = _start_serving(directory)
+    try:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect(os.path.join(directory, "supervisor.sock"))
+        s.sendall(b"not json\n")
+        reply = s.recv(4096)
+        s.close()
+        assert reply.startswith(b'{')
+        assert b'Bad request' in reply
+        service_supervisor.request_supervisor(dict(command='shutdown'), directory=directory)
+        thread.join()
+    finally:
+        listener.close()
+
+
+def test_main_runs_one_supervisor(tmpdir):
+    if not network_util.unix_sockets_supported():
+        return
+    directory = str(tmpdir.join("supervisor"))
+    results = []
+    thread = threading.Thread(target=lambda: results.append(service_supervisor.main(directory)))
+    thread.daemon = True
+    thread.start()
+
+    deadline = time.time() + 10
+    while service_supervisor.request_supervisor(dict(command='ping'), directory=directory) is None:
+        assert time.time() < deadline
+        time.sleep(0.05)
+
+    # a second one sees the lock and leaves
+    assert 0 == service_supervisor.main(directory)
+    assert service_supervisor.request_supervisor(dict(command='ping'), directory=directory) is not None
+
+    service_supervisor.request_supervisor(dict(command='shutdown'), directory=directory)
+    thread.join()
+    assert [0] == results
+    assert not os.path.exists(os.path.join(directory, "supervisor.sock"))
+
+
+def test_ensure_supervisor_running(tmpdir):
+    if not network_util.unix_sockets_supported():
+        return
+    directory = str(tmpdir.join("supervisor"))
+    assert service_supervisor.ensure_supervisor_running(directory=directory, timeout_seconds=30)
+    try:
+        # already running, so this is just a ping
+        assert service_supervisor.ensure_supervisor_running(directory=directory)
+    finally:
+        service_supervisor.request_supervisor(dict(command='shutdown'), directory=directory)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------------
+# Copyright © 2016, Continuum Analytics, Inc. All rights reserved.
+#
+# The full license is in the file LICENSE.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import absolute_import
+
+import os
+
+from conda_kapsel.plugins import warm_pool
+
+
+def _starter(started, fail=False):
+    def start(directory):
+        if fail:
+            return None
+        started.append(directory)
+        return dict(url="fake://%d" % len(started), run_state=dict(number=len(started)))
+
+    return start
+
+
+def test_pool_size():
+    assert 0 == warm_pool.pool_size('redis', dict())
+    assert 0 == warm_pool.pool_size('redis', dict(KAPSEL_WARM_POOL_REDIS='nope'))
+    assert 0 == warm_pool.pool_size('redis', dict(KAPSEL_WARM_POOL_REDIS='-1'))
+    assert 3 == warm_pool.pool_size('redis', dict(KAPSEL_WARM_POOL_REDIS=' 3 '))
+    assert 0 == warm_pool.pool_size('postgres', dict(KAPSEL_WARM_POOL_REDIS='3'))
+
+
+def test_refill_and_claim(tmpdir):
+    directory = str(tmpdir)
+    started = []
+    assert 2 == warm_pool.refill('fake', 2, _starter(started), directory=directory)
+    assert 2 == len(started)
+    for instance_dir in started:
+        assert os.path.isdir(instance_dir)
+    # already full
+    assert 0 == warm_pool.refill('fake', 2, _starter(started), directory=directory)
+
+    first = warm_pool.claim_instance('fake', lambda instance: True, directory=directory)
+    second = warm_pool.claim_instance('fake', lambda instance: True, directory=directory)
+    assert first is not None and second is not None
+    assert set([first['url'], second['url']]) == set(["fake://1", "fake://2"])
+    assert set([first['directory'], second['directory']]) == set(started)
+    assert warm_pool.claim_instance('fake', lambda instance: True, directory=directory) is None
+
+    # refill replaces what was claimed
+    assert 2 == warm_pool.refill('fake', 2, _starter(started), directory=directory)
+
+
+def test_claim_skips_unusable(tmpdir):
+    directory = str(tmpdir)
+    started = []
+    warm_pool.refill('fake', 2, _starter(started), directory=directory)
+    claimed = warm_pool.claim_instance('fake', lambda instance: instance['run_state']['number'] == 2,
+                                       directory=directory)
+    assert "fake://2" == claimed['url']
+    assert warm_pool.claim_instance('fake', lambda instance: instance['run_state']['number'] == 2,
+                                    directory=directory) is None
+    assert "fake://1" == warm_pool.claim_instance('fake', lambda instance: True, directory=directory)['url']
+
+
+def test_claim_from_missing_pool(tmpdir):
+    directory = str(tmpdir.join("nope"))
+    assert warm_pool.claim_instance('fake', lambda instance: True, directory=directory) is None
+
+
+def test_claim_lost_race(monkeypatch, tmpdir):
+    directory = str(tmpdir)
+    warm_pool.refill('fake', 1, _starter([]), directory=directory)
+
+    def mock_rename(src, dst):
+        raise OSError("someone else got it")
+
+    monkeypatch.setattr('os.rename', mock_rename)
+    assert warm_pool.claim_instance('fake', lambda instance: True, directory=directory) is None
+
+
+def test_refill_failed_start(tmpdir):
+    directory = str(tmpdir)
+    assert 0 == warm_pool.refill('fake', 2, _starter([], fail=True), directory=directory)
+    # the instance directory was cleaned up, only the lock is left
+    assert ['refill.lock'] == os.listdir(directory)
+
+
+def test_refill_discards_dead_instances(tmpdir):
+    directory = str(tmpdir)
+    started = []
+    warm_pool.refill('fake', 2, _starter(started), directory=directory)
+    assert 1 == warm_pool.refill('fake',
+                                 2,
+                                 _starter(started),
+                                 alive=lambda instance: instance['run_state']['number'] != 1,
+                                 directory=directory)
+    assert not os.path.exists(started[0])
+    urls = [warm_pool.claim_instance('fake', lambda instance: True, directory=directory)['url'] for i in (1, 2)]
+    assert ["fake://2", "fake://3"] == sorted(urls)
+
+
+def test_refill_when_someone_else_is(tmpdir):
+    from conda_kapsel.internal.file_lock import FileLock
+
+    directory = str(tmpdir)
+    with FileLock(os.path.join(directory, "refill.lock")):
+        assert 0 == warm_pool.refill('fake', 2, _starter([]), directory=directory)
+
+
+def test_refill_in_background(monkeypatch):
+    launched = []
+
+    def mock_Popen(*args, **kwargs):
+        launched.append(args[0])
+
+    monkeypatch.setattr('subprocess.Popen', mock_Popen)
+    warm_pool.refill_in_background('redis', 'RedisProvider', dict())
+    assert [] == launched
+    warm_pool.refill_in_background('redis', 'RedisProvider', dict(KAPSEL_WARM_POOL_REDIS='1'))
+    assert 1 == len(launched)
+    assert ['-m', 'conda_kapsel.plugins.warm_pool', 'redis', 'RedisProvider'] == launched[0][1:]
+
+
+def test_main_unknown_provider(capsys):
+    assert 1 == warm_pool.main('redis', 'NotAProvider')
+    (out, err) = capsys.readouterr()
+    assert "Unknown provider NotAProvider\n" == err
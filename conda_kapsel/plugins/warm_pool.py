@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------------
+# Copyright © 2016, Continuum Analytics, Inc. All rights reserved.
+#
+# The full license is in the file LICENSE.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+"""Idle service instances started ahead of time, so projects don't wait for them.
+
+Setting ``KAPSEL_WARM_POOL_<TYPE>`` (for example
+``KAPSEL_WARM_POOL_REDIS=2``) asks for that many idle instances of a
+service type. Each instance lives in its own directory in the user's
+pool directory. An instance is published by renaming a file describing
+it to a ``ready-`` name, and a project claims it by renaming that file
+again, so two projects can never get the same instance. Once a project has
+claimed an instance, a background process starts a replacement.
+
+A provider that supports the pool implements
+``start_pool_instance(directory, environ)``, which starts an instance
+in ``directory``. It returns a dict holding the instance's ``url`` and
+the ``run_state`` the project should save, or None if the start failed.
+It also implements ``pool_instance_is_alive(instance)``, so instances
+that died while idle can be replaced.
+"""
+from __future__ import absolute_import, print_function
+
+import codecs
+import json
+import os
+import shutil
+import subprocess
+import sys
+import uuid
+
+from conda_kapsel.internal.file_lock import FileLock, user_lock_directory
+from conda_kapsel.internal.makedirs import makedirs_ok_if_exists
+from conda_kapsel.internal import py2_compat
+
+WARM_POOL_VARIABLE_PREFIX = 'KAPSEL_WARM_POOL_'
+
+_READY_PREFIX = "ready-"
+_CLAIMED_PREFIX = "claimed-"
+_INFO_SUFFIX = ".json"
+
+
+def pool_size(service_type, environ):
+    """How many idle instances of a service type to keep around, 0 if there's no pool."""
+    value = environ.get(WARM_POOL_VARIABLE_PREFIX + service_type.upper(), '')
+    try:
+        size = int(value.strip())
+    except ValueError:
+        return 0
+    return max(0, size)
+
+
+def pool_directory(service_type):
+    """Directory holding this user's idle instances of a service type."""
+    return os.path.join(user_lock_directory("kapsel-warm-pool"), service_type)
+
+
+def _read_info(filename):
+    try:
+        with codecs.open(filename, 'r', 'utf-8') as f:
+            info = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if not isinstance(info, dict) or 'url' not in info or 'run_state' not in info:
+        return None
+    return info
+
+
+def _ready_instances(directory):
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    return sorted([name for name in names if name.startswith(_READY_PREFIX) and name.endswith(_INFO_SUFFIX)])
+
+
+def claim_instance(service_type, usable, directory=None):
+    """Take an idle instance out of the pool.
+
+    Args:
+        service_type (str): the service type
+        usable (function): given an instance dict, True if the caller
+            can use it; unusable instances are left in the pool
+        directory (str): pool directory, None for the default
+
+    Returns:
+        the instance dict, with the instance's ``directory`` added, or None if there wasn't one
+    """
+    if directory is None:
+        directory = pool_directory(service_type)
+    for name in _ready_instances(directory):
+        ready_filename = os.path.join(directory, name)
+        info = _read_info(ready_filename)
+        if info is None or not usable(info):
+            continue
+        instance_id = name[len(_READY_PREFIX):-len(_INFO_SUFFIX)]
+        claimed_filename = os.path.join(directory, _CLAIMED_PREFIX + instance_id + _INFO_SUFFIX)
+        try:
+            os.rename(ready_filename, claimed_filename)
+        except OSError:
+            # someone else claimed it first
+            continue
+        try:
+            os.remove(claimed_filename)
+        except OSError:
+            pass
+        info['directory'] = os.path.join(directory, instance_id)
+        return info
+    return None
+
+
+def add_instance(start, directory):
+    """Start one instance and publish it in the pool.
+
+    Args:
+        start (function): given a directory, starts an instance there and
+            returns its instance dict, or None on failure
+        directory (str): pool directory
+
+    Returns:
+        True if an instance was added
+    """
+    instance_id = str(uuid.uuid4())
+    instance_dir = os.path.join(directory, instance_id)
+    makedirs_ok_if_exists(instance_dir)
+    info = None
+    try:
+        info = start(instance_dir)
+    finally:
+        if info is None:
+            shutil.rmtree(instance_dir, ignore_errors=True)
+    if info is None:
+        return False
+    # write it under a name claim_instance() ignores, then publish it
+    starting_filename = os.path.join(directory, "starting-" + instance_id + _INFO_SUFFIX)
+    with codecs.open(starting_filename, 'w', 'utf-8') as f:
+        json.dump(info, f, sort_keys=True, indent=2)
+    os.rename(starting_filename, os.path.join(directory, _READY_PREFIX + instance_id + _INFO_SUFFIX))
+    return True
+
+
+def _discard_dead_instances(service_type, alive, directory):
+    while True:
+        # claiming them first means nobody else can be handed one while we delete it
+        dead = claim_instance(service_type, lambda info: not alive(info), directory=directory)
+        if dead is None:
+            break
+        shutil.rmtree(dead['directory'], ignore_errors=True)
+
+
+def refill(service_type, size, start, alive=None, directory=None):
+    """Start instances until the pool has size idle ones.
+
+    Only one process refills a given pool at a time; if another is
+    already doing it, this returns right away.
+
+    Args:
+        service_type (str): the service type
+        size (int): number of idle instances wanted
+        start (function): starts an instance, see ``add_instance()``
+        alive (function): given an instance dict, False if the instance
+            died and should be thrown away; None to keep them all
+        directory (str): pool directory, None for the default
+
+    Returns:
+        number of instances added
+    """
+    if directory is None:
+        directory = pool_directory(service_type)
+    makedirs_ok_if_exists(directory)
+    lock = FileLock(os.path.join(directory, "refill.lock"))
+    if not lock.try_acquire():
+        return 0
+    added = 0
+    try:
+        if alive is not None:
+            _discard_dead_instances(service_type, alive, directory)
+        while len(_ready_instances(directory)) < size:
+            if not add_instance(start, directory):
+                break
+            added += 1
+    finally:
+        lock.release()
+    return added
+
+
+def refill_in_background(service_type, provider_class_name, environ):
+    """Start a detached process to refill the pool, if there's supposed to be one."""
+    if pool_size(service_type, environ) == 0:
+        return
+    kwargs = dict(close_fds=True)
+    if hasattr(os, 'setsid'):
+        kwargs['preexec_fn'] = os.setsid
+    try:
+        with open(os.devnull, 'r+b') as devnull:
+            subprocess.Popen([sys.executable, '-m', 'conda_kapsel.plugins.warm_pool', service_type,
+                              provider_class_name],
+                             stdin=devnull,
+                             stdout=devnull,
+                             stderr=devnull,
+                             env=py2_compat.env_without_unicode(environ),
+                             **kwargs)
+    except (IOError, OSError):
+        # the next claim will try again
+        pass
+
+
+def main(service_type, provider_class_name):
+    """Refill the pool for a service type using the named provider."""
+    from conda_kapsel.plugins.registry import PluginRegistry
+
+    provider = PluginRegistry().find_provider_by_class_name(provider_class_name)
+    if provider is None:
+        print("Unknown provider %s" % provider_class_name, file=sys.stderr)
+        return 1
+    environ = dict(os.environ)
+    refill(service_type,
+           pool_size(service_type, environ),
+           lambda directory: provider.start_pool_instance(directory, environ),
+           alive=provider.pool_instance_is_alive)
+    return 0
+
+
+if __name__ == '__main__':  # pragma: no cover (runs in the refill process)
+    sys.exit(main(sys.argv[1], sys.argv[2]))
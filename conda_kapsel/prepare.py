@@ -11,6 +11,7 @@ from __future__ import print_function
 from abc import ABCMeta, abstractmethod
 import os
 import sys
+import threading
 from copy import deepcopy
 
 from conda_kapsel.internal.metaclass import with_metaclass
@@ -20,9 +21,11 @@ from conda_kapsel.internal.toposort import toposort_from_dependency_info
 from conda_kapsel.internal import conda_api
 from conda_kapsel.internal.py2_compat import is_string
 from conda_kapsel.local_state_file import LocalStateFile
+from conda_kapsel.project import ProjectSnapshot
 from conda_kapsel.provide import (_all_provide_modes, PROVIDE_MODE_DEVELOPMENT)
 from conda_kapsel.plugins.provider import ProvideContext
 from conda_kapsel.plugins.requirement import EnvVarRequirement, UserConfigOverrides
+from conda_kapsel.plugins.requirements.conda_env import CondaEnvRequirement
 
 
 def _update_environ(dest, src):
@@ -46,6 +49,9 @@ class PrepareResult(with_metaclass(ABCMeta)):
         self._statuses = tuple(statuses)
         self._environ = environ
         self._overrides = overrides
+        # status_for() lookups, filled in on first use
+        self._statuses_by_env_var = None
+        self._statuses_by_class = dict()
 
     def __bool__(self):
         """True if we were successful."""
@@ -91,14 +97,23 @@ class PrepareResult(with_metaclass(ABCMeta)):
 
     def status_for(self, env_var_or_class):
         """Get status for the given env var or class, or None if unknown."""
-        for status in self.statuses:
-            if is_string(env_var_or_class):
-                if isinstance(status.requirement, EnvVarRequirement) and \
-                   status.requirement.env_var == env_var_or_class:
-                    return status
-            elif isinstance(status.requirement, env_var_or_class):
-                return status
-        return None
+        if is_string(env_var_or_class):
+            if self._statuses_by_env_var is None:
+                by_env_var = dict()
+                for status in self.statuses:
+                    if isinstance(status.requirement, EnvVarRequirement):
+                        by_env_var.setdefault(status.requirement.env_var, status)
+                self._statuses_by_env_var = by_env_var
+            return self._statuses_by_env_var.get(env_var_or_class, None)
+
+        if env_var_or_class not in self._statuses_by_class:
+            found = None
+            for status in self.statuses:
+                if isinstance(status.requirement, env_var_or_class):
+                    found = status
+                    break
+            self._statuses_by_class[env_var_or_class] = found
+        return self._statuses_by_class[env_var_or_class]
 
     @property
     def environ(self):
@@ -418,19 +433,79 @@ def _sort_statuses(environ, local_state, statuses, missing_vars_getter):
     return toposort_from_dependency_info(statuses, get_node_key, get_dependency_keys, can_ignore_dependency_on_key)
 
 
-def _in_provide_whitelist(provide_whitelist, requirement):
-    if provide_whitelist is None:
-        # whitelist of None means "everything"
-        return True
+def _provide_all(statuses, environ, local_state, provide):
+    """Call provide(status, environ) for each status, returning a dict from status to result.
 
+    Statuses are provided in order, except that those whose provider
+    doesn't need the conda environment are provided in background
+    threads from the start, so they don't wait for the environment to
+    be created. A background provider works on its own copy of
+    environ, and its changes are copied back when it's done.
+    """
+    background = []
+    if len(statuses) > 1:
+        background = [status for status in statuses
+                      if not status.provider.env_prefix_needed(status.requirement, environ, local_state)]
+
+    results = dict()
+    exceptions = []
+
+    def provide_in_background(status, copied_environ):
+        try:
+            results[status] = provide(status, copied_environ)
+        except Exception as e:
+            exceptions.append(e)
+
+    threads = []
+    for status in background:
+        copied_environ = environ.copy()
+        thread = threading.Thread(target=provide_in_background, args=(status, copied_environ))
+        thread.start()
+        threads.append((thread, environ.copy(), copied_environ))
+
+    in_background = set(background)
+    try:
+        for status in statuses:
+            if status not in in_background:
+                results[status] = provide(status, environ)
+    finally:
+        for (thread, original, copied_environ) in threads:
+            thread.join()
+            for name in original:
+                if name not in copied_environ:
+                    environ.pop(name, None)
+            for (name, value) in copied_environ.items():
+                if original.get(name, None) != value:
+                    environ[name] = value
+    if exceptions:
+        raise exceptions[0]
+    return results
+
+
+def _compile_provide_whitelist(provide_whitelist):
+    # a whitelist of None means "everything"; otherwise we split it into
+    # a set of env vars and a tuple of classes, so checking a requirement
+    # doesn't depend on the whitelist's length
+    if provide_whitelist is None:
+        return None
+    env_vars = set()
+    classes = []
     for env_var_or_class in provide_whitelist:
         if is_string(env_var_or_class):
-            if isinstance(requirement, EnvVarRequirement) and requirement.env_var == env_var_or_class:
-                return True
+            env_vars.add(env_var_or_class)
         else:
-            if isinstance(requirement, env_var_or_class):
-                return True
-    return False
+            classes.append(env_var_or_class)
+    return (env_vars, tuple(classes))
+
+
+def _in_provide_whitelist(compiled_whitelist, requirement):
+    if compiled_whitelist is None:
+        return True
+
+    (env_vars, classes) = compiled_whitelist
+    if isinstance(requirement, EnvVarRequirement) and requirement.env_var in env_vars:
+        return True
+    return len(classes) > 0 and isinstance(requirement, classes)
 
 
 def _configure_and_provide(project, environ, local_state, statuses, all_statuses, keep_going_until_success, mode,
@@ -451,21 +526,19 @@ def _configure_and_provide(project, environ, local_state, statuses, all_statuses
 
         logs = []
         errors = []
-        did_any_providing = False
-        results_by_status = dict()
+        whitelist = _compile_provide_whitelist(provide_whitelist)
+        to_provide = [status for status in rechecked
+                      if _in_provide_whitelist(whitelist, status.requirement) and not status.has_been_provided]
+        did_any_providing = len(to_provide) > 0
 
-        for status in rechecked:
-            if not _in_provide_whitelist(provide_whitelist, status.requirement):
-                continue
-            elif status.has_been_provided:
-                continue
-            else:
-                did_any_providing = True
-                context = ProvideContext(environ, local_state, default_env_spec_name, status, mode)
-                result = status.provider.provide(status.requirement, context)
-                logs.extend(result.logs)
-                errors.extend(result.errors)
-                results_by_status[status] = result
+        def provide(status, environ):
+            context = ProvideContext(environ, local_state, default_env_spec_name, status, mode)
+            return status.provider.provide(status.requirement, context)
+
+        results_by_status = _provide_all(to_provide, environ, local_state, provide)
+        for status in to_provide:
+            logs.extend(results_by_status[status].logs)
+            errors.extend(results_by_status[status].errors)
 
         if did_any_providing:
             old = rechecked
@@ -738,7 +811,7 @@ def prepare_in_stages(project,
     ``project.problems`` must be empty.
 
     Args:
-        project (Project): the project
+        project (Project or ProjectSnapshot): the project
         environ (dict): the environment to start from (None to use os.environ)
         keep_going_until_success (bool): keep returning new stages until all requirements are met
         mode (str): One of ``PROVIDE_MODE_PRODUCTION``, ``PROVIDE_MODE_DEVELOPMENT``, ``PROVIDE_MODE_CHECK``
@@ -776,10 +849,18 @@ def _project_problems_to_prepare_failure(project, environ, overrides):
         return None
 
 
+def _project_filename(project):
+    # a snapshot doesn't have the project file, which can change
+    if isinstance(project, ProjectSnapshot):
+        return project.project_filename
+    else:
+        return project.project_file.filename
+
+
 def _prepare_failure_on_bad_command_name(project, command_name, environ, overrides):
     if command_name is not None and command_name not in project.commands:
         error = ("Command name '%s' is not in %s, these names were found: %s" %
-                 (command_name, project.project_file.filename, ", ".join(sorted(project.commands.keys()))))
+                 (command_name, _project_filename(project), ", ".join(sorted(project.commands.keys()))))
         return PrepareFailure(logs=[], statuses=(), errors=[error], environ=environ, overrides=overrides)
     else:
         return None
@@ -788,7 +869,7 @@ def _prepare_failure_on_bad_command_name(project, command_name, environ, overrid
 def _prepare_failure_on_bad_env_spec_name(project, env_spec_name, environ, overrides):
     if env_spec_name is not None and env_spec_name not in project.env_specs:
         error = ("Environment name '%s' is not in %s, these names were found: %s" %
-                 (env_spec_name, project.project_file.filename, ", ".join(sorted(project.env_specs.keys()))))
+                 (env_spec_name, _project_filename(project), ", ".join(sorted(project.env_specs.keys()))))
         return PrepareFailure(logs=[], statuses=(), errors=[error], environ=environ, overrides=overrides)
     else:
         return None
@@ -844,7 +925,7 @@ def prepare_without_interaction(project,
     advance.
 
     Args:
-        project (Project): from the ``load_project`` method
+        project (Project or ProjectSnapshot): from the ``load_project`` method
         environ (dict): os.environ or the previously-prepared environ; not modified in-place
         mode (str): mode from ``PROVIDE_MODE_PRODUCTION``, ``PROVIDE_MODE_DEVELOPMENT``, ``PROVIDE_MODE_CHECK``
         provide_whitelist (iterable of str): ONLY call provide() for the listed env vars' requirements
@@ -913,7 +994,7 @@ def prepare_with_browser_ui(project,
     advance.
 
     Args:
-        project (Project): from the ``load_project`` method
+        project (Project or ProjectSnapshot): from the ``load_project`` method
         environ (dict): os.environ or the previously-prepared environ; not modified in-place
         env_spec_name (str): the environment spec name to require, or None for default
         command_name (str): which named command to choose from the project, None for default
@@ -970,7 +1051,7 @@ def prepare_execute_with_browser_ui(project, stage, io_loop=None, show_url=None)
     anything. Expect side effects.
 
     Args:
-        project (Project): the project
+        project (Project or ProjectSnapshot): the project
         stage (PrepareStage): from prepare_in_stages()
         io_loop (IOLoop): tornado IOLoop to use, None for default
         show_url (function): takes a URL and displays it in a browser somehow, None for default
@@ -993,7 +1074,7 @@ def unprepare(project, prepare_result, whitelist=None):
     To stop a single service, use ``whitelist=["SERVICE_VARIABLE"]``.
 
     Args:
-        project (Project): the project
+        project (Project or ProjectSnapshot): the project
         prepare_result (PrepareResult): result from the previous prepare
         whitelist (iterable of str or type): ONLY call shutdown commands for the listed env vars' requirements
 
@@ -1010,17 +1091,45 @@ def unprepare(project, prepare_result, whitelist=None):
 
     # note: if the prepare_result was a failure before statuses
     # were even checked, then statuses could be empty
+    compiled_whitelist = _compile_provide_whitelist(whitelist)
+    statuses = [status for status in prepare_result.statuses
+                if _in_provide_whitelist(compiled_whitelist, status.requirement)]
+
+    # shutting down a service can mean waiting on it, so do them all
+    # at once; but services may run their shutdown commands from the
+    # project's environment, so only remove environments afterward.
+    unprovide_statuses = [None] * len(statuses)
+    exceptions = []
+
+    def unprovide(i):
+        status = statuses[i]
+        try:
+            unprovide_statuses[i] = status.provider.unprovide(status.requirement, prepare_result.environ,
+                                                              local_state_file, prepare_result.overrides, status)
+        except Exception as e:
+            exceptions.append((status.requirement, e))
+
+    def unprovide_concurrently(indices):
+        threads = [threading.Thread(target=unprovide, args=(i, )) for i in indices]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    removes_env = [isinstance(status.requirement, CondaEnvRequirement) for status in statuses]
+    unprovide_concurrently([i for i in range(0, len(statuses)) if not removes_env[i]])
+    unprovide_concurrently([i for i in range(0, len(statuses)) if removes_env[i]])
+    if exceptions:
+        # we can only raise one, so don't lose the others
+        for (requirement, e) in exceptions[1:]:
+            print("Failed to clean up %s: %s" % (requirement.title, e), file=sys.stderr)
+        raise exceptions[0][1]
+
     failed_statuses = []
     failed_requirements = []
     success_statuses = []
-    for status in prepare_result.statuses:
+    for (status, unprovide_status) in zip(statuses, unprovide_statuses):
         requirement = status.requirement
-        if not _in_provide_whitelist(whitelist, requirement):
-            continue
-
-        provider = status.provider
-        unprovide_status = provider.unprovide(requirement, prepare_result.environ, local_state_file,
-                                              prepare_result.overrides, status)
         if not unprovide_status:
             failed_requirements.append(requirement)
             failed_statuses.append(unprovide_status)
@@ -9,11 +9,12 @@ from __future__ import absolute_import
 
 from copy import deepcopy, copy
 import os
+import threading
 
 from conda_kapsel.env_spec import (EnvSpec, _anaconda_default_env_spec, _find_importable_spec,
-                                   _find_out_of_sync_importable_spec)
+                                   _find_out_of_sync_importable_spec, _importable_spec_dependencies)
 from conda_kapsel.conda_meta_file import CondaMetaFile, META_DIRECTORY
-from conda_kapsel.plugins.registry import PluginRegistry
+from conda_kapsel.plugins.registry import PluginRegistry, _sys_path_fingerprint
 from conda_kapsel.plugins.requirement import EnvVarRequirement
 from conda_kapsel.plugins.requirements.conda_env import CondaEnvRequirement
 from conda_kapsel.plugins.requirements.download import DownloadRequirement
@@ -22,6 +23,7 @@ from conda_kapsel.project_commands import ProjectCommand
 from conda_kapsel.project_file import ProjectFile
 from conda_kapsel.archiver import _list_relative_paths_for_unignored_project_files
 
+from conda_kapsel.internal import model_cache
 from conda_kapsel.internal.py2_compat import is_string
 from conda_kapsel.internal.simple_status import SimpleStatus
 from conda_kapsel.internal.slugify import slugify
@@ -83,12 +85,26 @@ def _make_problems_into_objects(problems):
     return new_problems
 
 
+# the project file sections that the expensive parts of the model are
+# computed from; a part is computed again only when one of them changes
+_MODEL_PART_SECTIONS = dict(variables=('variables', ),
+                            downloads=('downloads', ),
+                            services=('services', ),
+                            env_specs=('packages', 'channels', 'env_specs', 'skip_imports'),
+                            commands=('commands', ),
+                            notebooks=('commands', 'skip_imports'))
+
+
 class _ConfigCache(object):
     def __init__(self, directory_path, registry):
         self.directory_path = directory_path
         if registry is None:
             registry = PluginRegistry()
         self.registry = registry
+        # cached models don't record which plugins they were computed
+        # with, so only share them between projects using the default
+        # plugins (loaded from the entry points on sys.path)
+        self._registry_is_default = type(registry) is PluginRegistry and registry._index is None
 
         self.name = None
         self.description = ''
@@ -100,12 +116,24 @@ class _ConfigCache(object):
         self.env_specs = dict()
         self.default_env_spec_name = None
         self.global_base_env_spec = None
+        # (problems, requirements) from each part in _MODEL_PART_SECTIONS,
+        # or None if everything has to be computed
+        self._parts = None
+        # the sections those parts were computed from
+        self._section_snapshots = dict()
+        self._project_file_edit_count = 0
+        self._notebook_check_commands = dict()
+        # for find_requirements(); requirements by env var, and
+        # requirements by class filled in as classes are asked for
+        self._requirements_by_env_var = dict()
+        self._requirements_by_class = dict()
 
     def update(self, project_file, conda_meta_file):
         if project_file.change_count == self.project_file_count and \
            conda_meta_file.change_count == self.conda_meta_file_count:
             return
 
+        conda_meta_changed = conda_meta_file.change_count != self.conda_meta_file_count
         self.project_file_count = project_file.change_count
         self.conda_meta_file_count = conda_meta_file.change_count
 
@@ -124,28 +152,166 @@ class _ConfigCache(object):
                             (conda_meta_file.filename, conda_meta_file.corrupted_error_message))
 
         if project_exists and not (project_file.corrupted or conda_meta_file.corrupted):
-            self._update_name(problems, project_file, conda_meta_file)
-            self._update_description(problems, project_file)
-            self._update_icon(problems, project_file, conda_meta_file)
-            # future: we could un-hardcode this so plugins can add stuff here
-            self._update_variables(requirements, problems, project_file)
-            self._update_downloads(requirements, problems, project_file)
-            self._update_services(requirements, problems, project_file)
-            self._update_env_specs(problems, project_file)
-            # this MUST be after we _update_variables since we may get CondaEnvRequirement
-            # options in the variables section, and after _update_env_specs
-            # since we use those
-            self._update_conda_env_requirements(requirements, problems, project_file)
-
-            # this MUST be after we update env reqs so we have the valid env spec names
-            self._update_commands(problems, project_file, conda_meta_file, requirements)
+            stale = self._stale_parts(project_file, conda_meta_changed)
+
+            cache_directory = None
+            if self._registry_is_default:
+                cache_directory = model_cache.default_model_cache_directory()
+            key = None
+            if cache_directory is not None and len(stale) == len(_MODEL_PART_SECTIONS):
+                key = self._model_key(project_file, conda_meta_file)
+
+            if key is not None and self._load_model(cache_directory, key, problems, project_file, conda_meta_file):
+                # we don't know which part of the model each
+                # requirement came from, so compute everything next time
+                self._parts = None
+                requirements.extend(self.requirements)
+                self._verify_notebook_commands(self.commands, problems, requirements, project_file)
+            else:
+                self._update_parts(stale, problems, requirements, project_file, conda_meta_file)
+
+                # problems other than notebook suggestions would need the
+                # model computed again to report them, so we only save
+                # models without any
+                if key is not None and len(problems) == len(self._parts['notebooks'][0]):
+                    self._save_model(cache_directory, key, requirements)
 
             self._verify_command_dependencies(problems, project_file)
+        else:
+            self._parts = None
 
         self.requirements = requirements
+        self._index_requirements()
         self.problems = _make_problems_into_objects(problems)
         self.problem_strings = list([p.text for p in self.problems if not p.only_a_suggestion])
 
+    def _index_requirements(self):
+        by_env_var = dict()
+        for req in self.requirements:
+            if isinstance(req, EnvVarRequirement):
+                by_env_var.setdefault(req.env_var, []).append(req)
+        self._requirements_by_env_var = by_env_var
+        self._requirements_by_class = dict()
+
+    def find_requirements(self, env_var, klass):
+        if env_var is not None:
+            found = self._requirements_by_env_var.get(env_var, [])
+            if klass is not None:
+                found = [req for req in found if isinstance(req, klass)]
+        elif klass is not None:
+            found = self._requirements_by_class.get(klass)
+            if found is None:
+                found = [req for req in self.requirements if isinstance(req, klass)]
+                self._requirements_by_class[klass] = found
+        else:
+            found = self.requirements
+        # callers may modify the list
+        return list(found)
+
+    def _stale_parts(self, project_file, conda_meta_changed):
+        (self._project_file_edit_count, changed_sections) = project_file._changed_sections_since(
+            self._project_file_edit_count)
+        if self._parts is None or conda_meta_changed:
+            return set(_MODEL_PART_SECTIONS.keys())
+
+        stale = set()
+        for (part, sections) in _MODEL_PART_SECTIONS.items():
+            for section in sections:
+                if changed_sections is not None and section in changed_sections:
+                    stale.add(part)
+                elif project_file.get_value(section) != self._section_snapshots.get(section):
+                    # modified in place or by transform_yaml()
+                    stale.add(part)
+
+        # commands refer to env specs, and the notebook check uses
+        # commands, env specs, and downloaded filenames
+        if 'env_specs' in stale:
+            stale.add('commands')
+        if 'env_specs' in stale or 'commands' in stale or 'downloads' in stale:
+            stale.add('notebooks')
+        return stale
+
+    def _update_parts(self, stale, problems, requirements, project_file, conda_meta_file):
+        if len(stale) == len(_MODEL_PART_SECTIONS):
+            self._parts = dict()
+            self._section_snapshots = dict()
+
+        def update_part(name, compute):
+            if name in stale:
+                part_problems = []
+                part_requirements = []
+                compute(part_problems, part_requirements)
+                self._parts[name] = (part_problems, part_requirements)
+            (part_problems, part_requirements) = self._parts[name]
+            problems.extend(part_problems)
+            requirements.extend(part_requirements)
+
+        def update_commands(part_problems, part_requirements):
+            self._notebook_check_commands = self._update_commands(part_problems, project_file, conda_meta_file)
+
+        # these are cheap, and the icon depends on whether the icon file
+        # exists, so they're always computed
+        self._update_name(problems, project_file, conda_meta_file)
+        self._update_description(problems, project_file)
+        self._update_icon(problems, project_file, conda_meta_file)
+        # future: we could un-hardcode this so plugins can add stuff here
+        update_part('variables', lambda p, r: self._update_variables(r, p, project_file))
+        update_part('downloads', lambda p, r: self._update_downloads(r, p, project_file))
+        update_part('services', lambda p, r: self._update_services(r, p, project_file))
+        update_part('env_specs', lambda p, r: self._update_env_specs(p, project_file))
+        # this MUST be after we _update_variables since we may get CondaEnvRequirement
+        # options in the variables section, and after _update_env_specs
+        # since we use those
+        self._update_conda_env_requirements(requirements, problems, project_file)
+
+        # this MUST be after we update env reqs so we have the valid env spec names
+        update_part('commands', update_commands)
+        update_part('notebooks', lambda p, r: self._verify_notebook_commands(self._notebook_check_commands, p,
+                                                                             requirements, project_file))
+
+        for part in stale:
+            for section in _MODEL_PART_SECTIONS[part]:
+                self._section_snapshots[section] = deepcopy(project_file.get_value(section))
+
+    def _model_key(self, project_file, conda_meta_file):
+        texts = [project_file._unmodified_contents(), conda_meta_file._unmodified_contents()]
+        if None in texts:
+            # we're looking at changes that haven't been saved
+            return None
+        texts.append(repr(_sys_path_fingerprint()))
+        # the model includes problems from the importable spec, which
+        # can pull in other files with -r
+        filenames = _importable_spec_dependencies(self.directory_path)
+        return model_cache.model_key(self.directory_path, texts, filenames)
+
+    def _save_model(self, cache_directory, key, requirements):
+        # everything we compute from the files named in the key, but
+        # not what depends on other files in the project directory
+        model = dict(name=self.name,
+                     description=self.description,
+                     requirements=requirements,
+                     env_specs=self.env_specs,
+                     global_base_env_spec=self.global_base_env_spec,
+                     default_env_spec_name=self.default_env_spec_name,
+                     commands=self.commands,
+                     default_command_name=self.default_command_name)
+        model_cache.save_model(cache_directory, self.directory_path, key, model, self.registry)
+
+    def _load_model(self, cache_directory, key, problems, project_file, conda_meta_file):
+        model = model_cache.load_model(cache_directory, self.directory_path, key, self.registry)
+        if model is None:
+            return False
+        # the icon file can come and go without changing the key; if
+        # it's gone, compute everything so the problems are the same
+        # as they would have been
+        icon_problems = []
+        self._update_icon(icon_problems, project_file, conda_meta_file)
+        if len(icon_problems) > 0:
+            return False
+        for (name, value) in model.items():
+            setattr(self, name, value)
+        return True
+
     def _update_name(self, problems, project_file, conda_meta_file):
         name = project_file.get_value('name', None)
         if name is not None:
@@ -339,8 +505,9 @@ class _ConfigCache(object):
 
             return (deps, pip_deps)
 
-        (shared_deps, shared_pip_deps) = _parse_packages(project_file.root)
-        shared_channels = _parse_channels(project_file.root)
+        shared = dict(packages=project_file.get_value('packages', []), channels=project_file.get_value('channels', []))
+        (shared_deps, shared_pip_deps) = _parse_packages(shared)
+        shared_channels = _parse_channels(shared)
         env_specs = project_file.get_value('env_specs', default={})
         first_env_spec_name = None
         env_specs_is_empty_or_missing = False  # this should be iff it's an empty dict or absent entirely
@@ -520,7 +687,7 @@ class _ConfigCache(object):
         env_requirement = CondaEnvRequirement(registry=self.registry, env_specs=self.env_specs)
         requirements.append(env_requirement)
 
-    def _update_commands(self, problems, project_file, conda_meta_file, requirements):
+    def _update_commands(self, problems, project_file, conda_meta_file):
         failed = False
 
         first_command_name = None
@@ -604,8 +771,6 @@ class _ConfigCache(object):
                 if not failed:
                     commands[name] = ProjectCommand(name=name, attributes=copied_attrs)
 
-        self._verify_notebook_commands(commands, problems, requirements, project_file)
-
         if failed:
             self.commands = dict()
             self.default_command_name = None
@@ -619,6 +784,9 @@ class _ConfigCache(object):
             # note: this may be None
             self.default_command_name = first_command_name
 
+        # the notebook check wants these even if some command failed
+        return commands
+
     def _verify_notebook_commands(self, commands, problems, requirements, project_file):
         skipped_notebooks = project_file.get_value(['skip_imports', 'notebooks'])
         if skipped_notebooks is not None:
@@ -772,11 +940,39 @@ class Project(object):
         self._conda_meta_file = CondaMetaFile.load_for_directory(directory_path)
         self._directory_basename = os.path.basename(self._directory_path)
         self._config_cache = _ConfigCache(self._directory_path, plugin_registry)
+        # the cache is updated when properties are read, which
+        # shouldn't happen in two threads at once
+        self._lock = threading.RLock()
+        # ((project file change count, conda meta change count), ProjectSnapshot)
+        self._snapshot = None
 
     def _updated_cache(self):
-        self._config_cache.update(self._project_file, self._conda_meta_file)
+        with self._lock:
+            self._config_cache.update(self._project_file, self._conda_meta_file)
         return self._config_cache
 
+    def snapshot(self):
+        """Get an unchanging copy of the project as it is now.
+
+        The snapshot has the project's commands, env specs,
+        requirements and problems, and can be passed to the
+        prepare functions instead of the project. Unlike the
+        project, it can be used from several threads at once.
+
+        Snapshots are reused until the project is changed, so
+        this is cheap to call often. Don't call it while another
+        thread is modifying the project.
+
+        Returns:
+            a ``ProjectSnapshot``
+        """
+        with self._lock:
+            cache = self._updated_cache()
+            counts = (cache.project_file_count, cache.conda_meta_file_count)
+            if self._snapshot is None or self._snapshot[0] != counts:
+                self._snapshot = (counts, ProjectSnapshot(cache, self._project_file.filename))
+            return self._snapshot[1]
+
     @property
     def directory_path(self):
         """Get path to the project directory."""
@@ -840,14 +1036,7 @@ class Project(object):
         Returns:
            list of matching requirements (may be empty)
         """
-        found = []
-        for req in self.requirements:
-            if env_var is not None and not (isinstance(req, EnvVarRequirement) and req.env_var == env_var):
-                continue
-            if klass is not None and not isinstance(req, klass):
-                continue
-            found.append(req)
-        return found
+        return self._updated_cache().find_requirements(env_var, klass)
 
     @property
     def problems(self):
@@ -1108,3 +1297,185 @@ class Project(object):
         json['services'] = services
 
         return json
+
+
+class ProjectSnapshot(object):
+    """An unchanging copy of what a ``Project`` had loaded at one point.
+
+    Get one with ``Project.snapshot()``. It has the read-only parts
+    of the ``Project`` API needed to prepare and run the project,
+    and it never updates itself, so it's safe to share between
+    threads.
+    """
+
+    def __init__(self, cache, project_filename):
+        """Copy everything from the given up-to-date project config cache."""
+        self._directory_path = cache.directory_path
+        self._project_filename = project_filename
+        self._plugin_registry = cache.registry
+        self._name = cache.name
+        self._description = cache.description
+        self._icon = cache.icon
+        self._env_specs = dict(cache.env_specs)
+        self._global_base_env_spec = cache.global_base_env_spec
+        self._default_env_spec_name = cache.default_env_spec_name
+        self._commands = dict(cache.commands)
+        self._default_command_name = cache.default_command_name
+        self._requirements = tuple(cache.requirements)
+        self._requirements_by_env_var = dict(cache._requirements_by_env_var)
+        self._problem_objects = tuple(cache.problems)
+        self._problems = tuple(cache.problem_strings)
+        self._suggestions = tuple([problem.text for problem in cache.problems if problem.only_a_suggestion])
+
+    @property
+    def directory_path(self):
+        """Get path to the project directory."""
+        return self._directory_path
+
+    @property
+    def project_filename(self):
+        """Get the path to the project file the snapshot was loaded from."""
+        return self._project_filename
+
+    @property
+    def plugin_registry(self):
+        """Get the ``PluginRegistry`` for the project."""
+        return self._plugin_registry
+
+    @property
+    def name(self):
+        """Get the project's human-readable name."""
+        return self._name
+
+    @property
+    def url_friendly_name(self):
+        """Get the project's url-friendly name."""
+        return slugify(self._name)
+
+    @property
+    def description(self):
+        """Get the project description."""
+        return self._description
+
+    @property
+    def icon(self):
+        """Get the project's icon as an absolute path or None if no icon."""
+        return self._icon
+
+    @property
+    def requirements(self):
+        """Required items in order to run this project (tuple of ``Requirement`` instances)."""
+        return self._requirements
+
+    def find_requirements(self, env_var=None, klass=None):
+        """Find requirements that match the given env var and class.
+
+        If env_var and klass are both provided, BOTH must match.
+
+        Args:
+           env_var (str): if not None, filter requirements that have this env_var
+           klass (class): if not None, filter requirements that are an instance of this class
+
+        Returns:
+           list of matching requirements (may be empty)
+        """
+        if env_var is not None:
+            found = self._requirements_by_env_var.get(env_var, [])
+        else:
+            found = self._requirements
+        if klass is not None:
+            found = [req for req in found if isinstance(req, klass)]
+        return list(found)
+
+    @property
+    def problems(self):
+        """List of strings describing problems with the project configuration."""
+        return list(self._problems)
+
+    @property
+    def problem_objects(self):
+        """List of ProjectProblem instances describing problems with the project configuration."""
+        return [problem for problem in self._problem_objects if not problem.only_a_suggestion]
+
+    @property
+    def suggestions(self):
+        """List of strings describing suggested changes to the project configuration."""
+        return list(self._suggestions)
+
+    def problems_status(self, description=None):
+        """Get a ``Status`` describing project problems, or ``None`` if no problems."""
+        if len(self._problems) > 0:
+            if description is None:
+                description = "Unable to load the project."
+            return SimpleStatus(success=False, description=description, logs=[], errors=list(self._problems))
+        else:
+            return None
+
+    @property
+    def env_specs(self):
+        """Get a dictionary of environment names to ``EnvSpec`` instances.
+
+        The dictionary is a copy, since the snapshot can't change.
+        """
+        return dict(self._env_specs)
+
+    @property
+    def global_base_env_spec(self):
+        """Get the env spec representing global packages and channels sections."""
+        return self._global_base_env_spec
+
+    @property
+    def default_env_spec_name(self):
+        """Get the named environment to use by default."""
+        return self._default_env_spec_name
+
+    def default_env_spec_name_for_command(self, command):
+        """Get the named environment to use by default for a given ProjectCommand.
+
+        the command may be ``None``
+        """
+        if command is None:
+            return self._default_env_spec_name
+        else:
+            assert isinstance(command, ProjectCommand)
+            return command.default_env_spec_name
+
+    @property
+    def commands(self):
+        """Get the dictionary of command names to ``ProjectCommand``.
+
+        The dictionary is a copy, since the snapshot can't change.
+        """
+        return dict(self._commands)
+
+    @property
+    def default_command(self):
+        """Get the default ``ProjectCommand`` or None if we don't have one."""
+        return self.command_for_name(None)
+
+    def command_for_name(self, command_name):
+        """Get the ProjectCommand for the given command name, or None if no commands.
+
+        Args:
+           command_name (str): the command name, None for the default
+        Returns:
+           a ProjectCommand instance or None
+        """
+        if command_name is None:
+            command_name = self._default_command_name
+        return self._commands.get(command_name, None)
+
+    def default_exec_info_for_environment(self, environ, extra_args=None):
+        """Get the information needed to run the project's default command.
+
+        Args:
+            environ (dict): the environment
+            extra_args (list of str): extra args to append to the command line
+        Returns:
+            a CommandExecInfo instance
+        """
+        command = self.default_command
+        if command is None:
+            return None
+        else:
+            return command.exec_info_for_environment(environ=environ, extra_args=extra_args)
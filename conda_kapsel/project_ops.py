@@ -8,9 +8,11 @@
 from __future__ import absolute_import
 
 import codecs
+import contextlib
+import functools
 import os
-import shutil
 import tempfile
+import weakref
 
 from conda_kapsel.project import Project, ALL_COMMAND_TYPES
 from conda_kapsel import prepare
@@ -24,6 +26,7 @@ from conda_kapsel.plugins.requirements.download import _hash_algorithms
 from conda_kapsel.plugins.requirements.service import ServiceRequirement
 from conda_kapsel.plugins.providers.conda_env import _remove_env_path
 from conda_kapsel.internal.simple_status import SimpleStatus
+from conda_kapsel.internal import trash
 import conda_kapsel.conda_manager as conda_manager
 from conda_kapsel.internal.conda_api import parse_spec
 
@@ -45,6 +48,143 @@ __pycache__/
 """.lstrip()
 
 
+# the transaction each project is in, if any
+_transactions = weakref.WeakKeyDictionary()
+
+
+class _Transaction(object):
+    def __init__(self):
+        self.status = None
+        # status of the first operation that failed
+        self.failed = None
+        # list of (env_spec_name, list of env vars or classes) to prepare
+        self.to_prepare = []
+
+    def add_to_prepare(self, env_var_or_class, env_spec_name):
+        for (name, whitelist) in self.to_prepare:
+            if name == env_spec_name:
+                if env_var_or_class not in whitelist:
+                    whitelist.append(env_var_or_class)
+                return
+        self.to_prepare.append((env_spec_name, [env_var_or_class]))
+
+
+@contextlib.contextmanager
+def transaction(project):
+    """Make several changes to a project, then check and save them all at once.
+
+    The functions in this module that modify kapsel.yml only
+    modify it in memory when called inside the ``with`` block.
+    When the block ends, the project is checked for problems, it's
+    prepared once for all the requirements the changes need, and
+    kapsel.yml is saved once. If an operation fails, the
+    operations after it return its status without doing anything,
+    and none of the changes to kapsel.yml are saved. Operations
+    that delete files or environments, such as
+    ``remove_download()``, still delete them right away.
+
+    A transaction started inside another one for the same project
+    is part of the outer one.
+
+    Args:
+        project (Project): the project
+
+    Returns:
+        a context manager giving an object whose ``status``
+        attribute is a ``Status`` for the whole transaction once the
+        block ends (None until then)
+    """
+    pending = _transactions.get(project)
+    if pending is not None:
+        yield pending
+        return
+
+    pending = _Transaction()
+    _transactions[project] = pending
+    try:
+        yield pending
+    except Exception:
+        project.project_file.load()
+        raise
+    finally:
+        del _transactions[project]
+    pending.status = _commit_transaction(project, pending)
+
+
+def _commit_transaction(project, pending):
+    if pending.failed is not None:
+        project.project_file.load()
+        return pending.failed
+
+    project.project_file.use_changes_without_saving()
+    failed = project.problems_status(description="Unable to apply the changes.")
+    if failed is not None:
+        project.project_file.load()
+        return failed
+
+    for (env_spec_name, whitelist) in pending.to_prepare:
+        result = prepare.prepare_without_interaction(project,
+                                                     provide_whitelist=tuple([CondaEnvRequirement] + whitelist),
+                                                     env_spec_name=env_spec_name)
+        for env_var_or_class in whitelist:
+            # None if a later change removed the requirement again
+            status = result.status_for(env_var_or_class)
+            if status is not None and not status:
+                project.project_file.load()
+                return status
+
+    project.project_file.save()
+    return SimpleStatus(success=True, description="Project changes saved.")
+
+
+def _problems_status(project):
+    # after an operation in a transaction fails, the ones after it don't do anything
+    pending = _transactions.get(project)
+    if pending is not None and pending.failed is not None:
+        return pending.failed
+    return project.problems_status()
+
+
+def _save_project_file(project):
+    if project in _transactions:
+        # the transaction saves at the end; we only make the
+        # operations after this one see the change
+        project.project_file.use_changes_without_saving()
+    else:
+        project.project_file.save()
+
+
+def _revert_project_file(project, status):
+    pending = _transactions.get(project)
+    if pending is not None and pending.failed is None:
+        pending.failed = status
+    project.project_file.load()
+
+
+def _transactional(operation):
+    """Make an operation that modifies kapsel.yml fail the whole transaction it's part of.
+
+    Inside a transaction, the operation does nothing and returns the
+    earlier failure if another operation already failed; if the
+    operation itself returns a failed status, however it got there,
+    the transaction is marked failed and its changes are thrown away.
+    """
+
+    @functools.wraps(operation)
+    def wrapper(project, *args, **kwargs):
+        pending = _transactions.get(project)
+        if pending is None:
+            return operation(project, *args, **kwargs)
+        if pending.failed is not None:
+            return pending.failed
+        status = operation(project, *args, **kwargs)
+        if not status and pending.failed is None:
+            _revert_project_file(project, status)
+        return status
+
+    return wrapper
+
+
 def _add_projectignore_if_none(project_directory):
     filename = os.path.join(project_directory, ".kapselignore")
     if not os.path.exists(filename):
@@ -117,6 +257,7 @@ def create(directory_path, make_directory=False, name=None, icon=None, descripti
     return project
 
 
+@_transactional
 def set_properties(project, name=None, icon=None, description=None):
     """Set simple properties on a project.
 
@@ -135,7 +276,7 @@ def set_properties(project, name=None, icon=None, description=None):
     Returns:
         a ``Status`` instance indicating success or failure
     """
-    failed = project.problems_status()
+    failed = _problems_status(project)
     if failed is not None:
         return failed
 
@@ -152,20 +293,29 @@ def set_properties(project, name=None, icon=None, description=None):
 
     if len(project.problems) == 0:
         # write out the kapsel.yml if it looks like we're safe.
-        project.project_file.save()
+        _save_project_file(project)
         return SimpleStatus(success=True, description="Project properties updated.")
     else:
         # revert to previous state (after extracting project.problems)
         status = SimpleStatus(success=False,
                               description="Failed to set project properties.",
                               errors=list(project.problems))
-        project.project_file.load()
+        _revert_project_file(project, status)
         return status
 
 
 def _commit_requirement_if_it_works(project, env_var_or_class, env_spec_name=None):
     project.project_file.use_changes_without_saving()
 
+    pending = _transactions.get(project)
+    if pending is not None:
+        failed = project.problems_status()
+        if failed is not None:
+            _revert_project_file(project, failed)
+            return failed
+        pending.add_to_prepare(env_var_or_class, env_spec_name)
+        return SimpleStatus(success=True, description="Change will be checked when the transaction ends.")
+
     # See if we can perform the download
     result = prepare.prepare_without_interaction(project,
                                                  provide_whitelist=(CondaEnvRequirement,
@@ -190,6 +340,7 @@ def _commit_requirement_if_it_works(project, env_var_or_class, env_spec_name=Non
     return status
 
 
+@_transactional
 def add_download(project, env_var, url, filename=None, hash_algorithm=None, hash_value=None):
     """Attempt to download the URL; if successful, add it as a download to the project.
 
@@ -212,7 +363,7 @@ def add_download(project, env_var, url, filename=None, hash_algorithm=None, hash
         ``Status`` instance
     """
     assert ((hash_algorithm and hash_value) or (hash_algorithm is None and hash_value is None))
-    failed = project.problems_status()
+    failed = _problems_status(project)
     if failed is not None:
         return failed
     requirement = project.project_file.get_value(['downloads', env_var])
@@ -232,6 +383,7 @@ def add_download(project, env_var, url, filename=None, hash_algorithm=None, hash
     return _commit_requirement_if_it_works(project, env_var)
 
 
+@_transactional
 def remove_download(project, prepare_result, env_var):
     """Remove file or directory referenced by ``env_var`` from file system and the project.
 
@@ -247,7 +399,7 @@ def remove_download(project, prepare_result, env_var):
     Returns:
         ``Status`` instance
     """
-    failed = project.problems_status()
+    failed = _problems_status(project)
     if failed is not None:
         return failed
     # Modify the project file _in memory only_, do not save
@@ -262,7 +414,7 @@ def remove_download(project, prepare_result, env_var):
         project.project_file.unset_value(['downloads', env_var])
         project.project_file.use_changes_without_saving()
         assert project.problems == []
-        project.project_file.save()
+        _save_project_file(project)
 
     return status
 
@@ -287,7 +439,7 @@ def _map_inplace(f, items):
 
 
 def _update_env_spec(project, name, packages, channels, create):
-    failed = project.problems_status()
+    failed = _problems_status(project)
     if failed is not None:
         return failed
 
@@ -301,6 +453,15 @@ def _update_env_spec(project, name, packages, channels, create):
             problem = "Environment spec {} doesn't exist.".format(name)
             return SimpleStatus(success=False, description=problem)
 
+    # check the specs before we touch the project file, so a new
+    # env spec isn't left behind when we refuse to add it
+    bad_specs = [dep for dep in packages if parse_spec(dep) is None]
+    if len(bad_specs) > 0:
+        bad_specs_string = ", ".join(bad_specs)
+        return SimpleStatus(success=False,
+                            description="Could not add packages.",
+                            errors=[("Bad package specifications: %s." % bad_specs_string)])
+
     if name is None:
         env_dict = project.project_file.root
     else:
@@ -313,7 +474,6 @@ def _update_env_spec(project, name, packages, channels, create):
     # so don't convert this thing to a regular list.
     old_packages = env_dict.get('packages', [])
     old_packages_set = set(parse_spec(dep).name for dep in old_packages)
-    bad_specs = []
     updated_specs = []
     new_specs = []
     for dep in packages:
@@ -321,19 +481,10 @@ def _update_env_spec(project, name, packages, channels, create):
             # no-op adding the EXACT same thing (don't move it around)
             continue
         parsed = parse_spec(dep)
-        if parsed is None:
-            bad_specs.append(dep)
+        if parsed.name in old_packages_set:
+            updated_specs.append((parsed.name, dep))
         else:
-            if parsed.name in old_packages_set:
-                updated_specs.append((parsed.name, dep))
-            else:
-                new_specs.append(dep)
-
-    if len(bad_specs) > 0:
-        bad_specs_string = ", ".join(bad_specs)
-        return SimpleStatus(success=False,
-                            description="Could not add packages.",
-                            errors=[("Bad package specifications: %s." % bad_specs_string)])
+            new_specs.append(dep)
 
     # remove everything that we are changing the spec for
     def replace_spec(old):
@@ -364,6 +515,7 @@ def _update_env_spec(project, name, packages, channels, create):
     return status
 
 
+@_transactional
 def add_env_spec(project, name, packages, channels):
     """Attempt to create the environment spec and add it to kapsel.yml.
 
@@ -387,6 +539,7 @@ def add_env_spec(project, name, packages, channels):
     return _update_env_spec(project, name, packages, channels, create=True)
 
 
+@_transactional
 def remove_env_spec(project, name):
     """Remove the environment spec from project directory and remove from kapsel.yml.
 
@@ -403,7 +556,7 @@ def remove_env_spec(project, name):
     """
     assert name is not None
 
-    failed = project.problems_status()
+    failed = _problems_status(project)
     if failed is not None:
         return failed
 
@@ -428,11 +581,11 @@ def remove_env_spec(project, name):
         project.project_file.unset_value(['env_specs', name])
         project.project_file.use_changes_without_saving()
         if project.problems_status() is None:
-            project.project_file.save()
+            _save_project_file(project)
         else:
             # revert and return the problems
             status = project.problems_status()
-            project.project_file.load()
+            _revert_project_file(project, status)
 
     return status
 
@@ -454,7 +607,7 @@ def export_env_spec(project, name, filename):
     """
     assert name is not None
 
-    failed = project.problems_status()
+    failed = _problems_status(project)
     if failed is not None:
         return failed
 
@@ -472,6 +625,7 @@ def export_env_spec(project, name, filename):
     return SimpleStatus(success=True, description="Exported environment spec {} to {}.".format(name, filename))
 
 
+@_transactional
 def add_packages(project, env_spec_name, packages, channels):
     """Attempt to install packages then add them to kapsel.yml.
 
@@ -497,6 +651,7 @@ def add_packages(project, env_spec_name, packages, channels):
     return _update_env_spec(project, env_spec_name, packages, channels, create=False)
 
 
+@_transactional
 def remove_packages(project, env_spec_name, packages):
     """Attempt to remove packages from an environment in kapsel.yml.
 
@@ -538,7 +693,7 @@ def remove_packages(project, env_spec_name, packages):
     # be nicer to rewrite this whole thing when we add version pinning
     # anyway.
 
-    failed = project.problems_status()
+    failed = _problems_status(project)
     if failed is not None:
         return failed
 
@@ -613,7 +768,7 @@ def remove_packages(project, env_spec_name, packages):
 
 
 def _prepare_env_prefix(project, env_spec_name):
-    failed = project.problems_status()
+    failed = _problems_status(project)
     if failed is not None:
         return (None, failed)
 
@@ -629,6 +784,7 @@ def _prepare_env_prefix(project, env_spec_name):
         return (result.environ[status.requirement.env_var], status)
 
 
+@_transactional
 def add_variables(project, vars_to_add, defaults=None):
     """Add variables in kapsel.yml, optionally setting their defaults.
 
@@ -644,7 +800,7 @@ def add_variables(project, vars_to_add, defaults=None):
     Returns:
         ``Status`` instance
     """
-    failed = project.problems_status()
+    failed = _problems_status(project)
     if failed is not None:
         return failed
 
@@ -666,7 +822,7 @@ def add_variables(project, vars_to_add, defaults=None):
             # we are only adding the var if nonexistent and should leave
             # the default alone if it's already set
             project.project_file.set_value(['variables', varname], None)
-    project.project_file.save()
+    _save_project_file(project)
 
     return SimpleStatus(success=True, description="Variables added to the project file.")
 
@@ -685,6 +841,7 @@ def _unset_variable(project, env_prefix, varname, local_state):
             local_state.unset_value(['variables', varname])
 
 
+@_transactional
 def remove_variables(project, vars_to_remove, env_spec_name=None):
     """Remove variables from kapsel.yml and unset their values in local project state.
 
@@ -705,15 +862,17 @@ def remove_variables(project, vars_to_remove, env_spec_name=None):
         return status
 
     local_state = LocalStateFile.load_for_directory(project.directory_path)
-    for varname in vars_to_remove:
-        _unset_variable(project, env_prefix, varname, local_state)
-        project.project_file.unset_value(['variables', varname])
-        project.project_file.save()
-        local_state.save()
+    with project.project_file.coalesced_saves(), local_state.coalesced_saves():
+        for varname in vars_to_remove:
+            _unset_variable(project, env_prefix, varname, local_state)
+            project.project_file.unset_value(['variables', varname])
+            _save_project_file(project)
+            local_state.save()
 
     return SimpleStatus(success=True, description="Variables removed from the project file.")
 
 
+@_transactional
 def set_variables(project, vars_and_values, env_spec_name=None):
     """Set variables' values in kapsel-local.yml.
 
@@ -771,6 +930,7 @@ def set_variables(project, vars_and_values, env_spec_name=None):
         return SimpleStatus(success=True, description=description)
 
 
+@_transactional
 def unset_variables(project, vars_to_unset, env_spec_name=None):
     """Unset variables' values in kapsel-local.yml.
 
@@ -798,6 +958,7 @@ def unset_variables(project, vars_to_unset, env_spec_name=None):
     return SimpleStatus(success=True, description=("Variables were unset."))
 
 
+@_transactional
 def add_command(project, name, command_type, command, env_spec_name=None, supports_http_options=None):
     """Add a command to kapsel.yml.
 
@@ -821,7 +982,7 @@ def add_command(project, name, command_type, command, env_spec_name=None, suppor
 
     name = name.strip()
 
-    failed = project.problems_status()
+    failed = _problems_status(project)
     if failed is not None:
         return failed
 
@@ -851,13 +1012,14 @@ def add_command(project, name, command_type, command, env_spec_name=None, suppor
     failed = project.problems_status(description="Unable to add the command.")
     if failed is not None:
         # reset, maybe someone added conflicting command line types or something
-        project.project_file.load()
+        _revert_project_file(project, failed)
         return failed
     else:
-        project.project_file.save()
+        _save_project_file(project)
         return SimpleStatus(success=True, description="Command added to project file.")
 
 
+@_transactional
 def update_command(project, name, command_type=None, command=None, new_name=None):
     """Update attributes of a command in kapsel.yml.
 
@@ -887,7 +1049,7 @@ def update_command(project, name, command_type=None, command=None, new_name=None
     if command is None and command_type is not None:
         raise ValueError("If specifying the command_type, must also specify the command")
 
-    failed = project.problems_status()
+    failed = _problems_status(project)
     if failed is not None:
         return failed
 
@@ -922,13 +1084,14 @@ def update_command(project, name, command_type=None, command=None, new_name=None
     failed = project.problems_status(description="Unable to add the command.")
     if failed is not None:
         # reset, maybe someone added a nonexistent bokeh app or something
-        project.project_file.load()
+        _revert_project_file(project, failed)
         return failed
     else:
-        project.project_file.save()
+        _save_project_file(project)
         return SimpleStatus(success=True, description="Command updated in project file.")
 
 
+@_transactional
 def remove_command(project, name):
     """Remove a command from kapsel.yml.
 
@@ -943,7 +1106,7 @@ def remove_command(project, name):
     Returns:
        a ``Status`` instance
     """
-    failed = project.problems_status()
+    failed = _problems_status(project)
     if failed is not None:
         return failed
 
@@ -965,11 +1128,12 @@ def remove_command(project, name):
     project.project_file.use_changes_without_saving()
 
     assert project.problems == []
-    project.project_file.save()
+    _save_project_file(project)
 
     return SimpleStatus(success=True, description="Command: '{}' removed from project file.".format(name))
 
 
+@_transactional
 def add_service(project, service_type, variable_name=None):
     """Add a service to kapsel.yml.
 
@@ -987,7 +1151,7 @@ def add_service(project, service_type, variable_name=None):
     Returns:
         ``Status`` instance
     """
-    failed = project.problems_status()
+    failed = _problems_status(project)
     if failed is not None:
         return failed
 
@@ -1037,6 +1201,7 @@ def add_service(project, service_type, variable_name=None):
     return _commit_requirement_if_it_works(project, variable_name)
 
 
+@_transactional
 def remove_service(project, prepare_result, variable_name):
     """Remove a service to kapsel.yml.
 
@@ -1052,7 +1217,7 @@ def remove_service(project, prepare_result, variable_name):
     Returns:
         ``Status`` instance
     """
-    failed = project.problems_status()
+    failed = _problems_status(project)
     if failed is not None:
         return failed
 
@@ -1078,7 +1243,7 @@ def remove_service(project, prepare_result, variable_name):
     project.project_file.use_changes_without_saving()
     assert project.problems == []
 
-    project.project_file.save()
+    _save_project_file(project)
     return SimpleStatus(success=True, description="Removed service '{}' from the project file.".format(variable_name))
 
 
@@ -1115,7 +1280,7 @@ def clean(project, prepare_result):
         if os.path.isdir(dirname):
             logs.append("Removing %s." % dirname)
             try:
-                shutil.rmtree(dirname)
+                trash.remove_directory(dirname)
             except Exception as e:
                 errors.append("Error removing %s: %s." % (dirname, str(e)))
 
@@ -1182,7 +1347,7 @@ def upload(project, site=None, username=None, token=None, log_level=None):
     Returns:
         a ``Status``, if failed has ``errors``
     """
-    failed = project.problems_status()
+    failed = _problems_status(project)
     if failed is not None:
         return failed
 
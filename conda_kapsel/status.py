@@ -22,6 +22,9 @@ class Status(with_metaclass(ABCMeta)):
 
     """
 
+    # so subclasses can use __slots__
+    __slots__ = ()
+
     def __init__(self):
         """Construct an abstract Status."""
 
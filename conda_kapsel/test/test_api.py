@@ -576,3 +576,29 @@ def test_upload(monkeypatch):
     result = p.upload(**kwargs)
     assert 42 == result
     assert kwargs == params['kwargs']
+
+
+def test_snapshot_project():
+    class FakeProject(object):
+        def snapshot(self):
+            return 42
+
+    p = api.AnacondaProject()
+    assert 42 == p.snapshot_project(project=FakeProject())
+
+
+def test_transaction(monkeypatch):
+    params = dict(args=(), kwargs=dict())
+
+    def mock_transaction(*args, **kwargs):
+        params['args'] = args
+        params['kwargs'] = kwargs
+        return 42
+
+    monkeypatch.setattr('conda_kapsel.project_ops.transaction', mock_transaction)
+
+    p = api.AnacondaProject()
+    kwargs = dict(project=43)
+    result = p.transaction(**kwargs)
+    assert 42 == result
+    assert kwargs == params['kwargs']
@@ -11,8 +11,8 @@ import os
 from conda_kapsel.internal.test.tmpfile_utils import (with_file_contents, with_named_file_contents,
                                                       with_directory_contents)
 
-from conda_kapsel.env_spec import (EnvSpec, _load_environment_yml, _load_requirements_txt,
-                                   _find_out_of_sync_importable_spec)
+from conda_kapsel.env_spec import (EnvSpec, _load_environment_yml, _load_requirements_txt, _find_importable_spec,
+                                   _find_out_of_sync_importable_spec, _importable_spec_dependencies)
 
 
 def test_load_environment_yml():
@@ -176,6 +176,57 @@ d
         }, check)
 
 
+def test_find_importable_spec_is_cached_until_files_change(monkeypatch):
+    def check(dirname):
+        import conda_kapsel.env_spec as env_spec_module
+        loads = []
+        real_load = env_spec_module._load_importable
+
+        def counting_load(filename, included=None):
+            loads.append(os.path.basename(filename))
+            return real_load(filename, included)
+
+        monkeypatch.setattr(env_spec_module, '_load_importable', counting_load)
+
+        (spec, name) = _find_importable_spec(dirname)
+        assert ('a', 'b') == spec.pip_packages
+        assert 'requirements.txt' == name
+        assert ['environment.yml', 'environment.yaml', 'requirements.txt'] == loads
+
+        (again, name) = _find_importable_spec(dirname)
+        assert again is spec
+        assert 3 == len(loads)
+
+        # changing an included file is noticed
+        with open(os.path.join(dirname, "more-requirements.txt"), 'w') as f:
+            f.write("b\nc\n")
+        (spec, name) = _find_importable_spec(dirname)
+        assert ('a', 'b', 'c') == spec.pip_packages
+        assert ['requirements.txt'] == loads[3:]
+
+        # and so is creating a file that's looked for first
+        with open(os.path.join(dirname, "environment.yml"), 'w') as f:
+            f.write("name: foo\ndependencies: [d]\n")
+        (spec, name) = _find_importable_spec(dirname)
+        assert ('d', ) == spec.conda_packages
+        assert 'environment.yml' == name
+        assert ['environment.yml'] == loads[4:]
+
+    with_directory_contents({"requirements.txt": "a\n-r more-requirements.txt\n", "more-requirements.txt": "b\n"},
+                            check)
+
+
+def test_importable_spec_dependencies_include_included_files():
+    def check(dirname):
+        assert [os.path.join(dirname, name) for name in ('environment.yml', 'environment.yaml',
+                                                         'requirements.txt', 'more-requirements.txt',
+                                                         'even-more.txt')] == _importable_spec_dependencies(dirname)
+
+    with_directory_contents({"requirements.txt": "a\n-r more-requirements.txt\n",
+                             "more-requirements.txt": "b\n-r even-more.txt\n",
+                             "even-more.txt": "c\n"}, check)
+
+
 def test_find_in_sync_environment_yml():
     def check(filename):
         spec = _load_environment_yml(filename)
@@ -273,6 +324,64 @@ def test_to_json_multiple_inheritance():
             'packages': ['a', 'b', {'pip': ['c', 'd']}]} == json
 
 
+def test_diamond_inheritance():
+    base = EnvSpec(name="base", conda_packages=['a=1', 'b=1', 'a=2'], pip_packages=['pip1==1'], channels=['c1', 'c2'])
+    left = EnvSpec(name="left",
+                   conda_packages=['b=2', 'c'],
+                   channels=['c2'],
+                   inherit_from_names=('base', ),
+                   inherit_from=(base, ))
+    right = EnvSpec(name="right",
+                    conda_packages=['a=3'],
+                    pip_packages=['pip1==2', 'pip2'],
+                    channels=['c3'],
+                    inherit_from_names=('base', ),
+                    inherit_from=(base, ))
+    spec = EnvSpec(name="spec",
+                   conda_packages=['c=2'],
+                   channels=[],
+                   inherit_from_names=('left', 'right'),
+                   inherit_from=(left, right))
+
+    # base only once, and later specs replace earlier packages with the same name
+    assert (base, left, right, spec) == spec._ancestors
+    assert ('b=2', 'a=3', 'c=2') == spec.conda_packages
+    assert ('c1', 'c2', 'c3') == spec.channels
+    assert ('pip1==2', 'pip2') == spec.pip_packages
+    assert set(['a', 'b', 'c']) == spec.conda_package_names_set
+    assert ['a=3', 'c=2'] == spec.specs_for_conda_package_names(['a', 'c'])
+    assert ['pip1==2'] == spec.specs_for_pip_package_names(['pip1'])
+
+    # duplicates within one spec are kept unless replaced later
+    assert ('a=1', 'b=1', 'a=2') == base.conda_packages
+    assert ('a=1', 'a=2', 'b=2', 'c') == left.conda_packages
+
+
+def test_inherited_packages_computed_once(monkeypatch):
+    import conda_kapsel.internal.conda_api as conda_api
+    parsed = []
+    real_parse_spec = conda_api.parse_spec
+
+    def counting_parse_spec(spec):
+        parsed.append(spec)
+        return real_parse_spec(spec)
+
+    monkeypatch.setattr(conda_api, 'parse_spec', counting_parse_spec)
+
+    parent = EnvSpec(name="parent", conda_packages=['a', 'b'], channels=[])
+    spec = EnvSpec(name="child",
+                   conda_packages=['b=1'],
+                   channels=[],
+                   inherit_from_names=('parent', ),
+                   inherit_from=(parent, ))
+    assert ['a', 'b', 'b=1'] == parsed
+
+    assert spec.conda_packages is spec.conda_packages
+    spec.diff_from(parent)
+    spec.channels_and_packages_hash
+    assert ['a', 'b', 'b=1'] == parsed
+
+
 def test_diff_from():
     spec1 = EnvSpec(name="foo", conda_packages=['a', 'b'], pip_packages=['c', 'd'], channels=['x', 'y'])
     spec2 = EnvSpec(name="bar", conda_packages=['a', 'b', 'q'], pip_packages=['c'], channels=['x', 'y', 'z'])
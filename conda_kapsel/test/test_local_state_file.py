@@ -110,3 +110,74 @@ def test_run_state_must_be_dict():
         assert "service state should be a dict" in repr(excinfo.value)
 
     with_directory_contents(dict(), check_cannot_use_non_dict)
+
+
+def test_save_keeps_independent_changes_saved_by_others():
+    def check(dirname):
+        first = LocalStateFile.load_for_directory(dirname)
+        second = LocalStateFile.load_for_directory(dirname)
+
+        first.set_value(['variables', 'FOO'], 'foo')
+        first.set_service_run_state('A', {'port': 1})
+        first.save()
+
+        second.set_value(['variables', 'BAR'], 'bar')
+        second.set_service_run_state('B', {'port': 2})
+        second.save()
+
+        assert 'foo' == second.get_value(['variables', 'FOO'])
+
+        reloaded = LocalStateFile.load_for_directory(dirname)
+        assert dict(FOO='foo', BAR='bar') == reloaded.get_value('variables')
+        assert dict(A={'port': 1}, B={'port': 2}) == reloaded.get_all_service_run_states()
+
+    with_directory_contents(dict(), check)
+
+
+def test_save_merges_removals_and_conflicts():
+    def check(dirname):
+        first = LocalStateFile.load_for_directory(dirname)
+        second = LocalStateFile.load_for_directory(dirname)
+
+        first.unset_value(['variables', 'A'])
+        first.set_value(['variables', 'C'], 'first')
+        first.save()
+
+        second.set_value(['variables', 'B'], 'changed')
+        second.set_value(['variables', 'C'], 'second')
+        second.save()
+
+        reloaded = LocalStateFile.load_for_directory(dirname)
+        # the last save wins when both changed the same value
+        assert dict(B='changed', C='second') == reloaded.get_value('variables')
+
+    with_directory_contents({DEFAULT_LOCAL_STATE_FILENAME: "variables:\n  A: a\n  B: b\n  C: c\n"}, check)
+
+
+def test_save_holds_lock(monkeypatch):
+    def check(dirname):
+        local_state_file = LocalStateFile.load_for_directory(dirname)
+        filename = os.path.join(dirname, DEFAULT_LOCAL_STATE_FILENAME)
+        events = []
+
+        from conda_kapsel.internal.file_lock import FileLock
+
+        class RecordingLock(FileLock):
+            def __enter__(self):
+                events.append(('lock', os.path.exists(filename)))
+                return super(RecordingLock, self).__enter__()
+
+            def __exit__(self, type, value, traceback):
+                events.append(('unlock', os.path.exists(filename)))
+                return super(RecordingLock, self).__exit__(type, value, traceback)
+
+        monkeypatch.setattr('conda_kapsel.local_state_file.FileLock', RecordingLock)
+        local_state_file.set_value('a', 1)
+        local_state_file.save()
+        assert [('lock', False), ('unlock', True)] == events
+
+        # nothing to save, so no lock
+        local_state_file.save()
+        assert 2 == len(events)
+
+    with_directory_contents(dict(), check)
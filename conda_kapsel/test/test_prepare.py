@@ -11,19 +11,25 @@ import os
 import platform
 import pytest
 import subprocess
+import threading
+import time
 
 from conda_kapsel.test.environ_utils import minimal_environ, strip_environ
 from conda_kapsel.test.project_utils import project_no_dedicated_env
 from conda_kapsel.internal.test.tmpfile_utils import (with_directory_contents,
                                                       with_directory_contents_completing_project_file)
 from conda_kapsel.internal import conda_api
+from conda_kapsel.internal.simple_status import SimpleStatus
 from conda_kapsel.prepare import (prepare_without_interaction, prepare_with_browser_ui, unprepare, prepare_in_stages,
-                                  PrepareSuccess, PrepareFailure, _after_stage_success, _FunctionPrepareStage)
+                                  PrepareSuccess, PrepareFailure, _after_stage_success, _FunctionPrepareStage,
+                                  _provide_all, _compile_provide_whitelist, _in_provide_whitelist)
 from conda_kapsel.project import Project
 from conda_kapsel.project_file import DEFAULT_PROJECT_FILENAME
 from conda_kapsel.project_commands import ProjectCommand
 from conda_kapsel.local_state_file import LocalStateFile
+from conda_kapsel.plugins.registry import PluginRegistry
 from conda_kapsel.plugins.requirement import (EnvVarRequirement, UserConfigOverrides)
+from conda_kapsel.plugins.requirements.conda_env import CondaEnvRequirement
 from conda_kapsel.conda_manager import (push_conda_manager_class, pop_conda_manager_class, CondaManager,
                                         CondaEnvironmentDeviations)
 import conda_kapsel.internal.keyring as keyring
@@ -93,6 +99,76 @@ def test_unprepare_nothing_to_do():
     with_directory_contents(dict(), unprepare_nothing)
 
 
+class _UnprovideRecorder(object):
+    def __init__(self, record, name, delay=0.0, error=None):
+        self.record = record
+        self.name = name
+        self.delay = delay
+        self.error = error
+
+    def unprovide(self, requirement, environ, local_state_file, overrides, requirement_status=None):
+        time.sleep(self.delay)
+        self.record.append(self.name)
+        if self.error is not None:
+            raise self.error
+        return SimpleStatus(success=True, description=("Cleaned up %s." % self.name))
+
+
+class _FakeUnprovideStatus(object):
+    def __init__(self, requirement, provider):
+        self.requirement = requirement
+        self.provider = provider
+
+
+class _FakePrepareResult(object):
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.environ = minimal_environ()
+        self.overrides = UserConfigOverrides()
+
+
+def test_unprepare_removes_env_after_services_shut_down():
+    def unprepare_env_last(dirname):
+        project = project_no_dedicated_env(dirname)
+        registry = PluginRegistry()
+        record = []
+        # the services may need the env to run their shutdown commands
+        result = _FakePrepareResult([
+            _FakeUnprovideStatus(CondaEnvRequirement(registry), _UnprovideRecorder(record, 'env')),
+            _FakeUnprovideStatus(EnvVarRequirement(registry, env_var='SLOW'),
+                                 _UnprovideRecorder(record, 'slow', delay=0.2)),
+            _FakeUnprovideStatus(EnvVarRequirement(registry, env_var='FAST'), _UnprovideRecorder(record, 'fast'))
+        ])
+        status = unprepare(project, result)
+        assert status
+        assert ['fast', 'slow', 'env'] == record
+
+    with_directory_contents(dict(), unprepare_env_last)
+
+
+def test_unprepare_reports_every_exception(capsys):
+    def unprepare_exceptions(dirname):
+        project = project_no_dedicated_env(dirname)
+        registry = PluginRegistry()
+        record = []
+        result = _FakePrepareResult([
+            _FakeUnprovideStatus(EnvVarRequirement(registry, env_var='FIRST'),
+                                 _UnprovideRecorder(record, 'first', error=RuntimeError("first broke"))),
+            _FakeUnprovideStatus(EnvVarRequirement(registry, env_var='SECOND'),
+                                 _UnprovideRecorder(record, 'second', delay=0.2, error=RuntimeError("second broke"))),
+            _FakeUnprovideStatus(CondaEnvRequirement(registry), _UnprovideRecorder(record, 'env'))
+        ])
+        with pytest.raises(RuntimeError) as excinfo:
+            unprepare(project, result)
+        assert "first broke" in str(excinfo.value)
+        # everything still got its chance to clean up
+        assert ['first', 'second', 'env'] == record
+        (out, err) = capsys.readouterr()
+        assert "Failed to clean up SECOND: second broke\n" == err
+
+    with_directory_contents(dict(), unprepare_exceptions)
+
+
 def test_default_to_system_environ():
     def prepare_system_environ(dirname):
         project = project_no_dedicated_env(dirname)
@@ -276,6 +352,53 @@ def test_prepare_bad_command_name():
 """}, check)
 
 
+def test_prepare_snapshot_from_several_threads():
+    def check(dirname):
+        project = project_no_dedicated_env(dirname)
+        snapshot = project.snapshot()
+        results = []
+
+        def prepare_snapshot(command_name):
+            environ = minimal_environ(FOO='bar')
+            results.append((command_name, prepare_without_interaction(snapshot, environ=environ,
+                                                                      command_name=command_name)))
+
+        threads = [threading.Thread(target=prepare_snapshot, args=(name, )) for name in ('foo', 'bar', 'foo', 'bar')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert 4 == len(results)
+        for (command_name, result) in results:
+            assert result
+            assert 'bar' == result.environ['FOO']
+            assert ['echo %s' % command_name] == result.command_exec_info.args
+
+        result = prepare_without_interaction(snapshot, environ=minimal_environ(FOO='bar'), command_name='blah')
+        assert not result
+        assert ("Command name 'blah' is not in %s, these names were found: bar, foo" %
+                project.project_file.filename) == result.errors[0]
+
+        result = prepare_without_interaction(snapshot, environ=minimal_environ(), env_spec_name='nope')
+        assert not result
+        assert ("Environment name 'nope' is not in %s, these names were found: default" %
+                project.project_file.filename) == result.errors[0]
+
+    with_directory_contents_completing_project_file(
+        {DEFAULT_PROJECT_FILENAME: """
+variables:
+  FOO: {}
+commands:
+  foo:
+    unix: echo foo
+    windows: echo foo
+  bar:
+    unix: echo bar
+    windows: echo bar
+"""}, check)
+
+
 def _push_fake_env_creator():
     class HappyCondaManager(CondaManager):
         def find_environment_deviations(self, prefix, spec):
@@ -707,3 +830,101 @@ def test_prepare_success_properties():
     assert result.status_for('FOO') is None
     assert result.status_for(EnvVarRequirement) is None
     assert result.overrides is not None
+
+
+class _SpecialRequirement(EnvVarRequirement):
+    pass
+
+
+class _OtherRequirement(EnvVarRequirement):
+    pass
+
+
+def test_prepare_result_status_for():
+    def check(dirname):
+        local_state = LocalStateFile.load_for_directory(dirname)
+        statuses = []
+        for (klass, env_var) in ((EnvVarRequirement, 'FOO'), (EnvVarRequirement, 'BAR'), (EnvVarRequirement, 'FOO'),
+                                 (_SpecialRequirement, 'SPECIAL'), (_SpecialRequirement, 'SPECIAL2')):
+            requirement = klass(registry=PluginRegistry(), env_var=env_var)
+            statuses.append(requirement.check_status(dict(), local_state, 'default', UserConfigOverrides()))
+        result = PrepareFailure(logs=[], statuses=statuses, errors=[], environ=dict(), overrides=UserConfigOverrides())
+
+        # the first matching status wins
+        assert result.status_for('FOO') is statuses[0]
+        assert result.status_for('BAR') is statuses[1]
+        assert result.status_for('SPECIAL2') is statuses[4]
+        assert result.status_for('NOPE') is None
+        assert result.status_for(EnvVarRequirement) is statuses[0]
+        assert result.status_for(_SpecialRequirement) is statuses[3]
+        assert result.status_for(_SpecialRequirement) is statuses[3]
+        assert result.status_for(_OtherRequirement) is None
+
+    with_directory_contents(dict(), check)
+
+
+def test_in_provide_whitelist():
+    foo = EnvVarRequirement(registry=PluginRegistry(), env_var='FOO')
+    special = _SpecialRequirement(registry=PluginRegistry(), env_var='SPECIAL')
+
+    assert _in_provide_whitelist(_compile_provide_whitelist(None), foo)
+    assert not _in_provide_whitelist(_compile_provide_whitelist([]), foo)
+    whitelist = _compile_provide_whitelist(['FOO', _SpecialRequirement])
+    assert _in_provide_whitelist(whitelist, foo)
+    assert _in_provide_whitelist(whitelist, special)
+    assert not _in_provide_whitelist(whitelist, EnvVarRequirement(registry=PluginRegistry(), env_var='BAR'))
+    assert _in_provide_whitelist(_compile_provide_whitelist(['SPECIAL']), special)
+    assert not _in_provide_whitelist(_compile_provide_whitelist([_OtherRequirement]), special)
+
+
+class _FakeProvider(object):
+    def __init__(self, needs_env, provide):
+        self.needs_env = needs_env
+        self.provide = provide
+
+    def env_prefix_needed(self, requirement, environ, local_state_file):
+        return self.needs_env
+
+
+class _FakeStatus(object):
+    def __init__(self, provider):
+        self.provider = provider
+        self.requirement = None
+
+
+def test_provide_all_starts_providers_not_needing_env_right_away():
+    env_created = threading.Event()
+
+    def provide_env(environ):
+        environ['CONDA_PREFIX'] = '/env'
+        env_created.set()
+        return 'env'
+
+    def provide_service(environ):
+        # we're in the background, so the env isn't there yet
+        assert 'CONDA_PREFIX' not in environ
+        assert env_created.wait(10)
+        environ['SERVICE_URL'] = 'redis://localhost'
+        del environ['REMOVED']
+        return 'service'
+
+    service = _FakeStatus(_FakeProvider(False, provide_service))
+    env = _FakeStatus(_FakeProvider(True, provide_env))
+    environ = dict(REMOVED='x', KEPT='y')
+
+    results = _provide_all([service, env], environ, None, lambda status, environ: status.provider.provide(environ))
+
+    assert dict(CONDA_PREFIX='/env', SERVICE_URL='redis://localhost', KEPT='y') == environ
+    assert dict([(service, 'service'), (env, 'env')]) == results
+
+
+def test_provide_all_raises_background_exception():
+    def provide_service(environ):
+        raise RuntimeError("oops")
+
+    service = _FakeStatus(_FakeProvider(False, provide_service))
+    env = _FakeStatus(_FakeProvider(True, lambda environ: 'env'))
+
+    with pytest.raises(RuntimeError) as excinfo:
+        _provide_all([service, env], dict(), None, lambda status, environ: status.provider.provide(environ))
+    assert 'oops' in str(excinfo.value)
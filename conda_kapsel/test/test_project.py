@@ -2300,6 +2300,106 @@ def test_find_requirements():
          "foo.ipynb": ""}, check_find_requirements)
 
 
+def test_snapshot():
+    def check(dirname):
+        project = project_no_dedicated_env(dirname)
+        assert [] == project.problems
+        snapshot = project.snapshot()
+
+        assert snapshot is project.snapshot()
+        assert project.directory_path == snapshot.directory_path
+        assert project.project_file.filename == snapshot.project_filename
+        assert project.plugin_registry is snapshot.plugin_registry
+        assert project.name == snapshot.name
+        assert project.url_friendly_name == snapshot.url_friendly_name
+        assert project.description == snapshot.description
+        assert project.icon == snapshot.icon
+        assert project.env_specs == snapshot.env_specs
+        assert project.global_base_env_spec is snapshot.global_base_env_spec
+        assert project.default_env_spec_name == snapshot.default_env_spec_name
+        assert project.commands == snapshot.commands
+        assert project.default_command is snapshot.default_command
+        assert project.command_for_name('foo') is snapshot.command_for_name('foo')
+        assert snapshot.command_for_name('nope') is None
+        command = snapshot.command_for_name('foo')
+        assert command.default_env_spec_name == snapshot.default_env_spec_name_for_command(command)
+        assert snapshot.default_env_spec_name == snapshot.default_env_spec_name_for_command(None)
+        assert tuple(project.requirements) == snapshot.requirements
+        assert project.find_requirements(env_var='FOO') == snapshot.find_requirements(env_var='FOO')
+        assert project.find_requirements(klass=ServiceRequirement) == snapshot.find_requirements(
+            klass=ServiceRequirement)
+        assert [] == snapshot.find_requirements(env_var='FOO', klass=ServiceRequirement)
+        assert project.suggestions == snapshot.suggestions
+        assert [] == snapshot.problems
+        assert [] == snapshot.problem_objects
+        assert snapshot.problems_status() is None
+        environ = minimal_environ(PROJECT_DIR=dirname)
+        assert project.default_exec_info_for_environment(environ).args == \
+            snapshot.default_exec_info_for_environment(environ).args
+
+        # changing what we got back doesn't change the snapshot
+        snapshot.commands.clear()
+        snapshot.env_specs.clear()
+        snapshot.find_requirements(env_var='FOO').append(None)
+        assert project.commands == snapshot.commands
+        assert project.env_specs == snapshot.env_specs
+        assert 1 == len(snapshot.find_requirements(env_var='FOO'))
+
+        # nor does changing the project
+        project.project_file.unset_value(['variables', 'FOO'])
+        project.project_file.set_value('commands', dict(foo=dict(unix='echo', windows='echo'), bar="nope"))
+        project.project_file.use_changes_without_saving()
+        assert [] == project.find_requirements(env_var='FOO')
+        assert 1 == len(snapshot.find_requirements(env_var='FOO'))
+        assert 'redis-server --version' == snapshot.command_for_name('foo').unix_shell_commandline
+        assert [] == snapshot.problems
+
+        changed = project.snapshot()
+        assert changed is not snapshot
+        assert [] == changed.find_requirements(env_var='FOO')
+        assert len(changed.problems) > 0
+        assert changed.problems == project.problems
+        assert "Unable to load the project." == changed.problems_status().status_description
+        assert changed.problems == changed.problems_status().errors
+
+    with_directory_contents_completing_project_file(
+        {DEFAULT_PROJECT_FILENAME: """
+variables:
+  FOO: {}
+services:
+  REDIS_URL: redis
+commands:
+  foo:
+    unix: redis-server --version
+    windows: redis-server --version
+"""}, check)
+
+
+def test_find_requirements_sees_changes_and_returns_new_lists():
+    def check(dirname):
+        project = project_no_dedicated_env(dirname)
+        assert [] == project.problems
+
+        variables = project.find_requirements(klass=EnvVarRequirement)
+        assert ['FOO'] == [req.env_var for req in variables if req.env_var == 'FOO']
+        # modifying the returned list doesn't affect later calls
+        variables.append(None)
+        assert None not in project.find_requirements(klass=EnvVarRequirement)
+        project.find_requirements(env_var='FOO').append(None)
+        assert 1 == len(project.find_requirements(env_var='FOO'))
+
+        project.project_file.set_value(['variables', 'BAR'], None)
+        project.project_file.unset_value(['variables', 'FOO'])
+        project.project_file.use_changes_without_saving()
+        assert [] == project.find_requirements(env_var='FOO')
+        assert 'BAR' == project.find_requirements(env_var='BAR')[0].env_var
+        bars = [req for req in project.requirements if getattr(req, 'env_var', None) == 'BAR']
+        assert bars == project.find_requirements(env_var='BAR')
+        assert len(project.find_requirements(klass=EnvVarRequirement)) == len(variables) - 1
+
+    with_directory_contents_completing_project_file({DEFAULT_PROJECT_FILENAME: "variables:\n  FOO: {}\n"}, check)
+
+
 def test_requirements_subsets():
     def check_requirements_subsets(dirname):
         project = project_no_dedicated_env(dirname)
@@ -2722,3 +2822,262 @@ def test_auto_fix_bokeh_dep():
                                     '  bokeh_test:\n'
                                     '    bokeh_app: main.py\n'),
          'main.py': 'hello'}, check)
+
+
+_cached_model_project = """
+name: cached
+packages: [python]
+env_specs:
+  default:
+    packages: [numpy]
+  other:
+    inherit_from: default
+commands:
+  hello:
+    unix: echo hello
+    env_spec: other
+variables:
+  FOO: {default: 1}
+downloads:
+  DATA: http://example.com/data.csv
+services:
+  REDIS_URL: redis
+"""
+
+
+def _forbid_computing_model(monkeypatch):
+    def forbidden(*args, **kwargs):
+        raise AssertionError("should have used the cached model")
+
+    monkeypatch.setattr('conda_kapsel.project._ConfigCache._update_env_specs', forbidden)
+
+
+def test_project_model_loaded_from_cache(monkeypatch):
+    def check(dirname):
+        monkeypatch.setenv('KAPSEL_MODEL_CACHE', os.path.join(dirname, '.cache'))
+        project = project_no_dedicated_env(dirname)
+        assert [] == project.problems
+
+        _forbid_computing_model(monkeypatch)
+        cached = project_no_dedicated_env(dirname)
+        assert [] == cached.problems
+        assert 'cached' == cached.name
+        assert ['default', 'other'] == sorted(cached.env_specs.keys())
+        assert ('numpy', 'python') == tuple(sorted(cached.env_specs['other'].conda_packages))
+        assert 'echo hello' == cached.command_for_name('hello').unix_shell_commandline
+        assert 'other' == cached.command_for_name('hello').default_env_spec_name
+        assert [req.env_var for req in project.requirements] == [req.env_var for req in cached.requirements]
+        assert '1' == cached.find_requirements(env_var='FOO')[0].options['default']
+        for req in cached.requirements:
+            assert req.registry is cached.plugin_registry
+
+    with_directory_contents_completing_project_file({DEFAULT_PROJECT_FILENAME: _cached_model_project}, check)
+
+
+def test_project_model_computed_again_when_file_changes(monkeypatch):
+    def check(dirname):
+        monkeypatch.setenv('KAPSEL_MODEL_CACHE', os.path.join(dirname, '.cache'))
+        project = project_no_dedicated_env(dirname)
+        assert [] == project.problems
+
+        project.project_file.set_value('name', 'renamed')
+        # unsaved changes are never cached
+        project.project_file.use_changes_without_saving()
+        assert 'renamed' == project.name
+        project.project_file.save()
+
+        reloaded = project_no_dedicated_env(dirname)
+        assert 'renamed' == reloaded.name
+
+        with open(os.path.join(dirname, 'environment.yml'), 'w') as f:
+            f.write("name: imported\ndependencies:\n  - bar\n")
+        reloaded = project_no_dedicated_env(dirname)
+        assert "Environment spec 'imported' from environment.yml is not in" in reloaded.problems[0]
+
+    with_directory_contents_completing_project_file({DEFAULT_PROJECT_FILENAME: _cached_model_project}, check)
+
+
+def test_project_model_computed_again_when_included_requirements_change(monkeypatch):
+    def check(dirname):
+        monkeypatch.setenv('KAPSEL_MODEL_CACHE', os.path.join(dirname, '.cache'))
+        project = project_no_dedicated_env(dirname)
+        assert 1 == len(project.problem_objects)
+        project.problem_objects[0].fix(project)
+        project.project_file.save()
+        assert ('numpy', 'flask') == project.env_specs['default'].pip_packages
+
+        assert [] == project_no_dedicated_env(dirname).problems
+        assert os.path.exists(os.path.join(dirname, '.cache'))
+
+        with open(os.path.join(dirname, 'base.txt'), 'w') as f:
+            f.write("numpy\npandas\n")
+        reloaded = project_no_dedicated_env(dirname)
+        assert 1 == len(reloaded.problems)
+        assert ("Environment spec 'default' from requirements.txt is out of sync with kapsel.yml."
+                in reloaded.problems[0])
+
+    with_directory_contents(
+        {DEFAULT_PROJECT_FILENAME: "name: foo\nenv_specs: {}\n",
+         "requirements.txt": "-r base.txt\nflask\n",
+         "base.txt": "numpy\n"}, check)
+
+
+def test_project_model_cached_in_default_directory(monkeypatch):
+    def check(dirname):
+        monkeypatch.delenv('KAPSEL_MODEL_CACHE', raising=False)
+        monkeypatch.setenv('XDG_CACHE_HOME', os.path.join(dirname, '.xdg'))
+        project = project_no_dedicated_env(dirname)
+        assert [] == project.problems
+        models = os.path.join(dirname, '.xdg', 'conda-kapsel', 'models')
+        assert 1 == len(os.listdir(models))
+
+        _forbid_computing_model(monkeypatch)
+        cached = project_no_dedicated_env(dirname)
+        assert [] == cached.problems
+        assert 'cached' == cached.name
+
+    with_directory_contents_completing_project_file({DEFAULT_PROJECT_FILENAME: _cached_model_project}, check)
+
+
+def test_project_model_with_problems_not_cached(monkeypatch):
+    def check(dirname):
+        monkeypatch.setenv('KAPSEL_MODEL_CACHE', os.path.join(dirname, '.cache'))
+        project = project_no_dedicated_env(dirname)
+        assert 1 == len(project.problems)
+        assert not os.path.exists(os.path.join(dirname, '.cache'))
+
+    with_directory_contents_completing_project_file({DEFAULT_PROJECT_FILENAME: "name: 42\n"}, check)
+
+
+def test_project_model_from_cache_still_checks_directory(monkeypatch):
+    def check(dirname):
+        monkeypatch.setenv('KAPSEL_MODEL_CACHE', os.path.join(dirname, '.cache'))
+        project = project_no_dedicated_env(dirname)
+        assert [] == project.problems
+        assert [] == project.suggestions
+
+        _forbid_computing_model(monkeypatch)
+        with open(os.path.join(dirname, 'foo.ipynb'), 'w') as f:
+            f.write("{}")
+        cached = project_no_dedicated_env(dirname)
+        assert [] == cached.problems
+        assert ["%s: No command runs notebook foo.ipynb" % cached.project_file.filename] == cached.suggestions
+
+    with_directory_contents_completing_project_file({DEFAULT_PROJECT_FILENAME: _cached_model_project}, check)
+
+
+def test_project_model_not_cached_with_custom_registry(monkeypatch):
+    class CustomRegistry(PluginRegistry):
+        pass
+
+    def check(dirname):
+        cache_directory = os.path.join(dirname, '.cache')
+        monkeypatch.setenv('KAPSEL_MODEL_CACHE', cache_directory)
+        for registry in (CustomRegistry(), PluginRegistry(plugin_index=dict())):
+            project = project_no_dedicated_env(dirname, plugin_registry=registry)
+            assert [] == project.problems
+            assert not os.path.exists(cache_directory)
+
+        # a model cached with the default plugins isn't used with others either
+        assert [] == project_no_dedicated_env(dirname).problems
+        assert os.path.exists(cache_directory)
+        _forbid_computing_model(monkeypatch)
+        with pytest.raises(AssertionError):
+            project_no_dedicated_env(dirname, plugin_registry=CustomRegistry()).problems
+
+    with_directory_contents_completing_project_file({DEFAULT_PROJECT_FILENAME: _cached_model_project}, check)
+
+
+def test_project_model_not_cached_when_icon_disappears(monkeypatch):
+    def check(dirname):
+        monkeypatch.setenv('KAPSEL_MODEL_CACHE', os.path.join(dirname, '.cache'))
+        project = project_no_dedicated_env(dirname)
+        assert [] == project.problems
+        assert os.path.join(dirname, 'foo.png') == project.icon
+
+        os.remove(os.path.join(dirname, 'foo.png'))
+        reloaded = project_no_dedicated_env(dirname)
+        assert ["Icon file %s does not exist." % os.path.join(dirname, 'foo.png')] == reloaded.problems
+        assert reloaded.icon is None
+
+    with_directory_contents_completing_project_file(
+        {DEFAULT_PROJECT_FILENAME: _cached_model_project + "icon: foo.png\n",
+         'foo.png': 'not really a png'}, check)
+
+
+def _count_notebook_scans(monkeypatch):
+    from conda_kapsel.archiver import _list_relative_paths_for_unignored_project_files
+    scans = []
+
+    def counting_list(*args, **kwargs):
+        scans.append(1)
+        return _list_relative_paths_for_unignored_project_files(*args, **kwargs)
+
+    monkeypatch.setattr('conda_kapsel.project._list_relative_paths_for_unignored_project_files', counting_list)
+    return scans
+
+
+def test_set_variable_recomputes_only_variables(monkeypatch):
+    def check(dirname):
+        monkeypatch.setenv('KAPSEL_MODEL_CACHE', '')
+        project = project_no_dedicated_env(dirname)
+        assert [] == project.problems
+        scans = _count_notebook_scans(monkeypatch)
+        env_specs = project.env_specs
+
+        for name in ('A', 'B', 'C'):
+            project.project_file.set_value(['variables', name], dict(default=name.lower()))
+            project.project_file.use_changes_without_saving()
+            assert name.lower() == project.find_requirements(env_var=name)[0].options['default']
+
+        assert [] == scans
+        assert env_specs is project.env_specs
+        assert 'echo hello' == project.command_for_name('hello').unix_shell_commandline
+        assert 1 == len(project.find_requirements(klass=DownloadRequirement))
+        assert 1 == len(project.find_requirements(klass=CondaEnvRequirement))
+
+        project.project_file.set_value(['commands', 'bye'], dict(unix='echo bye'))
+        project.project_file.use_changes_without_saving()
+        assert 'echo bye' == project.command_for_name('bye').unix_shell_commandline
+        assert 1 == len(scans)
+
+    with_directory_contents_completing_project_file({DEFAULT_PROJECT_FILENAME: _cached_model_project}, check)
+
+
+def test_modifying_env_specs_recomputes_commands(monkeypatch):
+    def check(dirname):
+        monkeypatch.setenv('KAPSEL_MODEL_CACHE', '')
+        project = project_no_dedicated_env(dirname)
+        assert [] == project.problems
+
+        project.project_file.unset_value(['env_specs', 'other'])
+        project.project_file.use_changes_without_saving()
+        assert ['default'] == list(project.env_specs.keys())
+        assert [("%s: env_spec 'other' for command 'hello' does not appear in the env_specs section" %
+                 project.project_file.filename)] == project.problems
+        assert project.command_for_name('hello') is None
+
+    with_directory_contents_completing_project_file({DEFAULT_PROJECT_FILENAME: _cached_model_project}, check)
+
+
+def test_sections_modified_in_place_are_recomputed(monkeypatch):
+    def check(dirname):
+        monkeypatch.setenv('KAPSEL_MODEL_CACHE', '')
+        project = project_no_dedicated_env(dirname)
+        assert [] == project.problems
+
+        downloads = project.project_file.get_value('downloads')
+        downloads['DATA'] = dict(url='http://example.com/data.csv', filename='renamed.csv')
+        project.project_file.use_changes_without_saving()
+        assert 'renamed.csv' == project.find_requirements(env_var='DATA')[0].filename
+
+        project.project_file.root['variables']['FOO'] = 'changed'
+        project.project_file.use_changes_without_saving()
+        assert 'changed' == project.find_requirements(env_var='FOO')[0].options['default']
+
+        # going back to what's on disk
+        project.project_file.load()
+        assert 'data.csv' == project.find_requirements(env_var='DATA')[0].filename
+        assert '1' == project.find_requirements(env_var='FOO')[0].options['default']
+
+    with_directory_contents_completing_project_file({DEFAULT_PROJECT_FILENAME: _cached_model_project}, check)
@@ -18,6 +18,7 @@ from conda_kapsel import project_ops
 from conda_kapsel.conda_manager import (CondaManager, CondaEnvironmentDeviations, CondaManagerError,
                                         push_conda_manager_class, pop_conda_manager_class)
 from conda_kapsel.project import Project
+from conda_kapsel.internal import trash
 import conda_kapsel.prepare as prepare
 from conda_kapsel.internal.test.tmpfile_utils import (with_directory_contents, with_temporary_script_commandline,
                                                       with_directory_contents_completing_project_file,
@@ -1887,6 +1888,10 @@ def test_clean(monkeypatch):
         assert not os.path.isdir(os.path.join(dirname, "envs"))
         assert not os.path.isdir(os.path.join(dirname, "services"))
 
+        # the deletes finish in the background
+        trash.wait_for_background_deletes()
+        assert not os.path.exists(os.path.join(dirname, ".kapsel-trash"))
+
     with_directory_contents_completing_project_file(
         {DEFAULT_PROJECT_FILENAME: """
 env_specs:
@@ -1925,7 +1930,11 @@ def test_clean_failed_delete(monkeypatch):
         def mock_rmtree(path):
             raise IOError("No rmtree here")
 
+        def mock_rename_to_trash(path):
+            raise OSError("No renaming here")
+
         monkeypatch.setattr('shutil.rmtree', mock_rmtree)
+        monkeypatch.setattr('conda_kapsel.internal.trash._rename_to_trash', mock_rename_to_trash)
 
         status = project_ops.clean(project, result)
         assert not status
@@ -3145,3 +3154,162 @@ def test_upload_cannot_walk_directory(monkeypatch):
     with_directory_contents_completing_project_file(
         {DEFAULT_PROJECT_FILENAME: "name: foo\n",
          "foo.py": "print('hello')\n"}, check)
+
+
+def _monkeypatch_count_prepares(monkeypatch):
+    from conda_kapsel.prepare import prepare_without_interaction as real_prepare
+    prepares = []
+
+    def counting_prepare(*args, **kwargs):
+        prepares.append(kwargs.get('provide_whitelist'))
+        return real_prepare(*args, **kwargs)
+
+    monkeypatch.setattr('conda_kapsel.prepare.prepare_without_interaction', counting_prepare)
+    return prepares
+
+
+def test_transaction_saves_and_prepares_once(monkeypatch):
+    def check(dirname):
+        _monkeypatch_download_file(monkeypatch, dirname)
+        _monkeypatch_can_connect_to_socket_on_standard_redis_port(monkeypatch)
+        prepares = _monkeypatch_count_prepares(monkeypatch)
+
+        project = project_no_dedicated_env(dirname)
+        with project_ops.transaction(project) as transaction:
+            assert project_ops.add_variables(project, ['FOO'], dict(FOO='bar'))
+            assert project_ops.add_download(project, 'MYDATA', 'http://localhost:123456')
+            assert project_ops.add_service(project, service_type='redis')
+            # sees the changes made before it in the transaction
+            assert project_ops.add_command(project, 'hello', 'unix', 'echo $FOO')
+            assert project_ops.set_properties(project, name='batched')
+
+            assert [] == prepares
+            assert ProjectFile.load_for_directory(dirname).get_value('variables') == {}
+
+        assert transaction.status
+        assert "Project changes saved." == transaction.status.status_description
+        assert 1 == len(prepares)
+        assert 'MYDATA' in prepares[0]
+        assert 'REDIS_URL' in prepares[0]
+        assert os.path.isfile(os.path.join(dirname, "MYDATA"))
+
+        reloaded = project_no_dedicated_env(dirname)
+        assert 'batched' == reloaded.name
+        assert 'bar' == reloaded.find_requirements(env_var='FOO')[0].options['default']
+        assert 'redis' == reloaded.project_file.get_value(['services', 'REDIS_URL'])
+        assert 'echo $FOO' == reloaded.command_for_name('hello').unix_shell_commandline
+
+    with_directory_contents_completing_project_file(dict(), check)
+
+
+def test_transaction_failed_operation_discards_everything():
+    def check(dirname):
+        project = project_no_dedicated_env(dirname)
+        with project_ops.transaction(project) as transaction:
+            assert project_ops.add_variables(project, ['FOO'])
+            failed = project_ops.add_command(project, 'hello', 'unix', 'echo hello', env_spec_name='nope')
+            assert not failed
+            # the operations after a failure don't do anything
+            assert failed is project_ops.add_variables(project, ['BAR'])
+            assert failed is project_ops.remove_command(project, 'hello')
+
+        assert failed is transaction.status
+        assert project.find_requirements(env_var='FOO') == []
+        assert ProjectFile.load_for_directory(dirname).get_value('variables') == {}
+
+    with_directory_contents_completing_project_file(dict(), check)
+
+
+def test_transaction_early_failures_leave_file_unchanged():
+    def check(dirname):
+        filename = os.path.join(dirname, DEFAULT_PROJECT_FILENAME)
+        with codecs.open(filename, 'r', 'utf-8') as f:
+            before = f.read()
+
+        project = project_no_dedicated_env(dirname)
+        with project_ops.transaction(project) as transaction:
+            # these fail before getting anywhere near prepare
+            failed = project_ops.add_env_spec(project, 'newenv', ['foo bar baz qux'], [])
+            assert not failed
+            assert failed is project_ops.remove_command(project, 'nonexistent')
+            assert failed is project_ops.add_variables(project, ['FOO'])
+
+        assert failed is transaction.status
+        assert 'newenv' not in project.env_specs
+        with codecs.open(filename, 'r', 'utf-8') as f:
+            assert before == f.read()
+
+        # the same with the failure coming after a change that worked
+        with project_ops.transaction(project) as transaction:
+            assert project_ops.add_variables(project, ['FOO'])
+            assert not project_ops.remove_command(project, 'nonexistent')
+
+        assert not transaction.status
+        assert "Command: 'nonexistent' not found in project file." == transaction.status.status_description
+        with codecs.open(filename, 'r', 'utf-8') as f:
+            assert before == f.read()
+
+    with_directory_contents_completing_project_file(dict(), check)
+
+
+def test_add_env_spec_with_bad_packages_leaves_no_env_spec():
+    def check(dirname):
+        project = project_no_dedicated_env(dirname)
+        status = project_ops.add_env_spec(project, 'newenv', ['foo bar baz qux'], [])
+        assert not status
+        assert ["Bad package specifications: foo bar baz qux."] == status.errors
+        assert project.project_file.get_value(['env_specs', 'newenv']) is None
+
+    with_directory_contents_completing_project_file(dict(), check)
+
+
+def test_transaction_failed_prepare_discards_everything(monkeypatch):
+    def check(dirname):
+        _monkeypatch_download_file_fails(monkeypatch, dirname)
+
+        project = project_no_dedicated_env(dirname)
+        with project_ops.transaction(project) as transaction:
+            assert project_ops.add_variables(project, ['FOO'])
+            assert project_ops.add_download(project, 'MYDATA', 'http://localhost:123456')
+
+        assert not transaction.status
+        assert 'MYDATA' == transaction.status.requirement.env_var
+        assert [] == project.find_requirements(env_var='FOO')
+        assert ProjectFile.load_for_directory(dirname).get_value('downloads') == {}
+
+    with_directory_contents_completing_project_file(dict(), check)
+
+
+def test_transaction_exception_discards_everything():
+    def check(dirname):
+        project = project_no_dedicated_env(dirname)
+        with pytest.raises(RuntimeError):
+            with project_ops.transaction(project) as transaction:
+                assert project_ops.add_variables(project, ['FOO'])
+                raise RuntimeError("oops")
+
+        assert transaction.status is None
+        assert [] == project.find_requirements(env_var='FOO')
+        assert ProjectFile.load_for_directory(dirname).get_value('variables') == {}
+
+        # the project isn't stuck in the transaction
+        assert project_ops.add_variables(project, ['FOO'])
+        assert ['FOO'] == list(ProjectFile.load_for_directory(dirname).get_value('variables').keys())
+
+    with_directory_contents_completing_project_file(dict(), check)
+
+
+def test_nested_transaction_is_part_of_outer():
+    def check(dirname):
+        project = project_no_dedicated_env(dirname)
+        with project_ops.transaction(project) as outer:
+            with project_ops.transaction(project) as inner:
+                assert project_ops.add_variables(project, ['FOO'])
+            assert inner is outer
+            assert inner.status is None
+            assert ProjectFile.load_for_directory(dirname).get_value('variables') == {}
+
+        assert outer.status
+        assert ['FOO'] == list(ProjectFile.load_for_directory(dirname).get_value('variables').keys())
+
+    with_directory_contents_completing_project_file(dict(), check)
@@ -4,7 +4,8 @@
 #
 # The full license is in the file LICENSE.txt, distributed with this software.
 # ----------------------------------------------------------------------------
-from conda_kapsel.yaml_file import YamlFile
+from conda_kapsel.yaml_file import (YamlFile, default_durability, DURABILITY_NONE, DURABILITY_FILE,
+                                    DURABILITY_DIRECTORY)
 from conda_kapsel.internal.test.tmpfile_utils import with_file_contents, with_directory_contents
 
 import errno
@@ -542,3 +543,236 @@ def test_read_yaml_file_and_set_get_empty_string():
         assert value == ' '
 
     with_file_contents("", check)
+
+
+_commented_content = """
+# comment in front of a
+a:
+  x: y
+  # comment in front of z
+  z: q
+
+c:
+  # comment before a list item
+  - foo
+  - bar # comment after a list item
+  - baz
+"""
+
+
+def test_read_only_load_does_not_parse_comments(monkeypatch):
+    def check(filename):
+        round_trip_loads = []
+        from conda_kapsel import yaml_file
+        real_load_string = yaml_file._load_string
+
+        def mock_load_string(contents):
+            round_trip_loads.append(contents)
+            return real_load_string(contents)
+
+        monkeypatch.setattr('conda_kapsel.yaml_file._load_string', mock_load_string)
+
+        yaml = YamlFile(filename)
+        assert "y" == yaml.get_value(["a", "x"])
+        assert ["foo", "bar", "baz"] == yaml.get_value("c")
+        assert ["a", "c"] == list(yaml.root.keys())
+        assert [] == round_trip_loads
+
+        yaml.set_value(["a", "x"], "w")
+        assert 1 == len(round_trip_loads)
+        assert "w" == yaml.get_value(["a", "x"])
+        yaml.set_value(["a", "z"], "r")
+        assert 1 == len(round_trip_loads)
+
+        yaml.save()
+        content = open(filename, 'r').read()
+        assert "# comment in front of a" in content
+        assert "w" == YamlFile(filename).get_value(["a", "x"])
+
+    with_file_contents(_commented_content, check)
+
+
+def test_modify_values_in_place_before_editing():
+    def check(filename):
+        yaml = YamlFile(filename)
+        a = yaml.get_value("a")
+        a['x'] = 'changed'
+        c = yaml.get_value("c")
+        c.remove("foo")
+        c.append("added")
+        yaml.root['new'] = dict(hello='world')
+
+        yaml.use_changes_without_saving()
+        assert 'changed' == yaml.get_value(["a", "x"])
+        assert ['bar', 'baz', 'added'] == yaml.get_value("c")
+        assert 'world' == yaml.get_value(["new", "hello"])
+        yaml.save()
+
+        content = open(filename, 'r').read()
+        assert "# comment in front of a" in content
+        assert "# comment after a list item" in content
+        reloaded = YamlFile(filename)
+        assert 'changed' == reloaded.get_value(["a", "x"])
+        assert ['bar', 'baz', 'added'] == reloaded.get_value("c")
+        assert ['a', 'c', 'new'] == list(reloaded.root.keys())
+
+    with_file_contents(_commented_content, check)
+
+
+def test_modify_values_in_place_after_editing():
+    def check(filename):
+        yaml = YamlFile(filename)
+        # got before the comment-preserving parse, modified after it
+        a = yaml.get_value("a")
+        c = yaml.get_value("c")
+        yaml.set_value("b", 42)
+        a['x'] = 'changed'
+        del a['z']
+        c.reverse()
+        yaml.save()
+
+        reloaded = YamlFile(filename)
+        assert 42 == reloaded.get_value("b")
+        assert dict(x='changed') == reloaded.get_value("a")
+        assert ['baz', 'bar', 'foo'] == reloaded.get_value("c")
+
+        # a later set_value wins over the earlier in-place change
+        a['x'] = 'in place'
+        yaml.use_changes_without_saving()
+        yaml.set_value(["a", "x"], 'set')
+        yaml.save()
+        assert 'set' == YamlFile(filename).get_value(["a", "x"])
+
+    with_file_contents(_commented_content, check)
+
+
+def test_changed_sections_since():
+    def check(filename):
+        yaml = YamlFile(filename)
+        (count, changed) = yaml._changed_sections_since(0)
+        # the first load could have changed anything
+        assert changed is None
+
+        yaml.set_value(["a", "x"], 'changed')
+        yaml.unset_value("c")
+        yaml.unset_value("not_there")
+        (later, changed) = yaml._changed_sections_since(count)
+        assert set(["a", "c"]) == changed
+        assert (later, set()) == yaml._changed_sections_since(later)
+
+        yaml.transform_yaml(lambda tree: True)
+        assert (later, set()) == yaml._changed_sections_since(later)
+        yaml.transform_yaml(lambda tree: None)
+        assert yaml._changed_sections_since(later)[1] is None
+
+        (count, changed) = yaml._changed_sections_since(later)
+        yaml.load()
+        assert yaml._changed_sections_since(count)[1] is None
+
+    with_file_contents(_commented_content, check)
+
+
+def test_default_durability(monkeypatch):
+    monkeypatch.delenv('KAPSEL_YAML_DURABILITY', raising=False)
+    assert DURABILITY_FILE == default_durability()
+    monkeypatch.setenv('KAPSEL_YAML_DURABILITY', ' Directory ')
+    assert DURABILITY_DIRECTORY == default_durability()
+    monkeypatch.setenv('KAPSEL_YAML_DURABILITY', 'none')
+    assert DURABILITY_NONE == default_durability()
+    monkeypatch.setenv('KAPSEL_YAML_DURABILITY', 'sometimes')
+    assert DURABILITY_FILE == default_durability()
+
+
+def test_save_with_each_durability(monkeypatch):
+    def check(dirname):
+        synced = []
+        real_fsync = os.fsync
+
+        def mock_fsync(fd):
+            synced.append(fd)
+            real_fsync(fd)
+
+        monkeypatch.setattr('os.fsync', mock_fsync)
+        filename = os.path.join(dirname, "foo.yml")
+        for (durability, syncs) in [('none', 0), ('file', 1), ('directory', 2)]:
+            monkeypatch.setenv('KAPSEL_YAML_DURABILITY', durability)
+            del synced[:]
+            yaml = YamlFile(filename)
+            yaml.set_value("durability", durability)
+            yaml.save()
+            assert syncs == len(synced)
+            assert durability == YamlFile(filename).get_value("durability")
+            assert [] == [name for name in os.listdir(dirname) if name != "foo.yml"]
+
+    with_directory_contents(dict(), check)
+
+
+def test_save_checks_output_with_full_parse_if_fast_parse_differs(monkeypatch):
+    def check(filename):
+        full_parses = []
+        from conda_kapsel.yaml_file import ryaml
+        real_load = ryaml.load
+
+        def mock_load(contents, Loader):
+            if Loader is ryaml.RoundTripLoader:
+                full_parses.append(contents)
+            return real_load(contents, Loader=Loader)
+
+        monkeypatch.setattr(ryaml, 'load', mock_load)
+
+        yaml = YamlFile(filename)
+        yaml.set_value(["a", "x"], "changed")
+        del full_parses[:]
+        yaml.save()
+        # the first load was the round-trip one set_value needed
+        assert [] == full_parses
+
+        monkeypatch.setattr('conda_kapsel.yaml_file._load_string_read_only', lambda contents: dict())
+        yaml.set_value(["a", "x"], "changed again")
+        yaml.save()
+        assert 1 == len(full_parses)
+        assert "changed again" in open(filename, 'r').read()
+
+    with_file_contents(_commented_content, check)
+
+
+def test_coalesced_saves(monkeypatch):
+    def check(filename):
+        writes = []
+        from conda_kapsel.yaml_file import _atomic_replace as real_atomic_replace
+
+        def mock_atomic_replace(path, contents, **kwargs):
+            writes.append(contents)
+            real_atomic_replace(path, contents, **kwargs)
+
+        monkeypatch.setattr('conda_kapsel.yaml_file._atomic_replace', mock_atomic_replace)
+
+        yaml = YamlFile(filename)
+        with yaml.coalesced_saves():
+            for i in range(3):
+                with yaml.coalesced_saves():
+                    count = yaml.change_count
+                    yaml.set_value("b", i)
+                    yaml.save()
+                    # caches still see the change
+                    assert count + 1 == yaml.change_count
+            assert [] == writes
+            assert YamlFile(filename).get_value("b") is None
+
+        assert 1 == len(writes)
+        assert 2 == YamlFile(filename).get_value("b")
+
+        # nothing saved, nothing written
+        with yaml.coalesced_saves():
+            pass
+        assert 1 == len(writes)
+
+        # load() throws away the save along with the changes
+        with yaml.coalesced_saves():
+            yaml.set_value("b", 42)
+            yaml.save()
+            yaml.load()
+        assert 1 == len(writes)
+        assert 2 == YamlFile(filename).get_value("b")
+
+    with_file_contents(_commented_content, check)
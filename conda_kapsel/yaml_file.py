@@ -24,6 +24,8 @@ except ImportError:  # pragma: no cover
     from ruamel.yaml.comments import CommentedMap  # pragma: no cover
 
 import codecs
+import contextlib
+from copy import deepcopy
 import errno
 import os
 import sys
@@ -36,15 +38,54 @@ from conda_kapsel.internal.py2_compat import is_string
 # We use this in other files (to abstract over the imports above)
 _YAMLError = YAMLError
 
+# the C version is only there if ruamel.yaml was built with libyaml
+_ReadOnlyLoader = getattr(ryaml, 'CSafeLoader', ryaml.SafeLoader)
+# plain dicts only keep the order of keys in the file (which matters,
+# for example the first command is the default) in Python 3.7 and up
+_load_read_only_first = sys.version_info >= (3, 7)
 
-def _atomic_replace(path, contents, encoding='utf-8'):
+
+# how hard saves try to survive a crash: 'none' leaves it to the OS,
+# 'file' syncs the file before renaming it into place, and 'directory'
+# also syncs the directory so the rename itself is on disk
+DURABILITY_VARIABLE = 'KAPSEL_YAML_DURABILITY'
+DURABILITY_NONE = 'none'
+DURABILITY_FILE = 'file'
+DURABILITY_DIRECTORY = 'directory'
+_durability_levels = (DURABILITY_NONE, DURABILITY_FILE, DURABILITY_DIRECTORY)
+
+
+def default_durability():
+    """Get the durability level from ``KAPSEL_YAML_DURABILITY``, ``DURABILITY_FILE`` if it isn't set."""
+    durability = os.environ.get(DURABILITY_VARIABLE, '').strip().lower()
+    if durability in _durability_levels:
+        return durability
+    return DURABILITY_FILE
+
+
+def _sync_directory(dirname):
+    if os.name == 'nt':  # pragma: no cover (windows only)
+        # directories can't be opened there, and renames are already durable
+        return
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _atomic_replace(path, contents, encoding='utf-8', durability=DURABILITY_NONE):
     tmp = path + ".tmp-" + str(uuid.uuid4())
     try:
         with codecs.open(tmp, 'w', encoding) as file:
             file.write(contents)
             file.flush()
+            if durability != DURABILITY_NONE:
+                os.fsync(file.fileno())
             file.close()
         rename_over_existing(tmp, path)
+        if durability == DURABILITY_DIRECTORY:
+            _sync_directory(os.path.dirname(os.path.abspath(path)))
     finally:
         try:
             os.remove(tmp)
@@ -59,8 +100,54 @@ def _load_string(contents):
     return ryaml.load(contents, Loader=ryaml.RoundTripLoader)
 
 
-def _save_file(yaml, filename):
-    contents = ryaml.dump(yaml, Dumper=ryaml.RoundTripDumper)
+def _load_string_read_only(contents):
+    # plain dicts and lists, without the comments and formatting
+    # we'd need to save the file, but many times faster to load
+    return ryaml.load(contents, Loader=_ReadOnlyLoader)
+
+
+def _merge_changes(target, original, current):
+    # make the changes that turn original into current in target,
+    # without disturbing the parts of target (such as comments) they
+    # don't touch. Returns False if target has to be replaced instead.
+    if isinstance(target, dict) and isinstance(original, dict) and isinstance(current, dict):
+        for key in list(target.keys()):
+            if key in original and key not in current:
+                del target[key]
+        for (key, value) in current.items():
+            if key in original and original[key] == value:
+                continue
+            if key in target and key in original and _merge_changes(target[key], original[key], value):
+                continue
+            target[key] = deepcopy(value)
+        return True
+    elif isinstance(target, list) and isinstance(original, list) and isinstance(current, list):
+        # removing and appending items is the usual edit; anything
+        # else loses the comments on the list items
+        if target != original:
+            return False
+        kept = [item for item in original if item in current]
+        if kept != current[:len(kept)]:
+            return False
+        for i in reversed(range(len(target))):
+            if target[i] not in current:
+                del target[i]
+        for item in current[len(kept):]:
+            target.append(deepcopy(item))
+        return True
+    else:
+        return False
+
+
+def _verify_dump(yaml, contents):
+    # we compare a fast parse of what we're saving to what we dumped,
+    # and only if they differ make the slow parse that tells us if
+    # the file will load at all
+    try:
+        if _load_string_read_only(contents) == yaml:
+            return
+    except YAMLError:
+        pass
 
     try:
         # This is to ensure we don't corrupt the file, even if ruamel.yaml is broken
@@ -72,11 +159,19 @@ def _save_file(yaml, filename):
         print(contents, file=sys.stderr)
         raise RuntimeError("Bug in ruamel.yaml library; failed to parse a file that it generated: " + str(e))
 
+
+def _save_file(yaml, filename, durability=None):
+    contents = ryaml.dump(yaml, Dumper=ryaml.RoundTripDumper)
+    _verify_dump(yaml, contents)
+
     if not os.path.isfile(filename):
         # might have to make the directory
         dirname = os.path.dirname(filename)
         makedirs_ok_if_exists(dirname)
-    _atomic_replace(filename, contents)
+    if durability is None:
+        durability = default_durability()
+    _atomic_replace(filename, contents, durability=durability)
+    return contents
 
 
 class YamlFile(object):
@@ -104,6 +199,15 @@ class YamlFile(object):
         self.filename = filename
         self._dirty = False
         self._change_count = 0
+        # counts set_value() and friends, to tell caches which top-level
+        # sections were modified
+        self._edit_count = 0
+        self._section_edit_counts = dict()
+        self._everything_edit_count = 0
+        # nesting depth of coalesced_saves() blocks, and whether a save
+        # was put off until they end
+        self._coalescing = 0
+        self._save_pending = False
         self.load()
 
     def load(self):
@@ -114,32 +218,100 @@ class YamlFile(object):
         and attempts to modify the file will raise an
         exception.
 
+        Most loads never modify the file, so the file is parsed
+        into plain dicts and lists with a fast loader; the
+        comment-preserving parse happens the first time it's
+        modified.
+
         Returns:
             None
         """
         self._corrupted = False
         self._corrupted_error_message = None
         self._change_count = self._change_count + 1
+        self._note_edit(None)
+        self._save_pending = False
+        # the file's text, until we've made the comment-preserving parse of it
+        self._contents = None
+        # the plain tree from before the comment-preserving parse (callers
+        # may still hold parts of it), and how it looked when we last
+        # copied changes from it
+        self._plain = None
+        self._plain_synced = None
+        # what's in the file, while our tree is known to match it
+        self._synced_contents = None
 
         try:
             with codecs.open(self.filename, 'r', 'utf-8') as file:
                 contents = file.read()
-            self._yaml = _load_string(contents)
+            if _load_read_only_first:
+                try:
+                    self._yaml = _load_string_read_only(contents)
+                    self._contents = contents
+                except YAMLError:
+                    # get the error message from the parser we'd save with
+                    self._yaml = _load_string(contents)
+            else:
+                self._yaml = _load_string(contents)  # pragma: no cover (py2 only)
             self._dirty = False
+            self._synced_contents = contents
         except IOError as e:
             if e.errno == errno.ENOENT:
                 self._yaml = None
+                self._synced_contents = ""
             else:
                 raise e
         except YAMLError as e:
             self._corrupted = True
             self._corrupted_error_message = str(e)
             self._yaml = None
+            self._synced_contents = None
 
         if self._yaml is None:
+            self._contents = None
             self._yaml = self._default_content()
             self._dirty = True
 
+    def _editable_yaml(self):
+        # anything that modifies the tree calls this first
+        self._synced_contents = None
+        if self._contents is not None:
+            self._plain = self._yaml
+            self._plain_synced = _load_string_read_only(self._contents)
+            self._yaml = _load_string(self._contents)
+            self._contents = None
+        # people modify what they get from get_value() and root in
+        # place, so copy any changes they made to the plain tree
+        if self._plain is not None and self._plain != self._plain_synced:
+            if not _merge_changes(self._yaml, self._plain_synced, self._plain):
+                self._yaml = deepcopy(self._plain)  # pragma: no cover (the root is always a dict)
+            self._plain_synced = deepcopy(self._plain)
+        return self._yaml
+
+    def _note_edit(self, section):
+        # section is the top-level key that was modified, or None if it
+        # could have been anything
+        self._edit_count = self._edit_count + 1
+        if section is None:
+            self._everything_edit_count = self._edit_count
+        else:
+            self._section_edit_counts[section] = self._edit_count
+
+    def _changed_sections_since(self, edit_count):
+        # returns (edit count now, top-level keys modified since edit_count);
+        # the keys are None if we can't tell which were. Keys aren't
+        # reported when only what get_value() returned was modified in place.
+        if self._everything_edit_count > edit_count:
+            return (self._edit_count, None)
+        return (self._edit_count, set([section for (section, count) in self._section_edit_counts.items()
+                                       if count > edit_count]))
+
+    def _unmodified_contents(self):
+        # the file's text ("" if it doesn't exist) if we haven't modified it
+        # since we last loaded or saved it, otherwise None; used to key
+        # caches of things computed from the file
+        return self._synced_contents
+
     def _default_comment(self):
         return "yaml file"
 
@@ -194,12 +366,17 @@ class YamlFile(object):
         This is used to "try out" a change before we save it. We can load()
         to undo our changes.
         """
+        self._editable_yaml()
         self._change_count = self._change_count + 1
         self._dirty = True
 
     def save(self):
         """Write the file to disk, only if any changes have been made.
 
+        The file is replaced atomically, and synced to disk as
+        ``default_durability()`` says. Inside ``coalesced_saves()``,
+        writing waits until the block ends.
+
         Raises ``IOError`` if it fails for some reason.
 
         Returns:
@@ -210,11 +387,39 @@ class YamlFile(object):
         if not self._dirty:
             return
 
-        _save_file(self._yaml, self.filename)
+        if self._coalescing > 0:
+            # we count this as a change right away, so anything cached
+            # from the file is computed again as if we'd saved
+            self.use_changes_without_saving()
+            self._save_pending = True
+            return
+
+        contents = _save_file(self._editable_yaml(), self.filename)
+        self._synced_contents = contents
 
         self._change_count = self._change_count + 1
         self._dirty = False
 
+    @contextlib.contextmanager
+    def coalesced_saves(self):
+        """Write the file once when the block ends, instead of on each ``save()`` in it.
+
+        Inside the block, ``save()`` counts as a change as usual but
+        puts off writing the file. Blocks can be nested; the file is
+        written when the outermost one ends, if anything was saved.
+
+        Returns:
+            a context manager
+        """
+        self._coalescing = self._coalescing + 1
+        try:
+            yield
+        finally:
+            self._coalescing = self._coalescing - 1
+            if self._coalescing == 0 and self._save_pending:
+                self._save_pending = False
+                self.save()
+
     def transform_yaml(self, transformer):
         """Modify the YAML parse tree.
 
@@ -235,9 +440,10 @@ class YamlFile(object):
         """
         self._throw_if_corrupted()
 
-        result = transformer(self._yaml)
+        result = transformer(self._editable_yaml())
         if result is not True:
             self._dirty = True
+            self._note_edit(None)
 
     @classmethod
     def _path(cls, path):
@@ -261,7 +467,7 @@ class YamlFile(object):
     def _ensure_dicts_at_path(self, pieces):
         self._throw_if_corrupted()
 
-        current = self._yaml
+        current = self._editable_yaml()
         for p in pieces:
             if p not in current or not isinstance(current[p], dict):
                 # It's important to use CommentedMap because it preserves
@@ -289,6 +495,7 @@ class YamlFile(object):
         existing = self._ensure_dicts_at_path(path[:-1])
         existing[path[-1]] = value
         self._dirty = True
+        self._note_edit(path[0])
 
     def unset_value(self, path):
         """Remove a single value at the given path.
@@ -302,11 +509,13 @@ class YamlFile(object):
 
         path = self._path(path)
 
+        self._editable_yaml()
         existing = self._get_dict_or_none(path[:-1])
         key = path[-1]
         if existing is not None and key in existing:
             del existing[key]
             self._dirty = True
+            self._note_edit(path[0])
 
     def get_value(self, path, default=None):
         """Get a single value from the YAML file.
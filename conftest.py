@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------------
+# Copyright © 2016, Continuum Analytics, Inc. All rights reserved.
+#
+# The full license is in the file LICENSE.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import absolute_import
+
+import os
+
+import pytest
+
+from conda_kapsel.internal.model_cache import MODEL_CACHE_VARIABLE
+
+
+@pytest.fixture(scope='session', autouse=True)
+def no_model_cache_in_home_directory():
+    # the tests load thousands of throwaway projects; don't cache their
+    # models in the user's real cache directory. Tests of the cache
+    # itself point it somewhere temporary with monkeypatch.
+    old = os.environ.get(MODEL_CACHE_VARIABLE, None)
+    os.environ[MODEL_CACHE_VARIABLE] = ''
+    yield
+    if old is None:
+        del os.environ[MODEL_CACHE_VARIABLE]
+    else:
+        os.environ[MODEL_CACHE_VARIABLE] = old